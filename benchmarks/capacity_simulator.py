@@ -0,0 +1,811 @@
+"""
+Discrete-event capacity model of the review pipeline, for planning review campaigns.
+
+Models the review queue, the start_wafr_review event source with its admission scheduler, the Deep review state
+machine (prepare_wafr_review, extract_document_text, generate_solution_summary, generate_prompts_for_six_pillars,
+the Map state over generate_pillar_question_response and update_review_status) and the inline Quick review as
+queues and servers. Nothing is invoked; a night of reviews is simulated in seconds, so settings can be swept.
+
+What is modelled follows the stack: reserved concurrency of every review function (MAX_CONCURRENT_REVIEWS), function
+timeouts, the Map max_concurrency and its Wait state, the SQS visibility timeout, delivery delay and redrive to the
+dead-letter queue, the admission budget and deferral backoff of admission_scheduler, and the Bedrock requests and
+tokens per minute quotas with the BEDROCK_SLEEP_DURATION/BEDROCK_MAX_TRIES retries of the handlers. The state machine
+tasks retry Lambda throttling (Lambda.TooManyRequestsException) like the stack, 6 times from 30 seconds with backoff 2
+and full jitter, so a throttled task only fails its review once those retries run out. A throttled start_wafr_review
+invocation returns its batch to the queue.
+
+Stage service times are lognormal, given by their median and p95 in seconds. Defaults are below; override them with
+a JSON file (--service-times) or read them from the WAFRAccelerator CloudWatch metrics (--from-cloudwatch), ideally
+over a period without Bedrock throttling, as Bedrock latencies include retry sleeps. Bedrock entries also give the
+input and output tokens of each call.
+
+Reports completion time, review latency, admission wait, queue depth, Bedrock and Lambda throttling and how close
+each function came to its timeout. Comma separated values of the concurrency and quota options run every
+combination (--replications seeds each) and show which finish within --deadline-hours.
+
+Usage:
+    python benchmarks/capacity_simulator.py --reviews 50 --arrival-rate 10
+    python benchmarks/capacity_simulator.py --from-cloudwatch --days 7 --save-service-times service-times.json
+    python benchmarks/capacity_simulator.py --reviews 500 --service-times service-times.json --deadline-hours 10 \\
+        --max-concurrent-reviews 5,10,20,40 --map-concurrency 1,2,3 --bedrock-rpm 200,400 --replications 3
+"""
+import sys
+import json
+import heapq
+import argparse
+import datetime
+import functools
+import itertools
+import collections
+
+from pipeline_benchmark import PILLAR_IDS, load_prompts, percentile
+from service_fakes import LatencyModel
+
+# Seconds; the Bedrock entries are the model calls alone, the others exclude them
+DEFAULT_SERVICE_TIMES = {
+    # start_wafr_review invocation: admission budget (Step Functions, DynamoDB, CloudWatch) and start_execution
+    'admission': {'median': 0.8, 'p95': 2.0},
+    'prepare_review': {'median': 3.0, 'p95': 8.0},
+    'extract_document_text': {'median': 40.0, 'p95': 150.0},
+    'generate_solution_summary': {'median': 1.0, 'p95': 3.0},
+    'generate_prompts': {'median': 8.0, 'p95': 20.0},
+    # Per Deep question: knowledge base retrieval, Well-Architected Tool update, DynamoDB and S3 writes
+    'question': {'median': 1.5, 'p95': 4.0},
+    'update_review_status': {'median': 3.0, 'p95': 8.0},
+    # Quick review text extraction, and the per pillar work besides the model call
+    'quick_review': {'median': 40.0, 'p95': 150.0},
+    'quick_pillar': {'median': 1.5, 'p95': 4.0},
+    'bedrock_summary': {'median': 20.0, 'p95': 45.0, 'input_tokens': 10000, 'output_tokens': 1000},
+    'bedrock_question': {'median': 25.0, 'p95': 60.0, 'input_tokens': 6000, 'output_tokens': 1500},
+    'bedrock_quick_pillar': {'median': 60.0, 'p95': 150.0, 'input_tokens': 20000, 'output_tokens': 4000}
+}
+
+# Function timeouts in seconds, as in wafr_genai_accelerator_stack.py
+FUNCTION_TIMEOUTS = {
+    'start_wafr_review': 900,
+    'prepare_wafr_review': 300,
+    'extract_document_text': 900,
+    'generate_solution_summary': 900,
+    'generate_prompts_for_six_pillars': 900,
+    'generate_pillar_question_response': 900,
+    'update_review_status': 900
+}
+
+# (stage, function) of the Deep review state machine before the Map state
+DEEP_STAGES = [
+    ('prepare_review', 'prepare_wafr_review'),
+    ('extract_document_text', 'extract_document_text'),
+    ('generate_solution_summary', 'generate_solution_summary'),
+    ('generate_prompts', 'generate_prompts_for_six_pillars')
+]
+
+# Review queue and event source settings of the stack
+VISIBILITY_TIMEOUT_SECONDS = 1200
+DELIVERY_DELAY_SECONDS = 5
+MAX_RECEIVE_COUNT = 100
+BATCHING_WINDOW_SECONDS = 5
+
+# Defaults of admission_scheduler and start_wafr_review
+INTERACTIVE_RESERVE_FRACTION = 0.2
+REVIEW_TYPE_USAGE = {'Quick': (40000, 6), 'Deep': (20000, 2)}
+QUICK_REVIEW_LEASE_SECONDS = 960
+ADMISSION_DEFER_SECONDS = 60
+ADMISSION_MAX_DEFER_SECONDS = 900
+QUICK_REVIEW_REQUEUE_SECONDS = 10
+
+# Handler retries of throttled model calls, and how long Bedrock takes to throttle one
+BEDROCK_SLEEP_DURATION = 60
+BEDROCK_MAX_TRIES = 5
+BEDROCK_THROTTLE_SECONDS = 0.2
+
+# Retry of Lambda.TooManyRequestsException on every state machine task (stack)
+LAMBDA_THROTTLE_RETRY_SECONDS = 30
+LAMBDA_THROTTLE_BACKOFF_RATE = 2
+LAMBDA_THROTTLE_RETRIES = 6
+
+class StageFailed(Exception):
+    pass
+
+class Simulation:
+    """
+    Event loop. Processes are generators that yield a number of seconds to wait, or a MapState to wait for; a
+    StageFailed raised in a process is passed to whoever waits for it.
+    """
+
+    def __init__(self):
+        self.now = 0.0
+        self.events = []
+        self.sequence = itertools.count()
+
+    def schedule(self, delay, callback, *args):
+        heapq.heappush(self.events, (self.now + max(0.0, delay), next(self.sequence), callback, args))
+
+    def start(self, process, on_exit=None):
+        self.resume(process, on_exit, None, None)
+
+    def resume(self, process, on_exit, value, failure):
+
+        try:
+            request = process.throw(failure) if failure else process.send(value)
+        except StopIteration as stop:
+            if on_exit:
+                on_exit(stop.value, None)
+            return
+        except StageFailed as error:
+            if on_exit:
+                on_exit(None, error)
+            return
+
+        if isinstance(request, MapState):
+            request.begin(self, functools.partial(self.resume, process, on_exit))
+        else:
+            self.schedule(request, self.resume, process, on_exit, None, None)
+
+    def run(self, until, done):
+        while self.events and not done():
+            time, sequence, callback, args = heapq.heappop(self.events)
+            if time > until:
+                break
+            self.now = time
+            callback(*args)
+
+class MapState:
+    """Runs branches with at most max_concurrency at a time (0 for all); the first failure fails the Map."""
+
+    def __init__(self, branches, max_concurrency):
+        self.branches = list(branches)
+        self.max_concurrency = max_concurrency or len(self.branches)
+
+    def begin(self, simulation, on_exit):
+
+        pending = collections.deque(enumerate(self.branches))
+        results = [None] * len(self.branches)
+        state = {'running': 0, 'done': 0, 'failed': False}
+
+        def start_next():
+            while pending and state['running'] < self.max_concurrency:
+                index, branch = pending.popleft()
+                state['running'] += 1
+                simulation.start(branch, functools.partial(finished, index))
+
+        def finished(index, result, failure):
+            state['running'] -= 1
+            # Iterations already running when the Map failed still hold their Lambda concurrency until they end
+            if state['failed']:
+                return
+            if failure:
+                state['failed'] = True
+                on_exit(None, failure)
+                return
+            results[index] = result
+            state['done'] += 1
+            if state['done'] == len(self.branches):
+                on_exit(results, None)
+            else:
+                start_next()
+
+        if not self.branches:
+            on_exit([], None)
+        else:
+            start_next()
+
+class CapacityModel:
+
+    def __init__(self, settings, service_times, questions, seed):
+        self.settings = settings
+        self.service_times = service_times
+        self.questions = questions
+        self.simulation = Simulation()
+        self.latency = LatencyModel(None, service_times, seed)
+        self.random = self.latency.random
+
+        self.reviews = []
+        self.messages = []
+        # (visible_at, sequence, message) of the messages not in flight
+        self.queue = []
+        self.queue_sequence = itertools.count()
+        self.finished = 0
+        self.dead_lettered = 0
+        self.duplicate_deliveries = 0
+        self.deferrals = collections.Counter()
+        self.running_executions = 0
+        self.leases = {}
+
+        self.bedrock_requests = collections.deque()
+        self.bedrock_usage = collections.defaultdict(lambda: [0, 0])
+        self.bedrock_peak = {'rpm': 0, 'tpm': 0}
+
+        self.busy = collections.Counter()
+        self.functions = collections.defaultdict(lambda: {'invocations': 0, 'throttles': 0, 'timeouts': 0, 'peak_concurrency': 0, 'durations': []})
+        self.queue_depth = []
+        self.errors = collections.Counter()
+
+    def sample(self, name):
+        return self.latency.sample(name)
+
+    def submit_reviews(self):
+
+        submitted_at = 0.0
+        for index in range(self.settings['reviews']):
+            if self.settings['arrival_rate'] > 0 and index > 0:
+                submitted_at = submitted_at + self.random.expovariate(self.settings['arrival_rate'] / 3600)
+            review = {
+                'analysis_id': f"review-{index:05d}",
+                'review_type': 'Quick' if self.random.random() < self.settings['quick_share'] else 'Deep',
+                'submitted_at': submitted_at,
+                'admitted_at': None,
+                'finished_at': None,
+                'status': 'Queued',
+                'completed_pillars': set()
+            }
+            self.reviews.append(review)
+            message = {'review': review, 'visible_at': submitted_at + DELIVERY_DELAY_SECONDS, 'receive_count': 0, 'in_flight': False, 'deleted': False}
+            self.messages.append(message)
+            self.enqueue(message)
+
+    def finish(self, review, status, error=None):
+        review['status'] = status
+        review['finished_at'] = self.simulation.now
+        self.finished += 1
+        if error:
+            self.errors[error] += 1
+
+    # Review queue and event source
+
+    def enqueue(self, message):
+        heapq.heappush(self.queue, (message['visible_at'], next(self.queue_sequence), message))
+
+    def receive(self, count):
+
+        now = self.simulation.now
+        batch = []
+        while self.queue and self.queue[0][0] <= now and len(batch) < count:
+            visible_at, sequence, message = heapq.heappop(self.queue)
+            if message['receive_count'] >= MAX_RECEIVE_COUNT:
+                message['deleted'] = True
+                self.dead_lettered += 1
+                self.finish(message['review'], 'DeadLettered', 'moved to the dead-letter queue')
+                continue
+            message['receive_count'] += 1
+            message['in_flight'] = True
+            message['visible_at'] = now + VISIBILITY_TIMEOUT_SECONDS
+            batch.append(message)
+
+        return batch
+
+    def idle_seconds(self):
+        # Long polling returns as soon as a message becomes visible
+        next_visible = self.queue[0][0] if self.queue else self.simulation.now + self.settings['poll_seconds']
+        return max(0.001, min(self.settings['poll_seconds'], next_visible - self.simulation.now))
+
+    def consumer(self):
+
+        batch_size = self.settings['batch_size']
+        while True:
+            batch = self.receive(batch_size)
+            if not batch:
+                yield self.idle_seconds()
+                continue
+            if len(batch) < batch_size:
+                yield BATCHING_WINDOW_SECONDS
+                batch = batch + self.receive(batch_size - len(batch))
+
+            processed = []
+            try:
+                # Invoked by the event source, not Step Functions, so there is no task retry
+                yield from self.invoke('start_wafr_review', self.admit(batch, processed), retries=0)
+                # Partial batch response: everything not deferred or failed is deleted
+                for message in processed:
+                    message['deleted'] = True
+            except StageFailed:
+                # The whole batch becomes visible again after the visibility timeout
+                pass
+            finally:
+                for message in batch:
+                    message['in_flight'] = False
+                    if not message['deleted']:
+                        self.enqueue(message)
+
+    def sample_queue_depth(self):
+
+        while True:
+            now = self.simulation.now
+            waiting = [message for message in self.messages if not message['deleted'] and message['review']['submitted_at'] <= now]
+            visible = sum(1 for message in waiting if not message['in_flight'] and message['visible_at'] <= now)
+            self.queue_depth.append((now, visible, len(waiting) - visible))
+            yield 60
+
+    # Admission, as in start_wafr_review and admission_scheduler
+
+    def admission_budget(self):
+
+        now = self.simulation.now
+        in_flight_quick = sum(1 for expires_at in self.leases.values() if expires_at > now)
+        in_flight_deep = self.running_executions
+
+        estimated_tpm = in_flight_quick * REVIEW_TYPE_USAGE['Quick'][0] + in_flight_deep * REVIEW_TYPE_USAGE['Deep'][0]
+        estimated_rpm = in_flight_quick * REVIEW_TYPE_USAGE['Quick'][1] + in_flight_deep * REVIEW_TYPE_USAGE['Deep'][1]
+
+        minute = int(now // 60)
+        observed = [self.bedrock_usage[past_minute] for past_minute in range(minute - 4, minute + 1) if past_minute in self.bedrock_usage]
+        observed_tpm = max((tokens for tokens, requests in observed), default=0)
+        observed_rpm = max((requests for tokens, requests in observed), default=0)
+
+        return {
+            'in_flight': in_flight_quick + in_flight_deep,
+            'tpm': self.settings['bedrock_tpm'] * (1 - INTERACTIVE_RESERVE_FRACTION) - max(estimated_tpm, observed_tpm),
+            'rpm': self.settings['bedrock_rpm'] * (1 - INTERACTIVE_RESERVE_FRACTION) - max(estimated_rpm, observed_rpm)
+        }
+
+    def try_admit(self, budget, review_type):
+
+        review_tpm, review_rpm = REVIEW_TYPE_USAGE[review_type]
+        if min(budget['tpm'] // review_tpm, budget['rpm'] // review_rpm, self.settings['max_concurrent_reviews'] - budget['in_flight']) < 1:
+            return False
+
+        budget['tpm'] = budget['tpm'] - review_tpm
+        budget['rpm'] = budget['rpm'] - review_rpm
+        budget['in_flight'] = budget['in_flight'] + 1
+
+        return True
+
+    def defer(self, message, seconds):
+        message['visible_at'] = self.simulation.now + seconds
+        self.deferrals[message['review']['review_type']] += 1
+
+    def admit(self, batch, processed):
+
+        yield self.sample('admission')
+
+        budget = self.admission_budget()
+        quick_message = None
+
+        for message in batch:
+            review = message['review']
+
+            if review['admitted_at'] is not None and review['review_type'] == 'Deep':
+                # Redelivered after a failed invocation that had already started its execution
+                self.duplicate_deliveries += 1
+                processed.append(message)
+                continue
+
+            if review['review_type'] == 'Quick' and quick_message is not None:
+                self.defer(message, QUICK_REVIEW_REQUEUE_SECONDS)
+                continue
+
+            if not self.try_admit(budget, review['review_type']):
+                self.defer(message, min(ADMISSION_MAX_DEFER_SECONDS, ADMISSION_DEFER_SECONDS * message['receive_count']))
+                continue
+
+            if review['admitted_at'] is None:
+                review['admitted_at'] = self.simulation.now
+
+            if review['review_type'] == 'Quick':
+                quick_message = message
+                continue
+
+            processed.append(message)
+            self.running_executions += 1
+            self.simulation.start(self.execution(review))
+
+        if quick_message is not None:
+            review = quick_message['review']
+            # A timed out invocation never releases its lease, it expires
+            self.leases[review['analysis_id']] = self.simulation.now + QUICK_REVIEW_LEASE_SECONDS
+            try:
+                yield from self.quick_review(review)
+                self.finish(review, 'Completed')
+                processed.append(quick_message)
+            except StageFailed as error:
+                # Errored, and retried once the message is visible again
+                self.errors[str(error)] += 1
+                review['status'] = 'Errored'
+            self.leases.pop(review['analysis_id'], None)
+
+    # Lambda functions and Bedrock
+
+    def invoke(self, function, body, retries=None):
+
+        stats = self.functions[function]
+        if retries is None:
+            retries = self.settings['lambda_throttle_retries']
+
+        for attempt in range(retries + 1):
+            if self.busy[function] < self.settings['max_concurrent_reviews']:
+                break
+            stats['throttles'] += 1
+            if attempt == retries:
+                raise StageFailed(f"Lambda.TooManyRequestsException from {function}")
+            # Full jitter: anywhere up to the backed off interval
+            yield self.random.uniform(0, LAMBDA_THROTTLE_RETRY_SECONDS * LAMBDA_THROTTLE_BACKOFF_RATE ** attempt)
+
+        self.busy[function] += 1
+        stats['invocations'] += 1
+        stats['peak_concurrency'] = max(stats['peak_concurrency'], self.busy[function])
+        start = self.simulation.now
+
+        try:
+            return (yield from self.with_timeout(body, self.settings['timeouts'][function], function))
+        finally:
+            self.busy[function] -= 1
+            stats['durations'].append(self.simulation.now - start)
+
+    def with_timeout(self, body, seconds, function):
+
+        deadline = self.simulation.now + seconds
+        value = None
+        while True:
+            try:
+                delay = body.send(value)
+            except StopIteration as stop:
+                return stop.value
+            if self.simulation.now + delay > deadline:
+                yield deadline - self.simulation.now
+                body.close()
+                self.functions[function]['timeouts'] += 1
+                raise StageFailed(f"{function} timed out after {seconds} seconds")
+            value = yield delay
+
+    def admit_bedrock_request(self, tokens):
+
+        now = self.simulation.now
+        while self.bedrock_requests and self.bedrock_requests[0][0] <= now - 60:
+            self.bedrock_requests.popleft()
+
+        requests_in_window = len(self.bedrock_requests)
+        tokens_in_window = sum(request_tokens for request_time, request_tokens in self.bedrock_requests)
+        if requests_in_window + 1 > self.settings['bedrock_rpm'] or tokens_in_window + tokens > self.settings['bedrock_tpm']:
+            return False
+
+        self.bedrock_requests.append((now, tokens))
+        self.bedrock_peak['rpm'] = max(self.bedrock_peak['rpm'], requests_in_window + 1)
+        self.bedrock_peak['tpm'] = max(self.bedrock_peak['tpm'], tokens_in_window + tokens)
+        usage = self.bedrock_usage[int(now // 60)]
+        usage[0] += tokens
+        usage[1] += 1
+
+        return True
+
+    def bedrock_call(self, name):
+
+        profile = self.service_times[name]
+        tokens = profile.get('input_tokens', 0) + profile.get('output_tokens', 0)
+
+        for attempt in range(BEDROCK_MAX_TRIES):
+            if self.admit_bedrock_request(tokens):
+                seconds = self.sample(name)
+                self.latency.record(name, seconds)
+                yield seconds
+                return
+            self.latency.record(name, BEDROCK_THROTTLE_SECONDS, throttled=True)
+            yield BEDROCK_THROTTLE_SECONDS + BEDROCK_SLEEP_DURATION
+
+        raise StageFailed(f"Maximum retries ({BEDROCK_MAX_TRIES}) exceeded. Unable to invoke the model.")
+
+    # Reviews
+
+    def stage(self, name):
+        yield self.sample(name)
+        if name == 'generate_solution_summary':
+            yield from self.bedrock_call('bedrock_summary')
+
+    def answer_pillar(self, pillar):
+        for _ in range(self.questions[pillar]):
+            yield self.sample('question')
+            yield from self.bedrock_call('bedrock_question')
+
+    def pillar_branch(self, pillar):
+        yield self.settings['map_wait_seconds']
+        yield from self.invoke('generate_pillar_question_response', self.answer_pillar(pillar))
+
+    def execution(self, review):
+
+        try:
+            for stage, function in DEEP_STAGES:
+                yield from self.invoke(function, self.stage(stage))
+            yield MapState([self.pillar_branch(pillar) for pillar in self.questions], self.settings['map_concurrency'])
+            yield from self.invoke('update_review_status', self.stage('update_review_status'))
+            self.finish(review, 'Completed')
+        except StageFailed as error:
+            self.finish(review, 'Errored', str(error))
+        finally:
+            self.running_executions -= 1
+
+    def quick_review(self, review):
+
+        yield self.sample('quick_review')
+        for pillar in self.questions:
+            # Reruns skip the pillars already in completed_stages
+            if pillar in review['completed_pillars']:
+                continue
+            yield self.sample('quick_pillar')
+            yield from self.bedrock_call('bedrock_quick_pillar')
+            review['completed_pillars'].add(pillar)
+
+    def run(self):
+
+        self.submit_reviews()
+        for _ in range(min(self.settings['consumers'], self.settings['max_concurrent_reviews'])):
+            self.simulation.start(self.consumer())
+        self.simulation.start(self.sample_queue_depth())
+
+        self.simulation.run(self.settings['max_hours'] * 3600, lambda: self.finished == len(self.reviews))
+
+        return self.report()
+
+    def report(self):
+
+        completed = [review for review in self.reviews if review['status'] == 'Completed']
+        errored = [review for review in self.reviews if review['status'] == 'Errored' and review['finished_at'] is not None]
+        finished = [review for review in self.reviews if review['finished_at'] is not None]
+        completion_seconds = max((review['finished_at'] for review in finished), default=0.0) if len(finished) == len(self.reviews) else None
+
+        latencies = [review['finished_at'] - review['submitted_at'] for review in completed]
+        admission_waits = [review['admitted_at'] - review['submitted_at'] for review in self.reviews if review['admitted_at'] is not None]
+
+        bedrock_requests = sum(stats['calls'] for name, stats in self.latency.stats.items())
+        bedrock_throttled = sum(stats['throttled'] for name, stats in self.latency.stats.items())
+
+        hourly_depth = {}
+        for time, visible, not_visible in self.queue_depth:
+            hour = int(time // 3600)
+            hourly_depth[hour] = max(hourly_depth.get(hour, (0, 0)), (visible + not_visible, visible))
+
+        return {
+            'settings': {name: value for name, value in self.settings.items() if name != 'timeouts'},
+            'reviews': len(self.reviews),
+            'completed': len(completed),
+            'errored': len(errored),
+            'dead_lettered': self.dead_lettered,
+            'unfinished': len(self.reviews) - len(finished),
+            'completion_hours': completion_seconds / 3600 if completion_seconds is not None else None,
+            'met_deadline': completion_seconds is not None and len(completed) == len(self.reviews) and completion_seconds <= self.settings['deadline_hours'] * 3600,
+            'reviews_per_hour': len(completed) / max(self.simulation.now / 3600, 1e-9),
+            'review_latency_seconds': {'p50': percentile(latencies, 0.5), 'p95': percentile(latencies, 0.95)},
+            'admission_wait_seconds': {'p50': percentile(admission_waits, 0.5), 'p95': percentile(admission_waits, 0.95)},
+            'queue_depth': {
+                'max_messages': max((visible + not_visible for time, visible, not_visible in self.queue_depth), default=0),
+                'max_visible': max((visible for time, visible, not_visible in self.queue_depth), default=0),
+                'hourly_max': [{'hour': hour, 'messages': depth, 'visible': visible} for hour, (depth, visible) in sorted(hourly_depth.items())]
+            },
+            'deferrals': dict(self.deferrals),
+            'duplicate_deliveries': self.duplicate_deliveries,
+            'bedrock': {
+                'requests': bedrock_requests,
+                'throttled': bedrock_throttled,
+                'throttle_rate': bedrock_throttled / bedrock_requests if bedrock_requests else 0.0,
+                'peak_rpm': self.bedrock_peak['rpm'],
+                'peak_tpm': self.bedrock_peak['tpm']
+            },
+            'functions': {
+                function: {
+                    'invocations': stats['invocations'],
+                    'throttles': stats['throttles'],
+                    'timeouts': stats['timeouts'],
+                    'peak_concurrency': stats['peak_concurrency'],
+                    'p95_seconds': percentile(stats['durations'], 0.95),
+                    'max_seconds': max(stats['durations'], default=0.0),
+                    'timeout_seconds': self.settings['timeouts'][function]
+                } for function, stats in sorted(self.functions.items())
+            },
+            'errors': dict(self.errors.most_common(5))
+        }
+
+def count_questions(lens, pillars):
+
+    questions = {}
+    for item in load_prompts():
+        if item['wafr_lens'] == lens and item['wafr_pillar'] in pillars:
+            questions[item['wafr_pillar']] = len(item['wafr_pillar_prompt'].splitlines()[2:])
+
+    missing = [pillar for pillar in pillars if pillar not in questions]
+    if missing:
+        sys.exit(f"No prompts for {', '.join(missing)} in lens {lens}")
+
+    return {pillar: questions[pillar] for pillar in pillars}
+
+def read_service_times(days, questions):
+    """
+    Service times from the metrics the functions publish: StageDuration for the stages without model calls, the
+    Bedrock Latency, InputTokens and OutputTokens per stage, and the stage time left besides the model calls for the
+    others. Stages without data in the period keep their defaults.
+    """
+
+    import boto3
+
+    cloudwatch = boto3.client('cloudwatch')
+    end_time = datetime.datetime.now(datetime.timezone.utc)
+    start_time = end_time - datetime.timedelta(days=days)
+
+    def statistics(metric_name, **dimensions):
+        response = cloudwatch.get_metric_statistics(
+            Namespace='WAFRAccelerator',
+            MetricName=metric_name,
+            Dimensions=[{'Name': name, 'Value': value} for name, value in dimensions.items()],
+            StartTime=start_time,
+            EndTime=end_time,
+            Period=days * 86400,
+            Statistics=['Average', 'SampleCount'],
+            ExtendedStatistics=['p50', 'p95']
+        )
+        if not response['Datapoints']:
+            return None
+        datapoint = max(response['Datapoints'], key=lambda datapoint: datapoint['SampleCount'])
+        # Latency and StageDuration are in milliseconds
+        scale = 1000 if datapoint['Unit'] == 'Milliseconds' else 1
+        return {'median': datapoint['ExtendedStatistics']['p50'] / scale, 'p95': datapoint['ExtendedStatistics']['p95'] / scale, 'average': datapoint['Average'] / scale}
+
+    def remainder(total, call, calls):
+        # Stage time besides its model calls, kept at a tenth of the stage time at least
+        return {quantile: max(total[quantile] - calls * call[quantile], total[quantile] / 10) for quantile in ('median', 'p95')}
+
+    service_times = {name: dict(values) for name, values in DEFAULT_SERVICE_TIMES.items()}
+    found = []
+
+    for stage in ('prepare_review', 'extract_document_text', 'generate_prompts', 'update_review_status'):
+        stage_duration = statistics('StageDuration', Stage=stage)
+        if stage_duration:
+            service_times[stage] = {'median': stage_duration['median'], 'p95': stage_duration['p95']}
+            found.append(stage)
+
+    mean_questions = sum(questions.values()) / len(questions)
+
+    # (Bedrock entry, stage, operations, stage entry, model calls per stage)
+    for name, stage, operations, stage_name, calls in [
+            ('bedrock_summary', 'generate_solution_summary', ['bedrock_invoke_model'], 'generate_solution_summary', 1),
+            ('bedrock_question', 'answer_questions', ['bedrock_invoke_model_stream', 'bedrock_invoke_model'], 'question', mean_questions),
+            ('bedrock_quick_pillar', 'quick_review', ['bedrock_invoke_model'], 'quick_review', len(questions))]:
+
+        for operation in operations:
+            latency = statistics('Latency', Stage=stage, Operation=operation)
+            if latency:
+                break
+        if not latency:
+            continue
+
+        service_times[name].update({'median': latency['median'], 'p95': latency['p95']})
+        for token_metric, token_name in [('InputTokens', 'input_tokens'), ('OutputTokens', 'output_tokens')]:
+            tokens = statistics(token_metric, Stage=stage, Operation=operation)
+            if tokens:
+                service_times[name][token_name] = round(tokens['average'])
+        found.append(name)
+
+        stage_duration = statistics('StageDuration', Stage=stage)
+        if stage_duration:
+            if stage_name == 'question':
+                # answer_questions is timed per pillar
+                service_times[stage_name] = {quantile: value / mean_questions for quantile, value in remainder(stage_duration, latency, calls).items()}
+            else:
+                service_times[stage_name] = remainder(stage_duration, latency, calls)
+            found.append(stage_name)
+
+    print(f"Read from CloudWatch over {days} days: {', '.join(found) or 'nothing, using the defaults'}")
+
+    return service_times
+
+def integer_list(value):
+    return [int(item) for item in value.split(',')]
+
+def timeout_setting(value):
+    function, seconds = value.split('=', 1)
+    if function not in FUNCTION_TIMEOUTS:
+        raise argparse.ArgumentTypeError(f"unknown function {function}, one of {', '.join(FUNCTION_TIMEOUTS)}")
+    return function, int(seconds)
+
+def print_report(report):
+
+    print(f"{report['completed']} completed, {report['errored']} errored, {report['dead_lettered']} dead-lettered, "
+          f"{report['unfinished']} unfinished of {report['reviews']} reviews")
+    if report['completion_hours'] is not None:
+        print(f"all finished after:  {report['completion_hours']:.2f} h ({'within' if report['met_deadline'] else 'not within'} {report['settings']['deadline_hours']} h)")
+    print(f"reviews per hour:    {report['reviews_per_hour']:.2f}")
+    print(f"review latency:      p50 {report['review_latency_seconds']['p50'] / 60:.1f} min, p95 {report['review_latency_seconds']['p95'] / 60:.1f} min")
+    print(f"admission wait:      p50 {report['admission_wait_seconds']['p50'] / 60:.1f} min, p95 {report['admission_wait_seconds']['p95'] / 60:.1f} min")
+    print(f"admission deferrals: {', '.join(f'{count} {review_type}' for review_type, count in report['deferrals'].items()) or 'none'}")
+    bedrock = report['bedrock']
+    print(f"bedrock:             {bedrock['requests']} requests, {bedrock['throttled']} throttled ({bedrock['throttle_rate']:.1%}), "
+          f"peak {bedrock['peak_rpm']} requests and {bedrock['peak_tpm']} tokens per minute")
+    for error, count in report['errors'].items():
+        print(f"  {count} x {error}")
+
+    print(f"\n{'hour':>4}{'messages':>10}{'visible':>9}   (queue depth, hourly maximum)")
+    for depth in report['queue_depth']['hourly_max']:
+        print(f"{depth['hour']:>4}{depth['messages']:>10}{depth['visible']:>9}")
+
+    print(f"\n{'function':<36}{'invocations':>12}{'throttles':>10}{'timeouts':>9}{'peak':>6}{'p95 s':>8}{'max s':>8}{'timeout s':>10}")
+    for function, stats in report['functions'].items():
+        print(f"{function:<36}{stats['invocations']:>12}{stats['throttles']:>10}{stats['timeouts']:>9}{stats['peak_concurrency']:>6}"
+              f"{stats['p95_seconds']:>8.0f}{stats['max_seconds']:>8.0f}{stats['timeout_seconds']:>10}")
+
+def print_sweep(results, deadline_hours):
+
+    print(f"{'max reviews':>11}{'consumers':>10}{'map':>5}{'rpm':>6}{'tpm':>8}{'finished h':>12}{'errored':>9}{'max queue':>10}"
+          f"{'throttled':>10}{'lambda thr':>11}  within {deadline_hours} h")
+
+    for settings, reports in results:
+        hours = [report['completion_hours'] for report in reports]
+        finished_hours = f"{max(hours):.2f}" if None not in hours else 'unfinished'
+        print(f"{settings['max_concurrent_reviews']:>11}{settings['consumers']:>10}{settings['map_concurrency']:>5}{settings['bedrock_rpm']:>6}{settings['bedrock_tpm']:>8}"
+              f"{finished_hours:>12}{max(report['errored'] for report in reports):>9}{max(report['queue_depth']['max_messages'] for report in reports):>10}"
+              f"{max(report['bedrock']['throttle_rate'] for report in reports):>10.1%}"
+              f"{max(sum(stats['throttles'] for stats in report['functions'].values()) for report in reports):>11}"
+              f"  {'yes' if all(report['met_deadline'] for report in reports) else 'no'}")
+
+    # The grid is in increasing order, so the first that meets the deadline asks for the least
+    meeting = [settings for settings, reports in results if all(report['met_deadline'] for report in reports)]
+    if meeting:
+        settings = meeting[0]
+        print(f"\nLowest settings finishing every review within {deadline_hours} h: max concurrent reviews {settings['max_concurrent_reviews']}, "
+              f"consumers {settings['consumers']}, map concurrency {settings['map_concurrency']}, "
+              f"Bedrock {settings['bedrock_rpm']} requests and {settings['bedrock_tpm']} tokens per minute")
+    else:
+        print(f"\nNo settings finish every review within {deadline_hours} h")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--reviews', type=int, default=100)
+    parser.add_argument('--quick-share', type=float, default=0.0, help='share of Quick reviews, the rest are Deep')
+    parser.add_argument('--arrival-rate', type=float, default=0, help='reviews submitted per hour (Poisson), 0 submits all at once')
+    parser.add_argument('--lens', default='AWS Well-Architected Framework')
+    parser.add_argument('--pillars', nargs='+', default=list(PILLAR_IDS), metavar='PILLAR')
+    parser.add_argument('--deadline-hours', type=float, default=10, help='time every review has to finish in, e.g. overnight')
+    parser.add_argument('--max-concurrent-reviews', type=integer_list, default=[5], help='MAX_CONCURRENT_REVIEWS: admission limit and reserved concurrency of every review function')
+    parser.add_argument('--consumers', type=integer_list, default=[0], help='event source maximum concurrency, 0 for --max-concurrent-reviews')
+    parser.add_argument('--map-concurrency', type=integer_list, default=[1], help='max_concurrency of the Map over pillars, 0 for all pillars at once')
+    parser.add_argument('--bedrock-rpm', type=integer_list, default=[200], help='Bedrock requests per minute quota')
+    parser.add_argument('--bedrock-tpm', type=integer_list, default=[200000], help='Bedrock tokens per minute quota')
+    parser.add_argument('--map-wait-seconds', type=float, default=40, help='Wait state before each pillar')
+    parser.add_argument('--batch-size', type=int, default=10, help='SQS messages per start_wafr_review invocation')
+    parser.add_argument('--poll-seconds', type=float, default=20, help='wait after an empty receive')
+    parser.add_argument('--lambda-throttle-retries', type=int, default=LAMBDA_THROTTLE_RETRIES, help='Step Functions retries of Lambda throttling of each state machine task')
+    parser.add_argument('--timeout', type=timeout_setting, action='append', default=[], metavar='FUNCTION=SECONDS', help='override a function timeout (repeatable)')
+    parser.add_argument('--service-times', help='JSON file of {stage: {"median": s, "p95": s}} overrides, as written by --save-service-times')
+    parser.add_argument('--from-cloudwatch', action='store_true', help='read the service times from the WAFRAccelerator metrics')
+    parser.add_argument('--days', type=int, default=7, help='period of metrics read by --from-cloudwatch')
+    parser.add_argument('--save-service-times', help='write the service times used to this JSON file')
+    parser.add_argument('--replications', type=int, default=1, help='runs with different seeds per combination of settings')
+    parser.add_argument('--max-hours', type=float, default=72, help='stop after this many simulated hours')
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--json', action='store_true', help='print the reports as JSON')
+    args = parser.parse_args()
+
+    questions = count_questions(args.lens, args.pillars)
+
+    if args.from_cloudwatch:
+        service_times = read_service_times(args.days, questions)
+    else:
+        service_times = {name: dict(values) for name, values in DEFAULT_SERVICE_TIMES.items()}
+    if args.service_times:
+        with open(args.service_times, encoding='utf-8') as service_times_file:
+            for name, values in json.load(service_times_file).items():
+                service_times.setdefault(name, {}).update(values)
+    if args.save_service_times:
+        with open(args.save_service_times, 'w', encoding='utf-8') as service_times_file:
+            json.dump(service_times, service_times_file, indent=2)
+
+    timeouts = dict(FUNCTION_TIMEOUTS)
+    timeouts.update(dict(args.timeout))
+
+    results = []
+    for max_concurrent_reviews, consumers, map_concurrency, bedrock_rpm, bedrock_tpm in itertools.product(
+            sorted(args.max_concurrent_reviews), sorted(args.consumers), sorted(args.map_concurrency), sorted(args.bedrock_rpm), sorted(args.bedrock_tpm)):
+        settings = {
+            'reviews': args.reviews, 'quick_share': args.quick_share, 'arrival_rate': args.arrival_rate,
+            'deadline_hours': args.deadline_hours, 'max_concurrent_reviews': max_concurrent_reviews,
+            'consumers': consumers or max_concurrent_reviews, 'map_concurrency': map_concurrency,
+            'bedrock_rpm': bedrock_rpm, 'bedrock_tpm': bedrock_tpm, 'map_wait_seconds': args.map_wait_seconds,
+            'batch_size': args.batch_size, 'poll_seconds': args.poll_seconds,
+            'lambda_throttle_retries': args.lambda_throttle_retries, 'timeouts': timeouts, 'max_hours': args.max_hours
+        }
+        reports = [CapacityModel(settings, service_times, questions, args.seed + replication).run() for replication in range(args.replications)]
+        results.append((settings, reports))
+
+    if args.json:
+        print(json.dumps([report for settings, reports in results for report in reports], indent=2))
+    elif len(results) == 1 and args.replications == 1:
+        print_report(results[0][1][0])
+    else:
+        print_sweep(results, args.deadline_hours)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+"""
+Init duration benchmark for the Lambda functions in lambda_dir.
+
+Local mode imports each handler module in a fresh Python process, the way a new Lambda container does, and
+reports the median time of the import (the init phase). With --create-clients it also times creating every
+boto3 client and resource the module declares through aws_clients, which is what a handler pays the first
+time it uses all of them. Point --lambda-dir at an older checkout to compare against eagerly created clients.
+
+--from-logs reads the init durations Lambda reports for real cold starts (the REPORT lines in CloudWatch Logs)
+with a Logs Insights query over the given functions.
+
+Usage:
+    python benchmarks/cold_start_benchmark.py --runs 5
+    python benchmarks/cold_start_benchmark.py --create-clients
+    python benchmarks/cold_start_benchmark.py --from-logs <function name> [<function name> ...] --hours 24
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+LAYER_DIR = os.path.join(ROOT_DIR, 'lambda_dir', 'layers', 'wafr_common', 'python')
+
+# (code directory, handler module) of every function in the stack
+LAMBDA_MODULES = [
+    ('insert_wafr_prompts', 'insert_wafr_prompts'),
+    ('replace_ui_tokens', 'replace_ui_tokens'),
+    ('start_wafr_review', 'start_wafr_review'),
+    ('prepare_wafr_review', 'prepare_wafr_review'),
+    ('extract_document_text', 'extract_document_text'),
+    ('generate_solution_summary', 'generate_solution_summary'),
+    ('generate_prompts_for_six_pillars', 'generate_prompts_for_six_pillars'),
+    ('generate_pillar_question_response', 'generate_pillar_question_response'),
+    ('generate_pillar_question_response', 'batch_inference'),
+    ('prepare_wafr_redrive', 'prepare_wafr_redrive'),
+    ('update_review_status', 'update_review_status'),
+]
+
+# Values for the environment variables the modules read at import time; nothing is called with them
+DUMMY_ENVIRONMENT = {name: 'benchmark' for name in [
+    'DD_TABLE_NAME', 'EC2_INSTANCE_ID', 'GUARDRAIL_ID', 'KNOWLEDGE_BASE_ID', 'LLM_MODEL_ID',
+    'PARAMETER_1_NEW_WAFR_REVIEW', 'PARAMETER_2_EXISTING_WAFR_REVIEWS', 'PARAMETER_3_LOGIN_PAGE',
+    'PARAMETER_COGNITO_USER_POOL_CLIENT_ID', 'PARAMETER_COGNITO_USER_POOL_ID', 'PARAMETER_UI_SYNC_INITAITED_FLAG',
+    'START_WAFR_REVIEW_STATEMACHINE_ARN', 'UPLOAD_BUCKET_NAME', 'WAFR_ACCELERATOR_QUEUE_URL',
+    'WAFR_ACCELERATOR_RUNS_DD_TABLE_NAME', 'WAFR_PROMPT_DD_TABLE_NAME', 'WAFR_REFERENCE_DOCS_BUCKET',
+    'WAFR_RUNS_TABLE', 'WAFR_UI_BUCKET_ARN', 'WAFR_UI_BUCKET_NAME'
+]}
+DUMMY_ENVIRONMENT.update({
+    'AWS_DEFAULT_REGION': 'us-east-1', 'REGION': 'us-east-1', 'REGION_NAME': 'us-east-1',
+    'AWS_ACCESS_KEY_ID': 'benchmark', 'AWS_SECRET_ACCESS_KEY': 'benchmark',
+    'BEDROCK_SLEEP_DURATION': '0', 'BEDROCK_MAX_TRIES': '1'
+})
+
+# Runs in the child process; prints the timings as JSON on its last line
+MEASURE_SCRIPT = """
+import sys, json, time
+start = time.perf_counter()
+module = __import__(sys.argv[1])
+import_seconds = time.perf_counter() - start
+
+client_seconds = 0.0
+if sys.argv[2] == 'create-clients':
+    start = time.perf_counter()
+    for candidate in list(sys.modules.values()):
+        for value in list(vars(candidate).values()) if hasattr(candidate, '__dict__') else []:
+            if type(value).__name__ == 'LazyAWSObject':
+                value.meta
+    client_seconds = time.perf_counter() - start
+
+print(json.dumps({'import_seconds': import_seconds, 'client_seconds': client_seconds}))
+"""
+
+def measure_module(lambda_dir, code_dir, module, create_clients):
+
+    environment = dict(os.environ, **DUMMY_ENVIRONMENT)
+    environment['PYTHONPATH'] = os.pathsep.join([os.path.join(lambda_dir, code_dir), LAYER_DIR])
+    # Like Lambda, start without cached bytecode being written next to the sources
+    environment['PYTHONDONTWRITEBYTECODE'] = '1'
+
+    completed = subprocess.run(
+        [sys.executable, '-c', MEASURE_SCRIPT, module, 'create-clients' if create_clients else 'import-only'],
+        cwd=os.path.join(lambda_dir, code_dir), env=environment, capture_output=True, text=True
+    )
+    if completed.returncode != 0:
+        raise RuntimeError(f"{module}: {completed.stderr.strip().splitlines()[-1]}")
+
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+def run_local(lambda_dir, runs, create_clients):
+
+    print(f"{'function module':<40}{'init ms':>10}{'clients ms':>12}{'total ms':>10}")
+    for code_dir, module in LAMBDA_MODULES:
+        try:
+            timings = [measure_module(lambda_dir, code_dir, module, create_clients) for _ in range(runs)]
+        except RuntimeError as error:
+            print(f"{module:<40}  failed: {error}")
+            continue
+
+        import_ms = statistics.median(timing['import_seconds'] for timing in timings) * 1000
+        client_ms = statistics.median(timing['client_seconds'] for timing in timings) * 1000
+
+        print(f"{module:<40}{import_ms:>10.1f}{client_ms:>12.1f}{import_ms + client_ms:>10.1f}")
+
+def run_from_logs(function_names, hours):
+
+    import boto3
+
+    logs_client = boto3.client('logs')
+
+    query = ('filter @type = "REPORT" and ispresent(@initDuration) '
+             '| stats count(*) as cold_starts, avg(@initDuration) as avg_ms, pct(@initDuration, 50) as p50_ms, '
+             'pct(@initDuration, 99) as p99_ms, max(@initDuration) as max_ms')
+
+    end_time = int(time.time())
+    start_time = end_time - hours * 3600
+
+    print(f"{'function':<64}{'cold starts':>12}{'avg ms':>9}{'p50 ms':>9}{'p99 ms':>9}{'max ms':>9}")
+    for function_name in function_names:
+        query_id = logs_client.start_query(
+            logGroupName=f"/aws/lambda/{function_name}",
+            startTime=start_time,
+            endTime=end_time,
+            queryString=query
+        )['queryId']
+
+        response = logs_client.get_query_results(queryId=query_id)
+        while response['status'] in ('Scheduled', 'Running'):
+            time.sleep(1)
+            response = logs_client.get_query_results(queryId=query_id)
+
+        if not response['results']:
+            print(f"{function_name[:63]:<64}{0:>12}")
+            continue
+
+        row = {field['field']: field['value'] for field in response['results'][0]}
+        print(f"{function_name[:63]:<64}{row['cold_starts']:>12}" + ''.join(f"{float(row[name]):>9.1f}" for name in ('avg_ms', 'p50_ms', 'p99_ms', 'max_ms')))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--lambda-dir', default=os.path.join(ROOT_DIR, 'lambda_dir'))
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--create-clients', action='store_true', help='also time creating every client the module declares')
+    parser.add_argument('--from-logs', nargs='+', metavar='FUNCTION_NAME', help='report init durations of deployed functions instead')
+    parser.add_argument('--hours', type=int, default=24, help='look back window for --from-logs')
+    args = parser.parse_args()
+
+    if args.from_logs:
+        run_from_logs(args.from_logs, args.hours)
+    else:
+        run_local(os.path.abspath(args.lambda_dir), args.runs, args.create_clients)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,224 @@
+"""
+Local stand-in for the Amazon Bedrock batch inference job API.
+
+Runs the batch inference helpers in lambda_dir/generate_pillar_question_response/batch_inference.py
+(join pool -> submit the pool's job -> poll -> read outputs) for several reviews against an in-memory S3,
+the local DynamoDB fake and a local batch job service, so the batch path can be exercised without AWS access
+or Bedrock quota. The pool window passes on the modelled clock of the fakes.
+
+Usage:
+    python benchmarks/local_bedrock_batch.py --reviews 3 --questions 57 --error-rate 0.05
+"""
+import os
+import sys
+import io
+import json
+import random
+import argparse
+
+from botocore.exceptions import ClientError
+
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda_dir', 'generate_pillar_question_response')
+# Deployed as a Lambda layer (mounted at /opt/python), so it has to be added to the path when running locally
+LAYER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda_dir', 'layers', 'wafr_common', 'python')
+
+POOLS_TABLE = 'local-batch-pools'
+
+class InMemoryS3:
+    """Minimal subset of the boto3 S3 client used by the batch helpers."""
+
+    def __init__(self):
+        self.objects = {}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.objects[(Bucket, Key)] = Body if isinstance(Body, bytes) else Body.encode('utf-8')
+        return {}
+
+    def get_object(self, Bucket, Key, **kwargs):
+        if (Bucket, Key) not in self.objects:
+            raise ClientError({'Error': {'Code': 'NoSuchKey', 'Message': Key}}, 'GetObject')
+        return {'Body': io.BytesIO(self.objects[(Bucket, Key)])}
+
+    def copy_object(self, Bucket, Key, CopySource, **kwargs):
+        self.objects[(Bucket, Key)] = self.get_object(Bucket=CopySource['Bucket'], Key=CopySource['Key'])['Body'].read()
+        return {}
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        self.objects.pop((Bucket, Key), None)
+        return {}
+
+    def keys(self, Bucket, Prefix):
+        return sorted(key for bucket, key in self.objects if bucket == Bucket and key.startswith(Prefix))
+
+class LocalBatchJobService:
+    """
+    Mimics create_model_invocation_job / get_model_invocation_job. A job moves through
+    Submitted -> InProgress -> Completed (or PartiallyCompleted) over `polls_to_complete` status calls
+    and then writes <output prefix>/<job id>/<input file>.out for each file of its input folder in the
+    same format as Bedrock. A repeated clientRequestToken returns the job it created before.
+    """
+
+    def __init__(self, s3, responder, polls_to_complete=3, error_rate=0.0, seed=7):
+        self.s3 = s3
+        self.responder = responder
+        self.polls_to_complete = polls_to_complete
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.jobs = {}
+        self.request_tokens = {}
+
+    def create_model_invocation_job(self, jobName, roleArn, modelId, inputDataConfig, outputDataConfig, clientRequestToken=None, **kwargs):
+        if clientRequestToken in self.request_tokens:
+            return {'jobArn': self.request_tokens[clientRequestToken]}
+
+        job_id = f"local{len(self.jobs):07d}"
+        job_arn = f"arn:aws:bedrock:local:000000000000:model-invocation-job/{job_id}"
+        self.jobs[job_arn] = {
+            'job_id': job_id,
+            'model_id': modelId,
+            'input_uri': inputDataConfig['s3InputDataConfig']['s3Uri'],
+            'output_uri': outputDataConfig['s3OutputDataConfig']['s3Uri'],
+            'polls': 0,
+            'status': 'Submitted'
+        }
+        if clientRequestToken:
+            self.request_tokens[clientRequestToken] = job_arn
+        return {'jobArn': job_arn}
+
+    def get_model_invocation_job(self, jobIdentifier):
+        job = self.jobs[jobIdentifier]
+        job['polls'] += 1
+
+        if job['status'] in ('Submitted', 'InProgress'):
+            if job['polls'] >= self.polls_to_complete:
+                job['status'] = self._run(job)
+            else:
+                job['status'] = 'InProgress'
+
+        return {'jobArn': jobIdentifier, 'status': job['status'], 'message': ''}
+
+    def _run(self, job):
+        bucket, input_prefix = split_s3_uri(job['input_uri'])
+        output_bucket, output_prefix = split_s3_uri(job['output_uri'])
+
+        errors = 0
+        for input_key in self.s3.keys(Bucket=bucket, Prefix=input_prefix):
+            input_lines = self.s3.get_object(Bucket=bucket, Key=input_key)['Body'].read().decode('utf-8').splitlines()
+
+            output_lines = []
+            for line in input_lines:
+                record = json.loads(line)
+                if self.random.random() < self.error_rate:
+                    errors += 1
+                    output_lines.append(json.dumps({'recordId': record['recordId'], 'modelInput': record['modelInput'],
+                        'error': {'errorCode': 400, 'errorMessage': 'Local stand-in injected error'}}))
+                else:
+                    text = self.responder(record['modelInput'])
+                    output_lines.append(json.dumps({'recordId': record['recordId'], 'modelInput': record['modelInput'],
+                        'modelOutput': {'content': [{'type': 'text', 'text': text}], 'stop_reason': 'end_turn'}}))
+
+            output_key = f"{output_prefix}{job['job_id']}/{input_key.split('/')[-1]}.out"
+            self.s3.put_object(Bucket=output_bucket, Key=output_key, Body="\n".join(output_lines))
+
+        return 'PartiallyCompleted' if errors else 'Completed'
+
+def split_s3_uri(uri):
+    bucket, _, key = uri[len("s3://"):].partition('/')
+    return bucket, key
+
+def canned_response(model_input):
+    question = model_input['messages'][0]['content'][0]['text'].strip().splitlines()[-1].strip()
+    return (f"<response><question>{question}</question><assessment>Local stand-in assessment.</assessment>"
+            "<best_practices_followed>N/A</best_practices_followed>"
+            "<recommendations_and_examples>N/A</recommendations_and_examples><citations>N/A</citations>"
+            "<wafr_answer_choices><choice><id>local_choice</id></choice></wafr_answer_choices></response>")
+
+def build_pillar_prompts(s3, bucket, document, question_count):
+    prompt_objects = []
+    for index in range(question_count):
+        filename = f"local/analyses/{document}-security-sec{index}-prompt.txt"
+        body = json.dumps({
+            "anthropic_version": "bedrock-2023-05-31",
+            "max_tokens": 4096,
+            "system": "local",
+            "messages": [{"role": "user", "content": [{"type": "text", "text": f"Questions:\nSEC {index}: Local question {index}"}]}]
+        })
+        s3.put_object(Bucket=bucket, Key=filename, Body=body)
+        prompt_objects.append({
+            "pillar_review_prompt_filename": filename,
+            "pillar_specfic_question_id": f"sec{index}",
+            "pillar_specfic_prompt_question": f"Local question {index}",
+            "pillar_specfic_wafr_answer_choices": []
+        })
+    return [{'input_pillar': 'Security', 'Security': prompt_objects}]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--reviews', type=int, default=3, help='reviews queued in batch mode within one pool window')
+    parser.add_argument('--questions', type=int, default=57, help='questions per review')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--polls-to-complete', type=int, default=3)
+    parser.add_argument('--min-records', type=int, default=100, help='BEDROCK_BATCH_MIN_RECORDS')
+    args = parser.parse_args()
+
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    os.environ.setdefault('BEDROCK_SLEEP_DURATION', '0')
+    os.environ.setdefault('BEDROCK_MAX_TRIES', '1')
+    os.environ.setdefault('METRICS_SINK', 'off')
+    os.environ['BATCH_POOLS_DD_TABLE_NAME'] = POOLS_TABLE
+    os.environ['BEDROCK_BATCH_MIN_RECORDS'] = str(args.min_records)
+    sys.path.insert(0, LAYER_DIR)
+    sys.path.insert(0, LAMBDA_DIR)
+    import batch_inference
+    from service_fakes import ServiceFakes
+
+    # Only the pools table comes from the fakes; a modelled hour passes in a fraction of a second
+    services = ServiceFakes(time_scale=0.0001, table_keys={POOLS_TABLE: ('pool_id',)})
+    batch_inference.time = services.clock
+    batch_inference.dynamodb = services['dynamodb']
+
+    bucket = 'local-upload-bucket'
+    s3 = InMemoryS3()
+    batch_inference.s3client = s3
+    batch_inference.bedrock_batch_client = LocalBatchJobService(s3, canned_response, args.polls_to_complete, args.error_rate)
+
+    reviews = []
+    for index in range(args.reviews):
+        analysis_id = f"local-analysis-{index}"
+        all_pillar_prompts = build_pillar_prompts(s3, bucket, f"doc{index}", args.questions)
+        records, record_manifest = batch_inference.build_batch_records(bucket, all_pillar_prompts, {})
+        member = batch_inference.write_member_records(bucket, f"local/analyses/doc{index}-batch-inference", records, record_manifest)
+        batch_job = batch_inference.join_batch_pool(analysis_id, bucket, member, 'local.model-v1:0')
+        reviews.append((analysis_id, len(records), batch_job))
+
+    # Every member polls until the pool's job is done; the first one after the window submits it
+    services.clock.sleep(batch_inference.BEDROCK_BATCH_POOL_MINUTES * 60)
+
+    results = []
+    polls = 0
+    for analysis_id, record_count, batch_job in reviews:
+        while batch_job['status'] not in batch_inference.BATCH_JOB_COMPLETED_STATUSES + batch_inference.BATCH_JOB_FALLBACK_STATUSES:
+            if 'job_arn' not in batch_job:
+                batch_job.update(batch_inference.get_pool_job(batch_job['pool_id'], analysis_id))
+            if 'job_arn' in batch_job:
+                batch_job['status'] = batch_inference.get_batch_job_status(batch_job['job_arn'])
+            polls += 1
+
+        batch_outputs = batch_inference.read_batch_outputs(bucket, batch_job, analysis_id) if 'job_arn' in batch_job else {}
+        results.append({
+            'analysis_id': analysis_id,
+            'records': record_count,
+            'status': batch_job['status'],
+            'answered_by_batch': len(batch_outputs),
+            'needs_on_demand_fallback': record_count - len(batch_outputs)
+        })
+
+    print(json.dumps({
+        'pool_id': reviews[0][2]['pool_id'] if reviews else None,
+        'batch_jobs': len(batch_inference.bedrock_batch_client.jobs),
+        'status_polls': polls,
+        'reviews': results
+    }, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+"""
+Micro-benchmark for the model response parser in lambda_dir/generate_pillar_question_response/response_parser.py.
+
+Compares the single pass parser against the earlier sanitise + find/slice + regex extraction (reproduced
+below as legacy_parse) over recorded responses, or over synthetic responses of increasing size when no
+recordings are given. Raw responses can be recorded by uncommenting the put_object line in invoke_bedrock.
+
+It also streams each response through the incremental parser in small chunks, as Bedrock sends them, and reports
+the time that takes and how far into the response the choices and the assessment were complete, which is when the
+answer is first submitted to the Well-Architected Tool.
+
+Usage:
+    python benchmarks/parser_benchmark.py
+    python benchmarks/parser_benchmark.py --responses-dir ./recorded-responses --repeat 200
+"""
+import os
+import re
+import sys
+import glob
+import time
+import argparse
+
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda_dir', 'generate_pillar_question_response')
+
+SECTIONS = ('question', 'assessment', 'best_practices_followed', 'recommendations_and_examples', 'citations', 'risk')
+
+def legacy_sanitise_string(content):
+    junk_list = ["```", "xml", "**wafr_answer_choices:**", "{", "}", "[", "]", "<b>", "</b>", "<citation>", "</citation>", "Recommendations:", "Assessment:"]
+    for junk in junk_list:
+        content = content.replace(junk, '')
+    return content
+
+def legacy_sanitise_string_2(content):
+    junk_list = ["<citations>", "</citations>", "**", "```", "<b>", "</b>"]
+    for junk in junk_list:
+        content = content.replace(junk, '')
+    return content
+
+def legacy_extract_tag_data(content, tag):
+    tag_content = ""
+    xml_start = content.find(f'<{tag}>')
+    if xml_start != -1:
+        xml_content = content[(xml_start+len(f'<{tag}>')):]
+        xml_end = xml_content.find(f'</{tag}>')
+        if xml_end != -1:
+            tag_content = legacy_sanitise_string_2(xml_content[:xml_end].strip())
+    return tag_content
+
+def legacy_extract_choices(content):
+    selected_choices = []
+    xml_end = -1
+    xml_start = content.find('<wafr_answer_choices>')
+    if xml_start != -1:
+        xml_content = content[xml_start:]
+        xml_end = xml_content.find('</wafr_answer_choices>')
+        wafr_answer_choices = xml_content[:(xml_end + len("</wafr_answer_choices>"))].strip()
+    if ((xml_start != -1) and (xml_end != -1)):
+        id_pattern = re.compile(r'<id>(.*?)</id>', re.DOTALL)
+        selected_choices = [id_value.strip() for id_value in id_pattern.findall(wafr_answer_choices)]
+    return selected_choices
+
+def legacy_parse(content):
+    content = legacy_sanitise_string(content)
+    parsed = {section: legacy_extract_tag_data(content, section) for section in SECTIONS}
+    parsed['choices'] = legacy_extract_choices(content)
+    return parsed
+
+def synthetic_response(size, index=0):
+    """A response shaped like the model output, padded to roughly `size` characters of recommendations, its longest section."""
+    filler = "Define RTO and RPO per workload and **test** the restore process regularly. Example: AWS Backup restore testing. "
+    body = (filler * (size // len(filler) + 1))[:size]
+    return ("```xml\n<response>\n"
+            f"<question>How do you plan for disaster recovery (DR)? {index}</question>\n"
+            "<assessment>Assessment: The workload runs in a **single Region** with backups but no defined recovery objectives.</assessment>\n"
+            "<wafr_answer_choices><choice><id>rel_planning_for_recovery_objective_defined_recovery</id></choice>"
+            "<choice><id>rel_planning_for_recovery_disaster_recovery</id></choice></wafr_answer_choices>\n"
+            "<risk>Medium</risk>\n"
+            "<best_practices_followed>Backups are automated.</best_practices_followed>\n"
+            f"<recommendations_and_examples>Recommendations: {body}</recommendations_and_examples>\n"
+            "<citations><citation>https://docs.aws.amazon.com/wellarchitected/latest/reliability-pillar/</citation></citations>\n"
+            "</response>\n```")
+
+def load_responses(responses_dir):
+    responses = []
+    for filename in sorted(glob.glob(os.path.join(responses_dir, '*'))):
+        with open(filename, encoding='utf-8') as response_file:
+            responses.append((os.path.basename(filename), response_file.read()))
+    return responses
+
+def answer_position(response_parser, content, chunk_size=20):
+    """Share of the response streamed before the choices and the assessment were available."""
+    parser = response_parser.IncrementalResponseParser()
+    seen = set()
+    for position in range(0, len(content), chunk_size):
+        seen.update(name for name, value in parser.feed(content[position:position + chunk_size]))
+        if {'choices', 'assessment'} <= seen:
+            return min(1.0, (position + chunk_size) / len(content))
+    return 1.0
+
+def stream_response(response_parser, content, chunk_size=20):
+    parser = response_parser.IncrementalResponseParser()
+    for position in range(0, len(content), chunk_size):
+        parser.feed(content[position:position + chunk_size])
+    return parser.close()
+
+def time_parser(parse, content, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        parse(content)
+    return (time.perf_counter() - start) / repeat
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--responses-dir', help='directory of raw model responses, one per file')
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+
+    sys.path.insert(0, LAMBDA_DIR)
+    import response_parser
+
+    if args.responses_dir:
+        responses = load_responses(args.responses_dir)
+    else:
+        responses = [(f"synthetic-{size}", synthetic_response(size)) for size in (2000, 20000, 200000, 2000000)]
+
+    print(f"{'response':<32}{'chars':>10}{'legacy ms':>12}{'single pass ms':>16}{'speedup':>9}{'streamed ms':>13}{'answer at':>11}  sections match")
+    for name, content in responses:
+        legacy_seconds = time_parser(legacy_parse, content, args.repeat)
+        single_pass_seconds = time_parser(response_parser.parse_response, content, args.repeat)
+        streamed_seconds = time_parser(lambda response: stream_response(response_parser, response), content, max(1, args.repeat // 10))
+
+        # Choices are left out of the comparison: the legacy sanitiser strips brackets from choice ids
+        legacy = legacy_parse(content)
+        single_pass = response_parser.parse_response(content)
+        matches = all(legacy_sanitise_string(single_pass[section]) == legacy_sanitise_string(legacy[section]).strip() for section in SECTIONS)
+
+        print(f"{name[:31]:<32}{len(content):>10}{legacy_seconds * 1000:>12.3f}{single_pass_seconds * 1000:>16.3f}"
+              f"{legacy_seconds / single_pass_seconds:>8.1f}x{streamed_seconds * 1000:>13.3f}{answer_position(response_parser, content):>10.0%}  {matches}")
+
+if __name__ == '__main__':
+    main()
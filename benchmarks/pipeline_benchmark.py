@@ -0,0 +1,520 @@
+"""
+Offline end to end benchmark of the review pipeline.
+
+Runs the real handlers - start_wafr_review behind a simulated SQS event source, then the Deep review state
+machine (prepare_wafr_review, extract_document_text, generate_solution_summary, generate_prompts_for_six_pillars,
+the Map state over generate_pillar_question_response, update_review_status and generate_review_report) - against the local service fakes
+in service_fakes.py, which add latency from configurable distributions and throttle like the real services.
+
+Everything is modelled time: Bedrock calls, the 40 second Map wait and Bedrock retry sleeps all run --time-scale
+times faster than real time. Handler CPU time is not scaled, so keep the scale at a level where it is negligible
+next to the modelled service latencies (the default 0.01 runs an hour in 36 seconds).
+
+Reports reviews per hour, p50/p95 review latency (submission to completion), the time reviews waited for
+admission and the time spent in each stage, plus per operation call and throttle counts.
+
+Usage:
+    python benchmarks/pipeline_benchmark.py --reviews 5 --review-type Deep
+    python benchmarks/pipeline_benchmark.py --reviews 20 --arrival-rate 30 --review-type Quick --throttle-rate 0.05
+    python benchmarks/pipeline_benchmark.py --reviews 3 --map-concurrency 3 --map-wait-seconds 0 --latency-config latencies.json
+    python benchmarks/pipeline_benchmark.py --reviews 2 --arrival-rate 1 --same-document
+    python benchmarks/pipeline_benchmark.py --reviews 3 --arrival-rate 1 --update-reviews
+    python benchmarks/pipeline_benchmark.py --reviews 1 --additional-lenses "Financial Services Industry Lens"
+"""
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import random
+import argparse
+import importlib
+import threading
+import collections
+
+from concurrent.futures import ThreadPoolExecutor
+
+import service_fakes
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+LAMBDA_DIR = os.path.join(ROOT_DIR, 'lambda_dir')
+LAYER_DIR = os.path.join(LAMBDA_DIR, 'layers', 'wafr_common', 'python')
+PROMPTS_FILE = os.path.join(ROOT_DIR, 'wafr-prompts', 'wafr-prompts.json')
+
+# (code directory, handler module) of every function the review runs through
+PIPELINE_MODULES = [
+    ('start_wafr_review', 'start_wafr_review'),
+    ('prepare_wafr_review', 'prepare_wafr_review'),
+    ('extract_document_text', 'extract_document_text'),
+    ('generate_solution_summary', 'generate_solution_summary'),
+    ('generate_prompts_for_six_pillars', 'generate_prompts_for_six_pillars'),
+    ('generate_pillar_question_response', 'generate_pillar_question_response'),
+    ('update_review_status', 'update_review_status'),
+    ('generate_review_report', 'generate_review_report'),
+]
+
+RUNS_TABLE = 'wafr-accelerator-runs'
+PROMPTS_TABLE = 'wafr-prompts'
+FINDINGS_TABLE = 'wafr-accelerator-findings'
+LEASES_TABLE = 'wafr-admission-leases'
+RESPONSE_CACHE_TABLE = 'wafr-response-cache'
+QUEUE_NAME = 'wafr-accelerator-queue'
+DEAD_LETTER_QUEUE_URL = 'https://sqs.local/000000000000/wafr-accelerator-dead-letter-queue'
+REVIEW_STATE_MACHINE_ARN = 'arn:aws:states:us-east-1:000000000000:stateMachine:WAFRReviewStateMachine'
+# Retry of QuestionsFailed on the Map's pillar task (stack)
+PILLAR_RETRY_ATTEMPTS = 2
+PILLAR_RETRY_SECONDS = 60
+PILLAR_RETRY_BACKOFF = 2
+
+TABLE_KEYS = {
+    RUNS_TABLE: ('analysis_id', 'analysis_submitter'),
+    PROMPTS_TABLE: ('wafr_lens', 'wafr_pillar'),
+    FINDINGS_TABLE: ('analysis_id', 'question_id'),
+    LEASES_TABLE: ('lease_id',),
+    RESPONSE_CACHE_TABLE: ('cache_key',)
+}
+
+# Same values as the stack sets on the functions, with the resources pointing at the fakes
+ENVIRONMENT = {
+    'REGION': 'us-east-1', 'REGION_NAME': 'us-east-1', 'AWS_DEFAULT_REGION': 'us-east-1',
+    'WAFR_ACCELERATOR_RUNS_DD_TABLE_NAME': RUNS_TABLE, 'WAFR_RUNS_TABLE': RUNS_TABLE, 'DD_TABLE_NAME': RUNS_TABLE,
+    'WAFR_PROMPT_DD_TABLE_NAME': PROMPTS_TABLE, 'WAFR_FINDINGS_DD_TABLE_NAME': FINDINGS_TABLE,
+    'ADMISSION_LEASES_DD_TABLE_NAME': LEASES_TABLE,
+    'RESPONSE_CACHE_TABLE': RESPONSE_CACHE_TABLE, 'RESPONSE_CACHE_BUCKET': 'wafr-upload-bucket',
+    'UPLOAD_BUCKET_NAME': 'wafr-upload-bucket', 'WAFR_REFERENCE_DOCS_BUCKET': 'wafr-reference-docs-bucket',
+    'KNOWLEDGE_BASE_ID': 'LOCALKB0001', 'GUARDRAIL_ID': 'local-guardrail',
+    'LLM_MODEL_ID': 'anthropic.claude-3-5-sonnet-20240620-v1:0',
+    'START_WAFR_REVIEW_STATEMACHINE_ARN': REVIEW_STATE_MACHINE_ARN,
+    'WAFR_ACCELERATOR_QUEUE_URL': f"https://sqs.local/000000000000/{QUEUE_NAME}",
+    'DEAD_LETTER_QUEUE_URL': DEAD_LETTER_QUEUE_URL,
+    'BEDROCK_SLEEP_DURATION': '60', 'BEDROCK_MAX_TRIES': '5',
+    # Handlers log at ERROR only and emit no metrics, so the benchmark measures the pipeline and not its logging
+    'METRICS_SINK': 'off', 'LOG_LEVEL': 'ERROR'
+}
+
+PILLAR_IDS = {
+    'Operational Excellence': 'operationalExcellence',
+    'Security': 'security',
+    'Reliability': 'reliability',
+    'Performance Efficiency': 'performance',
+    'Cost Optimization': 'costOptimization',
+    'Sustainability': 'sustainability'
+}
+
+def load_prompts():
+    with open(PROMPTS_FILE, encoding='utf-8') as prompts_file:
+        return json.load(prompts_file)['data']
+
+def build_lenses(prompts, questions_per_pillar):
+    """Well-Architected lenses for the fakes, with the questions of the prompts file so answers map back to them."""
+
+    lenses = collections.defaultdict(list)
+    for item in prompts:
+        questions = []
+        for line in item['wafr_pillar_prompt'].splitlines()[2:]:
+            question_id, question_text = line.strip().split(': ', 1)
+            questions.append((re.sub(r'\W+', '-', question_id.lower()), question_text))
+        lenses[item['wafr_lens_alias']].append((PILLAR_IDS[item['wafr_pillar']], item['wafr_pillar'], questions[:questions_per_pillar or None]))
+
+    return dict(lenses)
+
+def load_handler(code_dir, module_name, clock=None):
+    """
+    Imports a handler module from its own code directory, as Lambda does. Given a clock, the module and the other
+    modules of its directory sleep and read time from it.
+    """
+
+    if LAYER_DIR not in sys.path:
+        sys.path.append(LAYER_DIR)
+
+    directory = os.path.join(LAMBDA_DIR, code_dir)
+    local_modules = [name[:-3] for name in os.listdir(directory) if name.endswith('.py')]
+
+    sys.path.insert(0, directory)
+    try:
+        handler_module = importlib.import_module(module_name)
+    finally:
+        sys.path.remove(directory)
+        # Drop the function's own modules so the next function does not pick them up
+        loaded = [sys.modules.pop(name) for name in local_modules if name in sys.modules]
+
+    if clock:
+        for module in loaded:
+            use_clock(module, clock)
+
+    return handler_module
+
+def load_handlers(clock):
+
+    # Handlers import this on first use; imported here so no invocation counts the import as modelled time
+    importlib.import_module('boto3.dynamodb.conditions')
+
+    handlers = {module_name: load_handler(code_dir, module_name, clock) for code_dir, module_name in PIPELINE_MODULES}
+
+    for module_name in ('admission_leases', 'aws_clients', 'cassettes', 'document_summary', 'emf_metrics', 'progress', 'reference_data_cache', 'response_cache', 'review_report', 'structured_logging'):
+        use_clock(sys.modules[module_name], clock)
+
+    return handlers
+
+def use_clock(module, clock):
+    if getattr(module, 'time', None) is time:
+        module.time = clock
+
+def percentile(values, share):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(share * len(ordered))) - 1))]
+
+class PipelineBenchmark:
+
+    def __init__(self, args):
+        self.args = args
+
+        latency_overrides = {}
+        if args.latency_config:
+            with open(args.latency_config, encoding='utf-8') as latency_file:
+                latency_overrides = json.load(latency_file)
+        for name in ('bedrock_first_token', 'kb_retrieve'):
+            latency_overrides.setdefault(name, {}).setdefault('throttle_rate', args.throttle_rate)
+
+        self.prompts = load_prompts()
+        self.services = service_fakes.ServiceFakes(
+            time_scale=args.time_scale,
+            latency_overrides=latency_overrides,
+            lenses=build_lenses(self.prompts, args.questions_per_pillar),
+            table_keys=TABLE_KEYS,
+            queue_name=QUEUE_NAME,
+            bedrock_rpm_limit=args.bedrock_rpm,
+            bedrock_tpm_limit=args.bedrock_tpm,
+            on_start_execution=self.start_execution,
+            seed=args.seed
+        )
+        self.clock = self.services.clock
+        self.queue = self.services['sqs']
+
+        self.handlers = load_handlers(self.clock)
+        service_fakes.install(self.services)
+
+        self.reviews = {}
+        self.stage_seconds = collections.defaultdict(list)
+        self.lock = threading.Lock()
+        self.all_finished = threading.Event()
+        self.random = random.Random(args.seed)
+
+    def seed_reference_data(self):
+
+        prompts_table = self.services.table(PROMPTS_TABLE)
+        for item in self.prompts:
+            prompts_table.put_item(Item=item)
+        prompts_table.put_item(Item={'wafr_lens': '__meta__', 'wafr_pillar': 'content_version', 'content_version': 'benchmark'})
+
+    def document_text(self, index):
+
+        if self.args.documents_dir:
+            names = sorted(name for name in os.listdir(self.args.documents_dir) if name.endswith(('.txt', '.md')))
+            with open(os.path.join(self.args.documents_dir, names[0 if self.args.same_document else index % len(names)]), encoding='utf-8') as document_file:
+                return document_file.read()
+
+        # About 50 lines of 80 characters per page under a numbered heading, like a dense architecture document
+        same_document = self.args.same_document or self.args.update_reviews
+        lines = service_fakes.filler_text(self.args.document_pages * 1000, line_chars=80, offset=0 if same_document else index).split("\n")
+        pages = [lines[start:start + 50] for start in range(0, len(lines), 50)]
+
+        # Each update revises one more page of the document the first review saw
+        if self.args.update_reviews:
+            for revision in range(1, index + 1):
+                page = (revision * 7) % len(pages)
+                pages[page] = service_fakes.filler_text(len("\n".join(pages[page])) // 4, line_chars=80, offset=revision * 13).split("\n")
+
+        return "\n".join(f"{number} Design Section {number}\n" + "\n".join(page) for number, page in enumerate(pages, 1))
+
+    def submit_reviews(self):
+        """Submits reviews the way the New WAFR Review page does: upload, queue message, then the run item."""
+
+        lens_aliases = {item['wafr_lens']: item['wafr_lens_alias'] for item in self.prompts}
+        submitter = 'benchmark-user'
+
+        previous_analysis_id = ''
+
+        for index in range(self.args.reviews):
+            if index and self.args.arrival_rate:
+                self.clock.sleep(self.random.expovariate(self.args.arrival_rate / 3600))
+
+            analysis_id = str(uuid.uuid4())
+            document_s3_key = f"{submitter}/analyses/{analysis_id}/architecture-{index}.txt"
+            self.services.s3_put(ENVIRONMENT['UPLOAD_BUCKET_NAME'], document_s3_key, self.document_text(index))
+
+            review_input = {
+                'analysis_id': analysis_id,
+                'analysis_name': f"benchmark-workload-{index}",
+                'wafr_lens': self.args.lens,
+                'analysis_submitter': submitter,
+                'selected_pillars': self.args.pillars,
+                'document_s3_key': document_s3_key,
+                'review_owner': submitter,
+                'analysis_owner': submitter,
+                'lenses': lens_aliases[self.args.lens],
+                'additional_lenses': {lens: lens_aliases[lens] for lens in self.args.additional_lenses},
+                'environment': 'PRODUCTION',
+                'workload_desc': 'Benchmark workload',
+                'industry_type': 'InfoTech',
+                'analysis_review_type': self.args.review_type
+            }
+
+            if self.args.update_reviews and previous_analysis_id:
+                review_input['previous_analysis_id'] = previous_analysis_id
+            previous_analysis_id = analysis_id
+
+            with self.lock:
+                self.reviews[analysis_id] = {'review_type': self.args.review_type, 'submitted_at': self.clock.now(), 'status': 'Submitted'}
+
+            self.queue.send_message(QueueUrl=self.queue.queue_url, MessageBody=json.dumps(review_input))
+            self.services.table(RUNS_TABLE).put_item(Item={
+                'analysis_id': analysis_id,
+                'analysis_submitter': submitter,
+                'analysis_title': review_input['analysis_name'],
+                'selected_lens': self.args.lens,
+                'creation_date': '2024-01-01 00-00-00',
+                'review_status': 'Submitted',
+                'selected_wafr_pillars': self.args.pillars,
+                'document_s3_key': document_s3_key,
+                'analysis_owner': submitter,
+                'lenses': review_input['lenses'],
+                'additional_lenses': review_input['additional_lenses'],
+                'environment': review_input['environment'],
+                'workload_desc': review_input['workload_desc'],
+                'review_owner': submitter,
+                'industry_type': review_input['industry_type'],
+                'analysis_review_type': self.args.review_type
+            })
+
+    def invoke(self, stage, module_name, event, output_path='body'):
+        """Invokes a handler like a Step Functions LambdaInvoke task with output_path $.Payload.body or $.Payload."""
+
+        start = self.clock.now()
+        try:
+            # Payloads are passed between states as JSON
+            response = self.handlers[module_name].lambda_handler(json.loads(json.dumps(event)), None)
+        finally:
+            self.record_stage(stage, self.clock.now() - start)
+
+        if output_path != 'body':
+            return response
+
+        # prepare_wafr_review and extract_document_text return their body JSON encoded
+        return json.loads(response['body']) if isinstance(response['body'], str) else response['body']
+
+    def record_stage(self, stage, seconds):
+        with self.lock:
+            self.stage_seconds[stage].append(seconds)
+
+    def consume_queue(self):
+        """One concurrent invocation of the SQS event source mapping."""
+
+        while not self.all_finished.is_set():
+            records = self.queue.receive_records(self.args.batch_size)
+            if not records:
+                # Long polling: an empty receive waits before trying again
+                self.clock.sleep(self.args.poll_seconds)
+                continue
+
+            start = self.clock.now()
+            quick_ids = [json.loads(record['body'])['analysis_id'] for record in records
+                         if self.reviews.get(json.loads(record['body'])['analysis_id'], {}).get('review_type') == 'Quick']
+            try:
+                response = self.handlers['start_wafr_review'].lambda_handler({'Records': records}, None)
+                failed = {failure['itemIdentifier'] for failure in response.get('batchItemFailures', [])}
+            except Exception:
+                # A failed invocation returns the whole batch to the queue
+                failed = {record['messageId'] for record in records}
+            end = self.clock.now()
+
+            for record in records:
+                if record['messageId'] not in failed:
+                    self.queue.delete(record['receiptHandle'])
+
+            finished_quick = [record for record in records if record['messageId'] not in failed and json.loads(record['body'])['analysis_id'] in quick_ids]
+            self.record_stage('quick_review' if finished_quick else 'admission', end - start)
+
+            for record in finished_quick:
+                analysis_id = json.loads(record['body'])['analysis_id']
+                self.admit_review(analysis_id, start)
+                self.finish_review(analysis_id, self.review_status(analysis_id))
+
+            # Given up on after too many failed attempts
+            for body in self.queue.sent_elsewhere[DEAD_LETTER_QUEUE_URL][:]:
+                analysis_id = json.loads(body)['analysis_id']
+                if 'finished_at' not in self.reviews.get(analysis_id, {'finished_at': None}):
+                    self.finish_review(analysis_id, 'Dead-lettered')
+
+    def review_status(self, analysis_id):
+        item = self.services.table(RUNS_TABLE).items.get((analysis_id, 'benchmark-user'), {})
+        return item.get('review_status', 'Unknown')
+
+    def admit_review(self, analysis_id, admitted_at):
+        with self.lock:
+            self.reviews[analysis_id].setdefault('admitted_at', admitted_at)
+
+    def finish_review(self, analysis_id, status):
+        with self.lock:
+            review = self.reviews[analysis_id]
+            review['status'] = status
+            review['finished_at'] = self.clock.now()
+            if len(self.reviews) == self.args.reviews and all('finished_at' in review for review in self.reviews.values()):
+                self.all_finished.set()
+
+    def start_execution(self, execution_arn, state_machine_arn, execution_input):
+        analysis_id = json.loads(json.loads(execution_input)[0]['body'])['analysis_id']
+        self.admit_review(analysis_id, self.clock.now())
+        threading.Thread(target=self.run_execution, args=(execution_arn, analysis_id, execution_input), daemon=True).start()
+
+    def run_execution(self, execution_arn, analysis_id, execution_input):
+        """The Deep review state machine with on-demand inference: the stages in order, then the Map over pillars."""
+
+        execution_status, review_status = 'FAILED', 'Errored'
+        try:
+            payload = self.invoke('prepare_review', 'prepare_wafr_review', json.loads(execution_input))
+            payload = self.invoke('extract_document_text', 'extract_document_text', payload)
+            payload = self.invoke('generate_solution_summary', 'generate_solution_summary', payload)
+            payload = self.invoke('generate_prompts', 'generate_prompts_for_six_pillars', payload)
+
+            with ThreadPoolExecutor(max_workers=self.args.map_concurrency) as executor:
+                pillar_results = list(executor.map(self.answer_pillar, payload['all_pillar_prompts']))
+
+            response = self.invoke('update_review_status', 'update_review_status', pillar_results, output_path='Payload')
+            response = self.invoke('generate_report', 'generate_review_report', response, output_path='Payload')
+            execution_status = 'SUCCEEDED'
+            review_status = 'Completed' if response['body'] == 'Success' else 'Errored'
+        except Exception as error:
+            with self.lock:
+                self.reviews[analysis_id]['error'] = str(error)[:300]
+        finally:
+            self.services['stepfunctions'].finish(execution_arn, execution_status)
+            self.finish_review(analysis_id, review_status)
+
+    def answer_pillar(self, pillar_prompts):
+        start = self.clock.now()
+        self.clock.sleep(self.args.map_wait_seconds)
+        self.record_stage('map_wait', self.clock.now() - start)
+
+        # Retry and Catch of QuestionsFailed on the pillar task (stack)
+        questions_failed = self.handlers['generate_pillar_question_response'].QuestionsFailed
+        for attempt in range(PILLAR_RETRY_ATTEMPTS + 1):
+            try:
+                return self.invoke('answer_questions', 'generate_pillar_question_response', pillar_prompts)
+            except questions_failed as error:
+                if attempt == PILLAR_RETRY_ATTEMPTS:
+                    return dict(pillar_prompts, question_failure={'Error': 'QuestionsFailed', 'Cause': str(error)})
+                self.clock.sleep(PILLAR_RETRY_SECONDS * PILLAR_RETRY_BACKOFF ** attempt)
+
+    def run(self):
+
+        self.seed_reference_data()
+
+        consumers = [threading.Thread(target=self.consume_queue, daemon=True) for _ in range(self.args.consumers)]
+        for consumer in consumers:
+            consumer.start()
+
+        self.submit_reviews()
+
+        if not self.all_finished.wait(timeout=self.args.max_hours * 3600 * self.args.time_scale):
+            print(f"Stopped after {self.args.max_hours} modelled hours with reviews still running", file=sys.stderr)
+        self.all_finished.set()
+
+        return self.report()
+
+    def report(self):
+
+        with self.lock:
+            reviews = list(self.reviews.values())
+            stage_seconds = {stage: list(seconds) for stage, seconds in self.stage_seconds.items()}
+
+        finished = [review for review in reviews if 'finished_at' in review]
+        completed = [review for review in finished if review['status'] == 'Completed']
+        latencies = [review['finished_at'] - review['submitted_at'] for review in completed]
+        admission_waits = [review['admitted_at'] - review['submitted_at'] for review in reviews if 'admitted_at' in review]
+
+        elapsed = max((review['finished_at'] for review in finished), default=0) - min((review['submitted_at'] for review in reviews), default=0)
+
+        return {
+            'review_type': self.args.review_type,
+            'reviews': len(reviews),
+            'completed': len(completed),
+            'errored': len(finished) - len(completed),
+            'unfinished': len(reviews) - len(finished),
+            'errors': [review['error'] for review in reviews if 'error' in review],
+            'modelled_hours': elapsed / 3600,
+            'reviews_per_hour': len(completed) / (elapsed / 3600) if elapsed else 0.0,
+            'review_latency_seconds': {'p50': percentile(latencies, 0.5), 'p95': percentile(latencies, 0.95)},
+            'admission_wait_seconds': {'p50': percentile(admission_waits, 0.5), 'p95': percentile(admission_waits, 0.95)},
+            'stages': {stage: {
+                'count': len(seconds),
+                'p50_seconds': percentile(seconds, 0.5),
+                'p95_seconds': percentile(seconds, 0.95),
+                'mean_seconds': sum(seconds) / len(seconds)
+            } for stage, seconds in stage_seconds.items()},
+            'operations': {name: dict(stats) for name, stats in sorted(self.services.latency.stats.items())}
+        }
+
+def print_report(report):
+
+    print(f"{report['review_type']} reviews: {report['completed']} completed, {report['errored']} errored, "
+          f"{report['unfinished']} unfinished of {report['reviews']} in {report['modelled_hours']:.2f} modelled hours")
+    for error in report['errors']:
+        print(f"  error: {error}")
+    print(f"reviews per hour: {report['reviews_per_hour']:.2f}")
+    print(f"review latency:   p50 {report['review_latency_seconds']['p50'] / 60:.1f} min, p95 {report['review_latency_seconds']['p95'] / 60:.1f} min")
+    print(f"admission wait:   p50 {report['admission_wait_seconds']['p50'] / 60:.1f} min, p95 {report['admission_wait_seconds']['p95'] / 60:.1f} min")
+
+    print(f"\n{'stage':<28}{'count':>8}{'p50 s':>10}{'p95 s':>10}{'mean s':>10}")
+    for stage, stats in report['stages'].items():
+        print(f"{stage:<28}{stats['count']:>8}{stats['p50_seconds']:>10.1f}{stats['p95_seconds']:>10.1f}{stats['mean_seconds']:>10.1f}")
+
+    print(f"\n{'operation':<36}{'calls':>8}{'throttled':>11}{'total s':>10}")
+    for name, stats in report['operations'].items():
+        print(f"{name:<36}{stats['calls']:>8}{stats['throttled']:>11}{stats['seconds']:>10.1f}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--reviews', type=int, default=3)
+    parser.add_argument('--review-type', choices=['Deep', 'Quick'], default='Deep')
+    parser.add_argument('--arrival-rate', type=float, default=0, help='reviews submitted per modelled hour (Poisson), 0 submits all at once')
+    parser.add_argument('--lens', default='AWS Well-Architected Framework')
+    parser.add_argument('--additional-lenses', nargs='*', default=[], metavar='LENS', help='further lenses reviewed in the same analysis')
+    parser.add_argument('--pillars', nargs='+', default=list(PILLAR_IDS), metavar='PILLAR')
+    parser.add_argument('--questions-per-pillar', type=int, default=0, help='limit the questions of each pillar, 0 for all')
+    parser.add_argument('--document-pages', type=int, default=10, help='size of the generated design documents')
+    parser.add_argument('--documents-dir', help='use the .txt/.md files in this directory as design documents instead')
+    parser.add_argument('--same-document', action='store_true', help='review the same document every time, so later reviews are re-runs of an unchanged document')
+    parser.add_argument('--update-reviews', action='store_true', help='submit each review as an update of the one before, of the same document with one more page revised')
+    parser.add_argument('--no-response-cache', action='store_true', help='run without the model response cache')
+    parser.add_argument('--consumers', type=int, default=5, help='concurrent start_wafr_review invocations (the event source maximum concurrency)')
+    parser.add_argument('--batch-size', type=int, default=10, help='SQS messages per start_wafr_review invocation')
+    parser.add_argument('--poll-seconds', type=float, default=20, help='modelled wait after an empty receive')
+    parser.add_argument('--map-concurrency', type=int, default=1, help='max_concurrency of the Map over pillars')
+    parser.add_argument('--map-wait-seconds', type=float, default=40, help='Wait state before each pillar')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='share of Bedrock and knowledge base calls throttled at random')
+    parser.add_argument('--bedrock-rpm', type=int, default=200, help='Bedrock requests per minute quota of the fake')
+    parser.add_argument('--bedrock-tpm', type=int, default=200000, help='Bedrock tokens per minute quota of the fake')
+    parser.add_argument('--latency-config', help='JSON file of {operation: {"median": s, "p95": s, "throttle_rate": share}} overrides')
+    parser.add_argument('--time-scale', type=float, default=0.01, help='real seconds per modelled second')
+    parser.add_argument('--max-hours', type=float, default=24, help='stop after this many modelled hours')
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args()
+
+    os.environ.update(ENVIRONMENT)
+    if args.no_response_cache:
+        os.environ['RESPONSE_CACHE_TABLE'] = ''
+
+    report = PipelineBenchmark(args).run()
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+if __name__ == '__main__':
+    main()
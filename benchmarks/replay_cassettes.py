@@ -0,0 +1,261 @@
+"""
+Replays recorded review invocations offline.
+
+With RECORD_CASSETTES set to true on the review functions, every invocation writes a cassette (see the cassettes
+module of the wafr_common layer) with its event, its result and each AWS call it made. This runs the same handlers
+from lambda_dir against those cassettes: every AWS call made through aws_clients is answered from the cassette, in
+order per operation, instead of being sent. Nothing is sent to AWS and no Bedrock tokens are spent, so parsing,
+prompt building and persistence can be profiled on real documents and real model outputs.
+
+--timing full runs at full speed, --timing original waits for each call as long as it took when recorded (and
+streams model responses at their recorded pace). The report shows, per invocation, the recorded and replayed
+duration, the number of calls replayed and whether the handler returned the recorded result. Bedrock requests
+that differ from the recorded ones are counted, which shows where prompt building has changed since the recording.
+
+Usage:
+    python benchmarks/replay_cassettes.py --bucket <upload bucket> --analysis-id <id> --download-dir cassettes/
+    python benchmarks/replay_cassettes.py --cassette-dir cassettes/<analysis id> --profile
+    python benchmarks/replay_cassettes.py --cassette-dir cassettes/<analysis id> --handler generate_pillar_question_response --repeat 5
+"""
+import io
+import os
+import sys
+import json
+import time
+import pstats
+import argparse
+import cProfile
+import threading
+import statistics
+import collections
+
+from cold_start_benchmark import LAMBDA_MODULES
+from pipeline_benchmark import LAYER_DIR, load_handler
+
+# Applied on top of the recorded environment of each function
+REPLAY_ENVIRONMENT = {
+    'RECORD_CASSETTES': 'false', 'METRICS_SINK': 'off', 'LOG_LEVEL': 'ERROR',
+    'AWS_ACCESS_KEY_ID': 'replay', 'AWS_SECRET_ACCESS_KEY': 'replay', 'AWS_DEFAULT_REGION': 'us-east-1'
+}
+
+# The layer modules read their environment when imported
+os.environ.update(REPLAY_ENVIRONMENT)
+sys.path.append(LAYER_DIR)
+import cassettes
+
+# Requests compared with the recorded ones; other services carry timestamps and generated ids that always differ
+COMPARED_SERVICES = ('bedrock-runtime', 'bedrock-agent-runtime')
+
+# Module level, so the clients created once (and kept, like in a warm container) answer from the current cassette
+current_player = {'player': None}
+
+class CassettePlayer:
+    """Answers the AWS calls of one invocation from its cassette, in recorded order per service and operation."""
+
+    def __init__(self, cassette, original_timing):
+        self.original_timing = original_timing
+        self.calls = collections.defaultdict(collections.deque)
+        for call in cassette['calls']:
+            self.calls[(call['service'], call['operation'])].append(call)
+
+        self.replayed = 0
+        self.missing = collections.Counter()
+        self.differing = collections.Counter()
+        self.lock = threading.Lock()
+
+    def remember_params(self, params, context, **kwargs):
+        context['cassette_params'] = cassettes.encode(params)
+
+    def respond(self, model, context, **kwargs):
+
+        from botocore.awsrequest import AWSResponse
+        from botocore.response import StreamingBody
+
+        key = (model.service_model.service_name, model.name)
+
+        with self.lock:
+            if not self.calls[key]:
+                self.missing[key] = self.missing[key] + 1
+                raise ReplayError(f"Cassette has no more {key[0]} {key[1]} calls")
+            call = self.calls[key].popleft()
+            self.replayed = self.replayed + 1
+            if key[0] in COMPARED_SERVICES and context.get('cassette_params') != call['params']:
+                self.differing[key] = self.differing[key] + 1
+
+        if self.original_timing:
+            time.sleep(call['duration'])
+
+        if call.get('error'):
+            raise ReplayError(f"Recorded error: {call['error']}")
+
+        parsed = cassettes.decode(call['response'])
+        for name, data in call.get('streaming_bodies', {}).items():
+            body = cassettes.decode({'__cassette_type__': 'bytes', 'value': data})
+            parsed[name] = StreamingBody(io.BytesIO(body), len(body))
+        for name, events in call.get('event_streams', {}).items():
+            parsed[name] = replay_events(events, call['started_at'] + call['duration'], self.original_timing)
+
+        return AWSResponse(url='', status_code=call['status_code'], headers={}, raw=None), parsed
+
+    def unused_calls(self):
+        return sum(len(calls) for calls in self.calls.values())
+
+class ReplayError(Exception):
+    pass
+
+def replay_events(events, response_offset, original_timing):
+
+    previous_offset = response_offset
+    for event in events:
+        if original_timing:
+            time.sleep(max(0.0, event['offset'] - previous_offset))
+        previous_offset = event['offset']
+        yield cassettes.decode(event['event'])
+
+def remember_params(**kwargs):
+    current_player['player'].remember_params(**kwargs)
+
+def respond(**kwargs):
+    return current_player['player'].respond(**kwargs)
+
+def install_player():
+    """Makes aws_clients create real boto3 clients whose calls are answered by the current player and never sent."""
+
+    import aws_clients
+
+    create = aws_clients.create
+
+    def create_replay_client(kind, service_name, region_name, config_options):
+        aws_object = create(kind, service_name, region_name or os.environ['AWS_DEFAULT_REGION'], config_options)
+        client = aws_object.meta.client if kind == 'resource' else aws_object
+        client.meta.events.register('before-parameter-build', remember_params)
+        client.meta.events.register('before-call', respond)
+        return aws_object
+
+    aws_clients.created_clients.clear()
+    aws_clients.create = create_replay_client
+
+def download_cassettes(bucket, analysis_id, download_dir):
+
+    import boto3
+
+    s3 = boto3.client('s3')
+    paginator = s3.get_paginator('list_objects_v2')
+
+    cassette_files = []
+    for page in paginator.paginate(Bucket=bucket, Prefix=f"cassettes/{analysis_id}/"):
+        for item in page.get('Contents', []):
+            data = s3.get_object(Bucket=bucket, Key=item['Key'])['Body'].read()
+            cassette_files.append((os.path.basename(item['Key']), data))
+            if download_dir:
+                os.makedirs(os.path.join(download_dir, analysis_id), exist_ok=True)
+                with open(os.path.join(download_dir, analysis_id, os.path.basename(item['Key'])), 'wb') as cassette_file:
+                    cassette_file.write(data)
+
+    return cassette_files
+
+def read_cassettes(cassette_dir):
+
+    cassette_files = []
+    for name in sorted(os.listdir(cassette_dir)):
+        if name.endswith('.json.gz'):
+            with open(os.path.join(cassette_dir, name), 'rb') as cassette_file:
+                cassette_files.append((name, cassette_file.read()))
+
+    return cassette_files
+
+def same_result(result, recorded_result):
+    return json.dumps(cassettes.encode(result), sort_keys=True) == json.dumps(recorded_result, sort_keys=True)
+
+def replay(cassette, handler, original_timing, profiler):
+
+    player = CassettePlayer(cassette, original_timing)
+    current_player['player'] = player
+
+    start = time.perf_counter()
+    if profiler:
+        profiler.enable()
+    try:
+        result = handler(cassettes.decode(cassette['event']), None)
+        outcome = 'same result' if same_result(result, cassette['result']) else 'different result'
+    except Exception as error:
+        outcome = 'same error' if cassette['error'] else f"raised {type(error).__name__}: {str(error)[:120]}"
+    finally:
+        if profiler:
+            profiler.disable()
+    seconds = time.perf_counter() - start
+
+    return seconds, player, outcome
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--cassette-dir', help='directory of .json.gz cassettes of one review')
+    parser.add_argument('--bucket', help='bucket the cassettes were recorded to (CASSETTE_BUCKET)')
+    parser.add_argument('--analysis-id', help='review to replay from --bucket')
+    parser.add_argument('--download-dir', help='also keep the cassettes downloaded from --bucket here')
+    parser.add_argument('--handler', action='append', help='only replay invocations of this handler module (repeatable)')
+    parser.add_argument('--timing', choices=['full', 'original'], default='full')
+    parser.add_argument('--repeat', type=int, default=1, help='replay every invocation this many times (later runs are warm)')
+    parser.add_argument('--profile', action='store_true', help='profile the handlers with cProfile')
+    parser.add_argument('--profile-top', type=int, default=30)
+    parser.add_argument('--profile-output', help='write the profile stats to this file (for snakeviz or pstats)')
+    args = parser.parse_args()
+
+    if args.cassette_dir:
+        cassette_files = read_cassettes(args.cassette_dir)
+    elif args.bucket and args.analysis_id:
+        cassette_files = download_cassettes(args.bucket, args.analysis_id, args.download_dir)
+    else:
+        parser.error('give --cassette-dir, or --bucket and --analysis-id')
+
+    recorded = sorted((cassettes.load(data) for name, data in cassette_files), key=lambda cassette: cassette['recorded_at'])
+    if args.handler:
+        recorded = [cassette for cassette in recorded if cassette['handler'].split('.')[0] in args.handler]
+    if not recorded:
+        sys.exit('No cassettes to replay')
+
+    code_dirs = {module_name: code_dir for code_dir, module_name in LAMBDA_MODULES}
+    handler_modules = {}
+    profiler = cProfile.Profile() if args.profile else None
+
+    print(f"{'handler':<56}{'recorded s':>12}{'replay s':>10}{'calls':>8}  outcome")
+    replay_seconds = collections.defaultdict(list)
+
+    for cassette in recorded:
+        module_name, function_name = cassette['handler'].rsplit('.', 1)
+
+        if module_name not in handler_modules:
+            # Modules read their environment when imported, so each one gets its function's recorded environment
+            os.environ.update(cassette['environment'])
+            os.environ.update(REPLAY_ENVIRONMENT)
+            handler_modules[module_name] = load_handler(code_dirs[module_name], module_name)
+            if len(handler_modules) == 1:
+                install_player()
+
+        handler = getattr(handler_modules[module_name], function_name)
+
+        for _ in range(args.repeat):
+            seconds, player, outcome = replay(cassette, handler, args.timing == 'original', profiler)
+            replay_seconds[cassette['handler']].append(seconds)
+
+        notes = []
+        if player.unused_calls():
+            notes.append(f"{player.unused_calls()} recorded calls not made")
+        notes.extend(f"{count} {service} {operation} not recorded" for (service, operation), count in player.missing.items())
+        notes.extend(f"{count} {operation} requests differ" for (service, operation), count in player.differing.items())
+
+        print(f"{cassette['handler'][:55]:<56}{cassette['duration']:>12.2f}{statistics.median(replay_seconds[cassette['handler']][-args.repeat:]):>10.3f}"
+              f"{player.replayed:>8}  {outcome}{'; ' + '; '.join(notes) if notes else ''}")
+
+    print(f"\n{'handler':<56}{'invocations':>12}{'replay s':>10}")
+    for handler_name, seconds in replay_seconds.items():
+        print(f"{handler_name[:55]:<56}{len(seconds):>12}{sum(seconds):>10.3f}")
+
+    if profiler:
+        if args.profile_output:
+            profiler.dump_stats(args.profile_output)
+        print()
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(args.profile_top)
+
+if __name__ == '__main__':
+    main()
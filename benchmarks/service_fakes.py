@@ -0,0 +1,952 @@
+"""
+Local stand-ins for the AWS services the review pipeline calls, so the real Lambda handlers can be run offline.
+
+install(services) makes aws_clients hand out these fakes instead of boto3 clients. Every fake call sleeps for a
+latency drawn from its operation's distribution in LatencyModel, and can be throttled the way the real service
+throttles. All latencies are in modelled seconds; ScaledTime runs them time_scale times faster than real time, so
+a 30 second Bedrock call takes 0.3 seconds at a 0.01 scale.
+
+Only the subset of each API that the handlers use is implemented. DynamoDB update and condition expressions
+support the forms the handlers write (SET with if_not_exists, ADD, REMOVE, attribute_(not_)exists and comparisons).
+"""
+import io
+import re
+import ast
+import json
+import math
+import zlib
+import time
+import random
+import datetime
+import threading
+import itertools
+import collections
+
+from botocore.exceptions import ClientError
+
+# (median, p95) in modelled seconds, or in tokens for the *_tokens entries, plus the share of calls throttled
+DEFAULT_LATENCIES = {
+    'bedrock_first_token': {'median': 1.5, 'p95': 4.0},
+    'bedrock_output_tokens': {'median': 900, 'p95': 1800},
+    'bedrock_embedding': {'median': 0.05, 'p95': 0.15},
+    'kb_retrieve': {'median': 0.4, 'p95': 1.2},
+    'textract_start': {'median': 0.2, 'p95': 0.5},
+    'textract_job': {'median': 8.0, 'p95': 30.0},
+    'textract_get': {'median': 0.15, 'p95': 0.4},
+    'wa_create_workload': {'median': 0.5, 'p95': 1.5},
+    'wa_read': {'median': 0.15, 'p95': 0.5},
+    'wa_update_answer': {'median': 0.25, 'p95': 0.8},
+    'wa_create_milestone': {'median': 0.5, 'p95': 1.5},
+    'dynamodb': {'median': 0.008, 'p95': 0.025},
+    's3': {'median': 0.03, 'p95': 0.1},
+    'sqs': {'median': 0.02, 'p95': 0.06},
+    'stepfunctions': {'median': 0.05, 'p95': 0.15},
+    'cloudwatch': {'median': 0.1, 'p95': 0.3}
+}
+
+# Output speed of the model once the first token has arrived
+BEDROCK_TOKENS_PER_SECOND = 60
+# Characters per token used to size fake prompts and responses
+CHARS_PER_TOKEN = 4
+
+WORDS = ("the workload uses amazon api gateway aws lambda amazon dynamodb and amazon s3 to serve requests from "
+         "customers in two regions with automated deployments monitoring alarms backups encryption at rest and in "
+         "transit least privilege access scaling policies cost allocation tags and runbooks for operational events").split()
+
+class ScaledTime:
+    """
+    Drop-in for the time module. sleep() runs time_scale times faster than real time and time() reports the
+    matching modelled clock, so timeouts, leases and backoffs in the handlers keep their modelled meaning.
+    """
+
+    def __init__(self, time_scale):
+        self.time_scale = time_scale
+        self.wall_start = time.monotonic()
+        self.epoch_start = time.time()
+
+    def now(self):
+        """Modelled seconds since the fakes were created."""
+        return (time.monotonic() - self.wall_start) / self.time_scale
+
+    def time(self):
+        return self.epoch_start + self.now()
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds * self.time_scale)
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+class LatencyModel:
+    """Draws latencies from lognormal distributions given by their median and p95, and keeps per operation counts."""
+
+    def __init__(self, clock, overrides=None, seed=7):
+        self.clock = clock
+        self.distributions = {name: dict(values) for name, values in DEFAULT_LATENCIES.items()}
+        for name, values in (overrides or {}).items():
+            self.distributions.setdefault(name, {'median': 0.0, 'p95': 0.0}).update(values)
+
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = collections.defaultdict(lambda: {'calls': 0, 'throttled': 0, 'seconds': 0.0})
+
+    def sample(self, name):
+
+        distribution = self.distributions[name]
+        median, p95 = distribution['median'], distribution['p95']
+
+        with self.lock:
+            if median <= 0 or p95 <= median:
+                return median
+            # 1.645 standard deviations above the mean of the underlying normal is its 95th percentile
+            return self.random.lognormvariate(math.log(median), math.log(p95 / median) / 1.645)
+
+    def call(self, name, operation_name, extra_seconds=0.0):
+        """Waits for one call of the operation, raising a throttling error for its share of calls."""
+
+        seconds = self.sample(name) + extra_seconds
+
+        with self.lock:
+            throttled = self.random.random() < self.distributions[name].get('throttle_rate', 0.0)
+            self.record(operation_name, seconds, throttled)
+
+        self.clock.sleep(seconds)
+
+        if throttled:
+            raise throttling_error(operation_name)
+
+    def record(self, operation_name, seconds, throttled=False):
+        stats = self.stats[operation_name]
+        stats['calls'] += 1
+        stats['throttled'] += int(throttled)
+        stats['seconds'] += seconds
+
+def throttling_error(operation_name, code='ThrottlingException'):
+    return ClientError({'Error': {'Code': code, 'Message': 'Rate exceeded (local fake)'}}, operation_name)
+
+def filler_text(tokens, line_chars=None, offset=0):
+    """Deterministic architecture flavoured text of roughly the given number of tokens."""
+
+    words = []
+    length = 0
+    for word in itertools.islice(itertools.cycle(WORDS), offset % len(WORDS), None):
+        if length >= tokens * CHARS_PER_TOKEN:
+            break
+        words.append(word)
+        length += len(word) + 1
+
+    if not line_chars:
+        return " ".join(words)
+
+    lines, line = [], []
+    for word in words:
+        line.append(word)
+        if sum(len(part) + 1 for part in line) >= line_chars:
+            lines.append(" ".join(line))
+            line = []
+    if line:
+        lines.append(" ".join(line))
+    return "\n".join(lines)
+
+def request_text(request):
+    parts = [request.get('system', '')]
+    for message in request.get('messages', []):
+        for content in message.get('content', []):
+            parts.append(content.get('text', ''))
+    return "\n".join(parts)
+
+def default_responder(request, output_tokens):
+    """
+    Model response shaped like the real ones: the review XML for question prompts, plain text otherwise.
+    The question and the first answer choices are taken from the prompt, so parsing and submission follow the real path.
+    """
+
+    prompt = request_text(request)
+
+    question_match = re.search(r"Questions:\s*\n\s*(.+)", prompt)
+    if not question_match:
+        return filler_text(output_tokens)
+
+    choice_ids = []
+    choices_match = re.search(r"Choices:\s*\n\s*(\[.*\])", prompt)
+    if choices_match:
+        try:
+            choice_ids = [choice['id'] for choice in ast.literal_eval(choices_match.group(1))][:2]
+        except (ValueError, SyntaxError, KeyError, TypeError):
+            choice_ids = []
+
+    choices = "".join(f"<choice><id>{choice_id}</id></choice>" for choice_id in choice_ids)
+    return (f"<response><question>{question_match.group(1).strip()}</question>"
+            f"<assessment>{filler_text(60)}</assessment>"
+            f"<wafr_answer_choices>{choices}</wafr_answer_choices><risk>Medium</risk>"
+            f"<best_practices_followed>{filler_text(output_tokens // 4)}</best_practices_followed>"
+            f"<recommendations_and_examples>{filler_text(output_tokens // 2, offset=7)}</recommendations_and_examples>"
+            f"<citations>N/A</citations></response>")
+
+class FakeBedrockRuntime:
+    """invoke_model and invoke_model_with_response_stream, limited by the account's requests and tokens per minute."""
+
+    def __init__(self, services):
+        self.services = services
+
+    def start_request(self, modelId, body):
+
+        request = json.loads(body)
+        input_tokens = max(1, len(request_text(request)) // CHARS_PER_TOKEN)
+        output_tokens = max(1, int(self.services.latency.sample('bedrock_output_tokens')))
+
+        self.services.admit_bedrock_request(input_tokens + output_tokens)
+
+        return request, input_tokens, output_tokens, self.services.responder(request, output_tokens)
+
+    def invoke_model(self, modelId, body, **kwargs):
+
+        if 'inputText' in json.loads(body):
+            return self.embedding(json.loads(body))
+
+        request, input_tokens, output_tokens, text = self.start_request(modelId, body)
+
+        self.services.latency.call('bedrock_first_token', 'InvokeModel', output_tokens / BEDROCK_TOKENS_PER_SECOND)
+
+        response = {
+            'content': [{'type': 'text', 'text': text}],
+            'stop_reason': 'end_turn',
+            'usage': {'input_tokens': input_tokens, 'output_tokens': output_tokens}
+        }
+        return {'body': io.BytesIO(json.dumps(response).encode('utf-8')), 'contentType': 'application/json'}
+
+    def invoke_model_with_response_stream(self, modelId, body, **kwargs):
+
+        request, input_tokens, output_tokens, text = self.start_request(modelId, body)
+
+        # The call returns with the response headers; tokens then arrive on the event stream
+        self.services.latency.call('bedrock_first_token', 'InvokeModelWithResponseStream')
+
+        return {'body': self.stream(text, input_tokens, output_tokens), 'contentType': 'application/json'}
+
+    def embedding(self, request):
+        """Titan style text embedding: a normalised hashed bag of words, so texts sharing words are similar."""
+
+        self.services.latency.call('bedrock_embedding', 'InvokeModel')
+
+        vector = [0.0] * request.get('dimensions', 1024)
+        for word in re.findall(r'[a-z0-9]+', request['inputText'].lower()):
+            vector[zlib.crc32(word.encode('utf-8')) % len(vector)] += 1.0
+        norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+
+        response = {'embedding': [value / norm for value in vector], 'inputTextTokenCount': len(request['inputText']) // CHARS_PER_TOKEN}
+        return {'body': io.BytesIO(json.dumps(response).encode('utf-8')), 'contentType': 'application/json'}
+
+    def stream(self, text, input_tokens, output_tokens):
+
+        yield stream_event({'type': 'message_start', 'message': {'usage': {'input_tokens': input_tokens, 'output_tokens': 1}}})
+
+        chunk_chars = 16 * CHARS_PER_TOKEN
+        for start in range(0, len(text), chunk_chars):
+            self.services.clock.sleep(16 / BEDROCK_TOKENS_PER_SECOND)
+            yield stream_event({'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'text_delta', 'text': text[start:start + chunk_chars]}})
+
+        yield stream_event({'type': 'message_delta', 'delta': {'stop_reason': 'end_turn'}, 'usage': {'output_tokens': output_tokens}})
+        yield stream_event({'type': 'message_stop'})
+
+def stream_event(message):
+    return {'chunk': {'bytes': json.dumps(message).encode('utf-8')}}
+
+class FakeBedrockAgentRuntime:
+
+    def __init__(self, services, chunk_tokens=300):
+        self.services = services
+        self.chunk_tokens = chunk_tokens
+
+    def retrieve(self, retrievalQuery, knowledgeBaseId, retrievalConfiguration=None, **kwargs):
+
+        self.services.latency.call('kb_retrieve', 'Retrieve')
+
+        number_of_results = (retrievalConfiguration or {}).get('vectorSearchConfiguration', {}).get('numberOfResults', 5)
+        return {'retrievalResults': [{
+            'content': {'text': filler_text(self.chunk_tokens, offset=index)},
+            'location': {'type': 'S3', 's3Location': {'uri': f"s3://local-reference-docs/chunk-{index}"}},
+            'score': 0.5
+        } for index in range(number_of_results)]}
+
+class FakeTextract:
+    """Asynchronous text detection over text documents; a job stays IN_PROGRESS for its modelled processing time."""
+
+    def __init__(self, services, lines_per_page=50):
+        self.services = services
+        self.lines_per_page = lines_per_page
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def start_document_text_detection(self, DocumentLocation, **kwargs):
+
+        self.services.latency.call('textract_start', 'StartDocumentTextDetection')
+
+        s3_object = DocumentLocation['S3Object']
+        lines = self.services.s3_get(s3_object['Bucket'], s3_object['Name']).decode('utf-8', 'replace').splitlines()
+
+        with self.lock:
+            job_id = f"local-textract-{len(self.jobs):06d}"
+            self.jobs[job_id] = {
+                'lines': lines,
+                'ready_at': self.services.clock.now() + self.services.latency.sample('textract_job')
+            }
+
+        return {'JobId': job_id}
+
+    def get_document_text_detection(self, JobId, NextToken=None, **kwargs):
+
+        self.services.latency.call('textract_get', 'GetDocumentTextDetection')
+
+        job = self.jobs[JobId]
+        if self.services.clock.now() < job['ready_at']:
+            return {'JobStatus': 'IN_PROGRESS', 'Blocks': []}
+
+        page = int(NextToken or 0)
+        page_lines = job['lines'][page * self.lines_per_page:(page + 1) * self.lines_per_page]
+
+        response = {
+            'JobStatus': 'SUCCEEDED',
+            'DocumentMetadata': {'Pages': max(1, math.ceil(len(job['lines']) / self.lines_per_page))},
+            'Blocks': [{'BlockType': 'PAGE'}] + [{'BlockType': 'LINE', 'Text': line} for line in page_lines]
+        }
+        if (page + 1) * self.lines_per_page < len(job['lines']):
+            response['NextToken'] = str(page + 1)
+
+        return response
+
+class FakeWellArchitected:
+    """Workloads, lens reviews and answers for the lenses described in services.lenses."""
+
+    def __init__(self, services, choices_per_question=6):
+        self.services = services
+        self.choices_per_question = choices_per_question
+        self.workloads = {}
+        self.lock = threading.Lock()
+        self.risks = itertools.cycle(['HIGH', 'MEDIUM', 'NONE'])
+
+    def create_workload(self, WorkloadName, Lenses, **kwargs):
+
+        self.services.latency.call('wa_create_workload', 'CreateWorkload')
+
+        with self.lock:
+            workload_id = f"local{len(self.workloads):08d}"
+            self.workloads[workload_id] = {'name': WorkloadName, 'lenses': Lenses, 'answers': {}, 'milestones': 0}
+
+        return {'WorkloadId': workload_id, 'WorkloadArn': f"arn:aws:wellarchitected:local:000000000000:workload/{workload_id}"}
+
+    def get_lens_review(self, WorkloadId, LensAlias, **kwargs):
+
+        self.services.latency.call('wa_read', 'GetLensReview')
+
+        return {'WorkloadId': WorkloadId, 'LensReview': {
+            'LensAlias': LensAlias,
+            'LensName': LensAlias,
+            'UpdatedAt': datetime.datetime.now(datetime.timezone.utc),
+            'PillarReviewSummaries': [{'PillarId': pillar_id, 'PillarName': pillar_name} for pillar_id, pillar_name, questions in self.services.lenses[LensAlias]]
+        }}
+
+    def list_answers(self, WorkloadId, LensAlias, PillarId, MaxResults=50, NextToken=None, **kwargs):
+
+        self.services.latency.call('wa_read', 'ListAnswers')
+
+        questions = next(questions for pillar_id, pillar_name, questions in self.services.lenses[LensAlias] if pillar_id == PillarId)
+        start = int(NextToken or 0)
+
+        response = {'AnswerSummaries': [{'QuestionId': question_id, 'QuestionTitle': title, 'PillarId': PillarId} for question_id, title in questions[start:start + MaxResults]]}
+        if start + MaxResults < len(questions):
+            response['NextToken'] = str(start + MaxResults)
+
+        return response
+
+    def get_answer(self, WorkloadId, LensAlias, QuestionId, **kwargs):
+
+        self.services.latency.call('wa_read', 'GetAnswer')
+
+        return {'WorkloadId': WorkloadId, 'Answer': {'QuestionId': QuestionId, 'Choices': self.choices(QuestionId)}}
+
+    def choices(self, question_id):
+        return [{'ChoiceId': f"{question_id}_choice_{index}", 'Title': f"Choice {index} of {question_id}"} for index in range(self.choices_per_question)]
+
+    def update_answer(self, WorkloadId, LensAlias, QuestionId, SelectedChoices=None, Notes='', IsApplicable=True, **kwargs):
+
+        self.services.latency.call('wa_update_answer', 'UpdateAnswer')
+
+        valid_choices = {choice['ChoiceId'] for choice in self.choices(QuestionId)}
+        if set(SelectedChoices or []) - valid_choices:
+            raise ClientError({'Error': {'Code': 'ValidationException', 'Message': 'Invalid choice ids (local fake)'}}, 'UpdateAnswer')
+
+        with self.lock:
+            risk = next(self.risks) if SelectedChoices else 'UNANSWERED'
+            self.workloads[WorkloadId]['answers'][QuestionId] = {'choices': SelectedChoices, 'notes': Notes, 'risk': risk}
+
+        return {'WorkloadId': WorkloadId, 'LensAlias': LensAlias, 'Answer': {'QuestionId': QuestionId, 'SelectedChoices': SelectedChoices, 'Risk': risk}}
+
+    def create_milestone(self, WorkloadId, MilestoneName, ClientRequestToken=None, **kwargs):
+
+        self.services.latency.call('wa_create_milestone', 'CreateMilestone')
+
+        with self.lock:
+            self.workloads[WorkloadId]['milestones'] += 1
+            return {'WorkloadId': WorkloadId, 'MilestoneNumber': self.workloads[WorkloadId]['milestones']}
+
+class FakeDynamoDBResource:
+
+    def __init__(self, services):
+        self.services = services
+
+    def Table(self, name):
+        return self.services.table(name)
+
+class FakeTable:
+    """In-memory table with the key schema it was created with. Items are deep copied in and out, like a real table."""
+
+    def __init__(self, services, name, key_names):
+        self.services = services
+        self.name = name
+        self.key_names = key_names
+        self.items = {}
+        self.lock = threading.Lock()
+
+    def item_key(self, item):
+        return tuple(item[name] for name in self.key_names)
+
+    def get_item(self, Key, **kwargs):
+
+        self.services.latency.call('dynamodb', 'GetItem')
+
+        with self.lock:
+            item = self.items.get(self.item_key(Key))
+            return {'Item': copy_value(item)} if item is not None else {}
+
+    def put_item(self, Item, ConditionExpression=None, ExpressionAttributeNames=None, ExpressionAttributeValues=None, **kwargs):
+
+        self.services.latency.call('dynamodb', 'PutItem')
+
+        with self.lock:
+            key = self.item_key(Item)
+            if ConditionExpression and not evaluate_condition(self.items.get(key, {}), ConditionExpression, ExpressionAttributeNames or {}, ExpressionAttributeValues or {}):
+                raise ClientError({'Error': {'Code': 'ConditionalCheckFailedException', 'Message': 'The conditional request failed'}}, 'PutItem')
+            self.items[key] = copy_value(Item)
+
+        return {}
+
+    def delete_item(self, Key, ConditionExpression=None, ExpressionAttributeNames=None, ExpressionAttributeValues=None, **kwargs):
+
+        self.services.latency.call('dynamodb', 'DeleteItem')
+
+        with self.lock:
+            key = self.item_key(Key)
+            if ConditionExpression and not evaluate_condition(self.items.get(key, {}), ConditionExpression, ExpressionAttributeNames or {}, ExpressionAttributeValues or {}):
+                raise ClientError({'Error': {'Code': 'ConditionalCheckFailedException', 'Message': 'The conditional request failed'}}, 'DeleteItem')
+            self.items.pop(key, None)
+
+        return {}
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeNames=None, ExpressionAttributeValues=None, ConditionExpression=None, ReturnValues='NONE', **kwargs):
+
+        self.services.latency.call('dynamodb', 'UpdateItem')
+
+        names = ExpressionAttributeNames or {}
+        values = ExpressionAttributeValues or {}
+
+        with self.lock:
+            item = copy_value(self.items.get(self.item_key(Key), dict(Key)))
+            if ConditionExpression and not evaluate_condition(item, ConditionExpression, names, values):
+                raise ClientError({'Error': {'Code': 'ConditionalCheckFailedException', 'Message': 'The conditional request failed'}}, 'UpdateItem')
+            apply_update(item, UpdateExpression, names, values)
+            self.items[self.item_key(Key)] = item
+
+        # All the attributes of the item for UPDATED_NEW as well, which is a superset of what DynamoDB returns
+        return {'Attributes': copy_value(item) if ReturnValues in ('UPDATED_NEW', 'ALL_NEW') else {}}
+
+    def query(self, KeyConditionExpression, FilterExpression=None, ScanIndexForward=True, **kwargs):
+
+        self.services.latency.call('dynamodb', 'Query')
+
+        with self.lock:
+            items = [copy_value(item) for item in self.items.values() if matches_condition(item, KeyConditionExpression)
+                     and (FilterExpression is None or matches_condition(item, FilterExpression))]
+
+        sort_key = self.key_names[-1]
+        items.sort(key=lambda item: str(item.get(sort_key, '')), reverse=not ScanIndexForward)
+
+        return {'Items': items, 'Count': len(items)}
+
+    def scan(self, FilterExpression=None, Select=None, **kwargs):
+
+        self.services.latency.call('dynamodb', 'Scan')
+
+        with self.lock:
+            items = [copy_value(item) for item in self.items.values() if FilterExpression is None or matches_condition(item, FilterExpression)]
+
+        if Select == 'COUNT':
+            return {'Count': len(items)}
+        return {'Items': items, 'Count': len(items)}
+
+    def batch_writer(self, **kwargs):
+        return FakeBatchWriter(self)
+
+class FakeBatchWriter:
+
+    def __init__(self, table):
+        self.table = table
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def put_item(self, Item):
+        self.table.put_item(Item=Item)
+
+    def delete_item(self, Key):
+        self.table.delete_item(Key=Key)
+
+def copy_value(value):
+    return json.loads(json.dumps(value, default=list)) if value is not None else None
+
+def split_clauses(expression):
+    """Splits on commas outside parentheses, e.g. 'a = :a, b = if_not_exists(b, :b)'."""
+
+    clauses, depth, current = [], 0, ''
+    for character in expression:
+        depth += {'(': 1, ')': -1}.get(character, 0)
+        if character == ',' and depth == 0:
+            clauses.append(current.strip())
+            current = ''
+        else:
+            current += character
+    if current.strip():
+        clauses.append(current.strip())
+    return clauses
+
+def resolve_path(path, names):
+    return [names.get(part, part) for part in path.strip().split('.')]
+
+def get_path(item, path):
+    for part in path:
+        if not isinstance(item, dict) or part not in item:
+            return None
+        item = item[part]
+    return item
+
+def set_path(item, path, value):
+    parent = get_path(item, path[:-1]) if len(path) > 1 else item
+    if not isinstance(parent, dict):
+        # Same as DynamoDB, nested attributes can only be set inside an existing map
+        raise ClientError({'Error': {'Code': 'ValidationException', 'Message': 'The document path provided in the update expression is invalid for update'}}, 'UpdateItem')
+    parent[path[-1]] = value
+
+def apply_update(item, expression, names, values):
+
+    for action, body in re.findall(r'(SET|ADD|REMOVE)\s+(.*?)(?=\s+(?:SET|ADD|REMOVE)\s+|$)', expression.strip()):
+        for clause in split_clauses(body):
+            if action == 'SET':
+                path, value_expression = clause.split('=', 1)
+                set_path(item, resolve_path(path, names), evaluate_operand(item, value_expression.strip(), names, values))
+            elif action == 'ADD':
+                path, placeholder = clause.split()
+                path = resolve_path(path, names)
+                current, value = get_path(item, path), values[placeholder]
+                if isinstance(value, (set, list)) and not isinstance(value, str):
+                    set_path(item, path, sorted(set(current or []) | set(value)))
+                else:
+                    set_path(item, path, (current or 0) + value)
+            else:
+                path = resolve_path(clause, names)
+                parent = get_path(item, path[:-1]) if len(path) > 1 else item
+                if isinstance(parent, dict):
+                    parent.pop(path[-1], None)
+
+def evaluate_operand(item, operand, names, values):
+
+    function_match = re.match(r'if_not_exists\((.*),(.*)\)$', operand)
+    if function_match:
+        current = get_path(item, resolve_path(function_match.group(1), names))
+        return current if current is not None else evaluate_operand(item, function_match.group(2).strip(), names, values)
+
+    if operand.startswith(':'):
+        return copy_value(values[operand])
+
+    return get_path(item, resolve_path(operand, names))
+
+def evaluate_condition(item, expression, names, values):
+
+    comparisons = {'=': lambda a, b: a == b, '<>': lambda a, b: a != b, '<': lambda a, b: a < b,
+                   '<=': lambda a, b: a <= b, '>': lambda a, b: a > b, '>=': lambda a, b: a >= b}
+
+    def evaluate_term(term):
+        term = term.strip()
+        function_match = re.match(r'(attribute_exists|attribute_not_exists)\((.*)\)$', term)
+        if function_match:
+            exists = get_path(item, resolve_path(function_match.group(2), names)) is not None
+            return exists if function_match.group(1) == 'attribute_exists' else not exists
+        left, operator, right = re.match(r'(.+?)\s*(<>|<=|>=|=|<|>)\s*(.+)', term).groups()
+        left_value = evaluate_operand(item, left.strip(), names, values)
+        right_value = evaluate_operand(item, right.strip(), names, values)
+        if left_value is None or right_value is None:
+            return operator == '<>' and left_value != right_value
+        return comparisons[operator](left_value, right_value)
+
+    return any(all(evaluate_term(term) for term in re.split(r'\s+AND\s+', alternative)) for alternative in re.split(r'\s+OR\s+', expression))
+
+def matches_condition(item, condition):
+    """Evaluates boto3.dynamodb.conditions Key and Attr conditions against an item."""
+
+    expression = condition.get_expression()
+    operator, operands = expression['operator'], expression['values']
+
+    if operator == 'AND':
+        return all(matches_condition(item, operand) for operand in operands)
+    if operator == 'OR':
+        return any(matches_condition(item, operand) for operand in operands)
+    if operator == 'NOT':
+        return not matches_condition(item, operands[0])
+
+    value = get_path(item, operands[0].name.split('.'))
+    arguments = operands[1:]
+
+    if operator == 'attribute_exists':
+        return value is not None
+    if operator == 'attribute_not_exists':
+        return value is None
+    if value is None:
+        return False
+    if operator == 'begins_with':
+        return str(value).startswith(arguments[0])
+    if operator == 'contains':
+        return arguments[0] in value
+    if operator == 'BETWEEN':
+        return arguments[0] <= value <= arguments[1]
+    if operator == 'IN':
+        return value in arguments[0]
+
+    return {'=': value == arguments[0] if arguments else False, '<>': value != arguments[0], '<': value < arguments[0],
+            '<=': value <= arguments[0], '>': value > arguments[0], '>=': value >= arguments[0]}[operator]
+
+class FakeS3Client:
+
+    def __init__(self, services):
+        self.services = services
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.services.latency.call('s3', 'PutObject')
+        self.services.s3_put(Bucket, Key, Body)
+        return {'ETag': '"local"'}
+
+    def get_object(self, Bucket, Key, **kwargs):
+        self.services.latency.call('s3', 'GetObject')
+        return {'Body': io.BytesIO(self.services.s3_get(Bucket, Key)), 'ETag': '"local"'}
+
+    def copy_object(self, Bucket, Key, CopySource, **kwargs):
+        self.services.latency.call('s3', 'CopyObject')
+        self.services.s3_put(Bucket, Key, self.services.s3_get(CopySource['Bucket'], CopySource['Key']))
+        return {'CopyObjectResult': {'ETag': '"local"'}}
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        self.services.latency.call('s3', 'DeleteObject')
+        self.services.s3_delete(Bucket, Key)
+        return {}
+
+class FakeS3Resource:
+
+    def __init__(self, services):
+        self.services = services
+
+    def Bucket(self, name):
+        return FakeS3Bucket(self.services, name)
+
+    def Object(self, bucket_name, key):
+        return FakeS3Object(self.services, bucket_name, key)
+
+class FakeS3Bucket:
+
+    def __init__(self, services, name):
+        self.services = services
+        self.name = name
+
+    def put_object(self, Key, Body, **kwargs):
+        return FakeS3Client(self.services).put_object(Bucket=self.name, Key=Key, Body=Body)
+
+    def Object(self, key):
+        return FakeS3Object(self.services, self.name, key)
+
+class FakeS3Object:
+
+    def __init__(self, services, bucket_name, key):
+        self.services = services
+        self.bucket_name = bucket_name
+        self.key = key
+
+    def get(self, **kwargs):
+        return FakeS3Client(self.services).get_object(Bucket=self.bucket_name, Key=self.key)
+
+    def put(self, Body, **kwargs):
+        return FakeS3Client(self.services).put_object(Bucket=self.bucket_name, Key=self.key, Body=Body)
+
+    def delete(self, **kwargs):
+        return FakeS3Client(self.services).delete_object(Bucket=self.bucket_name, Key=self.key)
+
+class FakeSQS:
+    """
+    A single standard queue. Messages are received as Lambda SQS event records and stay invisible for the
+    visibility timeout (or the one set with change_message_visibility) until they are deleted. Messages sent to any
+    other queue, e.g. the dead-letter queue, are only kept in sent_elsewhere.
+    """
+
+    def __init__(self, services, queue_name, visibility_timeout=1200):
+        self.services = services
+        self.queue_name = queue_name
+        self.queue_url = f"https://sqs.local/000000000000/{queue_name}"
+        self.visibility_timeout = visibility_timeout
+        self.messages = {}
+        self.sent_elsewhere = collections.defaultdict(list)
+        self.message_ids = itertools.count()
+        self.lock = threading.Lock()
+
+    def get_queue_url(self, QueueName, **kwargs):
+        self.services.latency.call('sqs', 'GetQueueUrl')
+        return {'QueueUrl': self.queue_url}
+
+    def send_message(self, QueueUrl, MessageBody, DelaySeconds=0, **kwargs):
+
+        self.services.latency.call('sqs', 'SendMessage')
+
+        with self.lock:
+            message_id = f"local-message-{next(self.message_ids):08d}"
+            if QueueUrl != self.queue_url:
+                self.sent_elsewhere[QueueUrl].append(MessageBody)
+            else:
+                self.messages[message_id] = {'body': MessageBody, 'visible_at': self.services.clock.now() + DelaySeconds, 'receive_count': 0}
+
+        return {'MessageId': message_id}
+
+    def change_message_visibility(self, QueueUrl, ReceiptHandle, VisibilityTimeout, **kwargs):
+
+        self.services.latency.call('sqs', 'ChangeMessageVisibility')
+
+        with self.lock:
+            if ReceiptHandle in self.messages:
+                self.messages[ReceiptHandle]['visible_at'] = self.services.clock.now() + VisibilityTimeout
+
+        return {}
+
+    def receive_records(self, max_records):
+
+        now = self.services.clock.now()
+        records = []
+
+        with self.lock:
+            for message_id, message in self.messages.items():
+                if len(records) >= max_records:
+                    break
+                if message['visible_at'] > now:
+                    continue
+                message['receive_count'] += 1
+                message['visible_at'] = now + self.visibility_timeout
+                records.append({
+                    'messageId': message_id,
+                    # The message id doubles as the receipt handle
+                    'receiptHandle': message_id,
+                    'body': message['body'],
+                    'attributes': {'ApproximateReceiveCount': str(message['receive_count'])},
+                    'eventSource': 'aws:sqs',
+                    'eventSourceARN': f"arn:aws:sqs:local:000000000000:{self.queue_name}"
+                })
+
+        return records
+
+    def delete(self, receipt_handle):
+        with self.lock:
+            self.messages.pop(receipt_handle, None)
+
+    def pending(self):
+        with self.lock:
+            return len(self.messages)
+
+class FakeStepFunctions:
+    """start_execution hands the input to on_start(execution_arn, state_machine_arn, input); the caller reports the end with finish()."""
+
+    def __init__(self, services, on_start):
+        self.services = services
+        self.on_start = on_start
+        self.executions = {}
+        self.execution_ids = itertools.count()
+        self.lock = threading.Lock()
+
+    def start_execution(self, stateMachineArn, input='{}', name=None, **kwargs):
+
+        self.services.latency.call('stepfunctions', 'StartExecution')
+
+        with self.lock:
+            execution_arn = f"{stateMachineArn.replace(':stateMachine:', ':execution:', 1)}:{name or next(self.execution_ids)}"
+            # Names are unique per state machine; a running execution with the same input is not told apart here
+            if execution_arn in self.executions:
+                raise ClientError({'Error': {'Code': 'ExecutionAlreadyExists', 'Message': f"Execution Already Exists: '{execution_arn}'"}}, 'StartExecution')
+            self.executions[execution_arn] = {'stateMachineArn': stateMachineArn, 'status': 'RUNNING'}
+
+        self.on_start(execution_arn, stateMachineArn, input)
+
+        return {'executionArn': execution_arn, 'startDate': datetime.datetime.now(datetime.timezone.utc)}
+
+    def describe_execution(self, executionArn, **kwargs):
+
+        self.services.latency.call('stepfunctions', 'DescribeExecution')
+
+        with self.lock:
+            if executionArn not in self.executions:
+                raise ClientError({'Error': {'Code': 'ExecutionDoesNotExist', 'Message': f"Execution Does Not Exist: '{executionArn}'"}}, 'DescribeExecution')
+            execution = self.executions[executionArn]
+            return {'executionArn': executionArn, 'stateMachineArn': execution['stateMachineArn'], 'status': execution['status']}
+
+    def finish(self, execution_arn, status):
+        with self.lock:
+            self.executions[execution_arn]['status'] = status
+
+    def get_paginator(self, operation_name):
+        return FakePaginator(self, operation_name)
+
+class FakePaginator:
+
+    def __init__(self, stepfunctions, operation_name):
+        self.stepfunctions = stepfunctions
+        self.operation_name = operation_name
+
+    def paginate(self, stateMachineArn, statusFilter=None, **kwargs):
+
+        self.stepfunctions.services.latency.call('stepfunctions', 'ListExecutions')
+
+        with self.stepfunctions.lock:
+            executions = [{'executionArn': execution_arn, 'stateMachineArn': execution['stateMachineArn'], 'status': execution['status']}
+                          for execution_arn, execution in self.stepfunctions.executions.items()
+                          if execution['stateMachineArn'] == stateMachineArn and (statusFilter is None or execution['status'] == statusFilter)]
+
+        yield {'executions': executions}
+
+class FakeCloudWatch:
+    """get_metric_data for the AWS/Bedrock usage metrics, from the requests the Bedrock fake has served."""
+
+    def __init__(self, services):
+        self.services = services
+
+    def get_metric_data(self, MetricDataQueries, **kwargs):
+
+        self.services.latency.call('cloudwatch', 'GetMetricData')
+
+        per_minute = self.services.bedrock_usage_per_minute(minutes=5)
+
+        results = []
+        for query in MetricDataQueries:
+            metric_name = query['MetricStat']['Metric']['MetricName']
+            if metric_name == 'Invocations':
+                values = [requests for tokens, requests in per_minute]
+            elif metric_name == 'InputTokenCount':
+                values = [tokens for tokens, requests in per_minute]
+            else:
+                # Input and output tokens are charged together when the request is admitted
+                values = [0 for tokens, requests in per_minute]
+            results.append({'Id': query['Id'], 'Values': values})
+
+        return {'MetricDataResults': results}
+
+class ServiceFakes:
+    """
+    Shared state of all the fakes: the modelled clock and latencies, S3 objects, DynamoDB tables and the Bedrock
+    quota. lenses maps a lens alias to [(pillar id, pillar name, [(question id, question title)])].
+    """
+
+    def __init__(self, time_scale=1.0, latency_overrides=None, lenses=None, table_keys=None, queue_name='local-review-queue',
+                 bedrock_rpm_limit=200, bedrock_tpm_limit=200000, responder=default_responder, on_start_execution=None, seed=7):
+
+        self.clock = ScaledTime(time_scale)
+        self.latency = LatencyModel(self.clock, latency_overrides, seed)
+        self.lenses = lenses or {}
+        self.table_keys = table_keys or {}
+        self.responder = responder
+        self.bedrock_rpm_limit = bedrock_rpm_limit
+        self.bedrock_tpm_limit = bedrock_tpm_limit
+
+        self.objects = {}
+        self.tables = {}
+        self.bedrock_requests = collections.deque()
+        self.lock = threading.Lock()
+
+        self.services = {
+            ('client', 'bedrock-runtime'): FakeBedrockRuntime(self),
+            ('client', 'bedrock-agent-runtime'): FakeBedrockAgentRuntime(self),
+            ('client', 'textract'): FakeTextract(self),
+            ('client', 'wellarchitected'): FakeWellArchitected(self),
+            ('client', 's3'): FakeS3Client(self),
+            ('resource', 's3'): FakeS3Resource(self),
+            ('resource', 'dynamodb'): FakeDynamoDBResource(self),
+            ('client', 'sqs'): FakeSQS(self, queue_name),
+            ('client', 'stepfunctions'): FakeStepFunctions(self, on_start_execution or (lambda *args: None)),
+            ('client', 'cloudwatch'): FakeCloudWatch(self)
+        }
+
+    def create(self, kind, service_name):
+        if (kind, service_name) not in self.services:
+            raise NotImplementedError(f"No local fake for the {service_name} {kind}")
+        return self.services[(kind, service_name)]
+
+    def __getitem__(self, service_name):
+        return self.services.get(('client', service_name)) or self.services[('resource', service_name)]
+
+    def table(self, name):
+        with self.lock:
+            if name not in self.tables:
+                self.tables[name] = FakeTable(self, name, self.table_keys.get(name, ('analysis_id', 'analysis_submitter')))
+            return self.tables[name]
+
+    def s3_put(self, bucket, key, body):
+        with self.lock:
+            self.objects[(bucket, key)] = body if isinstance(body, bytes) else body.encode('utf-8')
+
+    def s3_get(self, bucket, key):
+        with self.lock:
+            if (bucket, key) not in self.objects:
+                raise ClientError({'Error': {'Code': 'NoSuchKey', 'Message': key}}, 'GetObject')
+            return self.objects[(bucket, key)]
+
+    def s3_delete(self, bucket, key):
+        with self.lock:
+            self.objects.pop((bucket, key), None)
+
+    def admit_bedrock_request(self, tokens):
+        """Throttles like the Bedrock on-demand quotas: requests and tokens per rolling modelled minute."""
+
+        now = self.clock.now()
+        with self.lock:
+            while self.bedrock_requests and self.bedrock_requests[0][0] <= now - 60:
+                self.bedrock_requests.popleft()
+
+            requests_in_window = len(self.bedrock_requests)
+            tokens_in_window = sum(request_tokens for request_time, request_tokens in self.bedrock_requests)
+
+            if requests_in_window + 1 > self.bedrock_rpm_limit or tokens_in_window + tokens > self.bedrock_tpm_limit:
+                self.latency.record('BedrockQuota', 0.0, throttled=True)
+                raise throttling_error('InvokeModel')
+
+            self.bedrock_requests.append((now, tokens))
+
+    def bedrock_usage_per_minute(self, minutes):
+        now = self.clock.now()
+        with self.lock:
+            buckets = [[0, 0] for _ in range(minutes)]
+            for request_time, tokens in self.bedrock_requests:
+                minute = int((now - request_time) // 60)
+                if minute < minutes:
+                    buckets[minute][0] += tokens
+                    buckets[minute][1] += 1
+        return [tuple(bucket) for bucket in buckets]
+
+def install(services):
+    """Makes every aws_clients client and resource, lazy or not, one of the fakes."""
+
+    import aws_clients
+
+    aws_clients.created_clients.clear()
+    aws_clients.create = lambda kind, service_name, region_name, config_options: services.create(kind, service_name)
@@ -1,30 +1,34 @@
 import os
-import boto3
 import json
 import datetime
 import time
 import logging
 
-from boto3.dynamodb.conditions import Key
-from boto3.dynamodb.conditions import Attr
-
-from botocore.client import Config
 from botocore.exceptions import ClientError
 
-s3 = boto3.resource('s3')
-dynamodb = boto3.resource('dynamodb')
+import aws_clients
+import cassettes
+import emf_metrics
+import structured_logging
+import progress
+
+s3 = aws_clients.lazy_resource('s3')
+dynamodb = aws_clients.lazy_resource('dynamodb')
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+@cassettes.recorded
 def lambda_handler(event, context):
     
     entry_timeestamp = datetime.datetime.now().strftime("%Y-%m-%d %H-%M-%S-%f")
     
+    structured_logging.start_invocation(logger, event)
+    
     logger.info("extract_document_text invoked at " + entry_timeestamp)
 
     output_filename = extract_document_text = ""
-    logger.info(json.dumps(event))
+    logger.info("Event: %s", structured_logging.capped(event))
     
     return_response = data = event
     upload_bucket_name = data['extract_output_bucket']
@@ -35,10 +39,17 @@ def lambda_handler(event, context):
     
     document_s3_key = data['wafr_accelerator_run_items']['document_s3_key']
     
+    progress.set_progress_stage(wafr_accelerator_runs_table, wafr_accelerator_run_key, "extract_document_text")
+    
+    emf_metrics.start_invocation("extract_document_text", wafr_accelerator_run_key['analysis_id'], data['llm_model_id'], data['wafr_accelerator_run_items']['selected_lens'])
+    stage_start = time.time()
+    
     try:
 
         # Extract text from the document
-        extracted_document_text = extract_text(upload_bucket_name, document_s3_key , region)
+        with emf_metrics.timed("textract") as measurement:
+            extracted_document_text = extract_text(upload_bucket_name, document_s3_key , region)
+            measurement.add("DocumentCharacters", len(extracted_document_text))
         
         attribute_updates = {
             'extracted_document': {
@@ -69,7 +80,9 @@ def lambda_handler(event, context):
         handle_error(wafr_accelerator_runs_table, wafr_accelerator_run_key, error)
         raise Exception (f'Exception caught in extract_document_text: {error}')
     
-    logger.info('return_response: ' + json.dumps(return_response))
+    logger.info('return_response: %s', structured_logging.capped(return_response))
+    
+    emf_metrics.put_metric("StageDuration", (time.time() - stage_start) * 1000, "Milliseconds")
     
     exit_timeestamp = datetime.datetime.now().strftime("%Y-%m-%d %H-%M-%S-%f")
     logger.info("Exiting extract_document_text at " + exit_timeestamp)
@@ -94,8 +107,7 @@ def extract_text(upload_bucket_name, document_s3_key, region):
 
     logger.info ("solution_design_text is null and hence using Textract")
     # # Initialize Textract and Bedrock clients
-    textract_config = Config(retries = dict(max_attempts = 5))
-    textract_client = boto3.client('textract', region_name=region, config=textract_config)
+    textract_client = aws_clients.client('textract', region_name=region, retries = dict(max_attempts = 5))
 
     logger.debug ("extract_text checkpoint 1")
     # Start the text detection job
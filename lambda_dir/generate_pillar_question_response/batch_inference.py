@@ -0,0 +1,459 @@
+import os
+import json
+import time
+import datetime
+import logging
+
+from botocore.exceptions import ClientError
+
+import aws_clients
+import cassettes
+import emf_metrics
+import structured_logging
+import review_lenses
+import progress
+import admission_leases
+import generate_pillar_question_response as pillar_response
+
+s3client = aws_clients.lazy_client('s3')
+dynamodb = aws_clients.lazy_resource('dynamodb')
+bedrock_batch_client = aws_clients.lazy_client('bedrock')
+
+BEDROCK_BATCH_ROLE_ARN = os.environ.get('BEDROCK_BATCH_ROLE_ARN', '')
+# Bedrock rejects batch jobs below its per-job record minimum, which is more than the questions of a single review.
+# The reviews queued in batch mode within the same BEDROCK_BATCH_POOL_MINUTES window are therefore pooled into one
+# job; a pool that still has too few records falls back to on-demand inference
+BEDROCK_BATCH_MIN_RECORDS = int(os.environ.get('BEDROCK_BATCH_MIN_RECORDS', '100'))
+BEDROCK_BATCH_POOL_MINUTES = int(os.environ.get('BEDROCK_BATCH_POOL_MINUTES', '60'))
+BEDROCK_BATCH_TIMEOUT_HOURS = int(os.environ.get('BEDROCK_BATCH_TIMEOUT_HOURS', '24'))
+BATCH_POOLS_DD_TABLE_NAME = os.environ.get('BATCH_POOLS_DD_TABLE_NAME', '')
+# A claimed pool that has not been submitted after this long is submitted again by another member; the job is
+# created with the pool id as client request token, so this can not start a second job
+BATCH_POOL_SUBMIT_SECONDS = 900
+BATCH_POOL_PREFIX = 'batch-inference/'
+
+BATCH_JOB_COMPLETED_STATUSES = ['Completed', 'PartiallyCompleted']
+BATCH_JOB_FAILED_STATUSES = ['Failed', 'Stopped', 'Expired']
+# Answered on demand by the Map over pillars instead
+BATCH_JOB_FALLBACK_STATUSES = BATCH_JOB_FAILED_STATUSES + ['Skipped']
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+@cassettes.recorded
+def submit_handler(event, context):
+
+    entry_timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H-%M-%S-%f")
+
+    structured_logging.start_invocation(logger, event)
+
+    logger.info(f"submit_batch_inference_job invoked at {entry_timestamp}")
+
+    data = event
+    wafr_accelerator_runs_table = dynamodb.Table(data['wafr_accelerator_runs_table'])
+    wafr_accelerator_run_key = data['wafr_accelerator_run_key']
+
+    emf_metrics.start_invocation("batch_inference", wafr_accelerator_run_key['analysis_id'], data['llm_model_id'], data['wafr_accelerator_run_items']['selected_lens'])
+
+    try:
+        document_s3_key = data['wafr_accelerator_run_items']['document_s3_key']
+        batch_prefix = document_s3_key[:document_s3_key.rfind('.')] + "-batch-inference"
+
+        question_status = pillar_response.get_question_status(wafr_accelerator_runs_table, wafr_accelerator_run_key)
+
+        records, record_manifest = build_batch_records(data['extract_output_bucket'], data['all_pillar_prompts'], question_status)
+
+        logger.info (f"submit_batch_inference_job: {len(records)} records prepared")
+        emf_metrics.put_metric("BatchRecords", len(records))
+
+        if not records:
+            data['batch_job'] = {'status': 'Skipped'}
+        else:
+            member = write_member_records(data['extract_output_bucket'], batch_prefix, records, record_manifest)
+            data['batch_job'] = join_batch_pool(wafr_accelerator_run_key['analysis_id'], data['extract_output_bucket'], member, data['llm_model_id'])
+            progress.set_progress_stage(wafr_accelerator_runs_table, wafr_accelerator_run_key, "batch_inference")
+            # A review waiting for its batch job uses no on-demand quota, so it gives its admission slot to the next
+            # review; status_handler takes one again if the questions end up being answered on demand
+            released = admission_leases.release_slots(wafr_accelerator_run_key['analysis_id'])
+            if released:
+                data['batch_job']['admission_lease'] = {name: released[0][name] for name in ('holder', 'analysis_id', 'review_type', 'execution_arn') if name in released[0]}
+
+    except Exception as error:
+        pillar_response.handle_error(wafr_accelerator_runs_table, wafr_accelerator_run_key, error)
+        raise Exception (f'Exception caught in submit_batch_inference_job: {error}')
+
+    logger.info(f"batch_job: {json.dumps(data['batch_job'])}")
+
+    return {
+        'statusCode': 200,
+        'body': data
+    }
+
+@cassettes.recorded
+def status_handler(event, context):
+
+    structured_logging.start_invocation(logger, event)
+
+    data = event
+    batch_job = data['batch_job']
+    analysis_id = data['wafr_accelerator_run_key']['analysis_id']
+
+    # Until the pool is submitted the review only knows its pool; whichever member polls first after the pool's
+    # window has ended submits the job for all of them
+    if 'job_arn' not in batch_job:
+        batch_job.update(get_pool_job(batch_job['pool_id'], analysis_id))
+
+    if 'job_arn' in batch_job:
+        batch_job['status'] = get_batch_job_status(batch_job['job_arn'])
+
+    logger.info(f"Batch job of pool {batch_job['pool_id']} status: {batch_job['status']}")
+
+    if batch_job['status'] in BATCH_JOB_COMPLETED_STATUSES:
+        # Each pillar of the collect Map reads the review's outputs from here
+        batch_outputs_key = write_member_outputs(data['extract_output_bucket'], batch_job, analysis_id)
+        for pillar_prompts in data['all_pillar_prompts']:
+            pillar_prompts['batch_outputs_key'] = batch_outputs_key
+
+    admission_lease = batch_job.get('admission_lease')
+    if batch_job['status'] in BATCH_JOB_FALLBACK_STATUSES and admission_lease and not admission_leases.reacquire_slot(admission_lease):
+        # The on-demand fallback waits for an admission slot like any other review; polled again after the wait
+        logger.info("No batch output, waiting for an admission slot to answer the questions on demand")
+        batch_job['status'] = 'WaitingForSlot'
+
+    return {
+        'statusCode': 200,
+        'body': data
+    }
+
+@cassettes.recorded
+def collect_handler(event, context):
+    """Writes the answers of one pillar from the batch outputs; run by a Map over the pillars, like the on-demand path."""
+
+    entry_timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H-%M-%S-%f")
+
+    structured_logging.start_invocation(logger, event)
+
+    logger.info(f"collect_batch_inference_results invoked at {entry_timestamp}")
+
+    data = event
+    wafr_accelerator_runs_table = dynamodb.Table(data['wafr_accelerator_runs_table'])
+    wafr_accelerator_run_key = data['wafr_accelerator_run_key']
+    input_pillar = data['input_pillar']
+
+    emf_metrics.start_invocation("collect_batch_results", wafr_accelerator_run_key['analysis_id'], data['llm_model_id'], data['wafr_accelerator_run_items']['selected_lens'], input_pillar)
+    stage_start = time.time()
+
+    failed_questions = []
+    carried_questions = 0
+
+    try:
+        extract_output_bucket_name = data['extract_output_bucket']
+        wafr_workload_id = data['wafr_accelerator_run_items']['wafr_workload_id']
+
+        bedrock_client = aws_clients.client('bedrock-runtime', region_name=data['region'])
+
+        batch_outputs = json.loads(s3client.get_object(Bucket=extract_output_bucket_name, Key=data['batch_outputs_key'])['Body'].read())
+
+        question_status = pillar_response.get_question_status(wafr_accelerator_runs_table, wafr_accelerator_run_key)
+
+        input_pillar_id = pillar_response.get_pillar_name_to_id_mappings()[input_pillar]
+        # The pillars of every lens of the analysis share the one batch job
+        wafr_lens = data.get('wafr_lens', data['wafr_accelerator_run_items']['selected_lens'])
+        lens_alias = data.get('lens_alias', data['wafr_accelerator_run_items']['lens_alias'])
+        question_mappings = pillar_response.get_question_id_mappings(data['wafr_prompts_table'], wafr_lens, input_pillar)
+
+        pillar_review_output = ""
+
+        for pillar_question_object in data[input_pillar]:
+
+            filename = pillar_question_object["pillar_review_prompt_filename"]
+            pillar_review_prompt_ouput_filename = filename[:filename.rfind('.')] + "-output.txt"
+            pillar_question_review_output = batch_outputs.get(filename)
+
+            question_key = review_lenses.question_key(pillar_question_object)
+
+            if (question_status.get(question_key) == "Completed"):
+                # Carried forward from an earlier review, or written by an earlier attempt at this pillar
+                pillar_review_output = pillar_review_output + "  \n" + pillar_response.read_question_assessment(extract_output_bucket_name, pillar_review_prompt_ouput_filename)
+                carried_questions = carried_questions + 1
+                continue
+
+            try:
+                if pillar_question_review_output is None:
+                    # Record missing or errored in the batch output, so answer it on-demand instead
+                    logger.info (f"No batch output for {filename}, invoking the model on-demand")
+                    current_prompt = s3client.get_object(Bucket=extract_output_bucket_name, Key=filename)['Body'].read()
+                    pillar_question_review_output = pillar_response.invoke_bedrock(False, current_prompt, None, None, bedrock_client, data['llm_model_id'])
+
+                full_assessment, finding = pillar_response.process_pillar_question_response(pillar_question_review_output, pillar_question_object, question_mappings, wafr_workload_id, lens_alias)
+
+                pillar_response.write_question_finding(data.get('wafr_findings_table'), data['wafr_accelerator_run_items'], input_pillar, input_pillar_id, finding, wafr_lens)
+
+                pillar_response.complete_pillar_question(wafr_accelerator_runs_table, wafr_accelerator_run_key, extract_output_bucket_name, pillar_question_object, pillar_review_prompt_ouput_filename, full_assessment)
+
+            except Exception as error:
+                logger.error (f"Question {question_key} failed: {error}")
+                pillar_response.set_question_status(wafr_accelerator_runs_table, wafr_accelerator_run_key, question_key, "Failed")
+                failed_questions.append(question_key)
+                continue
+
+            pillar_review_output = pillar_review_output + "  \n" + full_assessment
+
+        pillar_response.write_pillar_response(wafr_accelerator_runs_table, wafr_accelerator_run_key, input_pillar, input_pillar_id, pillar_review_output, data.get('lens_tag', ''), wafr_lens)
+
+        logger.info (f"collect_batch_inference_results: pillar {input_pillar} written")
+
+    except Exception as error:
+        pillar_response.handle_error(wafr_accelerator_runs_table, wafr_accelerator_run_key, error)
+        raise Exception (f'Exception caught in collect_batch_inference_results: {error}')
+
+    data['failed_questions'] = failed_questions
+
+    emf_metrics.put_metrics({
+        'StageDuration': ((time.time() - stage_start) * 1000, 'Milliseconds'),
+        'QuestionsAnswered': (len(data[input_pillar]) - len(failed_questions) - carried_questions, 'Count'),
+        'QuestionsFailed': (len(failed_questions), 'Count')
+    })
+
+    exit_timeestamp = datetime.datetime.now().strftime("%Y-%m-%d %H-%M-%S-%f")
+    logger.info(f"Exiting collect_batch_inference_results at {exit_timeestamp}")
+
+    # Retried and caught by the Map like the on-demand pillar task
+    if failed_questions:
+        raise pillar_response.QuestionsFailed(f"{len(failed_questions)} questions failed: {', '.join(failed_questions)}")
+
+    return {
+        'statusCode': 200,
+        'body': data
+    }
+
+def build_batch_records(bucket, all_pillar_prompts, question_status):
+
+    records = []
+    record_manifest = {}
+
+    for pillar_prompts in all_pillar_prompts:
+        for pillar_question_object in pillar_prompts[pillar_prompts['input_pillar']]:
+
+            # Questions carried forward from an earlier review have no prompt
+            if (question_status.get(review_lenses.question_key(pillar_question_object)) == "Completed"):
+                continue
+
+            filename = pillar_question_object["pillar_review_prompt_filename"]
+            # Bedrock record ids are 11 characters
+            record_id = f"Q{len(records):010d}"
+
+            prompt_body = s3client.get_object(Bucket=bucket, Key=filename)['Body'].read()
+
+            records.append({
+                'recordId': record_id,
+                'modelInput': json.loads(prompt_body)
+            })
+            record_manifest[record_id] = filename
+
+    return records, record_manifest
+
+def write_member_records(bucket, batch_prefix, records, record_manifest):
+    """Writes the review's records and their manifest; returns the pool member entry of the review."""
+
+    records_key = f"{batch_prefix}/records.jsonl"
+    manifest_key = f"{batch_prefix}/manifest.json"
+
+    s3client.put_object(Bucket=bucket, Key=records_key, Body="\n".join(json.dumps(record) for record in records).encode('utf-8'))
+    s3client.put_object(Bucket=bucket, Key=manifest_key, Body=json.dumps(record_manifest).encode('utf-8'))
+
+    return {
+        'records_key': records_key,
+        'manifest_key': manifest_key,
+        'record_count': len(records)
+    }
+
+def join_batch_pool(analysis_id, bucket, member, llm_model_id):
+    """
+    Adds the review to the pool of the current window of its model and returns its batch_job. Members are keyed by
+    analysis id, so joining again (e.g. a retried invocation) changes nothing. A pool can not be joined once it is
+    claimed for submission, so its members are fixed from then on.
+    """
+
+    pools_table = dynamodb.Table(BATCH_POOLS_DD_TABLE_NAME)
+    pool_seconds = BEDROCK_BATCH_POOL_MINUTES * 60
+    window_start = int(time.time()) // pool_seconds * pool_seconds
+
+    while True:
+        window_end = window_start + pool_seconds
+        # Model ids contain ':' and '.', which Bedrock request tokens do not allow
+        pool_id = f"{window_start}-{''.join(character if character.isalnum() else '-' for character in llm_model_id)}"
+
+        try:
+            pools_table.update_item(
+                Key={'pool_id': pool_id},
+                UpdateExpression="SET #members = if_not_exists(#members, :empty), window_end = :window_end, #bucket = :bucket, "
+                                 "llm_model_id = :model, expires_at = :expires_at",
+                ConditionExpression="attribute_not_exists(job_status)",
+                # Both are DynamoDB reserved words
+                ExpressionAttributeNames={'#members': 'members', '#bucket': 'bucket'},
+                ExpressionAttributeValues={':empty': {}, ':window_end': window_end, ':bucket': bucket, ':model': llm_model_id,
+                                           ':expires_at': window_end + (BEDROCK_BATCH_TIMEOUT_HOURS + 48) * 3600}
+            )
+            pools_table.update_item(
+                Key={'pool_id': pool_id},
+                UpdateExpression="SET #members.#member = :member",
+                ConditionExpression="attribute_not_exists(job_status)",
+                ExpressionAttributeNames={'#members': 'members', '#member': analysis_id},
+                ExpressionAttributeValues={':member': member}
+            )
+        except ClientError as error:
+            if error.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            # Claimed already, which only happens at the end of the window; join the next one
+            window_start = window_end
+            continue
+
+        logger.info (f"Joined batch pool {pool_id} with {member['record_count']} records")
+        return {'status': 'Pooled', 'pool_id': pool_id, 'window_end': window_end}
+
+def get_pool_job(pool_id, analysis_id):
+    """Where the pool of a review stands: still Pooled, Skipped, or Submitted with the job to poll."""
+
+    pools_table = dynamodb.Table(BATCH_POOLS_DD_TABLE_NAME)
+    now = int(time.time())
+
+    pool = pools_table.get_item(Key={'pool_id': pool_id}, ConsistentRead=True)['Item']
+
+    if pool.get('job_status', 'Submitting') == 'Submitting':
+        if now < int(pool['window_end']):
+            return {'status': 'Pooled'}
+        try:
+            # Claimed once the window has ended, or again when the member that claimed it did not get to submit it
+            pool = pools_table.update_item(
+                Key={'pool_id': pool_id},
+                UpdateExpression="SET job_status = :submitting, claimed_at = :now",
+                ConditionExpression="attribute_not_exists(job_status) AND window_end <= :now OR job_status = :submitting AND claimed_at < :stale",
+                ExpressionAttributeValues={':submitting': 'Submitting', ':now': now, ':stale': now - BATCH_POOL_SUBMIT_SECONDS},
+                ReturnValues='ALL_NEW'
+            )['Attributes']
+        except ClientError as error:
+            if error.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            # Being submitted by another member
+            return {'status': 'Pooled'}
+        pool = submit_pool_job(pool)
+
+    if pool['job_status'] == 'Skipped':
+        return {'status': 'Skipped'}
+
+    return {
+        'status': 'Submitted',
+        'job_arn': pool['job_arn'],
+        'output_prefix': pool['output_prefix'],
+        'manifest_key': pool['members'][analysis_id]['manifest_key']
+    }
+
+def submit_pool_job(pool):
+
+    pools_table = dynamodb.Table(BATCH_POOLS_DD_TABLE_NAME)
+    bucket = pool['bucket']
+    record_count = sum(int(member['record_count']) for member in pool['members'].values())
+
+    emf_metrics.put_metrics({'BatchPoolMembers': (len(pool['members']), 'Count'), 'BatchPoolRecords': (record_count, 'Count')})
+
+    if record_count < BEDROCK_BATCH_MIN_RECORDS:
+        logger.info (f"Batch pool {pool['pool_id']} has only {record_count} records, below the batch minimum of {BEDROCK_BATCH_MIN_RECORDS}. Falling back to on-demand inference.")
+        update = {'job_status': 'Skipped'}
+    else:
+        # One input file per member in the job's input folder; Bedrock writes <output prefix><job id>/<file>.out for each
+        input_prefix = f"{BATCH_POOL_PREFIX}{pool['pool_id']}/input/"
+        for analysis_id, member in pool['members'].items():
+            s3client.copy_object(Bucket=bucket, Key=f"{input_prefix}{analysis_id}.jsonl", CopySource={'Bucket': bucket, 'Key': member['records_key']})
+
+        output_prefix = f"{BATCH_POOL_PREFIX}{pool['pool_id']}/output/"
+        job_arn = create_batch_job(bucket, input_prefix, output_prefix, pool['llm_model_id'], pool['pool_id'])
+        logger.info (f"Batch pool {pool['pool_id']} of {len(pool['members'])} reviews and {record_count} records submitted as {job_arn}")
+        update = {'job_status': 'Submitted', 'job_arn': job_arn, 'output_prefix': output_prefix}
+
+    pools_table.update_item(
+        Key={'pool_id': pool['pool_id']},
+        UpdateExpression="SET " + ", ".join(f"{name} = :{name}" for name in update),
+        ExpressionAttributeValues={f":{name}": value for name, value in update.items()}
+    )
+
+    return dict(pool, **update)
+
+def create_batch_job(bucket, input_prefix, output_prefix, llm_model_id, pool_id):
+
+    with emf_metrics.timed("bedrock_create_model_invocation_job"):
+        response = bedrock_batch_client.create_model_invocation_job(
+            jobName=f"wafr-{pool_id}"[:63],
+            roleArn=BEDROCK_BATCH_ROLE_ARN,
+            modelId=llm_model_id,
+            # The same job for every submission of the pool
+            clientRequestToken=pool_id,
+            inputDataConfig={
+                's3InputDataConfig': {
+                    's3InputFormat': 'JSONL',
+                    's3Uri': f"s3://{bucket}/{input_prefix}"
+                }
+            },
+            outputDataConfig={
+                's3OutputDataConfig': {
+                    's3Uri': f"s3://{bucket}/{output_prefix}"
+                }
+            },
+            timeoutDurationInHours=BEDROCK_BATCH_TIMEOUT_HOURS
+        )
+
+    logger.info (f"create_model_invocation_job response: {response}")
+
+    return response['jobArn']
+
+def get_batch_job_status(job_arn):
+
+    response = bedrock_batch_client.get_model_invocation_job(jobIdentifier=job_arn)
+
+    if response['status'] in BATCH_JOB_FAILED_STATUSES:
+        logger.info (f"Batch job {job_arn} ended with status {response['status']}: {response.get('message', '')}")
+
+    return response['status']
+
+def read_batch_outputs(bucket, batch_job, analysis_id):
+    """The model output of each of the review's records that the job answered, by prompt filename."""
+
+    # Outputs are written to <output prefix>/<job id>/<input file name>.out, one JSON record per line
+    job_id = batch_job['job_arn'].split('/')[-1]
+    output_key = f"{batch_job['output_prefix']}{job_id}/{analysis_id}.jsonl.out"
+
+    record_manifest = json.loads(s3client.get_object(Bucket=bucket, Key=batch_job['manifest_key'])['Body'].read())
+
+    batch_outputs = {}
+
+    try:
+        output_lines = s3client.get_object(Bucket=bucket, Key=output_key)['Body'].read().decode('utf-8').splitlines()
+    except ClientError as error:
+        if error.response['Error']['Code'] != 'NoSuchKey':
+            raise
+        logger.info (f"Batch output {output_key} not found, all records will be answered on-demand")
+        return batch_outputs
+
+    for line in output_lines:
+        if not line.strip():
+            continue
+
+        record = json.loads(line)
+        filename = record_manifest.get(record.get('recordId'))
+
+        if filename and 'error' not in record and record.get('modelOutput'):
+            batch_outputs[filename] = record['modelOutput']['content'][0]['text']
+        else:
+            logger.info (f"Batch record {record.get('recordId')} has no usable output: {record.get('error')}")
+
+    logger.info (f"read_batch_outputs: {len(batch_outputs)} of {len(record_manifest)} records answered by the batch job")
+
+    return batch_outputs
+
+def write_member_outputs(bucket, batch_job, analysis_id):
+
+    batch_outputs_key = batch_job['manifest_key'].rsplit('/', 1)[0] + "/outputs.json"
+
+    s3client.put_object(Bucket=bucket, Key=batch_outputs_key, Body=json.dumps(read_batch_outputs(bucket, batch_job, analysis_id)).encode('utf-8'))
+
+    return batch_outputs_key
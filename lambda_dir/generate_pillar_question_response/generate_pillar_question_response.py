@@ -1,22 +1,27 @@
 import os
-import boto3
 import json
 import datetime
 import time
 import logging
-import re
 
-from boto3.dynamodb.conditions import Key
-from boto3.dynamodb.conditions import Attr
+from concurrent.futures import ThreadPoolExecutor
 
-from botocore.client import Config
 from botocore.exceptions import ClientError
 
-s3 = boto3.resource('s3')
-s3client = boto3.client('s3')
+import aws_clients
+import cassettes
+import emf_metrics
+import structured_logging
+import response_parser
+import reference_data_cache
+import response_cache
+import review_lenses
 
-dynamodb = boto3.resource('dynamodb')
-wa_client = boto3.client('wellarchitected')
+s3 = aws_clients.lazy_resource('s3')
+s3client = aws_clients.lazy_client('s3')
+
+dynamodb = aws_clients.lazy_resource('dynamodb')
+wa_client = aws_clients.lazy_client('wellarchitected')
 
 BEDROCK_SLEEP_DURATION = int(os.environ['BEDROCK_SLEEP_DURATION'])
 BEDROCK_MAX_TRIES = int(os.environ['BEDROCK_MAX_TRIES'])
@@ -24,13 +29,19 @@ BEDROCK_MAX_TRIES = int(os.environ['BEDROCK_MAX_TRIES'])
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+class QuestionsFailed(Exception):
+    """Some questions of the pillar failed; the Map state retries the pillar, which only runs those again."""
+
+@cassettes.recorded
 def lambda_handler(event, context):
     
     entry_timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H-%M-%S-%f")
     
+    structured_logging.start_invocation(logger, event)
+    
     logger.info(f"generate_pillar_question_response invoked at {entry_timestamp}")
     
-    logger.info(json.dumps(event))
+    logger.info("Event: %s", structured_logging.capped(event))
 
     logger.debug(f"BEDROCK_SLEEP_DURATION: {BEDROCK_SLEEP_DURATION}")
     logger.debug(f"BEDROCK_MAX_TRIES: {BEDROCK_MAX_TRIES}")
@@ -38,9 +49,7 @@ def lambda_handler(event, context):
     data = event
 
     region = data['region']
-    bedrock_config = Config(connect_timeout=120, region_name=region, read_timeout=120, retries={'max_attempts': 0})
-    bedrock_client = boto3.client('bedrock-runtime',region_name=region)
-    bedrock_agent_client = boto3.client("bedrock-agent-runtime", config=bedrock_config)
+    bedrock_client = aws_clients.client('bedrock-runtime', region_name=region)
 
     wafr_accelerator_runs_table = dynamodb.Table(data['wafr_accelerator_runs_table'])
     wafr_prompts_table = dynamodb.Table(data['wafr_prompts_table'])
@@ -48,13 +57,19 @@ def lambda_handler(event, context):
     document_s3_key = data['wafr_accelerator_run_items']['document_s3_key']
     extract_output_bucket_name = data['extract_output_bucket']
     
-    wafr_lens = data['wafr_accelerator_run_items']['selected_lens']
+    # Pillar prompts of an additional lens name their lens; older payloads only have the analysis' lens
+    wafr_lens = data.get('wafr_lens', data['wafr_accelerator_run_items']['selected_lens'])
+    lens_tag = data.get('lens_tag', '')
     
     pillars = data['wafr_accelerator_run_items'] ['selected_wafr_pillars']
     input_pillar = data['input_pillar']
     llm_model_id = data['llm_model_id']
     wafr_workload_id = data['wafr_accelerator_run_items'] ['wafr_workload_id']
-    lens_alias = data['wafr_accelerator_run_items'] ['lens_alias']
+    lens_alias = data.get('lens_alias', data['wafr_accelerator_run_items'] ['lens_alias'])
+    bypass_response_cache = data['wafr_accelerator_run_items'].get('bypass_response_cache', False)
+    
+    emf_metrics.start_invocation("answer_questions", data['wafr_accelerator_run_key']['analysis_id'], llm_model_id, wafr_lens, input_pillar)
+    stage_start = time.time()
     
     return_response = {}
     
@@ -64,8 +79,6 @@ def lambda_handler(event, context):
     
     try:
         extract_output_bucket = s3.Bucket(extract_output_bucket_name)
-
-        streaming = False
         
         logger.debug (f"generate_pillar_question_response checkpoint 1")
         
@@ -77,9 +90,6 @@ def lambda_handler(event, context):
         }
 
         logger.debug (f"generate_pillar_question_response checkpoint 2")
-        
-        pillar_responses = get_existing_pillar_responses(wafr_accelerator_runs_table, data['wafr_accelerator_run_items']['analysis_id'], data['wafr_accelerator_run_items']['analysis_submitter'])
-        
         logger.debug (f"generate_pillar_question_response checkpoint 3")
 
         pillar_review_output = ""
@@ -99,48 +109,56 @@ def lambda_handler(event, context):
         
         question_mappings = get_question_id_mappings (data['wafr_prompts_table'], wafr_lens, input_pillar)
         
+        question_status = get_question_status(wafr_accelerator_runs_table, wafr_accelerator_run_key)
+        failed_questions = []
+        
         for pillar_question_object in data[input_pillar]:
             
             filename = pillar_question_object["pillar_review_prompt_filename"]
+            pillar_specfic_question_id = pillar_question_object["pillar_specfic_question_id"]
+            question_key = review_lenses.question_key(pillar_question_object)
             logger.info (f"generate_pillar_question_response checkpoint 5.{file_counter}")
             logger.info (f"Input Prompt filename: " + filename)
             
-            current_prompt_object = s3client.get_object(
-                Bucket=extract_output_bucket_name,
-                Key=filename,
-            )
-                    
-            current_prompt = current_prompt_object['Body'].read()
-            
-            logger.info (f"current_prompt: {current_prompt}")
-            
             logger.debug ("filename.rstrip('.'): " + filename.rstrip('.'))
             logger.debug ("filename[:document_s3_key.rfind('.')]: " + filename[:filename.rfind('.')] )
             pillar_review_prompt_ouput_filename = filename[:filename.rfind('.')]+ "-output.txt"
             logger.info (f"Ouput Prompt ouput filename: " + pillar_review_prompt_ouput_filename)            
             
-            logger.info (f"generate_pillar_question_response checkpoint 6.{file_counter}")
-            
-            pillar_specfic_question_id = pillar_question_object["pillar_specfic_question_id"]
-            pillar_specfic_prompt_question = pillar_question_object["pillar_specfic_prompt_question"]
-            
-            pillar_question_review_output = invoke_bedrock(streaming, current_prompt, pillar_review_prompt_ouput_filename, extract_output_bucket, bedrock_client, llm_model_id)
+            if (question_status.get(question_key) == "Completed"):
+                # Answered by an earlier run of this review, reuse the saved assessment
+                logger.info (f"Question {question_key} already completed, reusing its assessment")
+                full_assessment = read_question_assessment(extract_output_bucket_name, pillar_review_prompt_ouput_filename)
+                pillar_review_output = pillar_review_output + "  \n" + full_assessment 
+                file_counter = file_counter + 1
+                continue
             
-            logger.debug (f"pillar_question_review_output: {pillar_question_review_output}")
-
-            # Comment the next line if you would like to retain the prompts files
-            s3client.delete_object(Bucket=extract_output_bucket_name, Key=filename)
-
-            pillar_question_review_output = sanitise_string(pillar_question_review_output)
-            logger.debug (f"sanitised_string: {pillar_question_review_output}")
-            
-            full_assessment, extracted_question, extracted_assessment, best_practices_followed, recommendations_and_examples, risk, citations = extract_assessment(pillar_question_review_output, question_mappings, pillar_question_object["pillar_specfic_prompt_question"])
-            logger.debug (f"extracted_assessment: {full_assessment}")
-            
-            extracted_choices = extract_choices(pillar_question_review_output)
-            logger.debug (f"extracted_choices: {extracted_choices}")
-
-            update_wafr_question_response(wa_client, wafr_workload_id, lens_alias, pillar_specfic_question_id, extracted_choices, f"{extracted_assessment} {best_practices_followed} {recommendations_and_examples}")
+            try:
+                current_prompt_object = s3client.get_object(
+                    Bucket=extract_output_bucket_name,
+                    Key=filename,
+                )
+                        
+                current_prompt = current_prompt_object['Body'].read()
+                
+                logger.debug ("current_prompt: %s", structured_logging.capped(current_prompt))
+                
+                logger.info (f"generate_pillar_question_response checkpoint 6.{file_counter}")
+                
+                # The answer is submitted to the Well-Architected Tool while the rest of the response is still streaming
+                full_assessment, finding = answer_pillar_question(current_prompt, pillar_question_object, question_mappings, wafr_workload_id, lens_alias, bedrock_client, llm_model_id, wafr_accelerator_runs_table, wafr_accelerator_run_key, bypass_response_cache)
+                
+                write_question_finding(data.get('wafr_findings_table'), data['wafr_accelerator_run_items'], input_pillar, input_pillar_id, finding, wafr_lens)
+                
+                complete_pillar_question(wafr_accelerator_runs_table, wafr_accelerator_run_key, extract_output_bucket_name, pillar_question_object, pillar_review_prompt_ouput_filename, full_assessment)
+                
+            except Exception as error:
+                # A single question failing must not fail the review; it is left for a redrive
+                logger.error (f"Question {question_key} failed: {error}")
+                set_question_status(wafr_accelerator_runs_table, wafr_accelerator_run_key, question_key, "Failed")
+                failed_questions.append(question_key)
+                file_counter = file_counter + 1
+                continue
             
             pillar_review_output = pillar_review_output + "  \n" + full_assessment 
             
@@ -151,25 +169,12 @@ def lambda_handler(event, context):
         logger.debug (f"generate_pillar_question_response checkpoint 8")
         
         # Now write the completed pillar response in DynamoDB  
-        pillar_response = {
-            'pillar_name': input_pillar,
-            'pillar_id': input_pillar_id,
-            'llm_response': pillar_review_output
-        }
-    
-        # Add the dictionary object to the list
-        pillar_responses.append(pillar_response)
-            
-        # Update the item
-        response = wafr_accelerator_runs_table.update_item(
-            Key=wafr_accelerator_run_key,
-            UpdateExpression="SET pillars = :val",
-            ExpressionAttributeValues={':val': pillar_responses},
-            ReturnValues='UPDATED_NEW'  
-        )
+        response = write_pillar_response(wafr_accelerator_runs_table, wafr_accelerator_run_key, input_pillar, input_pillar_id, pillar_review_output, lens_tag, wafr_lens)
         
         logger.info (f"dynamodb status update response: {response}" )
         logger.info (f"generate_pillar_question_response checkpoint 10")
+        
+        data['failed_questions'] = failed_questions
     
     except Exception as error:
         handle_error(wafr_accelerator_runs_table, wafr_accelerator_run_key, error)
@@ -181,10 +186,17 @@ def lambda_handler(event, context):
     
     return_response = data
 
-    logger.info(f"return_response: " + json.dumps(return_response))
+    logger.info("return_response: %s", structured_logging.capped(return_response))
     
     exit_timeestamp = datetime.datetime.now().strftime("%Y-%m-%d %H-%M-%S-%f")
+    emf_metrics.put_metric("StageDuration", (time.time() - stage_start) * 1000, "Milliseconds")
+    
     logger.info(f"Exiting generate_pillar_question_response at {exit_timeestamp}")
+    
+    # Raised once the pillar is written, so the answered questions are kept. After the Map's retries the pillar is
+    # passed on with the error, and update_review_status leaves the questions to a redrive
+    if data['failed_questions']:
+        raise QuestionsFailed(f"{len(data['failed_questions'])} questions failed: {', '.join(data['failed_questions'])}")
         
     # Return a success response
     return {
@@ -192,7 +204,198 @@ def lambda_handler(event, context):
         'body': return_response
     }
 
+def answer_pillar_question(claude_prompt_body, pillar_question_object, question_mappings, wafr_workload_id, lens_alias, bedrock_client, llm_model_id, wafr_accelerator_runs_table, wafr_accelerator_run_key, bypass_response_cache=False):
+    
+    pillar_specfic_question_id = pillar_question_object["pillar_specfic_question_id"]
+    question_start = time.time()
+    early_answer = {}
+    
+    submitted_answer = None
+    
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        
+        def on_section(name, value):
+            early_answer[name] = value
+            if ('submitted' not in early_answer) and ('choices' in early_answer) and ('assessment' in early_answer):
+                # The choices and the assessment are complete; the rest of the notes and the citations are still being
+                # generated. The full notes are sent once the response completes
+                sections = dict(dict.fromkeys(response_parser.RESPONSE_SECTIONS, ''), **early_answer)
+                notes = answer_notes(sections, question_mappings, pillar_question_object["pillar_specfic_prompt_question"], ('assessment',))
+                early_answer['submitted'] = (executor.submit(update_wafr_question_response, wa_client, wafr_workload_id, lens_alias, pillar_specfic_question_id, early_answer['choices'], notes), early_answer['choices'], notes)
+                set_question_status(wafr_accelerator_runs_table, wafr_accelerator_run_key, review_lenses.question_key(pillar_question_object), "Answered")
+                logger.info (f"Question {pillar_specfic_question_id} answer submitted {time.time() - question_start:.1f}s after the request, before the response completed")
+                emf_metrics.put_metric("TimeToAnswerSubmitted", (time.time() - question_start) * 1000, "Milliseconds")
+        
+        parsed_response = invoke_bedrock_incremental(claude_prompt_body, bedrock_client, llm_model_id, on_section, bypass_response_cache)
+        
+        if 'submitted' in early_answer:
+            future, choices, notes = early_answer['submitted']
+            submitted_answer = (future.result(), choices, notes)
+    
+    logger.info (f"Question {pillar_specfic_question_id} response completed {time.time() - question_start:.1f}s after the request")
+    emf_metrics.put_metrics({"QuestionDuration": ((time.time() - question_start) * 1000, "Milliseconds"), "QuestionsAnswered": (1, "Count")})
+    
+    return complete_pillar_question_response(parsed_response, pillar_question_object, question_mappings, wafr_workload_id, lens_alias, submitted_answer)
+
+def process_pillar_question_response(pillar_question_review_output, pillar_question_object, question_mappings, wafr_workload_id, lens_alias):
+    
+    # Every tagged section and the selected choices come from a single pass over the response
+    parsed_response = response_parser.parse_response(pillar_question_review_output)
+    logger.debug ("parsed_response: %s", structured_logging.capped(parsed_response))
+    
+    return complete_pillar_question_response(parsed_response, pillar_question_object, question_mappings, wafr_workload_id, lens_alias)
+
+def complete_pillar_question_response(parsed_response, pillar_question_object, question_mappings, wafr_workload_id, lens_alias, submitted_answer=None):
+    
+    pillar_specfic_question_id = pillar_question_object["pillar_specfic_question_id"]
+    
+    full_assessment, extracted_question, extracted_assessment, best_practices_followed, recommendations_and_examples, risk, citations = extract_assessment(parsed_response, question_mappings, pillar_question_object["pillar_specfic_prompt_question"])
+    logger.debug ("extracted_assessment: %s", structured_logging.capped(full_assessment))
+    
+    extracted_choices = parsed_response['choices']
+    logger.info (f"extracted_choices: {extracted_choices}")
+    notes = f"{extracted_assessment} {best_practices_followed} {recommendations_and_examples}"
+
+    # An answer submitted while the response streamed is only updated if it failed or the full response changed it,
+    # e.g. with the notes sections that were completed after it was sent
+    if submitted_answer and submitted_answer[0] is not None and submitted_answer[1:] == (extracted_choices, notes):
+        response = submitted_answer[0]
+    else:
+        response = update_wafr_question_response(wa_client, wafr_workload_id, lens_alias, pillar_specfic_question_id, extracted_choices, notes)
+    
+    # The Well-Architected Tool derives the risk from the selected choices; the model's own rating is the fallback
+    wa_risk = response.get('Answer', {}).get('Risk', '') if response else ''
+    
+    finding = {
+        'question_id': review_lenses.question_key(pillar_question_object),
+        'question': pillar_question_object["pillar_specfic_prompt_question"],
+        'assessment': parsed_response['assessment'],
+        'best_practices_followed': parsed_response['best_practices_followed'],
+        'recommendations_and_examples': parsed_response['recommendations_and_examples'],
+        'citations': parsed_response['citations'],
+        'selected_choices': extracted_choices,
+        'risk_level': normalise_risk_level(wa_risk if wa_risk not in ('', 'UNANSWERED') else parsed_response['risk'])
+    }
+    
+    return full_assessment, finding
+
+def normalise_risk_level(risk):
+    
+    risk_levels = {
+        'HIGH': 'High',
+        'MEDIUM': 'Medium',
+        'LOW': 'Low',
+        'NONE': 'None',
+        'NOT_APPLICABLE': 'Not Applicable'
+    }
+    
+    return risk_levels.get(risk.strip().upper().replace(' ', '_'), 'Unknown')
+
+def write_question_finding(wafr_findings_table_name, wafr_accelerator_run_items, input_pillar, input_pillar_id, finding, wafr_lens=None):
+    
+    # Reviews started before the findings table existed have no table name in their payload
+    if not wafr_findings_table_name:
+        return
+    
+    wafr_findings_table = dynamodb.Table(wafr_findings_table_name)
+    
+    item = {
+        'analysis_id': wafr_accelerator_run_items['analysis_id'],
+        'analysis_submitter': wafr_accelerator_run_items['analysis_submitter'],
+        'wafr_workload_id': wafr_accelerator_run_items['wafr_workload_id'],
+        'selected_lens': wafr_lens or wafr_accelerator_run_items['selected_lens'],
+        'pillar_name': input_pillar,
+        'pillar_id': input_pillar_id,
+        'updated_at': datetime.datetime.now().strftime("%Y-%m-%d %H-%M-%S")
+    }
+    item.update(finding)
+    # Sort key of the submitter index, so a submitter's findings of one risk level are queried by prefix
+    item['risk_analysis'] = f"{item['risk_level']}#{item['analysis_id']}"
+    
+    wafr_findings_table.put_item(Item=item)
+
+def complete_pillar_question(wafr_accelerator_runs_table, wafr_accelerator_run_key, bucket, pillar_question_object, pillar_review_prompt_ouput_filename, full_assessment):
+    
+    # Save the assessment before marking the question completed so a redrive can always rebuild the pillar from it
+    s3client.put_object(Bucket=bucket, Key=pillar_review_prompt_ouput_filename, Body=full_assessment.encode('utf-8'))
+    
+    mark_question_completed(wafr_accelerator_runs_table, wafr_accelerator_run_key, review_lenses.question_key(pillar_question_object))
+    
+    # Prompts are kept until the question is completed so a redrive does not have to regenerate them
+    # Comment the next line if you would like to retain the prompts files
+    s3client.delete_object(Bucket=bucket, Key=pillar_question_object["pillar_review_prompt_filename"])
+
+def set_question_status(wafr_accelerator_runs_table, wafr_accelerator_run_key, pillar_specfic_question_id, status):
+    
+    wafr_accelerator_runs_table.update_item(
+        Key=wafr_accelerator_run_key,
+        UpdateExpression="SET question_status.#question_id = :val",
+        ExpressionAttributeNames={'#question_id': pillar_specfic_question_id},
+        ExpressionAttributeValues={':val': status},
+        ReturnValues='NONE'
+    )
+
+def mark_question_completed(wafr_accelerator_runs_table, wafr_accelerator_run_key, pillar_specfic_question_id):
+    
+    # progress_done only counts a question the first time it completes, so retried and redriven questions are not counted twice
+    try:
+        wafr_accelerator_runs_table.update_item(
+            Key=wafr_accelerator_run_key,
+            UpdateExpression="SET question_status.#question_id = :val ADD progress_done :one",
+            ConditionExpression="attribute_not_exists(question_status.#question_id) OR question_status.#question_id <> :val",
+            ExpressionAttributeNames={'#question_id': pillar_specfic_question_id},
+            ExpressionAttributeValues={':val': "Completed", ':one': 1},
+            ReturnValues='NONE'
+        )
+    except ClientError as error:
+        if error.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        logger.info(f"Question {pillar_specfic_question_id} was already completed")
+
+def get_question_status(wafr_accelerator_runs_table, wafr_accelerator_run_key):
+    
+    response = wafr_accelerator_runs_table.get_item(
+        Key=wafr_accelerator_run_key,
+        ProjectionExpression='question_status',
+        ConsistentRead=True
+    )
+    
+    return response.get('Item', {}).get('question_status', {})
+
+def read_question_assessment(bucket, pillar_review_prompt_ouput_filename):
+    
+    try:
+        return s3client.get_object(Bucket=bucket, Key=pillar_review_prompt_ouput_filename)['Body'].read().decode('utf-8')
+    except ClientError as error:
+        if error.response['Error']['Code'] != 'NoSuchKey':
+            raise
+        logger.info (f"Saved assessment {pillar_review_prompt_ouput_filename} not found")
+        return ""
+
+def write_pillar_response(wafr_accelerator_runs_table, wafr_accelerator_run_key, input_pillar, input_pillar_id, pillar_review_output, lens_tag='', wafr_lens=None):
+    
+    pillar_response = {
+        'pillar_name': f"{input_pillar} ({wafr_lens})" if lens_tag else input_pillar,
+        'pillar_id': input_pillar_id,
+        'llm_response': pillar_review_output
+    }
+
+    # pillars is a map keyed by pillar id (scoped by the lens tag for additional lenses), so each pillar writes only its
+    # own entry and a redriven pillar replaces it
+    response = wafr_accelerator_runs_table.update_item(
+        Key=wafr_accelerator_run_key,
+        UpdateExpression="SET pillars.#pillar_id = :val",
+        ExpressionAttributeNames={'#pillar_id': review_lenses.scoped(lens_tag, input_pillar_id)},
+        ExpressionAttributeValues={':val': pillar_response},
+        ReturnValues='NONE'  
+    )
+    
+    return response
+
 def get_pillar_name_to_id_mappings():
+    return reference_data_cache.get_static('pillar_name_to_id_mappings', build_pillar_name_to_id_mappings)
+
+def build_pillar_name_to_id_mappings():
     mappings = {}
     
     mappings["Operational Excellence"] = "1"
@@ -205,6 +408,9 @@ def get_pillar_name_to_id_mappings():
     return mappings
 
 def get_pillar_name_alias_mappings():
+    return reference_data_cache.get_static('pillar_name_alias_mappings', build_pillar_name_alias_mappings)
+
+def build_pillar_name_alias_mappings():
 
     mappings = {}
     
@@ -217,100 +423,46 @@ def get_pillar_name_alias_mappings():
     
     return mappings
     
-def sanitise_string(content):
-    junk_list = ["```", "xml", "**wafr_answer_choices:**", "{", "}", "[", "]", "<b>", "</b>", "<citation>", "</citation>", "Recommendations:", "Assessment:"]
-    for junk in junk_list:
-        content = content.replace(junk, '')
-    return content
-
-def sanitise_string_2(content):
-    junk_list = ["<citations>", "</citations>", "**", "```", "<b>", "</b>"]
-    for junk in junk_list:
-        content = content.replace(junk, '')
-    return content
+def answer_notes(parsed_response, question_mappings, question, sections=response_parser.NOTES_SECTIONS):
+    
+    full_assessment, extracted_question, extracted_assessment, best_practices_followed, recommendations_and_examples, risk, citations = extract_assessment(parsed_response, question_mappings, question)
+    notes = {'assessment': extracted_assessment, 'best_practices_followed': best_practices_followed, 'recommendations_and_examples': recommendations_and_examples}
+    
+    return " ".join(notes[section] for section in sections)
 
-# Function to recursively print XML nodes
-def extract_assessment(content, question_mappings, question):
+def extract_assessment(parsed_response, question_mappings, question):
     
-    tag_content = ""
-    full_assessment = question=  assessment = best_practices_followed = recommendations_and_examples = risk = citations = ""
+    full_assessment = assessment = best_practices_followed = recommendations_and_examples = risk = citations = ""
     try:
-        xml_start = content.find('<question>')
-        if xml_start != -1:
-            xml_content = content[(xml_start+len("<question>")):]
-            xml_end = xml_content.find('</question>')
-            if xml_end != -1:
-                tag_content = xml_content[:xml_end].strip()
-                print (f"question: {tag_content}")
-                question = f"**Question: {question_mappings[sanitise_string_2(tag_content)]} - {tag_content}**  \n"
-            else:
-                print (f"End tag for question not found")        
-                question = f"**Question: {question_mappings[sanitise_string_2(question)]} - {question}**  \n"
-        else:
-            question = f"**Question: {question_mappings[sanitise_string_2(question)]} - {question}**  \n"
+        # Fall back to the prompt question when the response does not echo it back
+        question_text = parsed_response['question'] or response_parser.clean_section(question)
+        question = f"**Question: {question_mappings[question_text]} - {question_text}**  \n"
         
-        assessment = f"**Assessment:** {extract_tag_data(content, 'assessment')}  \n  \n"
-        best_practices_followed = f"**Best Practices Followed:** {extract_tag_data(content, 'best_practices_followed')}  \n  \n"
-        recommendations_and_examples = f"**Recommendations:** {extract_tag_data(content, 'recommendations_and_examples')}  \n  \n"
-        citations = f"**Citations:** {extract_tag_data(content, 'citations')}  \n  \n"
+        assessment = f"**Assessment:** {parsed_response['assessment']}  \n  \n"
+        best_practices_followed = f"**Best Practices Followed:** {parsed_response['best_practices_followed']}  \n  \n"
+        recommendations_and_examples = f"**Recommendations:** {parsed_response['recommendations_and_examples']}  \n  \n"
+        if parsed_response['risk']:
+            risk = f"**Risk:** {parsed_response['risk']}  \n  \n"
+        citations = f"**Citations:** {parsed_response['citations']}  \n  \n"
         
         full_assessment = question + assessment + best_practices_followed + recommendations_and_examples + risk +citations
         
     except Exception as error:
-        errorFlag = True
+        question = ""
         logger.info("Exception caught by try loop in extract_assessment!")
         logger.info("Error received is:")
         logger.info(error) 
         
     return full_assessment, question, assessment, best_practices_followed, recommendations_and_examples, risk, citations
 
-def extract_tag_data(content, tag):
-    tag_content = ""
-    xml_start = content.find(f'<{tag}>')
-    if xml_start != -1:
-        xml_content = content[(xml_start+len(f'<{tag}>')):]
-        xml_end = xml_content.find(f'</{tag}>')
-        if xml_end != -1:
-            tag_content = sanitise_string_2(xml_content[:xml_end].strip())
-            print (f"{tag}: {tag_content}")
-        else:
-            print (f"End tag for assessment not found")
-    return tag_content     
-
-def extract_choices(content):
+def get_question_id_mappings(wafr_prompts_table_name, wafr_lens, input_pillar):
+    # Warm containers reuse the mappings until insert_wafr_prompts loads new prompts
+    return reference_data_cache.get_versioned(wafr_prompts_table_name, 'question_id_mappings', load_question_id_mappings, wafr_prompts_table_name, wafr_lens, input_pillar)
 
-    selectedChoices = []
-    
-    xml_end = -1
-    
-    try:
-        xml_start = content.find('<wafr_answer_choices>')
-        if xml_start != -1:
-            xml_content = content[xml_start:]
-            xml_end = xml_content.find('</wafr_answer_choices>')
-            wafr_answer_choices = xml_content[:(xml_end + len("</wafr_answer_choices>"))].strip()
-            logger.info(f"wafr_answer_choices: {wafr_answer_choices}")
-            logger.info(f"response_root is a well-formed XML")
-        
-        if ((xml_start!=-1) and (xml_end!=-1)):
-            # Use regular expression to find all occurrences of <id>...</id>
-            id_pattern = re.compile(r'<id>(.*?)</id>', re.DOTALL)       
-            # Find all matches
-            ids = id_pattern.findall(wafr_answer_choices)
-            # Loop through the matches
-            for index, id_value in enumerate(ids, 1):
-                print(f"ID {index}: {id_value.strip()}")
-                selectedChoices += [id_value.strip()]
-                            
-    except Exception as error:
-        errorFlag = True
-        logger.info("Exception caught by try loop in extract_choices!")
-        logger.info("Error received is:")
-        logger.info(error) 
-    
-    return selectedChoices
+def load_question_id_mappings(wafr_prompts_table_name, wafr_lens, input_pillar):
+    # Only needed on a reference data cache miss
+    from boto3.dynamodb.conditions import Key
 
-def get_question_id_mappings(wafr_prompts_table_name, wafr_lens, input_pillar):
     questions = {}
     
     wafr_prompts_table = dynamodb.Table(wafr_prompts_table_name)
@@ -320,7 +472,7 @@ def get_question_id_mappings(wafr_prompts_table_name, wafr_lens, input_pillar):
     		ScanIndexForward=True  # Set to False to sort in descending order
     	)
     logger.debug (f"response wafr_pillar_id: "  + str(response['Items'][0]['wafr_pillar_id']))
-    logger.debug (f"response wafr_pillar_prompt: " + response['Items'][0]['wafr_pillar_prompt'])
+    logger.debug ("response wafr_pillar_prompt: %s", structured_logging.capped(response['Items'][0]['wafr_pillar_prompt']))
     pillar_specific_prompt_question = response['Items'][0]['wafr_pillar_prompt']
     
     line_counter = 0 
@@ -358,150 +510,185 @@ def update_wafr_question_response(wa_client, wafr_workload_id, lens_alias, pilla
         logger.info(f"wafr_workload_id: {wafr_workload_id}, lens_alias: {lens_alias}, pillar_specfic_question_id: {pillar_specfic_question_id}")
         
         try:
-            response = wa_client.update_answer(
-                    WorkloadId=wafr_workload_id,
-                    LensAlias=lens_alias,
-                    QuestionId=pillar_specfic_question_id,
-                    SelectedChoices=selectedChoices,
-                    Notes=assessment[:2084],
-                    IsApplicable=True 
-                )
-            logger.info(f"With Choices- response: {response}")
+            with emf_metrics.timed("wa_update_answer"):
+                response = wa_client.update_answer(
+                        WorkloadId=wafr_workload_id,
+                        LensAlias=lens_alias,
+                        QuestionId=pillar_specfic_question_id,
+                        SelectedChoices=selectedChoices,
+                        Notes=assessment[:2084],
+                        IsApplicable=True 
+                    )
+            logger.debug("With Choices- response: %s", structured_logging.capped(response))
             logger.debug(f"update_wafr_question_response: 2")
         except Exception as error:
             logger.info("Updated answer with choices failed, now attempting update without the choices!")
             logger.info("With Choices- Error received is:")
             logger.info(error)
             selectedChoices = []
-            response = wa_client.update_answer(
-                    WorkloadId=wafr_workload_id,
-                    LensAlias=lens_alias,
-                    QuestionId=pillar_specfic_question_id,
-                    SelectedChoices=selectedChoices,
-                    Notes=assessment[:2084],
-                    IsApplicable=True
-                )
-            logger.info(f"Without Choices- response: {response}")
+            with emf_metrics.timed("wa_update_answer"):
+                response = wa_client.update_answer(
+                        WorkloadId=wafr_workload_id,
+                        LensAlias=lens_alias,
+                        QuestionId=pillar_specfic_question_id,
+                        SelectedChoices=selectedChoices,
+                        Notes=assessment[:2084],
+                        IsApplicable=True
+                    )
+            logger.debug("Without Choices- response: %s", structured_logging.capped(response))
             logger.debug(f"update_wafr_question_response: 3")
             
-        logger.info (json.dumps(response))
+        logger.info ("update_answer response: %s", structured_logging.capped(response))
         
     except Exception as error:
+        response = None
         logger.info("Exception caught by external try in update_wafr_question_response!")
         logger.info("Error received is:")
         logger.info(error)
     finally:    
         logger.info (f"update_wafr_question_response Inside finally")
+    
+    return response
         
-def invoke_bedrock(streaming, claude_prompt_body, pillar_review_outputFilename, bucket, bedrock_client, llm_model_id):
+def invoke_bedrock(streaming, claude_prompt_body, pillar_review_outputFilename, bucket, bedrock_client, llm_model_id, bypass_response_cache=False):
+
+    cached_response = response_cache.get(llm_model_id, claude_prompt_body, bypass_response_cache)
+    if cached_response is not None:
+        return cached_response
 
     pillar_review_output = ""
     retries = 0
     max_retries = BEDROCK_MAX_TRIES
     pillar_review_output = ""
-    while retries < max_retries:
-        try:
-            if(streaming):
-                streaming_response = bedrock_client.invoke_model_with_response_stream(
-                    modelId=llm_model_id,
-                    body=claude_prompt_body,
-                )
-                
-                logger.info (f"invoke_bedrock checkpoint 1.{retries}")
-                stream = streaming_response.get("body")
-                
-                logger.debug (f"invoke_bedrock checkpoint 2")
-        
-                for chunk in parse_stream(stream):
-                    pillar_review_output += chunk
+    with emf_metrics.timed("bedrock_invoke_model") as measurement:
+        while retries < max_retries:
+            try:
+                if(streaming):
+                    streaming_response = bedrock_client.invoke_model_with_response_stream(
+                        modelId=llm_model_id,
+                        body=claude_prompt_body,
+                    )
                     
-                # Uncomment next line if you would like to see response files for each question too. 
-                #bucket.put_object(Key=pillar_review_outputFilename, Body=bytes(pillar_review_output, encoding='utf-8'))
-                
-                return pillar_review_output
-                
-            else:
-                non_streaming_response = bedrock_client.invoke_model(
+                    logger.info (f"invoke_bedrock checkpoint 1.{retries}")
+                    stream = streaming_response.get("body")
+                    
+                    logger.debug (f"invoke_bedrock checkpoint 2")
+            
+                    usage = {}
+                    for chunk in parse_stream(stream, usage):
+                        pillar_review_output += chunk
+                        
+                    # Uncomment next line if you would like to see response files for each question too. 
+                    #bucket.put_object(Key=pillar_review_outputFilename, Body=bytes(pillar_review_output, encoding='utf-8'))
+                    
+                    add_invocation_metrics(measurement, retries, usage)
+                    response_cache.put(llm_model_id, claude_prompt_body, pillar_review_output, usage)
+                    return pillar_review_output
+                    
+                else:
+                    non_streaming_response = bedrock_client.invoke_model(
+                        modelId=llm_model_id,
+                        body=claude_prompt_body,
+                    )
+                    
+                    response_json = json.loads(non_streaming_response["body"].read().decode("utf-8"))
+            
+                    logger.debug ("response_json: %s", structured_logging.capped(response_json))
+                    
+                    logger.info (f"invoke_bedrock checkpoint 1.{retries}")
+            
+                    # Extract and logger.info the response text.
+                    pillar_review_output = response_json["content"][0]["text"]
+            
+                    logger.debug (f"invoke_bedrock checkpoint 2.{retries}")
+                    
+                    # Uncomment next line if you would like to see response files for each question too. 
+                    #bucket.put_object(Key=pillar_review_outputFilename, Body=pillar_review_output)
+                    
+                    add_invocation_metrics(measurement, retries, response_json.get("usage", {}))
+                    response_cache.put(llm_model_id, claude_prompt_body, pillar_review_output, response_json.get("usage", {}))
+                    return pillar_review_output
+                    
+            except Exception as e:
+                retries += 1
+                logger.info(f"Sleeping as attempt {retries} failed with exception: {e}")
+                time.sleep(BEDROCK_SLEEP_DURATION)  # Add a delay before the next retry
+
+        measurement.add("Retries", retries)
+        logger.info(f"Maximum retries ({max_retries}) exceeded. Unable to invoke the model.")
+        raise Exception (f"Maximum retries ({max_retries}) exceeded. Unable to invoke the model.")
+
+def invoke_bedrock_incremental(claude_prompt_body, bedrock_client, llm_model_id, on_section, bypass_response_cache=False):
+    
+    # Streaming counterpart of invoke_bedrock that calls on_section(name, value) as each tagged section of the response closes
+    cached_response = response_cache.get(llm_model_id, claude_prompt_body, bypass_response_cache)
+    if cached_response is not None:
+        parser = response_parser.IncrementalResponseParser()
+        for name, value in parser.feed(cached_response):
+            notify_section(on_section, name, value)
+        return parser.close()
+    
+    retries = 0
+    max_retries = BEDROCK_MAX_TRIES
+    with emf_metrics.timed("bedrock_invoke_model_stream") as measurement:
+        while retries < max_retries:
+            try:
+                request_start = time.time()
+                streaming_response = bedrock_client.invoke_model_with_response_stream(
                     modelId=llm_model_id,
                     body=claude_prompt_body,
                 )
                 
-                response_json = json.loads(non_streaming_response["body"].read().decode("utf-8"))
-        
-                logger.debug (response_json)
+                logger.info (f"invoke_bedrock_incremental checkpoint 1.{retries}")
                 
-                logger.info (f"invoke_bedrock checkpoint 1.{retries}")
-        
-                # Extract and logger.info the response text.
-                pillar_review_output = response_json["content"][0]["text"]
-        
-                logger.debug (f"invoke_bedrock checkpoint 2.{retries}")
+                parser = response_parser.IncrementalResponseParser()
+                usage = {}
+                for chunk in parse_stream(streaming_response.get("body"), usage):
+                    if "TimeToFirstToken" not in measurement.values:
+                        measurement.add("TimeToFirstToken", (time.time() - request_start) * 1000, "Milliseconds")
+                    for name, value in parser.feed(chunk):
+                        notify_section(on_section, name, value)
                 
-                # Uncomment next line if you would like to see response files for each question too. 
-                #bucket.put_object(Key=pillar_review_outputFilename, Body=pillar_review_output)
+                logger.debug ("pillar_question_review_output: %s", structured_logging.capped(parser.text))
                 
-                return pillar_review_output
+                add_invocation_metrics(measurement, retries, usage)
+                # Only complete responses are cached, a truncated one is asked for again on the next run
+                if '</response>' in parser.text:
+                    response_cache.put(llm_model_id, claude_prompt_body, parser.text, usage)
+                return parser.close()
                 
-        except Exception as e:
-            retries += 1
-            logger.info(f"Sleeping as attempt {retries} failed with exception: {e}")
-            time.sleep(BEDROCK_SLEEP_DURATION)  # Add a delay before the next retry
+            except Exception as e:
+                retries += 1
+                logger.info(f"Sleeping as attempt {retries} failed with exception: {e}")
+                time.sleep(BEDROCK_SLEEP_DURATION)  # Add a delay before the next retry
+
+        measurement.add("Retries", retries)
+        logger.info(f"Maximum retries ({max_retries}) exceeded. Unable to invoke the model.")
+        raise Exception (f"Maximum retries ({max_retries}) exceeded. Unable to invoke the model.")
+
+def notify_section(on_section, name, value):
+    # A failing callback (e.g. the early answer submission) is not a model failure, so it must not invoke the model
+    # again; whatever it did not get to do is done once the response completes
+    try:
+        on_section(name, value)
+    except Exception as error:
+        logger.error (f"Handling response section {name} failed: {error}")
 
-    logger.info(f"Maximum retries ({max_retries}) exceeded. Unable to invoke the model.")
-    raise Exception (f"Maximum retries ({max_retries}) exceeded. Unable to invoke the model.")
+def add_invocation_metrics(measurement, retries, usage):
+    measurement.add("Retries", retries)
+    measurement.add("InputTokens", usage.get("input_tokens", 0))
+    measurement.add("OutputTokens", usage.get("output_tokens", 0))
 
-def parse_stream(stream):
+def parse_stream(stream, usage=None):
     for event in stream:
         chunk = event.get('chunk')
         if chunk:
             message = json.loads(chunk.get("bytes").decode())
             if message['type'] == "content_block_delta":
                 yield message['delta']['text'] or ""
+            elif message['type'] == "message_start" and usage is not None:
+                usage.update(message['message'].get('usage', {}))
+            elif message['type'] == "message_delta" and usage is not None:
+                usage.update(message.get('usage', {}))
             elif message['type'] == "message_stop":
                 return "\n"
-
-
-def get_existing_pillar_responses(wafr_accelerator_runs_table, analysis_id, analysis_submitter):
-    
-    pillar_responses = []    
-    logger.info (f"analysis_id : {analysis_id}")
-    logger.info (f"analysis_submitter: " + analysis_submitter)
-    
-    response = wafr_accelerator_runs_table.query(
-        ProjectionExpression ='pillars',
-        KeyConditionExpression=Key('analysis_id').eq(analysis_id) & Key('analysis_submitter').eq(analysis_submitter),
-        ConsistentRead=True, 
-        ScanIndexForward=True  
-    )
-
-    logger.info (f"Existing pillar responses stored in wafr_prompts_table table : {response}" )
-
-    items = response['Items']
-    
-    logger.debug (f"items assigned: {items}" )
-    
-    logger.info (f"Items length: {len(response['Items'])}" )
-    
-    try:
-        if len(response['Items']) > 0: 
-            for item in items:
-                pillars = item['pillars']
-                logger.info (pillars)
-                for pillar in pillars:
-                    logger.info (pillar)
-                    pillar_response = {
-                        'pillar_name': pillar['pillar_name'],
-                        'pillar_id': str(pillar['pillar_id']),
-                        'llm_response': pillar['llm_response']
-                    }
-                    logger.info (f"pillar_response {pillar_response}")                
-                    # Add the dictionary object to the list
-                    pillar_responses.append(pillar_response)             
-        else:
-            logger.info("List is empty")
-            
-    except Exception as error:
-        logger.info("Exception caught by try loop in get_existing_pillar_responses! Looks attribute is empty.")
-        logger.info(f"Error received is: {error}")
-        
-    return pillar_responses
\ No newline at end of file
@@ -0,0 +1,140 @@
+import re
+import bisect
+
+# Tagged sections of the per question response requested in the prompt (see generate_prompts_for_six_pillars)
+RESPONSE_SECTIONS = ('question', 'assessment', 'best_practices_followed', 'recommendations_and_examples', 'citations', 'risk')
+CHOICES_SECTION = 'wafr_answer_choices'
+# Sections the notes of the answer in the Well-Architected Tool are made of
+NOTES_SECTIONS = ('assessment', 'best_practices_followed', 'recommendations_and_examples')
+CHOICE_ID_TAG = 'id'
+
+# Open and close tags of the sections and choice ids; everything else in the response, including the other tags,
+# is skipped over by the regular expression engine without being copied
+TAG_PATTERN = re.compile(r'<(/?)(' + '|'.join(RESPONSE_SECTIONS + (CHOICES_SECTION, CHOICE_ID_TAG)) + r')>')
+# Longest tag the parser cares about, so a tag split across two streamed chunks is never missed
+MAX_TAG_LENGTH = max(len(f'</{name}>') for name in RESPONSE_SECTIONS + (CHOICES_SECTION, CHOICE_ID_TAG))
+
+# Formatting the model sometimes adds inside a section. Longest alternatives first so they win over their prefixes
+SECTION_JUNK_PATTERN = re.compile(r'\*\*wafr_answer_choices:\*\*|```xml|```|\*\*|</?b>|</?citations?>|Recommendations:|Assessment:')
+
+def clean_section(content):
+    return SECTION_JUNK_PATTERN.sub('', content).strip()
+
+def parse_response(content):
+    """
+    Walks the model response once and returns every tagged section plus the selected choice ids.
+
+    Like the earlier find based extraction, a section is the text between the first opening tag and the
+    first closing tag after it, and choice ids are only taken from a closed <wafr_answer_choices> block.
+    Missing sections are returned as empty strings.
+    """
+
+    parser = IncrementalResponseParser()
+    parser.feed(content)
+
+    return parser.close()
+
+class IncrementalResponseParser:
+    """
+    parse_response for a response that arrives in chunks. feed() returns (name, value) events for the
+    sections that closed in that chunk, with name 'choices' for the selected choice ids, so callers can act
+    on a section while the rest of the response is still being generated. Each character is scanned once, and
+    chunks are kept as they arrive instead of being appended to one string, so feeding stays linear in the length
+    of the response.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.chunk_starts = []
+        self.length = 0
+        self.parsed = dict.fromkeys(RESPONSE_SECTIONS, '')
+        self.parsed['choices'] = []
+
+        self.scan_position = 0
+        self.section_starts = {}
+        self.closed_sections = set()
+
+        self.choices_open = self.choices_closed = False
+        self.choice_id_start = -1
+        self.pending_choices = []
+
+    @property
+    def text(self):
+        """The response fed so far."""
+        return ''.join(self.chunks)
+
+    def feed(self, chunk):
+
+        events = []
+        if not chunk:
+            return events
+
+        self.chunk_starts.append(self.length)
+        self.chunks.append(chunk)
+        self.length += len(chunk)
+
+        # Positions are offsets into the whole response. Only the text from the scan position on is searched: the
+        # new chunk and at most a tag's length of the chunks before it
+        window_start = self.scan_position
+        last_tag_end = window_start
+        for tag in TAG_PATTERN.finditer(self.slice(window_start, self.length)):
+            is_close, name = tag.groups()
+            tag_start, tag_end = tag.span()
+            last_tag_end = window_start + tag_end
+            event = self.handle_tag(is_close, name, window_start + tag_start, last_tag_end)
+            if event:
+                events.append(event)
+
+        # Only the tail can hold the start of a tag that the next chunk completes
+        self.scan_position = max(last_tag_end, self.length - MAX_TAG_LENGTH)
+
+        return events
+
+    def close(self):
+        return self.parsed
+
+    def slice(self, start, end):
+        """The response text from start to end, copied from the chunks that hold it."""
+
+        # A whole response fed at once (parse_response) is a single chunk
+        if len(self.chunks) == 1:
+            return self.chunks[0][start:end]
+
+        pieces = []
+        for index in range(bisect.bisect_right(self.chunk_starts, start) - 1, len(self.chunks)):
+            chunk_start = self.chunk_starts[index]
+            if chunk_start >= end:
+                break
+            pieces.append(self.chunks[index][max(start - chunk_start, 0):end - chunk_start])
+
+        return ''.join(pieces)
+
+    def handle_tag(self, is_close, name, tag_start, tag_end):
+
+        if name in RESPONSE_SECTIONS:
+            if name in self.closed_sections:
+                return None
+            if not is_close:
+                self.section_starts.setdefault(name, tag_end)
+            elif name in self.section_starts:
+                self.parsed[name] = clean_section(self.slice(self.section_starts[name], tag_start))
+                self.closed_sections.add(name)
+                return (name, self.parsed[name])
+
+        elif name == CHOICES_SECTION:
+            if not is_close and not self.choices_closed:
+                self.choices_open = True
+            elif is_close and self.choices_open:
+                self.parsed['choices'] = self.pending_choices
+                self.choices_open = False
+                self.choices_closed = True
+                return ('choices', self.parsed['choices'])
+
+        elif name == CHOICE_ID_TAG and self.choices_open:
+            if not is_close:
+                self.choice_id_start = tag_end
+            elif self.choice_id_start != -1:
+                self.pending_choices.append(self.slice(self.choice_id_start, tag_start).strip())
+                self.choice_id_start = -1
+
+        return None
@@ -1,38 +1,50 @@
 import os
-import boto3
 import json
 import datetime
 import time
 import logging
 
-from boto3.dynamodb.conditions import Key
-from boto3.dynamodb.conditions import Attr
-
-from botocore.client import Config
 from botocore.exceptions import ClientError
 
-s3 = boto3.resource('s3')
-s3client = boto3.client('s3')
-dynamodb = boto3.resource('dynamodb')
+import aws_clients
+import cassettes
+import emf_metrics
+import structured_logging
+import reference_data_cache
+import document_index
+import review_lenses
+import progress
+
+s3 = aws_clients.lazy_resource('s3')
+s3client = aws_clients.lazy_client('s3')
+dynamodb = aws_clients.lazy_resource('dynamodb')
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 WAFR_REFERENCE_DOCS_BUCKET = os.environ['WAFR_REFERENCE_DOCS_BUCKET']
 
+@cassettes.recorded
 def lambda_handler(event, context):
     
     entry_timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H-%M-%S-%f")
     
+    structured_logging.start_invocation(logger, event)
+    
     logger.info(f"generate_prompts_for_all_the_selected_pillars invoked at {entry_timestamp}")
     
-    logger.info(json.dumps(event))
+    logger.info("Event: %s", structured_logging.capped(event))
 
     data = event
     wafr_accelerator_runs_table = dynamodb.Table(data['wafr_accelerator_runs_table'])
     wafr_prompts_table = dynamodb.Table(data['wafr_prompts_table'])
     wafr_accelerator_run_key = data['wafr_accelerator_run_key']
     
+    progress.set_progress_stage(wafr_accelerator_runs_table, wafr_accelerator_run_key, "generate_prompts")
+    
+    emf_metrics.start_invocation("generate_prompts", wafr_accelerator_run_key['analysis_id'], data['llm_model_id'], data['wafr_accelerator_run_items']['selected_lens'])
+    stage_start = time.time()
+    
     try:
     
         document_s3_key = data['wafr_accelerator_run_items']['document_s3_key']
@@ -44,11 +56,10 @@ def lambda_handler(event, context):
         wafr_workload_id = data['wafr_accelerator_run_items'] ['wafr_workload_id']
         lens_alias = data['wafr_accelerator_run_items'] ['lens_alias']
         
-        waclient = boto3.client('wellarchitected', region_name=region)
+        waclient = aws_clients.client('wellarchitected', region_name=region)
         
-        bedrock_config = Config(connect_timeout=120, region_name=region, read_timeout=120, retries={'max_attempts': 0})
-        bedrock_client = boto3.client('bedrock-runtime',region_name=region)
-        bedrock_agent_client = boto3.client("bedrock-agent-runtime", config=bedrock_config)
+        bedrock_agent_client = aws_clients.client("bedrock-agent-runtime", region_name=region, connect_timeout=120, read_timeout=120, retries={'max_attempts': 0})
+        bedrock_client = aws_clients.client("bedrock-runtime", region_name=region)
     
         return_response = {}
 
@@ -58,17 +69,43 @@ def lambda_handler(event, context):
         pillar_name_alias_mappings = get_pillar_name_alias_mappings ()
         logger.info(pillar_name_alias_mappings)
     
-        pillars_dictionary = get_pillars_dictionary (waclient, wafr_workload_id, lens_alias)
+        # Every lens of the analysis is reviewed against the same extracted text, summary and section index, and its
+        # pillars join the one list of pillar prompts the Map state answers under a single concurrency limit
+        lens_pillars = []
+        pillars_dictionaries = {}
+        for lens in review_lenses.review_lenses(wafr_lens, lens_alias, data['wafr_accelerator_run_items'].get('additional_lenses')):
+            pillars_dictionaries[lens['lens_tag']] = get_pillars_dictionary (waclient, wafr_workload_id, lens['lens_alias'])
+            lens_pillars.extend((lens, item) for item in pillars if item in pillars_dictionaries[lens['lens_tag']])
 
         extracted_document_text = read_s3_file (data['extract_output_bucket'], data['extract_text_file_name'])
+        
+        # Large documents are indexed by section once per review, and each question's prompt gets the architecture
+        # summary plus the sections relevant to the question instead of the whole document
+        architecture_summary = get_architecture_summary(wafr_accelerator_runs_table, wafr_accelerator_run_key)
+        section_index_filename = document_s3_key[:document_s3_key.rfind('.')] + "-section-index.json"
+        
+        # An update of an earlier review compares the sections of both versions of the document, carries forward the
+        # answers of the questions whose relevant sections did not change, and only prompts for the rest
+        previous_review = get_previous_review(wafr_accelerator_runs_table, data['wafr_accelerator_run_items'], extract_output_bucket, bedrock_client)
+        
+        section_index = document_index.load_index(bedrock_client, extracted_document_text, extract_output_bucket, section_index_filename, required=previous_review is not None)
+        
+        if previous_review:
+            section_changes = document_index.changed_sections(section_index, previous_review['section_index'])
+            logger.info (f"{len(section_changes[0])} sections added or edited and {len(section_changes[1])} removed since analysis {previous_review['analysis_id']}")
+            emf_metrics.put_metric("DocumentSectionsChanged", len(section_changes[0]) + len(section_changes[1]))
+        
+        carried_questions = []
     
         pillar_counter = 0 
 
         #Get all the pillar prompts in a loop
-        for item in pillars:
+        for lens, item in lens_pillars:
             
             prompt_file_locations = []
-            logger.info (f"selected_pillar: {item}") 
+            logger.info (f"selected_pillar: {item} of {lens['wafr_lens']}") 
+            # Prompt files of additional lenses are prefixed with the lens tag
+            lens_prefix = lens['lens_tag'] + "-" if lens['lens_tag'] else ""
             response = ""
             logger.debug ("document_s3_key.rstrip('.'): " + document_s3_key.rstrip('.'))
             logger.debug ("document_s3_key[:document_s3_key.rfind('.')]: " + document_s3_key[:document_s3_key.rfind('.')] )
@@ -83,46 +120,60 @@ def lambda_handler(event, context):
 
             logger.info (f"generate_prompts_for_all_the_selected_pillars checkpoint 1.{pillar_counter}")
             
-            questions = pillars_dictionary[current_wafr_pillar]["wafr_q"]
+            questions = pillars_dictionaries[lens['lens_tag']][current_wafr_pillar]["wafr_q"]
             
-            logger.debug (json.dumps(questions))
+            logger.debug ("questions: %s", structured_logging.capped(questions))
             
             logger.debug (f"generate_prompts_for_all_the_selected_pillars checkpoint 2.{pillar_counter}")
             
             for question in questions: 
                 
-                logger.info (json.dumps(question))
+                logger.debug ("question: %s", structured_logging.capped(question))
                 
                 logger.debug (f"generate_prompts_for_all_the_selected_pillars checkpoint 3.{pillar_counter}.{question_array_counter}")
                 
                 pillar_specfic_question_id = question["id"]
                 pillar_specfic_prompt_question = question["text"]
                 pillar_specfic_wafr_answer_choices = question["wafr_answer_choices"]
+                question_key = review_lenses.scoped(lens['lens_tag'], pillar_specfic_question_id)
                 
                 logger.info (f"pillar_specfic_question_id: {pillar_specfic_question_id}")
                 logger.info (f"pillar_specfic_prompt_question: {pillar_specfic_prompt_question}")
-                logger.info (f"pillar_specfic_wafr_answer_choices: {json.dumps(pillar_specfic_wafr_answer_choices)}")
+                logger.debug ("pillar_specfic_wafr_answer_choices: %s", structured_logging.capped(pillar_specfic_wafr_answer_choices))
 
                 logger.debug (f"generate_prompts_for_all_the_selected_pillars checkpoint 4.{pillar_counter}.{question_array_counter}")
-                claude_prompt_body = bedrock_prompt(wafr_lens, current_wafr_pillar, pillar_specfic_question_id, pillar_specfic_wafr_answer_choices, pillar_specfic_prompt_question, knowledge_base_id, bedrock_agent_client, extracted_document_text, WAFR_REFERENCE_DOCS_BUCKET)
+                # The choice titles name the best practices, so they are scored along with the question
+                question_query = " ".join([pillar_specfic_prompt_question] + [choice["text"] for choice in pillar_specfic_wafr_answer_choices])
                 
-                logger.debug (f"generate_prompts_for_all_the_selected_pillars checkpoint 5.{pillar_counter}.{question_array_counter}")
-
-                # Write the textract output to a txt file 
-                output_bucket = s3.Bucket(extract_output_bucket)
                 logger.debug ("document_s3_key.rstrip('.'): " + document_s3_key.rstrip('.'))
                 logger.debug ("document_s3_key[:document_s3_key.rfind('.')]: " + document_s3_key[:document_s3_key.rfind('.')] )
-                pillar_review_prompt_filename = document_s3_key[:document_s3_key.rfind('.')]+ "-" + pillar_name_alias_mappings[item] + "-" + pillar_specfic_question_id + "-prompt.txt"
-                logger.info (f"Output prompt file name: {pillar_review_prompt_filename}")
+                pillar_review_prompt_filename = document_s3_key[:document_s3_key.rfind('.')]+ "-" + lens_prefix + pillar_name_alias_mappings[item] + "-" + pillar_specfic_question_id + "-prompt.txt"
                 
-                # Upload the file to S3
-                output_bucket.put_object(Key=pillar_review_prompt_filename, Body=claude_prompt_body)
+                if (previous_review and previous_review['question_status'].get(question_key) == "Completed"
+                        and not document_index.question_changed(bedrock_client, section_index, previous_review['section_index'], section_changes, question_query)
+                        and carry_forward_question(extract_output_bucket, previous_review, lens_prefix + pillar_name_alias_mappings[item], pillar_specfic_question_id, pillar_review_prompt_filename)):
+                    # Answered by the earlier review from the same sections; generate_pillar_question_response reuses the copied assessment
+                    logger.info (f"Question {question_key} unchanged since analysis {previous_review['analysis_id']}, carried forward")
+                    carried_questions.append(question_key)
+                else:
+                    document_content = document_index.relevant_content(bedrock_client, section_index, extracted_document_text, [question_query], architecture_summary)
+                    claude_prompt_body = bedrock_prompt(lens['wafr_lens'], current_wafr_pillar, pillar_specfic_question_id, pillar_specfic_wafr_answer_choices, pillar_specfic_prompt_question, knowledge_base_id, bedrock_agent_client, document_content, WAFR_REFERENCE_DOCS_BUCKET)
+                    
+                    logger.debug (f"generate_prompts_for_all_the_selected_pillars checkpoint 5.{pillar_counter}.{question_array_counter}")
+
+                    # Write the textract output to a txt file 
+                    output_bucket = s3.Bucket(extract_output_bucket)
+                    logger.info (f"Output prompt file name: {pillar_review_prompt_filename}")
+                    
+                    # Upload the file to S3
+                    output_bucket.put_object(Key=pillar_review_prompt_filename, Body=claude_prompt_body)
                 
                 logger.debug (f"generate_prompts_for_all_the_selected_pillars checkpoint 6.{pillar_counter}.{question_array_counter}")
                 question_metadata = {}
                 
                 question_metadata["pillar_review_prompt_filename"] = pillar_review_prompt_filename  ##########
                 question_metadata["pillar_specfic_question_id"] = pillar_specfic_question_id
+                question_metadata["question_key"] = question_key
                 question_metadata["pillar_specfic_prompt_question"] = pillar_specfic_prompt_question
                 question_metadata["pillar_specfic_wafr_answer_choices"] = pillar_specfic_wafr_answer_choices
                 
@@ -138,9 +189,13 @@ def lambda_handler(event, context):
             pillar_prompts['extract_output_bucket'] = data['extract_output_bucket'] 
             pillar_prompts['wafr_accelerator_runs_table'] = data ['wafr_accelerator_runs_table'] 
             pillar_prompts['wafr_prompts_table'] = data ['wafr_prompts_table'] 
+            pillar_prompts['wafr_findings_table'] = data.get('wafr_findings_table', '')
             pillar_prompts['llm_model_id'] =  data ['llm_model_id']                
             pillar_prompts['region'] = data['region']
             pillar_prompts['input_pillar'] = item
+            pillar_prompts['wafr_lens'] = lens['wafr_lens']
+            pillar_prompts['lens_alias'] = lens['lens_alias']
+            pillar_prompts['lens_tag'] = lens['lens_tag']
             
             return_response['wafr_accelerator_run_items'] = data ['wafr_accelerator_run_items']
     
@@ -153,6 +208,40 @@ def lambda_handler(event, context):
             pillar_counter =  pillar_counter + 1
             
         logger.debug (f"generate_prompts_for_all_the_selected_pillars checkpoint 10")
+        
+        # Record the question manifest and per question status so a failed review can be redriven question by question.
+        # pillars starts as an empty map that each pillar then fills in with its own entry
+        question_manifest_key = write_question_manifest(extract_output_bucket, document_s3_key, all_pillar_prompts)
+        
+        question_status = {}
+        for pillar_prompts in all_pillar_prompts:
+            for question_metadata in pillar_prompts[pillar_prompts['input_pillar']]:
+                question_status[question_metadata["question_key"]] = "Pending"
+        
+        for question_id in carried_questions:
+            question_status[question_id] = "Completed"
+        
+        if previous_review:
+            carry_forward_findings(data.get('wafr_findings_table', ''), previous_review['analysis_id'], data['wafr_accelerator_run_items'], carried_questions)
+            emf_metrics.put_metric("QuestionsCarriedForward", len(carried_questions))
+        
+        wafr_accelerator_runs_table.update_item(
+            Key=wafr_accelerator_run_key,
+            UpdateExpression="SET question_manifest_key = :val1, question_status = :val2, pillars = :val3, progress_total = :total, progress_done = :done, progress_unit = :unit",
+            ExpressionAttributeValues={
+                ':val1': question_manifest_key,
+                ':val2': question_status,
+                ':val3': {},
+                ':total': len(question_status),
+                ':done': len(carried_questions),
+                ':unit': "questions"
+            },
+            ReturnValues='NONE'
+        )
+        
+        progress.set_progress_stage(wafr_accelerator_runs_table, wafr_accelerator_run_key, "answer_questions")
+        
+        logger.debug (f"generate_prompts_for_all_the_selected_pillars checkpoint 10.1")
 
     except Exception as error:
         all_pillar_prompts = []
@@ -167,12 +256,17 @@ def lambda_handler(event, context):
         
     logger.debug (f"generate_prompts_for_all_the_selected_pillars checkpoint 11")
     
+    emf_metrics.put_metrics({
+        'StageDuration': ((time.time() - stage_start) * 1000, 'Milliseconds'),
+        'PromptsGenerated': (sum(len(pillar_prompts[pillar_prompts['input_pillar']]) for pillar_prompts in all_pillar_prompts), 'Count')
+    })
+    
     return_response = {}
 
     return_response = data
     return_response['all_pillar_prompts'] =  all_pillar_prompts
 
-    logger.info(f"return_response: {return_response}")
+    logger.info("return_response: %s", structured_logging.capped(return_response))
     
     exit_timeestamp = datetime.datetime.now().strftime("%Y-%m-%d %H-%M-%S-%f")
     logger.info(f"Exiting generate_prompts_for_all_the_selected_pillars at {exit_timeestamp}")
@@ -183,7 +277,97 @@ def lambda_handler(event, context):
         'body': return_response
     }
 
+def get_architecture_summary(wafr_accelerator_runs_table, wafr_accelerator_run_key):
+    
+    response = wafr_accelerator_runs_table.get_item(
+        Key=wafr_accelerator_run_key,
+        ProjectionExpression='architecture_summary'
+    )
+    
+    return response.get('Item', {}).get('architecture_summary', '')
+
+def get_previous_review(wafr_accelerator_runs_table, wafr_accelerator_run_items, bucket, bedrock_client):
+    
+    previous_analysis_id = wafr_accelerator_run_items.get('previous_analysis_id')
+    if not previous_analysis_id:
+        return None
+    
+    response = wafr_accelerator_runs_table.get_item(
+        Key={
+            'analysis_id': previous_analysis_id,
+            'analysis_submitter': wafr_accelerator_run_items['analysis_submitter']
+        },
+        ProjectionExpression='document_s3_key, question_status'
+    )
+    previous_analysis = response.get('Item', {})
+    
+    if not previous_analysis.get('question_status'):
+        logger.info (f"Analysis {previous_analysis_id} has no answered questions to carry forward")
+        return None
+    
+    previous_document_base = previous_analysis['document_s3_key'][:previous_analysis['document_s3_key'].rfind('.')]
+    
+    try:
+        previous_document_text = read_s3_file(bucket, previous_document_base + "-extracted-text.txt")
+    except ClientError as error:
+        # Without the earlier text nothing can be compared, so every question is answered again
+        logger.info (f"Extracted text of analysis {previous_analysis_id} not available, answering every question: {error}")
+        return None
+    
+    return {
+        'analysis_id': previous_analysis_id,
+        'document_base': previous_document_base,
+        'question_status': previous_analysis['question_status'],
+        'section_index': document_index.load_index(bedrock_client, previous_document_text, bucket, previous_document_base + "-section-index.json", required=True)
+    }
+
+def carry_forward_question(bucket, previous_review, pillar_alias, question_id, pillar_review_prompt_filename):
+    
+    previous_output_filename = previous_review['document_base'] + "-" + pillar_alias + "-" + question_id + "-prompt-output.txt"
+    pillar_review_prompt_ouput_filename = pillar_review_prompt_filename[:pillar_review_prompt_filename.rfind('.')] + "-output.txt"
+    
+    try:
+        s3client.copy_object(Bucket=bucket, Key=pillar_review_prompt_ouput_filename, CopySource={'Bucket': bucket, 'Key': previous_output_filename})
+    except ClientError as error:
+        logger.info (f"Assessment {previous_output_filename} not available, answering question {question_id} again: {error}")
+        return False
+    
+    return True
+
+def carry_forward_findings(wafr_findings_table_name, previous_analysis_id, wafr_accelerator_run_items, question_ids):
+    
+    # Reviews started before the findings table existed have no table name in their payload
+    if not wafr_findings_table_name:
+        return
+    
+    wafr_findings_table = dynamodb.Table(wafr_findings_table_name)
+    
+    for question_id in question_ids:
+        finding = wafr_findings_table.get_item(Key={'analysis_id': previous_analysis_id, 'question_id': question_id}).get('Item')
+        if finding is None:
+            continue
+        
+        finding['analysis_id'] = wafr_accelerator_run_items['analysis_id']
+        finding['analysis_submitter'] = wafr_accelerator_run_items['analysis_submitter']
+        finding['carried_forward_from'] = previous_analysis_id
+        finding['risk_analysis'] = f"{finding.get('risk_level', 'Unknown')}#{finding['analysis_id']}"
+        
+        wafr_findings_table.put_item(Item=finding)
+
+def write_question_manifest(bucket, document_s3_key, all_pillar_prompts):
+    
+    question_manifest_key = document_s3_key[:document_s3_key.rfind('.')] + "-question-manifest.json"
+    
+    s3client.put_object(Bucket=bucket, Key=question_manifest_key, Body=json.dumps(all_pillar_prompts).encode('utf-8'))
+    
+    logger.info (f"Question manifest written to {question_manifest_key}")
+    
+    return question_manifest_key
+
 def get_pillar_name_alias_mappings():
+    return reference_data_cache.get_static('pillar_name_alias_mappings', build_pillar_name_alias_mappings)
+
+def build_pillar_name_alias_mappings():
 
     mappings = {}
     
@@ -209,10 +393,11 @@ def get_pillars_dictionary(waclient, wafr_workload_id, lens_alias):
     
 def get_lens_review(client, workload_id, lens_alias):
     try:
-        response = client.get_lens_review(
-            WorkloadId=workload_id,
-            LensAlias=lens_alias
-        )
+        with emf_metrics.timed("wa_get_lens_review"):
+            response = client.get_lens_review(
+                WorkloadId=workload_id,
+                LensAlias=lens_alias
+            )
       
         lens_review = response['LensReview']
         formatted_data = {
@@ -287,6 +472,9 @@ def get_lens_review(client, workload_id, lens_alias):
         return None
 
 def get_lens_filter(kb_bucket, wafr_lens):
+    return reference_data_cache.get_static('lens_filter', build_lens_filter, kb_bucket, wafr_lens)
+
+def build_lens_filter(kb_bucket, wafr_lens):
 
     # Map lens prefixes to their corresponding lens names - will make it easier to add additional lenses
     lens_mapping = {
@@ -366,13 +554,11 @@ def bedrock_prompt(wafr_lens, pillar, pillar_specfic_question_id, pillar_specfic
         Example: BP 15.5: Optimize your data modeling and data storage for efficient data retrieval
     8) Do not make any assumptions or make up information. Your responses should only be based on the actual solution document provided in the "uploaded_document" section.
     9) Based on the assessment, select the most appropriate choices applicable from the choices provided within the <pillar_choices> section. Do not make up ids and use only the ids specified in the provided choices.
-    10) Return the entire response strictly in well-formed XML format. There should not be any text outside the XML response. Use the following XML structure, and ensure that the XML tags are in the same order:
+    10) Rate the risk of the solution architecture for this question as High, Medium or None, based on how many of the important best practices are not followed, and return it within <risk> and </risk> tags.
+    11) Return the entire response strictly in well-formed XML format. There should not be any text outside the XML response. Use the following XML structure, and ensure that the XML tags are in the same order:
         <response>
             <question>This is the input question</question>
             <assessment>This is assessment</assessment>
-            <best_practices_followed>Best practices followed with citaiton fom Well Architected best practices for the pillar</best_practices_followed>
-            <recommendations_and_examples>Recommendations with examples</recommendations_and_examples>
-            <citations>citations<citations>
             <wafr_answer_choices>
                 <choice>
                     <id>sec_securely_operate_multi_accounts</id>
@@ -387,6 +573,10 @@ def bedrock_prompt(wafr_lens, pillar, pillar_specfic_question_id, pillar_specfic
                     <id>sec_securely_operate_updated_threats</id>
                 </choice>
             </wafr_answer_choices>
+            <risk>High, Medium or None</risk>
+            <best_practices_followed>Best practices followed with citaiton fom Well Architected best practices for the pillar</best_practices_followed>
+            <recommendations_and_examples>Recommendations with examples</recommendations_and_examples>
+            <citations>citations</citations>
         </response>
     </instructions>
     """
@@ -446,20 +636,21 @@ def retrieve(question, kbId, bedrock_agent_client, lens_filter, pillar, wafr_len
     Question: {question}"""
     
     logger.debug (f"question: {question}")
-    logger.debug (f"kb_prompt: {kb_prompt}")
-    
-    return bedrock_agent_client.retrieve(
-        retrievalQuery= {
-            'text': kb_prompt
-        },
-        knowledgeBaseId=kbId,
-        retrievalConfiguration={
-            'vectorSearchConfiguration':{
-                'numberOfResults': 20,
-                "filter": lens_filter
+    logger.debug ("kb_prompt: %s", structured_logging.capped(kb_prompt))
+    
+    with emf_metrics.timed("kb_retrieve", Pillar=pillar):
+        return bedrock_agent_client.retrieve(
+            retrievalQuery= {
+                'text': kb_prompt
+            },
+            knowledgeBaseId=kbId,
+            retrievalConfiguration={
+                'vectorSearchConfiguration':{
+                    'numberOfResults': 20,
+                    "filter": lens_filter
+                }
             }
-        }
-    )
+        )
     
 def get_contexts(retrievalResults):
     contexts = []
@@ -484,8 +675,8 @@ def read_s3_file (bucket, filename):
         Key=filename,
     )
     
-    logger.info (f"read_s3_file: {document_text_object}")
+    logger.debug ("read_s3_file: %s", structured_logging.capped(document_text_object))
     
-    document_text = document_text_object['Body'].read()
+    document_text = document_text_object['Body'].read().decode('utf-8')
     
     return document_text
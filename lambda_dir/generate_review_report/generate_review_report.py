@@ -0,0 +1,52 @@
+import os
+import datetime
+import logging
+
+import aws_clients
+import cassettes
+import emf_metrics
+import structured_logging
+import review_report
+
+UPLOAD_BUCKET_NAME = os.environ['UPLOAD_BUCKET_NAME']
+WAFR_FINDINGS_DD_TABLE_NAME = os.environ.get('WAFR_FINDINGS_DD_TABLE_NAME', '')
+
+dynamodb = aws_clients.lazy_resource('dynamodb')
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+@cassettes.recorded
+def lambda_handler(event, context):
+
+    entry_timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H-%M-%S-%f")
+
+    structured_logging.start_invocation(logger, event)
+
+    logger.info(f"generate_review_report invoked at {entry_timestamp}")
+    logger.info("Event: %s", structured_logging.capped(event))
+
+    # The output of update_review_status; reviews that did not complete get their report when a redrive completes them
+    if event.get('body') != 'Success':
+        logger.info("Review did not complete, no report rendered")
+        return event
+
+    wafr_accelerator_runs_table = dynamodb.Table(event['wafr_accelerator_runs_table'])
+    wafr_accelerator_run_key = event['wafr_accelerator_run_key']
+
+    emf_metrics.start_invocation("generate_review_report", wafr_accelerator_run_key['analysis_id'])
+
+    return_response = dict(event)
+
+    try:
+        return_response['report_prefix'] = review_report.publish(wafr_accelerator_runs_table, wafr_accelerator_run_key, UPLOAD_BUCKET_NAME, WAFR_FINDINGS_DD_TABLE_NAME)
+    except Exception as error:
+        # The review itself is complete; the UI renders reviews without a report from the run item
+        logger.error(f"Exception caught in generate_review_report: {error}")
+        emf_metrics.put_metric("ReportsFailed", 1)
+
+    exit_timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H-%M-%S-%f")
+
+    logger.info(f"Exiting generate_review_report at {exit_timestamp}")
+
+    return return_response
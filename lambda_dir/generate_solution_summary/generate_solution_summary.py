@@ -1,26 +1,34 @@
-import boto3
-import json
 import datetime
+import time
 import logging
 
-from botocore.client import Config
 from botocore.exceptions import ClientError
 
-dynamodb = boto3.resource('dynamodb')
-s3 = boto3.resource('s3')
-s3client = boto3.client('s3')
-wa_client = boto3.client('wellarchitected')
+import aws_clients
+import cassettes
+import emf_metrics
+import structured_logging
+import document_summary
+import progress
+
+dynamodb = aws_clients.lazy_resource('dynamodb')
+s3 = aws_clients.lazy_resource('s3')
+s3client = aws_clients.lazy_client('s3')
+wa_client = aws_clients.lazy_client('wellarchitected')
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+@cassettes.recorded
 def lambda_handler(event, context):
     
     entry_timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H-%M-%S")
     
+    structured_logging.start_invocation(logger, event)
+    
     logger.info(f"generate_solution_summary invoked at {entry_timestamp}")
     
-    logger.info(json.dumps(event))
+    logger.info("Event: %s", structured_logging.capped(event))
 
     # Extract data from the input event
     return_response = data = event
@@ -30,19 +38,20 @@ def lambda_handler(event, context):
     # Set up Bedrock client
     REGION = data['region']
     LLM_MODEL_ID = data['llm_model_id']
-    bedrock_config = Config(connect_timeout=120, region_name=REGION, read_timeout=120, retries={'max_attempts': 0})
-    bedrock_client = boto3.client('bedrock-runtime', config=bedrock_config)
+    bedrock_client = aws_clients.client('bedrock-runtime', region_name=REGION, connect_timeout=120, read_timeout=120, retries={'max_attempts': 0})
+
+    progress.set_progress_stage(wafr_accelerator_runs_table, wafr_accelerator_run_key, "generate_solution_summary")
+
+    emf_metrics.start_invocation("generate_solution_summary", wafr_accelerator_run_key['analysis_id'], LLM_MODEL_ID, data['wafr_accelerator_run_items']['selected_lens'])
+    stage_start = time.time()
 
     try:
         extracted_document_text = read_s3_file (data['extract_output_bucket'], data['extract_text_file_name'])
 
-        # Prepare prompts for solution summary and workload description
-        prompt = f"The following document is a solution architecture document that you are reviewing as an AWS Cloud Solutions Architect. Please summarise the following solution in 250 words. Begin directly with the architecture summary, don't provide any other opening or closing statements.\n\n<Architecture>\n{extracted_document_text}\n</Architecture>\n"
+        # Generate the summary using Bedrock, in chunks for documents too large for one request
+        summary = document_summary.summarize(bedrock_client, LLM_MODEL_ID, extracted_document_text, data['wafr_accelerator_run_items'].get('bypass_response_cache', False))
 
-        # Generate summaries using Bedrock model
-        summary = invoke_bedrock_model(bedrock_client, LLM_MODEL_ID, prompt)
-
-        logger.info(f"Solution Summary: {summary}")
+        logger.info("Solution Summary: %s", structured_logging.capped(summary))
 
         # Update DynamoDB item with the generated summary
         update_dynamodb_item(wafr_accelerator_runs_table, wafr_accelerator_run_key, summary)
@@ -61,7 +70,8 @@ def lambda_handler(event, context):
         raise Exception (f'Exception caught in generate_solution_summary: {error}')
 
     # Prepare and return the response
-    logger.info(f"return_response: {json.dumps(return_response)}")
+    logger.info("return_response: %s", structured_logging.capped(return_response))
+    emf_metrics.put_metric("StageDuration", (time.time() - stage_start) * 1000, "Milliseconds")
     logger.info(f"Exiting generate_solution_summary at {datetime.datetime.now().strftime('%Y-%m-%d %H-%M-%S-%f')}")
 
     return {'statusCode': 200, 'body': return_response}
@@ -75,27 +85,10 @@ def read_s3_file (bucket, filename):
     
     logger.info (document_text_object)
     
-    document_text = document_text_object['Body'].read()
+    document_text = document_text_object['Body'].read().decode('utf-8')
     
     return document_text
     
-def invoke_bedrock_model(bedrock_client, model_id, prompt):
-    # Invoke Bedrock model and return the generated text
-    response = bedrock_client.invoke_model(
-        modelId=model_id,
-        contentType="application/json",
-        accept="application/json",
-        body=json.dumps({
-            "anthropic_version": "bedrock-2023-05-31",
-            "max_tokens": 200000,
-            "messages": [
-                {"role": "user", "content": [{"type": "text", "text": prompt}]}
-            ]
-        })
-    )
-    response_body = json.loads(response['body'].read())
-    return response_body['content'][0]['text']
-
 def update_dynamodb_item(table, key, summary):
     # Update DynamoDB item with the generated summary
     table.update_item(
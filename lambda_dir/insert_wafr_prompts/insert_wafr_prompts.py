@@ -1,19 +1,25 @@
 import os
-import boto3
 import json
 import datetime
 import urllib.parse
 import logging
 from botocore.exceptions import ClientError
 
-s3Client = boto3.client('s3')
-s3Resource = boto3.resource('s3')
+import aws_clients
+import emf_metrics
+import structured_logging
+
+s3Client = aws_clients.lazy_client('s3')
+s3Resource = aws_clients.lazy_resource('s3')
 
 TABLE_NAME = os.environ['DD_TABLE_NAME']
 REGION_NAME = os.environ['REGION_NAME']
-dynamodb = boto3.resource('dynamodb', region_name=REGION_NAME)
-table = dynamodb.Table(TABLE_NAME)
+dynamodb = aws_clients.lazy_resource('dynamodb', region_name=REGION_NAME)
 
+# Item that records the version of the loaded prompts; Lambdas caching prompts reload them when it changes
+CONTENT_VERSION_KEY = {'wafr_lens': '__meta__', 'wafr_pillar': 'content_version'}
+# TransactWriteItems limit, including the content version item
+TRANSACT_WRITE_MAX_ITEMS = 100
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -24,9 +30,12 @@ def lambda_handler(event, context):
     
     status = 'Prompts inserted successfully!'
     
+    structured_logging.start_invocation(logger, event)
+    emf_metrics.start_invocation("insert_wafr_prompts")
+    
     logger.info(f"insert_wafr_prompts invoked at {entry_timestamp}")
     
-    logger.info(json.dumps(event))
+    logger.info("Event: %s", structured_logging.capped(event))
 
     bucket = event['Records'][0]['s3']['bucket']['name']
     key = urllib.parse.unquote_plus(event['Records'][0]['s3']['object']['key'], encoding='utf-8')
@@ -35,8 +44,6 @@ def lambda_handler(event, context):
     logger.info (message)
     logger.info (f"insert_wafr_prompts checkpoint 1")
     
-    purge_existing_data(table)
-    
     try:
         s3_input_string = "s3://" + bucket + "/" + key
         logger.info("s3_input_string is : " + s3_input_string)
@@ -50,9 +57,10 @@ def lambda_handler(event, context):
 
         logger.info (f"insert_wafr_prompts checkpoint 2")
         
-        logger.info(json.dumps(prompts_json))
+        logger.info(f"Prompts file has {len(prompts_json['data'])} prompts")
+        logger.debug("prompts_json: %s", structured_logging.capped(prompts_json))
         
-        # Iterate over the array of items
+        new_items = {}
         for item_data in prompts_json['data']:
             # Prepare the item to be inserted
             item = {
@@ -63,9 +71,33 @@ def lambda_handler(event, context):
                 'wafr_pillar_prompt': item_data['wafr_pillar_prompt']
                 #'wafr_q': item_data['wafr_q']
             }
+            new_items[(item['wafr_lens'], item['wafr_pillar'])] = item
+        
+        # Created here rather than at import, which would build the DynamoDB resource during init
+        table = dynamodb.Table(TABLE_NAME)
+        existing_items = get_existing_items(table)
+        
+        logger.info (f"insert_wafr_prompts checkpoint 3")
+        
+        # Only prompts that were added or changed are written, and only prompts no longer in the file are deleted
+        items_to_put = [item for item_key, item in new_items.items() if not same_item(existing_items.get(item_key), item)]
+        keys_to_delete = [item_key for item_key in existing_items if item_key not in new_items]
+        
+        logger.info (f"{len(items_to_put)} prompts to add or update, {len(keys_to_delete)} prompts to delete, {len(new_items) - len(items_to_put)} unchanged")
+        emf_metrics.put_metrics({'PromptsWritten': (len(items_to_put), 'Count'), 'PromptsDeleted': (len(keys_to_delete), 'Count')})
         
-            # Insert the item into the DynamoDB table
-            table.put_item(Item=item)
+        if not items_to_put and not keys_to_delete:
+            status = 'Prompts are already up to date!'
+        else:
+            content_version = datetime.datetime.now().strftime("%Y-%m-%d %H-%M-%S-%f") + "-" + response.get('ETag', '').strip('"')
+            
+            if len(items_to_put) + len(keys_to_delete) < TRANSACT_WRITE_MAX_ITEMS:
+                # Small changes and the new content version are applied as one transaction, so readers see all or none of them
+                with emf_metrics.timed("dynamodb_transact_write"):
+                    write_changes_in_transaction(items_to_put, keys_to_delete, content_version)
+            else:
+                with emf_metrics.timed("dynamodb_batch_write"):
+                    write_changes_in_batches(table, items_to_put, keys_to_delete, content_version)
 
         logger.info (f"insert_wafr_prompts checkpoint 4")
         
@@ -84,14 +116,56 @@ def lambda_handler(event, context):
         'body': json.dumps(status)
     }
             
-def purge_existing_data(table):
-    existing_items = table.scan()
+def get_existing_items(table):
+    
+    existing_items = {}
+    
+    scan_kwargs = {}
+    while True:
+        response = table.scan(**scan_kwargs)
+        for item in response['Items']:
+            if item['wafr_lens'] != CONTENT_VERSION_KEY['wafr_lens']:
+                existing_items[(item['wafr_lens'], item['wafr_pillar'])] = item
+        if 'LastEvaluatedKey' not in response:
+            break
+        scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    
+    return existing_items
+
+def same_item(existing_item, item):
+    
+    # DynamoDB returns numbers as Decimal, so compare the string forms of the values
+    if existing_item is None:
+        return False
+    
+    return {name: str(value) for name, value in existing_item.items()} == {name: str(value) for name, value in item.items()}
+
+def write_changes_in_transaction(items_to_put, keys_to_delete, content_version):
+    
+    transact_items = [{'Put': {'TableName': TABLE_NAME, 'Item': item}} for item in items_to_put]
+    transact_items += [{'Delete': {'TableName': TABLE_NAME, 'Key': {'wafr_lens': wafr_lens, 'wafr_pillar': wafr_pillar}}} for wafr_lens, wafr_pillar in keys_to_delete]
+    transact_items.append({'Put': {'TableName': TABLE_NAME, 'Item': dict(CONTENT_VERSION_KEY, content_version=content_version)}})
+    
+    dynamodb.meta.client.transact_write_items(TransactItems=transact_items)
+    
+    logger.info(f"Prompts table updated in a single transaction, content version {content_version}")
+
+def write_changes_in_batches(table, items_to_put, keys_to_delete, content_version):
+    
+    # Too many changes for one transaction. Puts overwrite prompts in place and removed prompts are deleted last,
+    # so a running review always finds every prompt it needs, then the new version tells warm Lambdas to reload
     with table.batch_writer() as batch:
-        for item in existing_items['Items']:
-            batch.delete_item(
-                Key={
-                    'wafr_lens': item['wafr_lens'],
-                    'wafr_pillar': item['wafr_pillar']
-                }
-            )
-    
\ No newline at end of file
+        for item in items_to_put:
+            batch.put_item(Item=item)
+    
+    with table.batch_writer() as batch:
+        for wafr_lens, wafr_pillar in keys_to_delete:
+            batch.delete_item(Key={'wafr_lens': wafr_lens, 'wafr_pillar': wafr_pillar})
+    
+    set_content_version(table, content_version)
+
+def set_content_version(table, content_version):
+    
+    table.put_item(Item=dict(CONTENT_VERSION_KEY, content_version=content_version))
+    
+    logger.info(f"Prompts table content version set to {content_version}")
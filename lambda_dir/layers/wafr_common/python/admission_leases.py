@@ -0,0 +1,191 @@
+import os
+import time
+import logging
+
+from botocore.exceptions import ClientError
+
+import aws_clients
+
+# Every review in flight holds one of MAX_CONCURRENT_REVIEWS slot items (slot-0, slot-1, ...) in the admission leases
+# table. A slot is taken with a conditional write, so concurrent start_wafr_review invocations can never admit more
+# reviews between them than there are slots. An inline Quick review holds its slot until it ends; a Deep review until
+# its execution stops running or, in batch mode, until its batch inference job is submitted
+ADMISSION_LEASES_DD_TABLE_NAME = os.environ.get('ADMISSION_LEASES_DD_TABLE_NAME', '')
+MAX_CONCURRENT_REVIEWS = int(os.environ.get('MAX_CONCURRENT_REVIEWS', '5'))
+# Quick review leases outlive the 15 minute Lambda timeout so a crashed invocation frees its slot on its own
+QUICK_REVIEW_LEASE_SECONDS = int(os.environ.get('QUICK_REVIEW_LEASE_SECONDS', '960'))
+# Deep slots are freed once their execution is no longer running; the lease only backs that up and outlives the
+# 26 hour state machine timeout
+DEEP_REVIEW_LEASE_SECONDS = int(os.environ.get('DEEP_REVIEW_LEASE_SECONDS', str(27 * 3600)))
+# A Deep slot is taken just before its execution is started, so it is not checked against Step Functions before this
+DEEP_REVIEW_START_GRACE_SECONDS = 120
+
+SLOT_PREFIX = 'slot-'
+# Attempts at running the request of a queue message, kept as long as the review queue keeps its messages
+ATTEMPTS_PREFIX = 'attempts-'
+ATTEMPTS_RETENTION_SECONDS = 4 * 24 * 3600
+
+dynamodb = aws_clients.lazy_resource('dynamodb')
+sf = aws_clients.lazy_client('stepfunctions', region_name=os.environ.get('REGION'))
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+def execution_arn(state_machine_arn, execution_name):
+    # arn:aws:states:<region>:<account>:stateMachine:<name> -> arn:aws:states:<region>:<account>:execution:<name>:<execution>
+    return f"{state_machine_arn.replace(':stateMachine:', ':execution:', 1)}:{execution_name}"
+
+def list_slots():
+    """The slots held now, by slot id. Slots of Deep reviews whose execution has ended are freed on the way."""
+
+    from boto3.dynamodb.conditions import Attr
+
+    leases_table = dynamodb.Table(ADMISSION_LEASES_DD_TABLE_NAME)
+    now = int(time.time())
+
+    scan_kwargs = {
+        # Expired leases linger until DynamoDB TTL removes them, so filter on expiry as well
+        'FilterExpression': Attr('lease_id').begins_with(SLOT_PREFIX) & Attr('expires_at').gt(now),
+        'ConsistentRead': True
+    }
+
+    slots = {}
+    while True:
+        response = leases_table.scan(**scan_kwargs)
+        for lease in response['Items']:
+            if lease['review_type'] == 'Deep' and not is_execution_running(lease, now):
+                free_slot(lease)
+            else:
+                slots[lease['lease_id']] = lease
+        if 'LastEvaluatedKey' not in response:
+            break
+        scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    return slots
+
+def is_execution_running(lease, now):
+
+    if now < int(lease['acquired_at']) + DEEP_REVIEW_START_GRACE_SECONDS:
+        return True
+
+    try:
+        return sf.describe_execution(executionArn=lease['execution_arn'])['status'] == 'RUNNING'
+    except ClientError as error:
+        if error.response['Error']['Code'] == 'ExecutionDoesNotExist':
+            # Never started, e.g. the invocation that took the slot failed before start_execution
+            return False
+        # Keep the slot until its lease expires rather than risk admitting too many reviews
+        logger.info (f"Unable to look up execution {lease['execution_arn']}, keeping slot {lease['lease_id']}: {error}")
+        return True
+
+def acquire_slot(slots, holder, analysis_id, review_type, execution_arn=None):
+    """
+    Takes a free slot for holder (the execution name of the request) and adds it to slots. Returns the slot id, or
+    None when every slot is held.
+    """
+
+    leases_table = dynamodb.Table(ADMISSION_LEASES_DD_TABLE_NAME)
+    now = int(time.time())
+    lease_seconds = QUICK_REVIEW_LEASE_SECONDS if review_type == 'Quick' else DEEP_REVIEW_LEASE_SECONDS
+
+    for index in range(MAX_CONCURRENT_REVIEWS):
+        slot_id = f"{SLOT_PREFIX}{index}"
+        if slot_id in slots:
+            continue
+
+        lease = {
+            'lease_id': slot_id,
+            'holder': holder,
+            'analysis_id': analysis_id,
+            'review_type': review_type,
+            'acquired_at': now,
+            'expires_at': now + lease_seconds
+        }
+        if execution_arn:
+            lease['execution_arn'] = execution_arn
+
+        try:
+            leases_table.put_item(
+                Item=lease,
+                ConditionExpression="attribute_not_exists(lease_id) OR expires_at < :now",
+                ExpressionAttributeValues={':now': now}
+            )
+        except ClientError as error:
+            if error.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            # Taken by a concurrent invocation since the slots were listed
+            continue
+
+        slots[slot_id] = lease
+        return slot_id
+
+    return None
+
+def release_slots(analysis_id):
+    """
+    Frees the slots held for an analysis and returns their leases. Failing to do so only delays later reviews until
+    the leases end.
+    """
+
+    from boto3.dynamodb.conditions import Attr
+
+    leases_table = dynamodb.Table(ADMISSION_LEASES_DD_TABLE_NAME)
+    released = []
+
+    try:
+        scan_kwargs = {'FilterExpression': Attr('lease_id').begins_with(SLOT_PREFIX) & Attr('analysis_id').eq(analysis_id)}
+        while True:
+            response = leases_table.scan(**scan_kwargs)
+            for lease in response['Items']:
+                free_slot(lease)
+                released.append(lease)
+            if 'LastEvaluatedKey' not in response:
+                break
+            scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    except Exception as error:
+        logger.error (f"Unable to release admission slots of {analysis_id}: {error}")
+
+    return released
+
+def reacquire_slot(lease):
+    """Takes a slot again for the holder of a lease that release_slots returned; False when every slot is held."""
+
+    slots = list_slots()
+    if any(held['holder'] == lease['holder'] for held in slots.values()):
+        return True
+
+    return acquire_slot(slots, lease['holder'], lease['analysis_id'], lease['review_type'], lease.get('execution_arn')) is not None
+
+def count_attempt(message_id):
+    """
+    Counts one more attempt at running the request of a queue message and returns the attempts so far. Deferred
+    messages are received many times before they run, so the receive count of the queue can not tell them apart
+    from messages that keep failing.
+    """
+
+    leases_table = dynamodb.Table(ADMISSION_LEASES_DD_TABLE_NAME)
+
+    response = leases_table.update_item(
+        Key={'lease_id': f"{ATTEMPTS_PREFIX}{message_id}"},
+        UpdateExpression="ADD attempts :one SET expires_at = :expires_at",
+        ExpressionAttributeValues={':one': 1, ':expires_at': int(time.time()) + ATTEMPTS_RETENTION_SECONDS},
+        ReturnValues='UPDATED_NEW'
+    )
+
+    return int(response['Attributes']['attempts'])
+
+def free_slot(lease):
+
+    leases_table = dynamodb.Table(ADMISSION_LEASES_DD_TABLE_NAME)
+
+    try:
+        # Only if it still has the same holder, as it may have been freed and taken again in the meantime
+        leases_table.delete_item(
+            Key={'lease_id': lease['lease_id']},
+            ConditionExpression="holder = :holder",
+            ExpressionAttributeValues={':holder': lease['holder']}
+        )
+        logger.info (f"Admission slot {lease['lease_id']} of {lease['holder']} freed")
+    except ClientError as error:
+        if error.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
@@ -0,0 +1,77 @@
+import os
+import threading
+
+import cassettes
+
+# Shared by every Lambda through the wafr_common layer. boto3 ships with the Lambda Python runtime, so the layer
+# only carries this module
+
+# Sized for the threads a single invocation runs (e.g. answer submission while Bedrock is still streaming)
+AWS_CLIENT_MAX_POOL_CONNECTIONS = int(os.environ.get('AWS_CLIENT_MAX_POOL_CONNECTIONS', '50'))
+
+# Module level, so clients and their connection pools are reused for as long as the Lambda container is warm
+created_clients = {}
+created_clients_lock = threading.Lock()
+
+def client(service_name, region_name=None, **config_options):
+    """boto3 client for the service, created on first use and shared by every later caller in the container."""
+
+    return get_or_create('client', service_name, region_name, config_options)
+
+def resource(service_name, region_name=None, **config_options):
+    """boto3 resource for the service, created on first use and shared by every later caller in the container."""
+
+    return get_or_create('resource', service_name, region_name, config_options)
+
+def lazy_client(service_name, region_name=None, **config_options):
+    """
+    Stand-in for a module level client. Nothing is imported or created until the first attribute is used,
+    so an invocation only pays for the clients it actually calls.
+    """
+
+    return LazyAWSObject('client', service_name, region_name, config_options)
+
+def lazy_resource(service_name, region_name=None, **config_options):
+
+    return LazyAWSObject('resource', service_name, region_name, config_options)
+
+def get_or_create(kind, service_name, region_name, config_options):
+
+    # Config values can be dicts (retries), so they are keyed by their repr
+    cache_key = (kind, service_name, region_name, repr(sorted(config_options.items())))
+
+    if cache_key not in created_clients:
+        # Client creation is not thread safe on a shared boto3 session
+        with created_clients_lock:
+            if cache_key not in created_clients:
+                # Recorded to a cassette when RECORD_CASSETTES is on
+                created_clients[cache_key] = cassettes.attach(create(kind, service_name, region_name, config_options), kind)
+
+    return created_clients[cache_key]
+
+def create(kind, service_name, region_name, config_options):
+
+    # Deferred so that importing a handler module does not load boto3 and botocore
+    import boto3
+    from botocore.config import Config
+
+    config = Config(max_pool_connections=AWS_CLIENT_MAX_POOL_CONNECTIONS, tcp_keepalive=True, **config_options)
+
+    if kind == 'client':
+        return boto3.client(service_name, region_name=region_name, config=config)
+
+    return boto3.resource(service_name, region_name=region_name, config=config)
+
+class LazyAWSObject:
+
+    def __init__(self, kind, service_name, region_name, config_options):
+        self.kind = kind
+        self.service_name = service_name
+        self.region_name = region_name
+        self.config_options = config_options
+
+    def __getattr__(self, name):
+        return getattr(get_or_create(self.kind, self.service_name, self.region_name, self.config_options), name)
+
+    def __repr__(self):
+        return f"<lazy {self.service_name} {self.kind}>"
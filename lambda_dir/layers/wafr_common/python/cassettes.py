@@ -0,0 +1,210 @@
+import os
+import io
+import json
+import gzip
+import time
+import logging
+import base64
+import datetime
+import functools
+import threading
+
+import structured_logging
+
+# Shared by every Lambda through the wafr_common layer. With RECORD_CASSETTES set to true, each invocation of a
+# handler decorated with @cassettes.recorded writes a cassette - the event, the result and every AWS call made through
+# aws_clients with its request, response and timing - gzipped to s3://CASSETTE_BUCKET/CASSETTE_PREFIX<analysis id>/.
+# benchmarks/replay_cassettes.py runs the same handlers offline against them
+RECORD_CASSETTES = os.environ.get('RECORD_CASSETTES', 'false').lower() == 'true'
+CASSETTE_BUCKET = os.environ.get('CASSETTE_BUCKET', '')
+CASSETTE_PREFIX = os.environ.get('CASSETTE_PREFIX', 'cassettes/')
+
+CASSETTE_VERSION = 1
+
+# Lambda runtime and credential variables are never written to a cassette
+UNRECORDED_ENVIRONMENT_PREFIXES = ('AWS_', '_', 'LAMBDA_')
+UNRECORDED_ENVIRONMENT_WORDS = ('SECRET', 'TOKEN', 'PASSWORD', 'API_KEY')
+
+# Module level, so calls made from any thread of the invocation are added to its cassette
+active_cassette = {'cassette': None, 'started_at': 0.0}
+cassette_lock = threading.Lock()
+cassette_clients = {}
+
+logger = logging.getLogger()
+
+def recorded(handler):
+    """Handler decorator; returns the handler unchanged unless RECORD_CASSETTES is on."""
+
+    if not RECORD_CASSETTES:
+        return handler
+
+    @functools.wraps(handler)
+    def recording_handler(event, context):
+
+        start_cassette(handler, event)
+        try:
+            result = handler(event, context)
+            active_cassette['cassette']['result'] = encode(result)
+            return result
+        except Exception as error:
+            active_cassette['cassette']['error'] = f"{type(error).__name__}: {error}"
+            raise
+        finally:
+            save_cassette()
+
+    return recording_handler
+
+def start_cassette(handler, event):
+
+    with cassette_lock:
+        active_cassette['started_at'] = time.time()
+        active_cassette['cassette'] = {
+            'version': CASSETTE_VERSION,
+            'handler': f"{handler.__module__}.{handler.__name__}",
+            'function_name': os.environ.get('AWS_LAMBDA_FUNCTION_NAME', ''),
+            'recorded_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'environment': {name: value for name, value in os.environ.items() if recorded_variable(name)},
+            'event': encode(event),
+            'result': None,
+            'error': None,
+            'calls': []
+        }
+
+def recorded_variable(name):
+    return not name.startswith(UNRECORDED_ENVIRONMENT_PREFIXES) and not any(word in name.upper() for word in UNRECORDED_ENVIRONMENT_WORDS)
+
+def save_cassette():
+
+    with cassette_lock:
+        cassette = active_cassette['cassette']
+        cassette['duration'] = time.time() - active_cassette['started_at']
+        active_cassette['cassette'] = None
+
+    correlation_id = structured_logging.invocation_context['correlation_id'] or 'uncorrelated'
+    module_name = cassette['handler'].split('.')[0]
+    key = f"{CASSETTE_PREFIX}{correlation_id}/{cassette['recorded_at'].replace(':', '-')}-{module_name}.json.gz"
+
+    try:
+        # Written with a client that is not recorded itself
+        get_cassette_client().put_object(Bucket=CASSETTE_BUCKET, Key=key, Body=gzip.compress(json.dumps(cassette).encode('utf-8')))
+    except Exception as error:
+        # Recording must never fail the review
+        logger.error(f"Unable to save cassette {key}: {error}")
+
+def get_cassette_client():
+    if 's3' not in cassette_clients:
+        import boto3
+        cassette_clients['s3'] = boto3.client('s3')
+    return cassette_clients['s3']
+
+def attach(aws_object, kind):
+    """Records the calls of a client or resource created by aws_clients; a no-op unless RECORD_CASSETTES is on."""
+
+    if not RECORD_CASSETTES:
+        return aws_object
+
+    client = aws_object.meta.client if kind == 'resource' else aws_object
+    client.meta.events.register('before-parameter-build', record_request)
+    client.meta.events.register('after-call', record_response)
+    client.meta.events.register('after-call-error', record_call_error)
+
+    return aws_object
+
+def record_request(params, model, context, **kwargs):
+
+    # The request context is shared by the events of one call
+    context['cassette_call'] = {
+        'service': model.service_model.service_name,
+        'operation': model.name,
+        'params': encode(params),
+        'started_at': time.time() - active_cassette['started_at']
+    }
+
+def record_response(http_response, parsed, model, context, **kwargs):
+
+    call = context.get('cassette_call')
+    if call is None:
+        return
+
+    call['duration'] = time.time() - active_cassette['started_at'] - call['started_at']
+    call['status_code'] = http_response.status_code
+
+    from botocore.response import StreamingBody
+    from botocore.eventstream import EventStream
+
+    for name, value in list(parsed.items()):
+        if isinstance(value, StreamingBody):
+            # Read here so it can be recorded; the handler reads the same bytes from the replacement
+            data = value.read()
+            parsed[name] = StreamingBody(io.BytesIO(data), len(data))
+            call.setdefault('streaming_bodies', {})[name] = base64.b64encode(data).decode('ascii')
+        elif isinstance(value, EventStream):
+            call.setdefault('event_streams', {})[name] = []
+            parsed[name] = RecordingEventStream(value, call['event_streams'][name])
+
+    call['response'] = encode({name: value for name, value in parsed.items() if name not in call.get('streaming_bodies', {}) and name not in call.get('event_streams', {})})
+
+    add_call(call)
+
+def record_call_error(exception, context, **kwargs):
+
+    call = context.get('cassette_call')
+    if call is None:
+        return
+
+    call['duration'] = time.time() - active_cassette['started_at'] - call['started_at']
+    call['error'] = f"{type(exception).__name__}: {exception}"
+
+    add_call(call)
+
+def add_call(call):
+    with cassette_lock:
+        if active_cassette['cassette'] is not None:
+            active_cassette['cassette']['calls'].append(call)
+
+class RecordingEventStream:
+    """Passes the events of a response stream on to the handler, recording each with its time since the call started."""
+
+    def __init__(self, event_stream, events):
+        self.event_stream = event_stream
+        self.events = events
+
+    def __iter__(self):
+        for event in self.event_stream:
+            self.events.append({'offset': time.time() - active_cassette['started_at'], 'event': encode(event)})
+            yield event
+
+    def __getattr__(self, name):
+        return getattr(self.event_stream, name)
+
+def encode(value):
+    """JSON safe copy of a request, response or payload; bytes and datetimes are tagged so decode() restores them."""
+
+    if isinstance(value, dict):
+        return {str(key): encode(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple, set)):
+        return [encode(item) for item in value]
+    if isinstance(value, (bytes, bytearray)):
+        return {'__cassette_type__': 'bytes', 'value': base64.b64encode(bytes(value)).decode('ascii')}
+    if isinstance(value, datetime.datetime):
+        return {'__cassette_type__': 'datetime', 'value': value.isoformat()}
+    if isinstance(value, (str, int, float, bool)) or value is None:
+        return value
+    return str(value)
+
+def decode(value):
+
+    if isinstance(value, list):
+        return [decode(item) for item in value]
+    if isinstance(value, dict):
+        if value.get('__cassette_type__') == 'bytes':
+            return base64.b64decode(value['value'])
+        if value.get('__cassette_type__') == 'datetime':
+            return datetime.datetime.fromisoformat(value['value'])
+        return {key: decode(item) for key, item in value.items()}
+    return value
+
+def load(data):
+    """Cassette from the bytes of a .json.gz cassette file."""
+
+    return json.loads(gzip.decompress(data).decode('utf-8'))
@@ -0,0 +1,261 @@
+import os
+import re
+import json
+import math
+import hashlib
+import logging
+import collections
+
+from concurrent.futures import ThreadPoolExecutor
+
+import aws_clients
+import emf_metrics
+import document_summary
+
+# Shared by the per question prompts of generate_prompts_for_six_pillars and the per pillar prompts of the inline
+# Quick review in start_wafr_review. Instead of the whole extracted document, each prompt gets the architecture
+# summary plus the sections that score best for its questions, up to DOCUMENT_SLICE_TOKENS. Documents up to
+# DOCUMENT_SLICE_MIN_CHARACTERS, and prompts whose best section scores below DOCUMENT_SLICE_MIN_SCORE, still get
+# the whole document, as does every prompt with DOCUMENT_SLICING set to false
+DOCUMENT_SLICING = os.environ.get('DOCUMENT_SLICING', 'true').lower() == 'true'
+DOCUMENT_SLICE_MIN_CHARACTERS = int(os.environ.get('DOCUMENT_SLICE_MIN_CHARACTERS', '60000'))
+DOCUMENT_SLICE_TOKENS = int(os.environ.get('DOCUMENT_SLICE_TOKENS', '8000'))
+DOCUMENT_SLICE_MIN_SCORE = float(os.environ.get('DOCUMENT_SLICE_MIN_SCORE', '0.05'))
+# Sections larger than this are split into passages of up to this size, so a long section does not crowd out the rest
+# of the budget. Sections are not packed together, so an edit to the document changes only the sections it touches
+DOCUMENT_SECTION_CHARACTERS = int(os.environ.get('DOCUMENT_SECTION_CHARACTERS', '4000'))
+# An update of an earlier review re-evaluates a question when a section added, edited or removed by the new version of
+# the document is among the question's DOCUMENT_CHANGE_SECTIONS best scoring sections in either version
+DOCUMENT_CHANGE_SECTIONS = int(os.environ.get('DOCUMENT_CHANGE_SECTIONS', '5'))
+
+# Scores are the lexical (BM25) score and the cosine similarity of the embeddings, each scaled to 0..1, weighted by
+# DOCUMENT_INDEX_VECTOR_WEIGHT. An empty embedding model id, or a failed embedding call, scores lexically only
+DOCUMENT_INDEX_EMBEDDING_MODEL_ID = os.environ.get('DOCUMENT_INDEX_EMBEDDING_MODEL_ID', 'amazon.titan-embed-text-v2:0')
+DOCUMENT_INDEX_EMBEDDING_DIMENSIONS = int(os.environ.get('DOCUMENT_INDEX_EMBEDDING_DIMENSIONS', '512'))
+DOCUMENT_INDEX_VECTOR_WEIGHT = float(os.environ.get('DOCUMENT_INDEX_VECTOR_WEIGHT', '0.5'))
+DOCUMENT_INDEX_MAX_PARALLEL_EMBEDDINGS = int(os.environ.get('DOCUMENT_INDEX_MAX_PARALLEL_EMBEDDINGS', '8'))
+
+# Titan accepts up to 8192 tokens per embedding request
+EMBEDDING_MAX_CHARACTERS = 30000
+CHARS_PER_TOKEN = 4
+BM25_K1 = 1.2
+BM25_B = 0.75
+# Part of the stored index hash, so indexes of an earlier layout are rebuilt rather than reused
+INDEX_FORMAT = 2
+
+# Words every question and most sections share, which would otherwise dominate the lexical scores
+STOP_WORDS = frozenset("""a an and are as at be by can do does for from has have how in is it its of on or that the
+    their them this to use used uses using what when where which who will with you your workload workloads""".split())
+
+s3client = aws_clients.lazy_client('s3')
+
+# Question embeddings by question text for the life of the container; the questions of a lens are few and fixed, and an
+# update scores each question against both versions of the document
+question_embeddings = {}
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+def slices(document_text):
+    return DOCUMENT_SLICING and len(document_text) > DOCUMENT_SLICE_MIN_CHARACTERS
+
+def load_index(bedrock_client, document_text, bucket=None, index_key=None, required=False):
+    """
+    Section index of the document text, or None when its prompts get the whole document and the index is not
+    required (an update compares the sections of documents of any size). The index is kept at index_key in bucket,
+    so a rerun or redrive of the same review, and a later update of it, reuse its section embeddings.
+    """
+
+    if not required and not slices(document_text):
+        return None
+
+    document_hash = hashlib.sha256(f"{INDEX_FORMAT}\n{DOCUMENT_INDEX_EMBEDDING_MODEL_ID}\n{DOCUMENT_SECTION_CHARACTERS}\n{document_text}".encode('utf-8')).hexdigest()
+
+    if bucket and index_key:
+        try:
+            index = json.loads(s3client.get_object(Bucket=bucket, Key=index_key)['Body'].read())
+            if index['document_hash'] == document_hash:
+                return index
+        except Exception as error:
+            # Without s3:ListBucket a missing key is AccessDenied rather than NoSuchKey
+            logger.debug(f"No stored section index {index_key}: {error}")
+
+    index = build_index(bedrock_client, document_text)
+    index['document_hash'] = document_hash
+
+    if bucket and index_key:
+        try:
+            s3client.put_object(Bucket=bucket, Key=index_key, Body=json.dumps(index).encode('utf-8'))
+        except Exception as error:
+            logger.info(f"Unable to store section index {index_key}: {error}")
+
+    return index
+
+def build_index(bedrock_client, document_text):
+
+    sections = [passage for section in document_summary.split_sections(document_text) for passage in document_summary.split_into_chunks(section, DOCUMENT_SECTION_CHARACTERS)]
+    term_counts = [collections.Counter(terms(section)) for section in sections]
+
+    document_frequencies = collections.Counter()
+    for counts in term_counts:
+        document_frequencies.update(counts.keys())
+
+    index = {
+        'sections': sections,
+        'term_counts': [dict(counts) for counts in term_counts],
+        'lengths': [sum(counts.values()) for counts in term_counts],
+        'document_frequencies': dict(document_frequencies),
+        'fingerprints': [section_fingerprint(section) for section in sections],
+        'embeddings': None
+    }
+
+    if DOCUMENT_INDEX_EMBEDDING_MODEL_ID and DOCUMENT_INDEX_VECTOR_WEIGHT > 0:
+        try:
+            with ThreadPoolExecutor(max_workers=DOCUMENT_INDEX_MAX_PARALLEL_EMBEDDINGS) as executor:
+                index['embeddings'] = list(executor.map(lambda section: embed(bedrock_client, section), sections))
+        except Exception as error:
+            logger.info(f"Scoring sections lexically only, embedding failed: {error}")
+
+    logger.info(f"Indexed {len(document_text)} characters as {len(sections)} sections")
+    emf_metrics.put_metric("DocumentSections", len(sections))
+
+    return index
+
+def relevant_content(bedrock_client, index, document_text, questions, architecture_summary):
+    """
+    Document content for a prompt that answers the questions: the architecture summary and the best scoring
+    sections of each question in turn, in document order and within DOCUMENT_SLICE_TOKENS, or the whole document.
+    """
+
+    if index is None or not slices(document_text):
+        return document_text
+
+    rankings = []
+    for question in questions:
+        scores = score_sections(bedrock_client, index, question)
+        if scores and max(scores) >= DOCUMENT_SLICE_MIN_SCORE:
+            rankings.append(sorted(range(len(scores)), key=lambda position: scores[position], reverse=True))
+
+    if not rankings:
+        logger.info("No section scores high enough, using the whole document")
+        return document_text
+
+    # Each question's next best section in turn, so every question of a pillar prompt gets its own context
+    budget = DOCUMENT_SLICE_TOKENS * CHARS_PER_TOKEN - len(architecture_summary or '')
+    selected = set()
+    used = 0
+    for rank in range(len(index['sections'])):
+        for ranking in rankings:
+            position = ranking[rank]
+            if position in selected or used + len(index['sections'][position]) > budget:
+                continue
+            selected.add(position)
+            used = used + len(index['sections'][position])
+
+    sections = "\n".join(f"<section>\n{index['sections'][position]}\n</section>" for position in sorted(selected))
+
+    emf_metrics.put_metrics({
+        'DocumentSectionsSelected': (len(selected), 'Count'),
+        'DocumentTokensSaved': ((len(document_text) - used) // CHARS_PER_TOKEN, 'Count')
+    })
+
+    return f"""<architecture_summary>
+{architecture_summary}
+</architecture_summary>
+<document_sections>
+The sections of the document most relevant to these questions, in document order. The other sections are left out, the architecture summary above covers the whole document.
+{sections}
+</document_sections>"""
+
+def score_sections(bedrock_client, index, question):
+
+    lexical = bm25_scores(index, terms(question))
+    highest = max(lexical, default=0.0)
+    lexical = [score / highest if highest else 0.0 for score in lexical]
+
+    if not index['embeddings']:
+        return lexical
+
+    try:
+        if question not in question_embeddings:
+            question_embeddings[question] = embed(bedrock_client, question)
+        question_embedding = question_embeddings[question]
+    except Exception as error:
+        logger.info(f"Scoring question lexically only, embedding failed: {error}")
+        return lexical
+
+    # Titan returns normalised embeddings, so the dot product is the cosine similarity
+    similarities = [sum(a * b for a, b in zip(question_embedding, embedding)) for embedding in index['embeddings']]
+
+    weight = DOCUMENT_INDEX_VECTOR_WEIGHT
+    return [(1 - weight) * lexical_score + weight * max(similarity, 0.0) for lexical_score, similarity in zip(lexical, similarities)]
+
+def changed_sections(index, previous_index):
+    """Positions of the sections of index not in previous_index (added or edited), and of previous_index not in index."""
+
+    fingerprints = set(index['fingerprints'])
+    previous_fingerprints = set(previous_index['fingerprints'])
+
+    added = [position for position, fingerprint in enumerate(index['fingerprints']) if fingerprint not in previous_fingerprints]
+    removed = [position for position, fingerprint in enumerate(previous_index['fingerprints']) if fingerprint not in fingerprints]
+
+    return added, removed
+
+def question_changed(bedrock_client, index, previous_index, changes, question):
+    """Whether the changes (from changed_sections) touch the sections relevant to the question in either version."""
+
+    added, removed = changes
+
+    return touches(bedrock_client, index, question, added) or touches(bedrock_client, previous_index, question, removed)
+
+def touches(bedrock_client, index, question, positions):
+
+    if not positions:
+        return False
+
+    scores = score_sections(bedrock_client, index, question)
+    best = sorted(range(len(scores)), key=lambda position: scores[position], reverse=True)[:DOCUMENT_CHANGE_SECTIONS]
+
+    return any(scores[position] >= DOCUMENT_SLICE_MIN_SCORE for position in set(best).intersection(positions))
+
+def section_fingerprint(section):
+    # Textract may re-flow whitespace between extractions of the same text
+    return hashlib.sha256(" ".join(section.lower().split()).encode('utf-8')).hexdigest()
+
+def bm25_scores(index, query_terms):
+
+    section_count = len(index['sections'])
+    average_length = (sum(index['lengths']) / section_count) or 1
+
+    scores = []
+    for counts, length in zip(index['term_counts'], index['lengths']):
+        score = 0.0
+        for term in set(query_terms):
+            frequency = counts.get(term, 0)
+            if not frequency:
+                continue
+            document_frequency = index['document_frequencies'][term]
+            idf = math.log(1 + (section_count - document_frequency + 0.5) / (document_frequency + 0.5))
+            score += idf * frequency * (BM25_K1 + 1) / (frequency + BM25_K1 * (1 - BM25_B + BM25_B * length / average_length))
+        scores.append(score)
+
+    return scores
+
+def terms(text):
+    return [word for word in re.findall(r'[a-z0-9]+', text.lower()) if len(word) > 1 and word not in STOP_WORDS]
+
+def embed(bedrock_client, text):
+
+    with emf_metrics.timed("bedrock_embed"):
+        response = bedrock_client.invoke_model(
+            modelId=DOCUMENT_INDEX_EMBEDDING_MODEL_ID,
+            contentType="application/json",
+            accept="application/json",
+            body=json.dumps({
+                "inputText": text[:EMBEDDING_MAX_CHARACTERS],
+                "dimensions": DOCUMENT_INDEX_EMBEDDING_DIMENSIONS,
+                "normalize": True
+            })
+        )
+
+    return json.loads(response['body'].read())['embedding']
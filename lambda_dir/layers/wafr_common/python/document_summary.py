@@ -0,0 +1,167 @@
+import os
+import re
+import json
+import time
+import logging
+
+from concurrent.futures import ThreadPoolExecutor
+
+import emf_metrics
+import response_cache
+
+# Shared by generate_solution_summary and the inline Quick review in start_wafr_review. Documents up to
+# SUMMARY_SINGLE_PASS_CHARACTERS are summarised in one request as before; larger ones are split on section and page
+# boundaries into chunks of up to SUMMARY_CHUNK_CHARACTERS, summarised SUMMARY_MAX_PARALLEL_CHUNKS at a time, and the
+# partial summaries are reduced (in rounds, if they do not fit one request) into the architecture summary
+SUMMARY_SINGLE_PASS_CHARACTERS = int(os.environ.get('SUMMARY_SINGLE_PASS_CHARACTERS', '120000'))
+SUMMARY_CHUNK_CHARACTERS = int(os.environ.get('SUMMARY_CHUNK_CHARACTERS', '60000'))
+SUMMARY_MAX_PARALLEL_CHUNKS = int(os.environ.get('SUMMARY_MAX_PARALLEL_CHUNKS', '4'))
+# Each reduce round shrinks the summaries about tenfold, so few rounds are ever needed
+SUMMARY_MAX_REDUCE_ROUNDS = int(os.environ.get('SUMMARY_MAX_REDUCE_ROUNDS', '3'))
+
+BEDROCK_SLEEP_DURATION = int(os.environ.get('BEDROCK_SLEEP_DURATION', '60'))
+BEDROCK_MAX_TRIES = int(os.environ.get('BEDROCK_MAX_TRIES', '5'))
+
+SUMMARY_PROMPT = "The following document is a solution architecture document that you are reviewing as an AWS Cloud Solutions Architect. Please summarise the following solution in 250 words. Begin directly with the architecture summary, don't provide any other opening or closing statements.\n\n<Architecture>\n{text}\n</Architecture>\n"
+
+# Chunks are not numbered, so the cached summary of a chunk (response_cache) is reused wherever the chunk appears
+CHUNK_PROMPT = "The following is a part of a solution architecture document that you are reviewing as an AWS Cloud Solutions Architect. Summarise the architecture it describes in at most 300 words. Keep the AWS services, components, data flows, and the security, reliability, performance, cost and operational details. Begin directly with the summary, don't provide any other opening or closing statements. If this part describes nothing about the architecture, respond with NONE only.\n\n<Part>\n{text}\n</Part>\n"
+
+REDUCE_PROMPT = "The following are summaries of consecutive parts of a solution architecture document that you are reviewing as an AWS Cloud Solutions Architect. Combine them into a single summary of at most 500 words that keeps the AWS services, components, data flows, and the security, reliability, performance, cost and operational details. Begin directly with the summary, don't provide any other opening or closing statements.\n\n<Summaries>\n{text}\n</Summaries>\n"
+
+# Numbered headings (3, 3.2, 3.2.1 Networking) and short all capitals lines start a section; Textract output has
+# one line per text line and no blank lines, so these are the section boundaries it keeps
+HEADING_PATTERN = re.compile(r'^(\d+(\.\d+)*\.?\s+[A-Z]\S*.{0,80}|[A-Z][A-Z0-9 &/,\-]{3,60})$')
+# Form feeds mark page breaks in documents that keep them
+PAGE_BREAK = '\f'
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+def summarize(bedrock_client, model_id, document_text, bypass_cache=False):
+    """Architecture summary of the document text, map-reduced over its sections when it is too large for one request."""
+
+    if len(document_text) <= SUMMARY_SINGLE_PASS_CHARACTERS:
+        return invoke_model(bedrock_client, model_id, SUMMARY_PROMPT.format(text=document_text), 4096, bypass_cache)
+
+    chunks = split_into_chunks(document_text, SUMMARY_CHUNK_CHARACTERS)
+    logger.info(f"Summarising {len(document_text)} characters in {len(chunks)} chunks")
+
+    def summarize_chunk(chunk):
+        return invoke_model(bedrock_client, model_id, CHUNK_PROMPT.format(text=chunk), 1024, bypass_cache)
+
+    with ThreadPoolExecutor(max_workers=SUMMARY_MAX_PARALLEL_CHUNKS) as executor:
+        summaries = [summary for summary in executor.map(summarize_chunk, chunks) if summary.strip() != 'NONE']
+
+    emf_metrics.put_metric("SummaryChunks", len(chunks))
+
+    # Reduce consecutive summaries until they fit one request, which gives the final summary. Stops after
+    # SUMMARY_MAX_REDUCE_ROUNDS, or when a round no longer shortens them (the model ignoring the word limit)
+    reduce_rounds = 0
+    combined = '\n\n'.join(summaries)
+    while len(summaries) > 1 and len(combined) > SUMMARY_CHUNK_CHARACTERS and reduce_rounds < SUMMARY_MAX_REDUCE_ROUNDS:
+        groups = split_into_chunks(combined, SUMMARY_CHUNK_CHARACTERS, separator='\n\n')
+        with ThreadPoolExecutor(max_workers=SUMMARY_MAX_PARALLEL_CHUNKS) as executor:
+            summaries = list(executor.map(lambda group: invoke_model(bedrock_client, model_id, REDUCE_PROMPT.format(text=group), 2048, bypass_cache), groups))
+        reduce_rounds += 1
+        previous_length = len(combined)
+        combined = '\n\n'.join(summaries)
+        if len(combined) >= previous_length:
+            logger.warning(f"Reduce round {reduce_rounds} did not shorten the summaries ({len(combined)} characters)")
+            break
+
+    emf_metrics.put_metric("SummaryReduceRounds", reduce_rounds)
+
+    # Whatever is left over the single request size is cut rather than sent
+    return invoke_model(bedrock_client, model_id, SUMMARY_PROMPT.format(text=combined[:SUMMARY_SINGLE_PASS_CHARACTERS]), 4096, bypass_cache)
+
+def split_sections(document_text):
+    """Sections of the document text in order, split before headings and at page breaks."""
+
+    sections = []
+    lines = []
+    for page in document_text.split(PAGE_BREAK):
+        for line in page.splitlines():
+            if lines and HEADING_PATTERN.match(line.strip()):
+                sections.append('\n'.join(lines))
+                lines = []
+            lines.append(line)
+        if lines:
+            sections.append('\n'.join(lines))
+            lines = []
+
+    return [section for section in sections if section.strip()]
+
+def split_into_chunks(document_text, max_characters, separator=None):
+    """
+    Consecutive whole sections (or separator delimited parts) packed into chunks of at most max_characters.
+    Sections that are larger on their own are split at line ends, and lines at max_characters.
+    """
+
+    parts = document_text.split(separator) if separator else split_sections(document_text)
+    joiner = separator or '\n'
+
+    pieces = []
+    for part in parts:
+        if len(part) <= max_characters:
+            pieces.append(part)
+            continue
+        for line in part.splitlines():
+            pieces.extend(line[start:start + max_characters] for start in range(0, max(len(line), 1), max_characters))
+
+    chunks = []
+    current = []
+    current_length = 0
+    for piece in pieces:
+        if current and current_length + len(joiner) + len(piece) > max_characters:
+            chunks.append(joiner.join(current))
+            current = []
+            current_length = 0
+        current.append(piece)
+        current_length = current_length + len(piece) + (len(joiner) if current_length else 0)
+    if current:
+        chunks.append(joiner.join(current))
+
+    return chunks
+
+def invoke_model(bedrock_client, model_id, prompt, max_tokens, bypass_cache=False):
+
+    body = json.dumps({
+        "anthropic_version": "bedrock-2023-05-31",
+        "max_tokens": max_tokens,
+        "messages": [
+            {"role": "user", "content": [{"type": "text", "text": prompt}]}
+        ]
+    })
+
+    cached_response = response_cache.get(model_id, body, bypass_cache)
+    if cached_response is not None:
+        return cached_response
+
+    retries = 0
+    with emf_metrics.timed("bedrock_invoke_model") as measurement:
+        while True:
+            try:
+                response = bedrock_client.invoke_model(
+                    modelId=model_id,
+                    contentType="application/json",
+                    accept="application/json",
+                    body=body
+                )
+                break
+            except Exception as error:
+                # Chunks are summarised concurrently, so throttling is retried like the per question calls
+                retries += 1
+                if retries >= BEDROCK_MAX_TRIES:
+                    raise
+                logger.info(f"Sleeping as attempt {retries} failed with exception: {error}")
+                time.sleep(BEDROCK_SLEEP_DURATION)
+
+        response_body = json.loads(response['body'].read())
+        measurement.add("Retries", retries)
+        measurement.add("InputTokens", response_body.get('usage', {}).get('input_tokens', 0))
+        measurement.add("OutputTokens", response_body.get('usage', {}).get('output_tokens', 0))
+
+    response_cache.put(model_id, body, response_body['content'][0]['text'], response_body.get('usage'))
+
+    return response_body['content'][0]['text']
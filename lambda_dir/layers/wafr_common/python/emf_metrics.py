@@ -0,0 +1,147 @@
+import os
+import json
+import time
+import socket
+import threading
+
+from contextlib import contextmanager
+
+# Shared by the Lambda functions (wafr_common layer) and the Streamlit pages, which the stack deploys this file next to
+
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'WAFRAccelerator')
+# Where embedded metric format records go: stdout (Lambda, CloudWatch extracts the metrics from the log line),
+# tcp://host:port (CloudWatch agent EMF endpoint, e.g. on the UI instance), file:<path> (local runs) or off
+METRICS_SINK = os.environ.get('METRICS_SINK', 'stdout')
+
+# Module level, so it is set once per invocation (or page run) and added to every record
+invocation_context = {'dimensions': {}, 'properties': {}}
+sink = {'target': METRICS_SINK}
+sink_lock = threading.Lock()
+
+def configure_sink(target):
+    sink['target'] = target
+
+def start_invocation(stage, analysis_id=None, model=None, lens=None, pillar=None):
+    """
+    Called at the start of every handler. Stage, model, lens and pillar become dimensions of every record of the
+    invocation, the analysis id a property, so the metrics of one review can still be found in CloudWatch Logs Insights.
+    """
+
+    dimensions = {'Stage': stage, 'Model': model, 'Lens': lens, 'Pillar': pillar}
+    invocation_context['dimensions'] = {name: str(value) for name, value in dimensions.items() if value}
+    invocation_context['properties'] = {'analysis_id': analysis_id} if analysis_id else {}
+
+def put_metric(name, value, unit='Count', **dimensions):
+    put_metrics({name: (value, unit)}, **dimensions)
+
+def put_metrics(values, **dimensions):
+    """Writes one EMF record with every metric in values ({name: (value, unit)}) under the same dimensions."""
+
+    if sink['target'] == 'off' or not values:
+        return
+
+    record_dimensions = dict(invocation_context['dimensions'])
+    record_dimensions.update({name: str(value) for name, value in dimensions.items() if value is not None})
+    # Also rolled up by stage and operation alone, so latencies can be compared across models, lenses and pillars
+    rollup_dimensions = [name for name in ('Stage', 'Operation') if name in record_dimensions]
+
+    record = {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': METRICS_NAMESPACE,
+                'Dimensions': [list(record_dimensions), rollup_dimensions],
+                'Metrics': [{'Name': name, 'Unit': unit} for name, (value, unit) in values.items()]
+            }]
+        }
+    }
+    record.update(invocation_context['properties'])
+    record.update(record_dimensions)
+    record.update({name: value for name, (value, unit) in values.items()})
+
+    write_record(json.dumps(record, default=str))
+
+class Measurement:
+    """Handed out by timed() so the caller can add metrics of the call, e.g. token or retry counts."""
+
+    def __init__(self):
+        self.values = {}
+        self.error = False
+
+    def add(self, name, value, unit='Count'):
+        self.values[name] = (value, unit)
+
+@contextmanager
+def timed(operation, **dimensions):
+    """
+    Times an external call (or any block) as Latency in milliseconds plus an Errors count, with an Operation
+    dimension, and records it as an X-Ray subsegment when the invocation is traced.
+    """
+
+    measurement = Measurement()
+    start_time = time.time()
+
+    try:
+        yield measurement
+    except Exception:
+        measurement.error = True
+        raise
+    finally:
+        end_time = time.time()
+
+        values = {'Latency': ((end_time - start_time) * 1000, 'Milliseconds'), 'Errors': (int(measurement.error), 'Count')}
+        values.update(measurement.values)
+
+        try:
+            put_metrics(values, Operation=operation, **dimensions)
+            send_xray_subsegment(operation, start_time, end_time, measurement.error)
+        except Exception:
+            # Metrics must never fail the review
+            pass
+
+def write_record(line):
+
+    target = sink['target']
+
+    with sink_lock:
+        if target == 'stdout':
+            print(line, flush=True)
+        elif target.startswith('file:'):
+            with open(target[len('file:'):], 'a', encoding='utf-8') as metrics_file:
+                metrics_file.write(line + '\n')
+        elif target.startswith('tcp://'):
+            host, port = target[len('tcp://'):].rsplit(':', 1)
+            with socket.create_connection((host, int(port)), timeout=1) as connection:
+                connection.sendall((line + '\n').encode('utf-8'))
+
+def send_xray_subsegment(name, start_time, end_time, error):
+
+    # Lambda sets both when active tracing is on; outside Lambda this is a no-op. Sent straight to the X-Ray daemon,
+    # which is what the X-Ray SDK does, so the layer does not need the SDK
+    trace_header = os.environ.get('_X_AMZN_TRACE_ID', '')
+    daemon_address = os.environ.get('AWS_XRAY_DAEMON_ADDRESS', '')
+    if not trace_header or not daemon_address:
+        return
+
+    trace = dict(part.split('=', 1) for part in trace_header.split(';') if '=' in part)
+    if trace.get('Sampled') != '1' or 'Root' not in trace or 'Parent' not in trace:
+        return
+
+    subsegment = {
+        'name': name,
+        'id': os.urandom(8).hex(),
+        'trace_id': trace['Root'],
+        'parent_id': trace['Parent'],
+        'type': 'subsegment',
+        'namespace': 'remote',
+        'start_time': start_time,
+        'end_time': end_time,
+        'error': error
+    }
+
+    # Either host:port or udp:host:port tcp:host:port
+    address = daemon_address.split()[0].replace('udp:', '')
+    host, port = address.rsplit(':', 1)
+
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as daemon_socket:
+        daemon_socket.sendto(('{"format": "json", "version": 1}\n' + json.dumps(subsegment)).encode('utf-8'), (host, int(port)))
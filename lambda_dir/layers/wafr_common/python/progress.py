@@ -0,0 +1,22 @@
+import time
+import logging
+
+# Progress of a review as the UI shows it: the stage a review is in (progress_stage) and when each stage started
+# (stage_started_at), on the item of the run in the runs table
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+def set_progress_stage(wafr_accelerator_runs_table, wafr_accelerator_run_key, stage):
+
+    # Progress is informational only, so failing to record it must not fail the review
+    try:
+        wafr_accelerator_runs_table.update_item(
+            Key=wafr_accelerator_run_key,
+            UpdateExpression="SET progress_stage = :stage, stage_started_at.#stage = :now, progress_baseline = if_not_exists(progress_done, :zero)",
+            ExpressionAttributeNames={'#stage': stage},
+            ExpressionAttributeValues={':stage': stage, ':now': int(time.time()), ':zero': 0},
+            ReturnValues='NONE'
+        )
+    except Exception as error:
+        logger.info(f"Unable to record progress stage {stage}: {error}")
@@ -0,0 +1,65 @@
+import os
+import time
+import logging
+
+import aws_clients
+
+# Item of the prompts table that insert_wafr_prompts rewrites with a new version whenever it loads prompts
+CONTENT_VERSION_KEY = {'wafr_lens': '__meta__', 'wafr_pillar': 'content_version'}
+
+# How long a warm container serves prompts table data before checking the content version again
+REFERENCE_DATA_VERSION_TTL_SECONDS = int(os.environ.get('REFERENCE_DATA_VERSION_TTL_SECONDS', '60'))
+
+dynamodb = aws_clients.lazy_resource('dynamodb')
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Module level, so both caches live as long as the Lambda container. Cached values are shared and must not be modified
+static_values = {}
+versioned_values = {}
+
+def get_static(name, loader, *args):
+    """Value of loader(*args) for data that never changes within a deployment, built once per container."""
+
+    cache_key = (name,) + args
+    if cache_key not in static_values:
+        static_values[cache_key] = loader(*args)
+
+    return static_values[cache_key]
+
+def get_versioned(wafr_prompts_table_name, name, loader, *args):
+    """Value of loader(*args) for data read from the prompts table, dropped when the table's content version changes."""
+
+    cache = get_versioned_cache(wafr_prompts_table_name)
+
+    cache_key = (name,) + args
+    if cache_key not in cache['values']:
+        cache['values'][cache_key] = loader(*args)
+    else:
+        logger.debug(f"Reference data {cache_key} served from cache, content version {cache['version']}")
+
+    return cache['values'][cache_key]
+
+def get_versioned_cache(wafr_prompts_table_name):
+
+    cache = versioned_values.setdefault(wafr_prompts_table_name, {'version': None, 'checked_at': 0, 'values': {}})
+
+    if time.time() - cache['checked_at'] >= REFERENCE_DATA_VERSION_TTL_SECONDS:
+        content_version = get_content_version(wafr_prompts_table_name)
+
+        if content_version != cache['version']:
+            logger.info(f"Prompts table content version changed from {cache['version']} to {content_version}, reloading reference data")
+            cache['values'] = {}
+            cache['version'] = content_version
+
+        cache['checked_at'] = time.time()
+
+    return cache
+
+def get_content_version(wafr_prompts_table_name):
+
+    response = dynamodb.Table(wafr_prompts_table_name).get_item(Key=CONTENT_VERSION_KEY, ProjectionExpression='content_version')
+
+    # Tables loaded before content versions were recorded share the empty version until the prompts are next loaded
+    return response.get('Item', {}).get('content_version', '')
@@ -0,0 +1,198 @@
+import os
+import time
+import zlib
+import hashlib
+import logging
+
+from botocore.exceptions import ClientError
+
+import aws_clients
+import emf_metrics
+
+# Exact match cache of model responses, shared by generate_pillar_question_response, the inline Quick review in
+# start_wafr_review and document_summary (architecture summaries). Entries are keyed by the hash of the model id and
+# the rendered request body, so a re-run of a review of an unchanged document is answered without calling Bedrock.
+# Disabled when RESPONSE_CACHE_TABLE is not set
+RESPONSE_CACHE_TABLE = os.environ.get('RESPONSE_CACHE_TABLE', '')
+RESPONSE_CACHE_TTL_DAYS = int(os.environ.get('RESPONSE_CACHE_TTL_DAYS', '30'))
+# Least recently used entries are evicted once the compressed responses add up to more than this
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get('RESPONSE_CACHE_MAX_BYTES', str(1024 * 1024 * 1024)))
+# DynamoDB items are limited to 400 KB, so larger compressed responses are kept under RESPONSE_CACHE_PREFIX in
+# RESPONSE_CACHE_BUCKET (which expires them after the same TTL) and the table holds their key
+RESPONSE_CACHE_INLINE_BYTES = int(os.environ.get('RESPONSE_CACHE_INLINE_BYTES', '300000'))
+RESPONSE_CACHE_BUCKET = os.environ.get('RESPONSE_CACHE_BUCKET', '')
+RESPONSE_CACHE_PREFIX = os.environ.get('RESPONSE_CACHE_PREFIX', 'response-cache/')
+
+# Item holding the running total of cached bytes and the eviction lease
+USAGE_KEY = '#usage'
+EVICTION_LEASE_SECONDS = 300
+# Eviction stops once the cache is back under this share of RESPONSE_CACHE_MAX_BYTES, so it does not run on every put
+EVICTION_TARGET = 0.8
+
+dynamodb = aws_clients.lazy_resource('dynamodb')
+s3client = aws_clients.lazy_client('s3')
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+def cache_key(model_id, body):
+    if isinstance(body, bytes):
+        body = body.decode('utf-8')
+    return hashlib.sha256(f"{model_id}\n{body}".encode('utf-8')).hexdigest()
+
+def get(model_id, body, bypass=False):
+    """
+    Cached response text of the request, or None. A bypassed lookup counts as a miss, and the fresh response the
+    caller then puts replaces the cached one.
+    """
+
+    if not RESPONSE_CACHE_TABLE:
+        return None
+
+    if bypass:
+        emf_metrics.put_metrics({'ResponseCacheHits': (0, 'Count'), 'ResponseCacheMisses': (1, 'Count'), 'ResponseCacheBypassed': (1, 'Count')})
+        return None
+
+    key = cache_key(model_id, body)
+    table = dynamodb.Table(RESPONSE_CACHE_TABLE)
+
+    try:
+        item = table.get_item(Key={'cache_key': key}).get('Item')
+        if item is None or item['expires_at'] < time.time():
+            response_text = None
+        else:
+            response_text = read_response(item)
+            table.update_item(
+                Key={'cache_key': key},
+                UpdateExpression="SET last_used_at = :now ADD hits :one",
+                ExpressionAttributeValues={':now': int(time.time()), ':one': 1}
+            )
+    except Exception as error:
+        # The cache is an optimisation only, a failed lookup is a miss
+        logger.info(f"Response cache lookup of {key} failed: {error}")
+        response_text = None
+
+    if response_text is None:
+        emf_metrics.put_metrics({'ResponseCacheHits': (0, 'Count'), 'ResponseCacheMisses': (1, 'Count')})
+        return None
+
+    logger.info(f"Response cache hit {key}")
+    emf_metrics.put_metrics({
+        'ResponseCacheHits': (1, 'Count'),
+        'ResponseCacheMisses': (0, 'Count'),
+        'InputTokensSaved': (int(item.get('input_tokens', 0)), 'Count'),
+        'OutputTokensSaved': (int(item.get('output_tokens', 0)), 'Count')
+    })
+    return response_text
+
+def put(model_id, body, response_text, usage=None):
+    """Caches the response text of the request; usage is the model's token usage, reported as saved on hits."""
+
+    if not RESPONSE_CACHE_TABLE:
+        return
+
+    key = cache_key(model_id, body)
+    table = dynamodb.Table(RESPONSE_CACHE_TABLE)
+    compressed = zlib.compress(response_text.encode('utf-8'))
+    now = int(time.time())
+
+    item = {
+        'cache_key': key,
+        'model_id': model_id,
+        'size': len(compressed),
+        'input_tokens': (usage or {}).get('input_tokens', 0),
+        'output_tokens': (usage or {}).get('output_tokens', 0),
+        'created_at': now,
+        'last_used_at': now,
+        'expires_at': now + RESPONSE_CACHE_TTL_DAYS * 24 * 3600,
+        'hits': 0
+    }
+
+    try:
+        if len(compressed) <= RESPONSE_CACHE_INLINE_BYTES:
+            item['response'] = compressed
+        elif RESPONSE_CACHE_BUCKET:
+            item['s3_key'] = f"{RESPONSE_CACHE_PREFIX}{key}.gz"
+            s3client.put_object(Bucket=RESPONSE_CACHE_BUCKET, Key=item['s3_key'], Body=compressed)
+        else:
+            return
+
+        table.put_item(Item=item)
+
+        usage_item = table.update_item(
+            Key={'cache_key': USAGE_KEY},
+            UpdateExpression="ADD total_bytes :size",
+            ExpressionAttributeValues={':size': len(compressed)},
+            ReturnValues='UPDATED_NEW'
+        )
+        total_bytes = usage_item.get('Attributes', {}).get('total_bytes', 0)
+    except Exception as error:
+        logger.info(f"Unable to cache response {key}: {error}")
+        return
+
+    if total_bytes > RESPONSE_CACHE_MAX_BYTES:
+        evict(table)
+
+def read_response(item):
+
+    if 's3_key' in item:
+        compressed = s3client.get_object(Bucket=RESPONSE_CACHE_BUCKET, Key=item['s3_key'])['Body'].read()
+    else:
+        compressed = bytes(item['response'])
+
+    return zlib.decompress(compressed).decode('utf-8')
+
+def evict(table):
+    """
+    Deletes expired and then least recently used entries until the cache is back under EVICTION_TARGET of
+    RESPONSE_CACHE_MAX_BYTES, and resets the running total to what is left (TTL deletes do not decrease it).
+    """
+
+    now = int(time.time())
+
+    try:
+        # Only one invocation evicts at a time
+        table.update_item(
+            Key={'cache_key': USAGE_KEY},
+            UpdateExpression="SET evicting_until = :until",
+            ConditionExpression="attribute_not_exists(evicting_until) OR evicting_until < :now",
+            ExpressionAttributeValues={':until': now + EVICTION_LEASE_SECONDS, ':now': now}
+        )
+    except ClientError as error:
+        if error.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return
+        raise
+
+    entries = []
+    scan_arguments = {
+        'ProjectionExpression': "cache_key, #size, last_used_at, expires_at, s3_key",
+        'ExpressionAttributeNames': {'#size': 'size'}
+    }
+    while True:
+        response = table.scan(**scan_arguments)
+        entries.extend(item for item in response['Items'] if item['cache_key'] != USAGE_KEY)
+        if 'LastEvaluatedKey' not in response:
+            break
+        scan_arguments['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    entries.sort(key=lambda entry: (entry['expires_at'] >= now, entry['last_used_at']))
+
+    total_bytes = sum(int(entry['size']) for entry in entries)
+    evicted = 0
+    for entry in entries:
+        if total_bytes <= RESPONSE_CACHE_MAX_BYTES * EVICTION_TARGET and entry['expires_at'] >= now:
+            break
+        table.delete_item(Key={'cache_key': entry['cache_key']})
+        if entry.get('s3_key'):
+            s3client.delete_object(Bucket=RESPONSE_CACHE_BUCKET, Key=entry['s3_key'])
+        total_bytes -= int(entry['size'])
+        evicted += 1
+
+    table.update_item(
+        Key={'cache_key': USAGE_KEY},
+        UpdateExpression="SET total_bytes = :total REMOVE evicting_until",
+        ExpressionAttributeValues={':total': total_bytes}
+    )
+
+    logger.info(f"Evicted {evicted} cached responses, {total_bytes} bytes remain")
+    emf_metrics.put_metric("ResponseCacheEvictions", evicted)
@@ -0,0 +1,30 @@
+# An analysis reviews its lens (selected_lens, lens_alias) and any additional_lenses, a map of lens name to lens alias,
+# in one run: the document is extracted, summarised and indexed once, and every lens is attached to the one
+# Well-Architected Tool workload. Question status keys, prompt files and pillar entries of the first lens are named as
+# they always were; those of additional lenses are scoped by the lens tag, as question ids and pillar ids repeat across
+# lenses
+
+def review_lenses(wafr_lens, lens_alias, additional_lenses=None):
+    """The lenses of an analysis, first lens first, each as a dict of wafr_lens, lens_alias and lens_tag."""
+
+    lenses = [{'wafr_lens': wafr_lens, 'lens_alias': lens_alias, 'lens_tag': ''}]
+
+    for additional_lens, additional_lens_alias in sorted((additional_lenses or {}).items()):
+        if additional_lens_alias != lens_alias:
+            lenses.append({'wafr_lens': additional_lens, 'lens_alias': additional_lens_alias, 'lens_tag': lens_tag(additional_lens_alias)})
+
+    return lenses
+
+def lens_aliases(lens_alias, additional_lenses=None):
+    return [lens['lens_alias'] for lens in review_lenses('', lens_alias, additional_lenses)]
+
+def lens_tag(lens_alias):
+    # The last part of the lens ARN, e.g. financialservices
+    return lens_alias.split('/')[-1]
+
+def scoped(lens_tag, key):
+    return f"{lens_tag}:{key}" if lens_tag else key
+
+def question_key(question_metadata):
+    # Manifests written before analyses had additional lenses key their questions by question id
+    return question_metadata.get('question_key', question_metadata['pillar_specfic_question_id'])
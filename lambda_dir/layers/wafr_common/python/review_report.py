@@ -0,0 +1,359 @@
+import re
+import html
+import zlib
+import time
+import hashlib
+import logging
+import textwrap
+
+import aws_clients
+import emf_metrics
+
+# The consolidated report of a review (details, architecture summary, risk table and every pillar's findings), rendered
+# once when the review completes as Markdown, HTML and PDF and kept next to the uploaded document under
+# report/v<version>/. The run item records the version, so the UI shows and downloads a review with one S3 fetch instead
+# of reading and rendering the pillars. Reports are only rendered again when their content changes (a redrive that
+# answers the remaining questions), which is a new version
+REPORT_FORMAT = 1
+REPORT_FILES = {
+    'md': ('report.md', 'text/markdown; charset=utf-8'),
+    'html': ('report.html', 'text/html; charset=utf-8'),
+    'pdf': ('report.pdf', 'application/pdf')
+}
+RISK_LEVELS = ["High", "Medium", "Low", "None", "Not Applicable", "Unknown"]
+
+# A4 in points; the PDF uses the standard Helvetica fonts, so it needs no font files
+PDF_PAGE_WIDTH = 595
+PDF_PAGE_HEIGHT = 842
+PDF_MARGIN = 48
+PDF_BODY_SIZE = 10
+PDF_HEADING_SIZES = {1: 16, 2: 13, 3: 11}
+# Average Helvetica character width as a share of the font size, used to wrap lines
+PDF_CHARACTER_WIDTH = 0.5
+PDF_CHARACTERS = {'\u2018': "'", '\u2019': "'", '\u201c': '"', '\u201d': '"', '\u2013': '-', '\u2014': '-', '\u2022': '-', '\u2026': '...', '\u00a0': ' '}
+
+dynamodb = aws_clients.lazy_resource('dynamodb')
+s3client = aws_clients.lazy_client('s3')
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+def publish(wafr_accelerator_runs_table, wafr_accelerator_run_key, bucket, wafr_findings_table_name=None):
+    """
+    Renders the report of the review and stores it in bucket, unless the stored version already has the same content.
+    Returns the report prefix.
+    """
+
+    review = wafr_accelerator_runs_table.get_item(
+        Key=wafr_accelerator_run_key,
+        ProjectionExpression="analysis_id, analysis_submitter, analysis_title, workload_desc, analysis_review_type, selected_lens, "
+                             "additional_lenses, creation_date, review_owner, selected_wafr_pillars, architecture_summary, pillars, "
+                             "document_s3_key, report_hash, report_version, report_prefix"
+    )['Item']
+
+    findings = get_findings(wafr_findings_table_name, review['analysis_id']) if review.get('analysis_review_type') != "Quick" else []
+
+    markdown = render_markdown(review, findings)
+    report_hash = hashlib.sha256(f"{REPORT_FORMAT}\n{markdown}".encode('utf-8')).hexdigest()
+
+    if review.get('report_hash') == report_hash:
+        logger.info(f"Report {review['report_prefix']} is up to date")
+        emf_metrics.put_metric("ReportsReused", 1)
+        return review['report_prefix']
+
+    report_version = int(review.get('report_version', 0)) + 1
+    report_prefix = f"{report_directory(review)}/report/v{report_version}/"
+
+    with emf_metrics.timed("render_report") as measurement:
+        rendered = {
+            'md': markdown.encode('utf-8'),
+            'html': render_html(markdown, review.get('analysis_title', '')).encode('utf-8'),
+            'pdf': render_pdf(markdown)
+        }
+        measurement.add("ReportBytes", sum(len(body) for body in rendered.values()))
+
+    for report_format, (filename, content_type) in REPORT_FILES.items():
+        s3client.put_object(Bucket=bucket, Key=report_prefix + filename, Body=rendered[report_format], ContentType=content_type)
+
+    wafr_accelerator_runs_table.update_item(
+        Key=wafr_accelerator_run_key,
+        UpdateExpression="SET report_prefix = :prefix, report_version = :version, report_hash = :hash, report_created_at = :now",
+        ExpressionAttributeValues={':prefix': report_prefix, ':version': report_version, ':hash': report_hash, ':now': int(time.time())},
+        ReturnValues='NONE'
+    )
+
+    logger.info(f"Report rendered to {report_prefix}")
+    emf_metrics.put_metric("ReportsRendered", 1)
+
+    return report_prefix
+
+def report_directory(review):
+    # The directory of the uploaded document, <submitter>/analyses/<analysis id>
+    document_s3_key = review.get('document_s3_key', '')
+    if '/' in document_s3_key:
+        return document_s3_key[:document_s3_key.rfind('/')]
+    return f"{review['analysis_submitter']}/analyses/{review['analysis_id']}"
+
+def get_findings(wafr_findings_table_name, analysis_id):
+
+    # Reviews started before the findings table existed have no findings
+    if not wafr_findings_table_name:
+        return []
+
+    from boto3.dynamodb.conditions import Key
+
+    wafr_findings_table = dynamodb.Table(wafr_findings_table_name)
+
+    query_arguments = {'KeyConditionExpression': Key('analysis_id').eq(analysis_id)}
+    findings = []
+    while True:
+        response = wafr_findings_table.query(**query_arguments)
+        findings.extend(response['Items'])
+        if 'LastEvaluatedKey' not in response:
+            break
+        query_arguments['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    return findings
+
+def pillar_order(pillar_key, pillar):
+    # Pillars of the first lens first, then those of additional lenses (keyed <lens tag>:<pillar id>), by pillar id
+    lens_tag = pillar_key.split(':')[0] if ':' in pillar_key else ''
+    pillar_id = str(pillar.get('pillar_id', ''))
+    return (lens_tag, int(pillar_id) if pillar_id.isdigit() else 0, pillar_id)
+
+def table_cell(value):
+    return ' '.join(str(value).split()).replace('|', '\\|')
+
+def render_markdown(review, findings):
+
+    lenses = ', '.join([review.get('selected_lens', '')] + sorted(review.get('additional_lenses') or {}))
+    selected_pillars = review.get('selected_wafr_pillars', [])
+    if isinstance(selected_pillars, (list, set)):
+        selected_pillars = ', '.join(selected_pillars)
+
+    lines = [
+        f"# {review.get('analysis_title', '')} - Well-Architected Framework Review",
+        "",
+        "| Field | Value |",
+        "| --- | --- |"
+    ]
+    for field, value in [("Analysis Id", review['analysis_id']), ("Workload Description", review.get('workload_desc', '')),
+                         ("Analysis Type", review.get('analysis_review_type', '')), ("WAFR Lens", lenses),
+                         ("Selected WAFR Pillars", selected_pillars), ("Creation Date", review.get('creation_date', '')),
+                         ("Created By", review['analysis_submitter']), ("Review Owner", review.get('review_owner', ''))]:
+        lines.append(f"| {field} | {table_cell(value)} |")
+
+    lines.extend(["", "## Solution Summary", "", review.get('architecture_summary', '').strip()])
+
+    if findings:
+        risk_counts = {}
+        for finding in findings:
+            counts = risk_counts.setdefault(finding.get('pillar_name', ''), dict.fromkeys(RISK_LEVELS, 0))
+            risk_level = finding.get('risk_level', "Unknown")
+            counts[risk_level if risk_level in counts else "Unknown"] += 1
+
+        lines.extend(["", "## Risk Summary", "", "| Pillar | " + " | ".join(RISK_LEVELS) + " |", "| --- |" + " --- |" * len(RISK_LEVELS)])
+        for pillar_name in sorted(risk_counts):
+            lines.append(f"| {table_cell(pillar_name)} | " + " | ".join(str(risk_counts[pillar_name][risk_level]) for risk_level in RISK_LEVELS) + " |")
+
+        risks = [finding for finding in findings if finding.get('risk_level') in ("High", "Medium")]
+        if risks:
+            lines.extend(["", "## High and Medium Risks", "", "| Pillar | Question | Risk |", "| --- | --- | --- |"])
+            for finding in sorted(risks, key=lambda finding: (RISK_LEVELS.index(finding['risk_level']), finding.get('pillar_name', ''), finding['question_id'])):
+                lines.append(f"| {table_cell(finding.get('pillar_name', ''))} | {table_cell(finding.get('question', finding['question_id']))} | {finding['risk_level']} |")
+
+    pillars = review.get('pillars') or {}
+    # Reviews created before pillars was a map stored a list
+    pillar_items = sorted(pillars.items(), key=lambda entry: pillar_order(*entry)) if isinstance(pillars, dict) else [(str(index), pillar) for index, pillar in enumerate(pillars)]
+    for _, pillar in pillar_items:
+        lines.extend(["", f"## {pillar.get('pillar_name', '')}", "", pillar.get('llm_response', '').strip()])
+
+    return '\n'.join(lines) + '\n'
+
+def render_inline(text):
+    text = html.escape(text, quote=False)
+    text = re.sub(r'`([^`]+)`', r'<code>\1</code>', text)
+    text = re.sub(r'\*\*(.+?)\*\*', r'<strong>\1</strong>', text)
+    text = re.sub(r'(?<![\w*])\*(?!\s)(.+?)(?<!\s)\*(?![\w*])', r'<em>\1</em>', text)
+    return text
+
+def table_cells(line):
+    return [cell.strip().replace('\\|', '|') for cell in re.split(r'(?<!\\)\|', line.strip().strip('|'))]
+
+def render_html(markdown, title):
+    """
+    HTML of the report Markdown. Covers the Markdown the report and the model responses use: headings, paragraphs,
+    bullet and numbered lists, tables, fenced code, bold, italics and inline code.
+    """
+
+    body = []
+    paragraph = []
+    list_tag = None
+    lines = markdown.splitlines()
+    position = 0
+
+    def close_blocks():
+        nonlocal list_tag
+        if paragraph:
+            body.append(f"<p>{render_inline(' '.join(paragraph))}</p>")
+            paragraph.clear()
+        if list_tag:
+            body.append(f"</{list_tag}>")
+            list_tag = None
+
+    while position < len(lines):
+        line = lines[position]
+        stripped = line.strip()
+        heading = re.match(r'^(#{1,6})\s+(.*)$', stripped)
+        list_item = re.match(r'^([-*+]|\d+[.)])\s+(.*)$', stripped)
+
+        if stripped.startswith('```'):
+            close_blocks()
+            code = []
+            position += 1
+            while position < len(lines) and not lines[position].strip().startswith('```'):
+                code.append(lines[position])
+                position += 1
+            body.append(f"<pre><code>{html.escape(chr(10).join(code), quote=False)}</code></pre>")
+        elif stripped.startswith('|'):
+            close_blocks()
+            rows = []
+            while position < len(lines) and lines[position].strip().startswith('|'):
+                if not re.match(r'^\|[\s:\-|]+\|$', lines[position].strip()):
+                    rows.append(table_cells(lines[position]))
+                position += 1
+            position -= 1
+            if not rows:
+                continue
+            header = ''.join(f"<th>{render_inline(cell)}</th>" for cell in rows[0])
+            rest = ''.join('<tr>' + ''.join(f"<td>{render_inline(cell)}</td>" for cell in row) + '</tr>' for row in rows[1:])
+            body.append(f"<table><thead><tr>{header}</tr></thead><tbody>{rest}</tbody></table>")
+        elif heading:
+            close_blocks()
+            level = len(heading.group(1))
+            body.append(f"<h{level}>{render_inline(heading.group(2))}</h{level}>")
+        elif list_item:
+            tag = 'ol' if list_item.group(1)[0].isdigit() else 'ul'
+            if paragraph or list_tag != tag:
+                close_blocks()
+                body.append(f"<{tag}>")
+                list_tag = tag
+            body.append(f"<li>{render_inline(list_item.group(2))}</li>")
+        elif not stripped:
+            close_blocks()
+        elif list_tag and line[:1].isspace():
+            # Continuation of the list item above
+            body[-1] = body[-1][:-len('</li>')] + ' ' + render_inline(stripped) + '</li>'
+        else:
+            if list_tag:
+                close_blocks()
+            paragraph.append(stripped)
+        position += 1
+
+    close_blocks()
+
+    return f"""<!DOCTYPE html>
+<html lang="en">
+<head>
+<meta charset="utf-8">
+<title>{html.escape(title)} - Well-Architected Framework Review</title>
+<style>
+body {{ font-family: -apple-system, "Segoe UI", Helvetica, Arial, sans-serif; line-height: 1.5; max-width: 60em; margin: 2em auto; padding: 0 1em; color: #16191f; }}
+table {{ border-collapse: collapse; margin: 1em 0; }}
+th, td {{ border: 1px solid #d5dbdb; padding: 0.3em 0.6em; text-align: left; vertical-align: top; }}
+th {{ background: #f2f3f3; }}
+pre {{ background: #f2f3f3; padding: 0.8em; overflow-x: auto; }}
+h2 {{ border-bottom: 1px solid #d5dbdb; padding-bottom: 0.2em; margin-top: 1.6em; }}
+</style>
+</head>
+<body>
+{chr(10).join(body)}
+</body>
+</html>
+"""
+
+def pdf_lines(markdown):
+    """The report Markdown as (bold, font size, text) lines wrapped to the page width, with None for spacing."""
+
+    lines = []
+    in_code = False
+    for line in markdown.splitlines():
+        stripped = line.strip()
+        if stripped.startswith('```'):
+            in_code = not in_code
+            continue
+
+        heading = re.match(r'^(#{1,6})\s+(.*)$', stripped)
+        if in_code:
+            bold, size, text = False, PDF_BODY_SIZE, line.rstrip()
+        elif heading:
+            lines.append(None)
+            bold, size, text = True, PDF_HEADING_SIZES.get(len(heading.group(1)), PDF_BODY_SIZE + 1), heading.group(2)
+        elif stripped.startswith('|'):
+            if re.match(r'^\|[\s:\-|]+\|$', stripped):
+                continue
+            bold, size, text = False, PDF_BODY_SIZE, '   '.join(table_cells(stripped))
+        elif not stripped:
+            lines.append(None)
+            continue
+        else:
+            bold, size, text = False, PDF_BODY_SIZE, re.sub(r'^([*+]|-)\s+', '- ', stripped)
+
+        text = re.sub(r'\*\*(.+?)\*\*|`([^`]+)`', lambda match: match.group(1) or match.group(2), text)
+        width = int((PDF_PAGE_WIDTH - 2 * PDF_MARGIN) / (size * PDF_CHARACTER_WIDTH))
+        for wrapped in textwrap.wrap(text, width, subsequent_indent='  ' if text.startswith('- ') else '') or ['']:
+            lines.append((bold, size, wrapped))
+
+    return lines
+
+def pdf_text(text):
+    # The standard fonts use WinAnsiEncoding, so characters outside Latin-1 are replaced
+    text = ''.join(PDF_CHARACTERS.get(character, character) for character in text)
+    text = text.encode('latin-1', 'replace').decode('latin-1')
+    return text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+
+def render_pdf(markdown):
+    """A text PDF of the report Markdown, built without a PDF library."""
+
+    pages = []
+    page = []
+    y = PDF_PAGE_HEIGHT - PDF_MARGIN
+    for line in pdf_lines(markdown):
+        height = PDF_BODY_SIZE * 0.6 if line is None else line[1] * 1.4
+        if y - height < PDF_MARGIN:
+            pages.append(page)
+            page = []
+            y = PDF_PAGE_HEIGHT - PDF_MARGIN
+            if line is None:
+                continue
+        y -= height
+        if line is not None:
+            bold, size, text = line
+            page.append(f"BT /{'F2' if bold else 'F1'} {size} Tf {PDF_MARGIN} {y:.1f} Td ({pdf_text(text)}) Tj ET")
+    pages.append(page)
+
+    # 1 catalog, 2 page tree, 3 and 4 fonts, then a page and its content stream for each page
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        f"<< /Type /Pages /Kids [{' '.join(f'{5 + 2 * index} 0 R' for index in range(len(pages)))}] /Count {len(pages)} >>".encode('latin-1'),
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>",
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica-Bold /Encoding /WinAnsiEncoding >>"
+    ]
+    for index, page in enumerate(pages):
+        content = zlib.compress('\n'.join(page).encode('latin-1'))
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {PDF_PAGE_WIDTH} {PDF_PAGE_HEIGHT}] "
+                       f"/Resources << /Font << /F1 3 0 R /F2 4 0 R >> >> /Contents {6 + 2 * index} 0 R >>".encode('latin-1'))
+        objects.append(f"<< /Length {len(content)} /Filter /FlateDecode >>\nstream\n".encode('latin-1') + content + b"\nendstream")
+
+    pdf = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(pdf))
+        pdf.extend(f"{number} 0 obj\n".encode('latin-1') + body + b"\nendobj\n")
+
+    xref_offset = len(pdf)
+    pdf.extend(f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode('latin-1'))
+    pdf.extend(''.join(f"{offset:010d} 00000 n \n" for offset in offsets).encode('latin-1'))
+    pdf.extend(f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref_offset}\n%%EOF\n".encode('latin-1'))
+
+    return bytes(pdf)
@@ -0,0 +1,146 @@
+import os
+import json
+import random
+import hashlib
+import logging
+import datetime
+
+# Longest string logged from any single field. Longer values are cut and tagged with their length and hash, so the
+# size of a log record does not depend on the size of the document, prompt or model response being processed
+LOG_FIELD_MAX_CHARS = int(os.environ.get('LOG_FIELD_MAX_CHARS', '500'))
+# Items logged from any single list or dict, and how deep nested values are followed
+LOG_FIELD_MAX_ITEMS = int(os.environ.get('LOG_FIELD_MAX_ITEMS', '20'))
+LOG_FIELD_MAX_DEPTH = int(os.environ.get('LOG_FIELD_MAX_DEPTH', '6'))
+# Cap on the whole message, for messages that were formatted before reaching the logger (f-strings)
+LOG_MESSAGE_MAX_CHARS = int(os.environ.get('LOG_MESSAGE_MAX_CHARS', '4000'))
+
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+# Share of invocations that log at DEBUG regardless of LOG_LEVEL, e.g. 0.01 to see prompts and responses of 1 in 100
+LOG_DEBUG_SAMPLE_RATE = float(os.environ.get('LOG_DEBUG_SAMPLE_RATE', '0'))
+
+# Module level, so it is set once per invocation and added to every record of that invocation
+invocation_context = {'correlation_id': None, 'debug_sampled': False}
+
+def start_invocation(logger, event=None, correlation_id=None):
+    """
+    Called first thing in every handler. Switches the Lambda log handlers to JSON records, sets the correlation id
+    (the analysis id) added to each record, and decides whether this invocation is sampled for DEBUG logging.
+    """
+
+    install_formatter(logger)
+
+    set_correlation_id(correlation_id or find_correlation_id(event))
+
+    invocation_context['debug_sampled'] = random.random() < LOG_DEBUG_SAMPLE_RATE
+    logger.setLevel(logging.DEBUG if invocation_context['debug_sampled'] else LOG_LEVEL)
+
+def set_correlation_id(correlation_id):
+    invocation_context['correlation_id'] = correlation_id
+
+def find_correlation_id(event):
+
+    # Step Functions payloads carry the run key, the review queue messages and the Map state outputs the analysis id
+    if isinstance(event, list) and event:
+        return find_correlation_id(event[0].get('body', event[0]) if isinstance(event[0], dict) else None)
+    if isinstance(event, dict):
+        if isinstance(event.get('wafr_accelerator_run_key'), dict):
+            return event['wafr_accelerator_run_key'].get('analysis_id')
+        if isinstance(event.get('body'), dict):
+            return find_correlation_id(event['body'])
+        return event.get('analysis_id')
+
+    return None
+
+def capped(value, max_chars=None):
+    """
+    Log argument that is only serialised, with every field capped, if the record is actually written.
+    Use with %s formatting, e.g. logger.debug("prompt: %s", capped(prompt)), never inside an f-string.
+    """
+
+    return CappedValue(value, max_chars or LOG_FIELD_MAX_CHARS)
+
+class CappedValue:
+
+    def __init__(self, value, max_chars):
+        self.value = value
+        self.max_chars = max_chars
+
+    def __str__(self):
+        value = cap_value(self.value, self.max_chars)
+        return value if isinstance(value, str) else json.dumps(value, default=str)
+
+def cap_value(value, max_chars=LOG_FIELD_MAX_CHARS, depth=0):
+
+    if isinstance(value, bytes):
+        value = value.decode('utf-8', 'replace')
+
+    if isinstance(value, str):
+        return cap_string(value, max_chars)
+
+    if depth >= LOG_FIELD_MAX_DEPTH and isinstance(value, (dict, list, tuple, set)):
+        return f"<{type(value).__name__} of {len(value)} items>"
+
+    if isinstance(value, dict):
+        capped_dict = {str(key): cap_value(item, max_chars, depth + 1) for key, item in list(value.items())[:LOG_FIELD_MAX_ITEMS]}
+        if len(value) > LOG_FIELD_MAX_ITEMS:
+            capped_dict['...'] = f"{len(value) - LOG_FIELD_MAX_ITEMS} more keys"
+        return capped_dict
+
+    if isinstance(value, (list, tuple, set)):
+        items = list(value)
+        capped_list = [cap_value(item, max_chars, depth + 1) for item in items[:LOG_FIELD_MAX_ITEMS]]
+        if len(items) > LOG_FIELD_MAX_ITEMS:
+            capped_list.append(f"... {len(items) - LOG_FIELD_MAX_ITEMS} more items")
+        return capped_list
+
+    if isinstance(value, (int, float, bool)) or value is None:
+        return value
+
+    return cap_string(str(value), max_chars)
+
+def cap_string(value, max_chars):
+
+    if len(value) <= max_chars:
+        return value
+
+    # The hash identifies the full body (e.g. to match it with the prompt or output file in S3) without logging it
+    digest = hashlib.sha256(value.encode('utf-8', 'replace')).hexdigest()[:16]
+
+    return f"{value[:max_chars]}... [{len(value)} chars, sha256 {digest}]"
+
+class JsonLogFormatter(logging.Formatter):
+    """One JSON object per record, so CloudWatch Logs Insights can filter on level, correlation_id and fields."""
+
+    def format(self, record):
+
+        entry = {
+            'timestamp': datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'message': cap_string(record.getMessage(), LOG_MESSAGE_MAX_CHARS),
+            'correlation_id': invocation_context['correlation_id'],
+            'request_id': getattr(record, 'aws_request_id', None),
+            'location': f"{record.module}.{record.funcName}:{record.lineno}"
+        }
+
+        # Structured fields passed as logger.info("...", extra={'fields': {...}})
+        if isinstance(getattr(record, 'fields', None), dict):
+            entry['fields'] = cap_value(record.fields)
+
+        if record.exc_info:
+            entry['exception'] = cap_string(self.formatException(record.exc_info), LOG_MESSAGE_MAX_CHARS)
+
+        return json.dumps(entry, default=str)
+
+def install_formatter(logger):
+
+    if getattr(logger, 'wafr_json_formatter_installed', False):
+        return
+
+    # The Lambda runtime attaches its own handler to the root logger; reuse it so records keep the request id
+    if not logger.handlers:
+        logger.addHandler(logging.StreamHandler())
+
+    for handler in logger.handlers:
+        handler.setFormatter(JsonLogFormatter())
+
+    logger.wafr_json_formatter_installed = True
@@ -0,0 +1,214 @@
+import os
+import json
+import datetime
+import logging
+
+from botocore.exceptions import ClientError
+
+import aws_clients
+import cassettes
+import emf_metrics
+import structured_logging
+import review_lenses
+import progress
+
+s3client = aws_clients.lazy_client('s3')
+dynamodb = aws_clients.lazy_resource('dynamodb')
+
+WAFR_ACCELERATOR_RUNS_DD_TABLE_NAME = os.environ['WAFR_ACCELERATOR_RUNS_DD_TABLE_NAME']
+UPLOAD_BUCKET_NAME = os.environ['UPLOAD_BUCKET_NAME']
+REGION = os.environ['REGION']
+WAFR_PROMPT_DD_TABLE_NAME = os.environ['WAFR_PROMPT_DD_TABLE_NAME']
+WAFR_FINDINGS_DD_TABLE_NAME = os.environ.get('WAFR_FINDINGS_DD_TABLE_NAME', '')
+KNOWLEDGE_BASE_ID = os.environ['KNOWLEDGE_BASE_ID']
+LLM_MODEL_ID = os.environ['LLM_MODEL_ID']
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+@cassettes.recorded
+def lambda_handler(event, context):
+
+    entry_timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H-%M-%S-%f")
+
+    structured_logging.start_invocation(logger)
+
+    logger.info('prepare_wafr_redrive invoked at ' + entry_timestamp)
+
+    logger.info("Event: %s", structured_logging.capped(event))
+
+    data = json.loads(event[0]['body'])
+    structured_logging.set_correlation_id(data.get('analysis_id'))
+    emf_metrics.start_invocation("prepare_redrive", data.get('analysis_id'))
+
+    wafr_accelerator_runs_table = dynamodb.Table(WAFR_ACCELERATOR_RUNS_DD_TABLE_NAME)
+
+    wafr_accelerator_run_key = {
+        'analysis_id': data['analysis_id'],
+        'analysis_submitter': data['analysis_submitter']
+    }
+
+    try:
+        analysis = wafr_accelerator_runs_table.get_item(Key=wafr_accelerator_run_key, ConsistentRead=True).get('Item')
+
+        if analysis is None:
+            raise Exception (f"Analysis {data['analysis_id']} not found")
+
+        document_s3_key = analysis['document_s3_key']
+
+        # Resume from the first stage whose output is missing on the run item
+        if ('wafr_workload_id' not in analysis):
+            redrive_stage = 'prepare'
+        elif ('extracted_document' not in analysis):
+            redrive_stage = 'extract'
+        elif ('architecture_summary' not in analysis):
+            redrive_stage = 'summary'
+        elif ('question_manifest_key' not in analysis):
+            redrive_stage = 'prompts'
+        else:
+            redrive_stage = 'questions'
+
+        logger.info(f"Redriving analysis {data['analysis_id']} from stage: {redrive_stage}")
+
+        wafr_accelerator_runs_table.update_item(
+            Key=wafr_accelerator_run_key,
+            UpdateExpression="SET review_status = :val, stage_started_at = if_not_exists(stage_started_at, :empty_map)",
+            ExpressionAttributeValues={':val': "In Progress", ':empty_map': {}},
+            ReturnValues='UPDATED_NEW'
+        )
+
+        logger.debug("prepare_wafr_redrive checkpoint 1")
+
+        if (redrive_stage == 'prepare'):
+            # Nothing reusable yet, so hand the original review request to prepare_wafr_review
+            review_request = {
+                'analysis_id': analysis['analysis_id'],
+                'analysis_submitter': analysis['analysis_submitter'],
+                'analysis_name': analysis['analysis_title'],
+                'wafr_lens': analysis['selected_lens'],
+                'selected_pillars': analysis['selected_wafr_pillars'],
+                'document_s3_key': document_s3_key,
+                'additional_lenses': analysis.get('additional_lenses', {}),
+                'analysis_review_type': analysis.get('analysis_review_type', 'Deep')
+            }
+            if 'llm_model_id' in analysis:
+                review_request['llm_model_id'] = analysis['llm_model_id']
+
+            return_response = {
+                'redrive_stage': redrive_stage,
+                'records': [{'body': json.dumps(review_request)}]
+            }
+        else:
+            return_response = get_review_payload(analysis, wafr_accelerator_run_key)
+            return_response['redrive_stage'] = redrive_stage
+
+            if (redrive_stage == 'questions'):
+                return_response['all_pillar_prompts'] = get_pending_pillar_prompts(analysis['question_manifest_key'], analysis.get('question_status', {}))
+
+                logger.info(f"{len(return_response['all_pillar_prompts'])} pillars have questions left to answer")
+
+                # The other stages record their progress themselves; redriven questions go straight to the pillar Map
+                progress.set_progress_stage(wafr_accelerator_runs_table, wafr_accelerator_run_key, "answer_questions")
+
+        logger.debug("prepare_wafr_redrive checkpoint 2")
+
+    except Exception as error:
+        update_analysis_status (data, error)
+        raise Exception (f'Exception caught in prepare_wafr_redrive: {error}')
+
+    logger.info('return_response: %s', structured_logging.capped(return_response))
+
+    exit_timeestamp = datetime.datetime.now().strftime("%Y-%m-%d %H-%M-%S-%f")
+
+    logger.info(f'Exiting prepare_wafr_redrive at {exit_timeestamp}')
+
+    return {
+        'statusCode': 200,
+        'body': return_response
+    }
+
+def get_review_payload(analysis, wafr_accelerator_run_key):
+
+    # Same shape as the payload built by prepare_wafr_review and extract_document_text
+    document_s3_key = analysis['document_s3_key']
+
+    wafr_accelerator_run_items = {
+        'analysis_id': analysis['analysis_id'],
+        'analysis_submitter': analysis['analysis_submitter'],
+        'analysis_title': analysis.get('analysis_title', ''),
+        'selected_lens': analysis['selected_lens'],
+        'creation_date': analysis.get('creation_date', ''),
+        'review_status': "In Progress",
+        'selected_wafr_pillars': analysis['selected_wafr_pillars'],
+        'document_s3_key': document_s3_key,
+        'analysis_owner': analysis.get('analysis_owner', ''),
+        'wafr_workload_id': analysis['wafr_workload_id'],
+        'workload_name': analysis.get('analysis_title', ''),
+        'workload_desc': analysis.get('workload_desc', ''),
+        'environment': analysis.get('environment', ''),
+        'review_owner': analysis.get('review_owner', ''),
+        'industry_type': analysis.get('industry_type', ''),
+        'lens_alias': analysis['lenses'],
+        'additional_lenses': analysis.get('additional_lenses', {}),
+        'inference_mode': 'on_demand',
+        'previous_analysis_id': analysis.get('previous_analysis_id', '')
+    }
+
+    return_response = {}
+
+    return_response['wafr_accelerator_run_items'] = wafr_accelerator_run_items
+    return_response['wafr_accelerator_run_key'] = wafr_accelerator_run_key
+    return_response['extract_output_bucket'] = UPLOAD_BUCKET_NAME
+    return_response['pillars_string'] = ",".join(analysis['selected_wafr_pillars'])
+    return_response['wafr_accelerator_runs_table'] = WAFR_ACCELERATOR_RUNS_DD_TABLE_NAME
+    return_response['wafr_prompts_table'] = WAFR_PROMPT_DD_TABLE_NAME
+    return_response['wafr_findings_table'] = WAFR_FINDINGS_DD_TABLE_NAME
+    return_response['region'] = REGION
+    return_response['knowledge_base_id'] = KNOWLEDGE_BASE_ID
+    # The model the review started with; runs from before the model was recorded used this function's default
+    return_response['llm_model_id'] = analysis.get('llm_model_id', LLM_MODEL_ID)
+    return_response['wafr_workload_id'] = analysis['wafr_workload_id']
+    return_response['lens_alias'] = analysis['lenses']
+    return_response['extract_text_file_name'] = document_s3_key[:document_s3_key.rfind('.')] + "-extracted-text.txt"
+
+    return return_response
+
+def get_pending_pillar_prompts(question_manifest_key, question_status):
+
+    try:
+        all_pillar_prompts = json.loads(s3client.get_object(Bucket=UPLOAD_BUCKET_NAME, Key=question_manifest_key)['Body'].read())
+    except ClientError as error:
+        raise Exception (f"Unable to read question manifest {question_manifest_key}: {error}")
+
+    # Only pillars with at least one question that did not complete are run again; their completed answers are reused
+    pending_pillar_prompts = []
+
+    for pillar_prompts in all_pillar_prompts:
+        pending_questions = [
+            review_lenses.question_key(question_metadata)
+            for question_metadata in pillar_prompts[pillar_prompts['input_pillar']]
+            if question_status.get(review_lenses.question_key(question_metadata)) != "Completed"
+        ]
+
+        if pending_questions:
+            logger.info(f"Pillar {pillar_prompts['input_pillar']} questions to redrive: {pending_questions}")
+            pending_pillar_prompts.append(pillar_prompts)
+
+    return pending_pillar_prompts
+
+def update_analysis_status (data, error):
+
+    wafr_accelerator_runs_table = dynamodb.Table(WAFR_ACCELERATOR_RUNS_DD_TABLE_NAME)
+
+    wafr_accelerator_run_key = {
+        'analysis_id':  data['analysis_id'],
+        'analysis_submitter':  data['analysis_submitter']
+    }
+
+    wafr_accelerator_runs_table.update_item(
+        Key=wafr_accelerator_run_key,
+        UpdateExpression="SET review_status = :val",
+        ExpressionAttributeValues={':val': "Errored"},
+        ReturnValues='UPDATED_NEW'
+    )
+    logger.error(f"Exception caught in prepare_wafr_redrive: {error}")
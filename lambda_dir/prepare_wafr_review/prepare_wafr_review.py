@@ -1,57 +1,50 @@
 import os
-import boto3
 import json
 import datetime
 import time
 import logging
 
-from boto3.dynamodb.conditions import Key
-from boto3.dynamodb.conditions import Attr
-from botocore.client import Config
 from botocore.exceptions import ClientError
 
-s3 = boto3.resource('s3')
-dynamodb = boto3.resource('dynamodb')
-well_architected_client = boto3.client('wellarchitected')
+import aws_clients
+import cassettes
+import emf_metrics
+import structured_logging
+import review_lenses
+
+s3 = aws_clients.lazy_resource('s3')
+dynamodb = aws_clients.lazy_resource('dynamodb')
+well_architected_client = aws_clients.lazy_client('wellarchitected')
 
 WAFR_ACCELERATOR_RUNS_DD_TABLE_NAME = os.environ['WAFR_ACCELERATOR_RUNS_DD_TABLE_NAME']
 UPLOAD_BUCKET_NAME = os.environ['UPLOAD_BUCKET_NAME']
 REGION = os.environ['REGION']
 WAFR_PROMPT_DD_TABLE_NAME = os.environ['WAFR_PROMPT_DD_TABLE_NAME']
+WAFR_FINDINGS_DD_TABLE_NAME = os.environ.get('WAFR_FINDINGS_DD_TABLE_NAME', '')
 KNOWLEDGE_BASE_ID=os.environ['KNOWLEDGE_BASE_ID']
 LLM_MODEL_ID=os.environ['LLM_MODEL_ID']
 BEDROCK_SLEEP_DURATION = os.environ['BEDROCK_SLEEP_DURATION']
 BEDROCK_MAX_TRIES = os.environ['BEDROCK_MAX_TRIES']
 
-bedrock_config = Config(connect_timeout=120, region_name=REGION, read_timeout=120, retries={'max_attempts': 0})
-bedrock_client = boto3.client('bedrock-runtime',region_name=REGION)
-bedrock_agent_client = boto3.client("bedrock-agent-runtime", config=bedrock_config)
-
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-def get_lens_alias (wafr_lens):
-    wafr_prompts_table = dynamodb.Table(WAFR_PROMPT_DD_TABLE_NAME)
-    
-    response = wafr_prompts_table.query(
-        ProjectionExpression ='wafr_pillar_id, wafr_pillar_prompt, wafr_lens_alias',
-        KeyConditionExpression=Key('wafr_lens').eq(wafr_lens),
-        ScanIndexForward=True  
-    )
-   
-    print (f"response wafr_lens_alias: " + response['Items'][0]['wafr_lens_alias'])
-    
-    return response['Items'][0]['wafr_lens_alias']
-    
+@cassettes.recorded
 def lambda_handler(event, context):
     
     entry_timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H-%M-%S-%f")
     
+    structured_logging.start_invocation(logger)
+
     logger.info('prepare_wafr_review invoked at ' + entry_timestamp)
 
-    logger.info(json.dumps(event))
+    logger.info("Event: %s", structured_logging.capped(event))
 
     data = json.loads(event[0]['body'])
+    structured_logging.set_correlation_id(data.get('analysis_id'))
+    # A redrive of a review that failed before it got here asks for the model the review started with
+    llm_model_id = data.get('llm_model_id', LLM_MODEL_ID)
+    emf_metrics.start_invocation("prepare_review", data.get('analysis_id'), llm_model_id, data.get('wafr_lens'))
         
     try:
         
@@ -76,7 +69,7 @@ def lambda_handler(event, context):
         )
         analysis = analysis_response.get("Item", {})
         
-        logger.info(f'analysis: {json.dumps(analysis)}')
+        logger.info('analysis: %s', structured_logging.capped(analysis))
         
         name = data.get("analysis_name", "")
         wafr_lens = data['wafr_lens']
@@ -90,13 +83,25 @@ def lambda_handler(event, context):
         
         # Get the lens ARN from the friendly name
         lenses =  analysis["lenses"] 
+        # Further lenses reviewed in the same run, by name
+        additional_lenses = data.get('additional_lenses', {})
 
         aws_regions = [REGION]  
             
         logger.info('creation_date: ' + creation_date)
         
-        wafr_workload_id = create_workload(well_architected_client, workload_name, 
-            workload_desc, environment, lenses, review_owner, industry_type, aws_regions)
+        # An update of an earlier review answers the questions of the earlier review's workload again, so the answers it
+        # does not re-evaluate carry over and the new milestone sits next to the earlier ones
+        previous_analysis = get_previous_analysis(wafr_accelerator_runs_table, data.get('previous_analysis_id'), analysis_submitter, lenses, additional_lenses)
+        
+        if previous_analysis:
+            wafr_workload_id = previous_analysis['wafr_workload_id']
+            previous_analysis_id = previous_analysis['analysis_id']
+            logger.info(f"Updating analysis {previous_analysis_id} in workload {wafr_workload_id}")
+        else:
+            wafr_workload_id = create_workload(well_architected_client, workload_name, 
+                workload_desc, environment, review_lenses.lens_aliases(lenses, additional_lenses), review_owner, industry_type, aws_regions)
+            previous_analysis_id = ''
     
         review_status = "In Progress"
         document_s3_key = data['document_s3_key']
@@ -108,10 +113,15 @@ def lambda_handler(event, context):
             
         response = wafr_accelerator_runs_table.update_item(
             Key=wafr_accelerator_run_key,
-            UpdateExpression="SET review_status = :val1, wafr_workload_id = :val2",
+            UpdateExpression="SET review_status = :val1, wafr_workload_id = :val2, previous_analysis_id = :val3, additional_lenses = :val4, progress_stage = :stage, stage_started_at = if_not_exists(stage_started_at, :stage_started_at), llm_model_id = :model",
             ExpressionAttributeValues={
                 ':val1': review_status,
-                ':val2': wafr_workload_id
+                ':val2': wafr_workload_id,
+                ':val3': previous_analysis_id,
+                ':val4': additional_lenses,
+                ':stage': "prepare_review",
+                ':stage_started_at': {'prepare_review': int(time.time())},
+                ':model': llm_model_id
             },
             ReturnValues='UPDATED_NEW'
         )
@@ -140,7 +150,11 @@ def lambda_handler(event, context):
             'environment': environment,
             'review_owner': review_owner,
             'industry_type': industry_type,
-            'lens_alias': lenses
+            'lens_alias': lenses,
+            'additional_lenses': additional_lenses,
+            'inference_mode': data.get('inference_mode', 'on_demand'),
+            'bypass_response_cache': data.get('bypass_response_cache', False),
+            'previous_analysis_id': previous_analysis_id
         }
         
         logger.debug('prepare_wafr_review checkpoint 2')
@@ -153,9 +167,10 @@ def lambda_handler(event, context):
         return_response['pillars_string'] = pillar_string
         return_response['wafr_accelerator_runs_table'] = WAFR_ACCELERATOR_RUNS_DD_TABLE_NAME
         return_response['wafr_prompts_table'] = WAFR_PROMPT_DD_TABLE_NAME
+        return_response['wafr_findings_table'] = WAFR_FINDINGS_DD_TABLE_NAME
         return_response['region'] = REGION
         return_response['knowledge_base_id'] = KNOWLEDGE_BASE_ID
-        return_response['llm_model_id'] = LLM_MODEL_ID
+        return_response['llm_model_id'] = llm_model_id
         return_response['wafr_workload_id'] = wafr_workload_id
         return_response['lens_alias'] = lenses
     
@@ -163,7 +178,7 @@ def lambda_handler(event, context):
         update_analysis_status (data, error)
         raise Exception (f'Exception caught in prepare_wafr_review: {error}')
         
-    logger.info(f'return_response: {return_response}')
+    logger.info('return_response: %s', structured_logging.capped(return_response))
     
     exit_timeestamp = datetime.datetime.now().strftime("%Y-%m-%d %H-%M-%S-%f")
     
@@ -174,6 +189,29 @@ def lambda_handler(event, context):
         'body': json.dumps(return_response)
     }
     
+def get_previous_analysis(wafr_accelerator_runs_table, previous_analysis_id, analysis_submitter, lenses, additional_lenses):
+    
+    if not previous_analysis_id:
+        return None
+    
+    response = wafr_accelerator_runs_table.get_item(
+        Key={
+            'analysis_id': previous_analysis_id,
+            'analysis_submitter': analysis_submitter
+        }
+    )
+    previous_analysis = response.get('Item')
+    
+    # Anything else is reviewed in full, in a workload of its own
+    if not previous_analysis or not previous_analysis.get('wafr_workload_id'):
+        logger.info(f"Analysis {previous_analysis_id} of {analysis_submitter} has no workload to update, running a full review")
+        return None
+    if previous_analysis.get('lenses') != lenses or previous_analysis.get('additional_lenses', {}) != additional_lenses:
+        logger.info(f"Analysis {previous_analysis_id} reviewed other lenses, running a full review")
+        return None
+    
+    return previous_analysis
+
 def create_workload(client, workload_name, description, environment, lenses, review_owner, industry_type, aws_regions, architectural_design=None):
     workload_params = {
         'WorkloadName': workload_name,
@@ -186,12 +224,12 @@ def create_workload(client, workload_name, description, environment, lenses, rev
     }
     if architectural_design:
         workload_params['ArchitecturalDesign'] = architectural_design
-    response = client.create_workload(**workload_params)
+    with emf_metrics.timed("wa_create_workload"):
+        response = client.create_workload(**workload_params)
     return response['WorkloadId']
         
 def update_analysis_status (data, error):
     
-    dynamodb = boto3.resource('dynamodb')
     wafr_accelerator_runs_table = dynamodb.Table(WAFR_ACCELERATOR_RUNS_DD_TABLE_NAME)
     
     wafr_accelerator_run_key = {
@@ -1,11 +1,14 @@
 import os
-import boto3
 import json
 import datetime
 import urllib.parse
 import re
 import logging
 
+import aws_clients
+import emf_metrics
+import structured_logging
+
 WAFR_ACCELERATOR_QUEUE_URL = os.environ['WAFR_ACCELERATOR_QUEUE_URL']
 WAFR_UI_BUCKET_NAME = os.environ['WAFR_UI_BUCKET_NAME']
 WAFR_UI_BUCKET_ARN = os.environ['WAFR_UI_BUCKET_ARN']
@@ -21,10 +24,10 @@ PARAMETER_COGNITO_USER_POOL_ID = os.environ['PARAMETER_COGNITO_USER_POOL_ID']
 PARAMETER_COGNITO_USER_POOL_CLIENT_ID = os.environ['PARAMETER_COGNITO_USER_POOL_CLIENT_ID']
 GUARDRAIL_ID = os.environ['GUARDRAIL_ID'] 
 
-ssm_client = boto3.client('ssm')
-s3Client = boto3.client('s3')
-s3Resource = boto3.resource('s3')
-ssm_parameter_store = boto3.client('ssm', region_name=REGION_NAME) 
+ssm_client = aws_clients.lazy_client('ssm')
+s3Client = aws_clients.lazy_client('s3')
+s3Resource = aws_clients.lazy_resource('s3')
+ssm_parameter_store = aws_clients.lazy_client('ssm', region_name=REGION_NAME) 
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -33,6 +36,9 @@ def lambda_handler(event, context):
     
     entry_timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H-%M-%S")
     
+    structured_logging.start_invocation(logger)
+    emf_metrics.start_invocation("replace_ui_tokens")
+    
     logger.info("replace_ui_tokens invoked at " + entry_timestamp)
     
     s3_script = """
@@ -78,7 +84,7 @@ except Exception as e:
     logger.info("PARAMETER_COGNITO_USER_POOL_CLIENT_ID: " + PARAMETER_COGNITO_USER_POOL_CLIENT_ID)
     logger.info("GUARDRAIL_ID: " + GUARDRAIL_ID)
 
-    logger.info(json.dumps(event))
+    logger.info("Event: %s", structured_logging.capped(event))
 
     status = 'Everything done successfully - token update, s3 script creation and execution!'
     
@@ -194,7 +200,8 @@ except Exception as e:
     if( ui_sync_flag == "False"):
         if(((update1 =="True") and (update2 =="True")) and (update3 =="True")):
             logger.info (f"replace_ui_tokens checkpoint 4d : All the parameters are true, sending SSM command!")
-            send_ssm_command (EC2_INSTANCE_ID, s3_script, WAFR_UI_BUCKET_NAME)
+            with emf_metrics.timed("ssm_sync_ui"):
+                send_ssm_command (EC2_INSTANCE_ID, s3_script, WAFR_UI_BUCKET_NAME)
             ssm_parameter_store.put_parameter(
                     Name=PARAMETER_UI_SYNC_INITAITED_FLAG,
                     Value=f'True',
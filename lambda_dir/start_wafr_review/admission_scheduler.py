@@ -0,0 +1,159 @@
+import os
+import math
+import datetime
+import logging
+
+import aws_clients
+import admission_leases
+
+REGION = os.environ['REGION']
+# Quick reviews run in this function with LLM_MODEL_ID, Deep reviews in the state machine with DEEP_REVIEW_LLM_MODEL_ID
+LLM_MODEL_ID = os.environ['LLM_MODEL_ID']
+DEEP_REVIEW_LLM_MODEL_ID = os.environ.get('DEEP_REVIEW_LLM_MODEL_ID', LLM_MODEL_ID)
+
+# Account level Bedrock quotas of each model and the share of them kept free for interactive users. When both review
+# types use the same model they share the BEDROCK_* quota
+BEDROCK_TPM_LIMIT = int(os.environ.get('BEDROCK_TPM_LIMIT', '200000'))
+BEDROCK_RPM_LIMIT = int(os.environ.get('BEDROCK_RPM_LIMIT', '200'))
+DEEP_REVIEW_BEDROCK_TPM_LIMIT = int(os.environ.get('DEEP_REVIEW_BEDROCK_TPM_LIMIT', str(BEDROCK_TPM_LIMIT)))
+DEEP_REVIEW_BEDROCK_RPM_LIMIT = int(os.environ.get('DEEP_REVIEW_BEDROCK_RPM_LIMIT', str(BEDROCK_RPM_LIMIT)))
+INTERACTIVE_RESERVE_FRACTION = float(os.environ.get('INTERACTIVE_RESERVE_FRACTION', '0.2'))
+
+# Estimated steady state consumption of a single running review
+QUICK_REVIEW_TPM = int(os.environ.get('QUICK_REVIEW_TPM', '40000'))
+QUICK_REVIEW_RPM = int(os.environ.get('QUICK_REVIEW_RPM', '6'))
+DEEP_REVIEW_TPM = int(os.environ.get('DEEP_REVIEW_TPM', '20000'))
+DEEP_REVIEW_RPM = int(os.environ.get('DEEP_REVIEW_RPM', '2'))
+
+REVIEW_TYPE_USAGE = {
+    'Quick': (QUICK_REVIEW_TPM, QUICK_REVIEW_RPM),
+    'Deep': (DEEP_REVIEW_TPM, DEEP_REVIEW_RPM)
+}
+
+REVIEW_TYPE_MODEL = {
+    'Quick': LLM_MODEL_ID,
+    'Deep': DEEP_REVIEW_LLM_MODEL_ID
+}
+
+MODEL_LIMITS = {
+    DEEP_REVIEW_LLM_MODEL_ID: (DEEP_REVIEW_BEDROCK_TPM_LIMIT, DEEP_REVIEW_BEDROCK_RPM_LIMIT),
+    LLM_MODEL_ID: (BEDROCK_TPM_LIMIT, BEDROCK_RPM_LIMIT)
+}
+
+cloudwatch = aws_clients.lazy_client('cloudwatch', region_name = REGION)
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+def get_review_type(data):
+    # Redrives always run the Deep review state machines
+    if (data.get('request_type') == 'Redrive'):
+        return 'Deep'
+    return 'Quick' if data['analysis_review_type'] == 'Quick' else 'Deep'
+
+def get_admission_budget(slots):
+    """
+    Snapshot of how much Bedrock quota is left for new reviews, given the admission slots held (admission_leases).
+    Each model has its own quota, so Quick and Deep reviews are budgeted against the quota of the model they run
+    with. In-flight usage of a model is the larger of what CloudWatch observed over the last few minutes and what
+    the in-flight reviews are estimated to use, so interactive traffic and reviews that have not ramped up yet are
+    both accounted for.
+    """
+
+    in_flight = {review_type: sum(1 for lease in slots.values() if lease['review_type'] == review_type) for review_type in REVIEW_TYPE_USAGE}
+    # Leases only know Quick and Deep; anything else is run by the Deep state machines
+    in_flight['Deep'] = len(slots) - in_flight['Quick']
+
+    observed_usage = get_observed_bedrock_usage(list(MODEL_LIMITS))
+
+    budget = {'in_flight': len(slots), 'models': {}}
+    for model_id, (tpm_limit, rpm_limit) in MODEL_LIMITS.items():
+        review_types = [review_type for review_type, review_model_id in REVIEW_TYPE_MODEL.items() if review_model_id == model_id]
+        estimated_tpm = sum(in_flight[review_type] * REVIEW_TYPE_USAGE[review_type][0] for review_type in review_types)
+        estimated_rpm = sum(in_flight[review_type] * REVIEW_TYPE_USAGE[review_type][1] for review_type in review_types)
+        observed_tpm, observed_rpm = observed_usage[model_id]
+
+        budget['models'][model_id] = {
+            'tpm': tpm_limit * (1 - INTERACTIVE_RESERVE_FRACTION) - max(estimated_tpm, observed_tpm),
+            'rpm': rpm_limit * (1 - INTERACTIVE_RESERVE_FRACTION) - max(estimated_rpm, observed_rpm)
+        }
+
+    logger.info (f"Admission budget: quick in flight {in_flight['Quick']}, deep in flight {in_flight['Deep']}, "
+                 f"observed usage {observed_usage}, budget {budget}")
+
+    return budget
+
+def get_available_slots(budget, review_type):
+
+    review_tpm, review_rpm = REVIEW_TYPE_USAGE[review_type]
+    model_budget = budget['models'][REVIEW_TYPE_MODEL[review_type]]
+
+    return max(0, min(
+        math.floor(model_budget['tpm'] / review_tpm),
+        math.floor(model_budget['rpm'] / review_rpm),
+        admission_leases.MAX_CONCURRENT_REVIEWS - budget['in_flight']
+    ))
+
+def try_admit(budget, slots, holder, analysis_id, review_type, execution_arn=None):
+    """
+    Admit one review of review_type against budget, charging its estimated usage when admitted. The budget is only a
+    snapshot of this invocation; the slot it then takes is what keeps concurrent invocations from admitting too many.
+    """
+
+    if any(lease['holder'] == holder for lease in slots.values()):
+        # Admitted by an earlier delivery of the same message
+        return True
+
+    if get_available_slots(budget, review_type) < 1:
+        return False
+
+    if admission_leases.acquire_slot(slots, holder, analysis_id, review_type, execution_arn) is None:
+        logger.info (f"No admission slot left for {holder}")
+        return False
+
+    review_tpm, review_rpm = REVIEW_TYPE_USAGE[review_type]
+    model_budget = budget['models'][REVIEW_TYPE_MODEL[review_type]]
+    model_budget['tpm'] = model_budget['tpm'] - review_tpm
+    model_budget['rpm'] = model_budget['rpm'] - review_rpm
+    budget['in_flight'] = budget['in_flight'] + 1
+
+    return True
+
+def get_observed_bedrock_usage(model_ids):
+    """Peak per-minute token and request counts of each model over the last five minutes, by model id."""
+
+    end_time = datetime.datetime.now(datetime.timezone.utc)
+    start_time = end_time - datetime.timedelta(minutes=5)
+
+    queries = []
+    for index, model_id in enumerate(model_ids):
+        for metric_id, metric_name in [('input_tokens', 'InputTokenCount'), ('output_tokens', 'OutputTokenCount'), ('invocations', 'Invocations')]:
+            queries.append({
+                # Query ids have to start with a lower case letter, so model ids can not be used in them
+                'Id': f"{metric_id}_{index}",
+                'MetricStat': {
+                    'Metric': {
+                        'Namespace': 'AWS/Bedrock',
+                        'MetricName': metric_name,
+                        'Dimensions': [{'Name': 'ModelId', 'Value': model_id}]
+                    },
+                    'Period': 60,
+                    'Stat': 'Sum'
+                }
+            })
+
+    try:
+        response = cloudwatch.get_metric_data(MetricDataQueries=queries, StartTime=start_time, EndTime=end_time)
+    except Exception as error:
+        # Metrics are an optimisation only; fall back to the in-flight estimates
+        logger.info (f"Unable to read Bedrock usage metrics, using estimates only: {error}")
+        return {model_id: (0, 0) for model_id in model_ids}
+
+    results = {result['Id']: result['Values'] for result in response['MetricDataResults']}
+
+    observed_usage = {}
+    for index, model_id in enumerate(model_ids):
+        per_minute_tokens = [input_tokens + output_tokens for input_tokens, output_tokens in zip(results.get(f"input_tokens_{index}", []), results.get(f"output_tokens_{index}", []))]
+        observed_usage[model_id] = (max(per_minute_tokens, default=0), max(results.get(f"invocations_{index}", []), default=0))
+
+    return observed_usage
@@ -1,17 +1,26 @@
 import os
-import boto3
 import json
 import datetime
 import time
 import logging  
 
-from boto3.dynamodb.conditions import Key
-from boto3.dynamodb.conditions import Attr
-
-from botocore.client import Config
 from botocore.exceptions import ClientError
 
-s3 = boto3.resource('s3')
+import aws_clients
+import cassettes
+import emf_metrics
+import structured_logging
+import admission_scheduler
+import admission_leases
+import reference_data_cache
+import document_summary
+import document_index
+import response_cache
+import review_lenses
+import review_report
+import progress
+
+s3 = aws_clients.lazy_resource('s3')
 
 WAFR_ACCELERATOR_RUNS_DD_TABLE_NAME = os.environ['WAFR_ACCELERATOR_RUNS_DD_TABLE_NAME']
 UPLOAD_BUCKET_NAME = os.environ['UPLOAD_BUCKET_NAME']
@@ -20,59 +29,206 @@ WAFR_PROMPT_DD_TABLE_NAME = os.environ['WAFR_PROMPT_DD_TABLE_NAME']
 KNOWLEDGE_BASE_ID=os.environ['KNOWLEDGE_BASE_ID']
 LLM_MODEL_ID=os.environ['LLM_MODEL_ID'] 
 START_WAFR_REVIEW_STATEMACHINE_ARN = os.environ['START_WAFR_REVIEW_STATEMACHINE_ARN']
+START_WAFR_REDRIVE_STATEMACHINE_ARN = os.environ.get('START_WAFR_REDRIVE_STATEMACHINE_ARN', '')
 BEDROCK_SLEEP_DURATION = int(os.environ['BEDROCK_SLEEP_DURATION'])
 BEDROCK_MAX_TRIES = int(os.environ['BEDROCK_MAX_TRIES'])
 WAFR_REFERENCE_DOCS_BUCKET = os.environ['WAFR_REFERENCE_DOCS_BUCKET']
-
-dynamodb = boto3.resource('dynamodb')
-bedrock_config = Config(connect_timeout=120, region_name=REGION, read_timeout=120, retries={'max_attempts': 0})
-bedrock_client = boto3.client('bedrock-runtime',region_name=REGION)
-bedrock_agent_client = boto3.client("bedrock-agent-runtime", config=bedrock_config)
+ADMISSION_DEFER_SECONDS = int(os.environ.get('ADMISSION_DEFER_SECONDS', '60'))
+ADMISSION_MAX_DEFER_SECONDS = int(os.environ.get('ADMISSION_MAX_DEFER_SECONDS', '900'))
+QUICK_REVIEW_REQUEUE_SECONDS = int(os.environ.get('QUICK_REVIEW_REQUEUE_SECONDS', '10'))
+# Messages whose request failed this many times after admission are moved to the dead-letter queue
+ADMISSION_MAX_ATTEMPTS = int(os.environ.get('ADMISSION_MAX_ATTEMPTS', '5'))
+DEAD_LETTER_QUEUE_URL = os.environ.get('DEAD_LETTER_QUEUE_URL', '')
+
+# Stage names recorded in the completed_stages string set of the run item
+EXTRACT_DOCUMENT_TEXT_STAGE = "extract_document_text"
+GENERATE_SOLUTION_SUMMARY_STAGE = "generate_solution_summary"
+
+# Deep reviews only need sqs, stepfunctions and dynamodb here, so the Bedrock clients are created on first use
+dynamodb = aws_clients.lazy_resource('dynamodb')
+bedrock_client = aws_clients.lazy_client('bedrock-runtime', region_name=REGION)
+bedrock_agent_client = aws_clients.lazy_client("bedrock-agent-runtime", region_name=REGION, connect_timeout=120, read_timeout=120, retries={'max_attempts': 0})
+sf = aws_clients.lazy_client('stepfunctions', region_name = REGION)
+sqs = aws_clients.lazy_client('sqs', region_name = REGION)
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+@cassettes.recorded
 def lambda_handler(event, context):
     
     entry_timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H-%M-%S-%f")
+    structured_logging.start_invocation(logger)
     logger.info (f"start_wafr_review invoked at  {entry_timestamp}" )
-    logger.info(json.dumps(event))
+    logger.info("Event: %s", structured_logging.capped(event))
     
     logger.info(f"REGION: {REGION}")
     logger.debug(f"START_WAFR_REVIEW_STATEMACHINE_ARN: {START_WAFR_REVIEW_STATEMACHINE_ARN}")
     logger.debug(f"WAFR_ACCELERATOR_RUNS_DD_TABLE_NAME: {WAFR_ACCELERATOR_RUNS_DD_TABLE_NAME}" )
     
-    data = json.loads(event['Records'][0]['body'])
-    
-    return_status = ""
-    analysis_review_type = data['analysis_review_type']
-    
+    batch_item_failures = []
+    quick_review_record = None
+
     try:
-        if (analysis_review_type != 'Quick' ): #"Deep with Well-Architected Tool"
-            logger.info("Initiating \'Deep with Well-Architected Tool\' analysis")
-            sf = boto3.client('stepfunctions', region_name = REGION)
-            response = sf.start_execution(stateMachineArn = START_WAFR_REVIEW_STATEMACHINE_ARN, input = json.dumps(event['Records']))
-            logger.info (f"Step function response: {response}")
-            return_status = 'Deep analysis commenced successfully!'
-        else: #Quick
-            logger.info("Executing \'Quick\' analysis")
-            do_quick_analysis (data, context)
-            return_status = 'Quick analysis completed successfully!'
+        slots = admission_leases.list_slots()
+        budget = admission_scheduler.get_admission_budget(slots)
     except Exception as error:
-        handle_error (data, error)
-        raise Exception (f'Exception caught in start_wafr_review: {error}')
-                
+        # Nothing can be admitted without the slots; every message is returned to the queue and tried again. This is
+        # not an attempt at running the request, so it does not count towards ADMISSION_MAX_ATTEMPTS
+        logger.error (f"Unable to read the admission slots, returning all {len(event['Records'])} messages to the queue: {error}")
+        return {
+            'batchItemFailures': [{'itemIdentifier': record['messageId']} for record in event['Records']]
+        }
+
+    for record in event['Records']:
+
+        try:
+            data = json.loads(record['body'])
+            review_type = admission_scheduler.get_review_type(data)
+            missing = [name for name in ('analysis_id', 'analysis_submitter') if name not in data]
+            if missing:
+                raise KeyError(', '.join(missing))
+        except (ValueError, TypeError, KeyError) as error:
+            # Would fail every time, and with it the rest of the batch
+            try:
+                dead_letter(record, f"Malformed review request: {error}")
+            except Exception as dead_letter_error:
+                logger.error (f"Unable to move message {record['messageId']} to the dead-letter queue: {dead_letter_error}")
+                batch_item_failures.append({'itemIdentifier': record['messageId']})
+            continue
+
+        structured_logging.set_correlation_id(data.get('analysis_id'))
+        emf_metrics.start_invocation("admission", data.get('analysis_id'), LLM_MODEL_ID, data.get('wafr_lens'))
+
+        # Quick reviews run inline, so each invocation takes at most one and leaves the rest to concurrent invocations
+        if (review_type == 'Quick' and quick_review_record is not None):
+            logger.info (f"Quick review {data['analysis_id']} returned to the queue for another invocation")
+            defer_message(record, QUICK_REVIEW_REQUEUE_SECONDS)
+            emf_metrics.put_metric("ReviewsDeferred", 1, ReviewType=review_type)
+            batch_item_failures.append({'itemIdentifier': record['messageId']})
+            continue
+
+        if (data.get('request_type') == 'Redrive'):
+            state_machine_arn = START_WAFR_REDRIVE_STATEMACHINE_ARN
+        else:
+            state_machine_arn = START_WAFR_REVIEW_STATEMACHINE_ARN
+        execution_name = get_execution_name(data, record)
+        execution_arn = admission_leases.execution_arn(state_machine_arn, execution_name) if review_type == 'Deep' else None
+
+        if (not admission_scheduler.try_admit(budget, slots, execution_name, data['analysis_id'], review_type, execution_arn)):
+            defer_seconds = get_defer_seconds(record)
+            logger.info (f"Bedrock quota budget exhausted, deferring {review_type} review {data['analysis_id']} by {defer_seconds} seconds")
+            defer_message(record, defer_seconds)
+            emf_metrics.put_metric("ReviewsDeferred", 1, ReviewType=review_type)
+            batch_item_failures.append({'itemIdentifier': record['messageId']})
+            continue
+
+        if (review_type == 'Quick'):
+            quick_review_record = record
+            continue
+
+        try:
+            if (data.get('request_type') == 'Redrive'):
+                # Rerun only the stages and questions of a failed Deep review that did not complete
+                logger.info(f"Initiating redrive of analysis {data['analysis_id']}")
+            else:
+                logger.info("Initiating \'Deep with Well-Architected Tool\' analysis")
+            if (admission_leases.count_attempt(record['messageId']) > ADMISSION_MAX_ATTEMPTS):
+                give_up(record, data)
+                continue
+            # A failed start keeps its slot for the redelivered message; if there is none, the slot is freed once
+            # admission_leases finds that the execution does not exist
+            start_review_execution(state_machine_arn, execution_name, record)
+            logger.info (f"Deep analysis {data['analysis_id']} commenced successfully!")
+        except Exception as error:
+            handle_error (data, error)
+            batch_item_failures.append({'itemIdentifier': record['messageId']})
+
+    if (quick_review_record is not None):
+        data = json.loads(quick_review_record['body'])
+        structured_logging.set_correlation_id(data.get('analysis_id'))
+        emf_metrics.start_invocation("quick_review", data.get('analysis_id'), LLM_MODEL_ID, data.get('wafr_lens'))
+        try:
+            # Counted before the review runs, as a review that times out never gets to report its failure
+            if (admission_leases.count_attempt(quick_review_record['messageId']) > ADMISSION_MAX_ATTEMPTS):
+                give_up(quick_review_record, data)
+            else:
+                logger.info("Executing \'Quick\' analysis")
+                stage_start = time.time()
+                do_quick_analysis (data, context)
+                emf_metrics.put_metric("StageDuration", (time.time() - stage_start) * 1000, "Milliseconds")
+                logger.info (f"Quick analysis {data['analysis_id']} completed successfully!")
+        except Exception as error:
+            handle_error (data, error)
+            batch_item_failures.append({'itemIdentifier': quick_review_record['messageId']})
+        finally:
+            # The lease expires on its own, so failing to release it does not fail the already processed batch
+            admission_leases.release_slots(data['analysis_id'])
+
     exit_timeestamp = datetime.datetime.now().strftime("%Y-%m-%d %H-%M-%S-%f")
     logger.info(f"Exiting start_wafr_review at {exit_timeestamp}" )
-    
+
+    # Partial batch response: only the listed messages become visible again, the rest are deleted
     return {
-        'statusCode': 200,
-        'body': json.dumps(return_status)
-    }        
+        'batchItemFailures': batch_item_failures
+    }
+
+def get_execution_name(data, record):
+
+    # The same for every delivery of a message, so a redelivered message cannot start a second execution. The
+    # message id tells apart the requests of one analysis, e.g. the review and its later redrives
+    return f"{data['analysis_id']}-{record['messageId']}"[:80]
+
+def start_review_execution(state_machine_arn, execution_name, record):
+
+    try:
+        with emf_metrics.timed("sfn_start_execution"):
+            response = sf.start_execution(stateMachineArn = state_machine_arn, name = execution_name, input = json.dumps([record]))
+        logger.info (f"Step function response: {response}")
+    except ClientError as error:
+        if error.response['Error']['Code'] != 'ExecutionAlreadyExists':
+            raise
+        # Started by an earlier delivery of the same message
+        logger.info (f"Execution {execution_name} already started")
+
+def give_up(record, data):
+
+    error = f"Review request failed {ADMISSION_MAX_ATTEMPTS} times"
+    dead_letter(record, error)
+    handle_error(data, error)
+    admission_leases.release_slots(data['analysis_id'])
+
+def dead_letter(record, reason):
+    """
+    Moves a message to the dead-letter queue; it is then deleted from the review queue as processed. The queue's own
+    max receive count only backs this up, as deferred messages are received many times before they run.
+    """
+
+    logger.error (f"Moving message {record['messageId']} to the dead-letter queue: {reason}")
+    sqs.send_message(
+        QueueUrl=DEAD_LETTER_QUEUE_URL,
+        MessageBody=record['body'],
+        MessageAttributes={'DeadLetterReason': {'DataType': 'String', 'StringValue': reason[:1000]}}
+    )
+    emf_metrics.put_metric("ReviewsDeadLettered", 1)
+
+def get_defer_seconds(record):
+
+    # Back off further each time a message is deferred, within the SQS visibility timeout maximum
+    receive_count = int(record.get('attributes', {}).get('ApproximateReceiveCount', '1'))
+
+    return min(ADMISSION_MAX_DEFER_SECONDS, ADMISSION_DEFER_SECONDS * receive_count)
+
+def defer_message(record, defer_seconds):
+
+    # arn:aws:sqs:<region>:<account>:<queue name>
+    arn_parts = record['eventSourceARN'].split(':')
+    queue_url = sqs.get_queue_url(QueueName=arn_parts[5], QueueOwnerAWSAccountId=arn_parts[4])['QueueUrl']
+
+    sqs.change_message_visibility(QueueUrl=queue_url, ReceiptHandle=record['receiptHandle'], VisibilityTimeout=defer_seconds)
 
 def handle_error (data, error):
     
-    dynamodb = boto3.resource('dynamodb')
     wafr_accelerator_runs_table = dynamodb.Table(WAFR_ACCELERATOR_RUNS_DD_TABLE_NAME)
     
     # Define the key for the item you want to update
@@ -115,7 +271,7 @@ def do_quick_analysis (data, context):
     wafr_accelerator_runs_table = dynamodb.Table(WAFR_ACCELERATOR_RUNS_DD_TABLE_NAME)
     wafr_prompts_table = dynamodb.Table(WAFR_PROMPT_DD_TABLE_NAME)
 
-    logger.info(json.dumps(data))
+    logger.info("data: %s", structured_logging.capped(data))
 
     analysis_id = data['analysis_id'] 
     name = data['analysis_name']
@@ -123,10 +279,15 @@ def do_quick_analysis (data, context):
     
     analysis_submitter = data['analysis_submitter']
     document_s3_key = data['document_s3_key']
+    # Set on the queue message to answer every request from the model again instead of from the response cache
+    bypass_response_cache = data.get('bypass_response_cache', False)
 
     pillars = data['selected_pillars']    
     pillar_string = get_pillar_string (pillars)
     logger.info ("Final pillar_string: " + pillar_string)
+    
+    # Each selected pillar of each lens of the analysis, all answered from the one extraction and summary
+    lens_pillars = [(lens, item) for lens in review_lenses.review_lenses(wafr_lens, data.get('lenses', ''), data.get('additional_lenses')) for item in pillars]
 
     logger.debug ("do_quick_analysis checkpoint 1")
     
@@ -135,10 +296,13 @@ def do_quick_analysis (data, context):
         'analysis_submitter': analysis_submitter  
     }
         
+    # pillars is a map keyed by pillar id; a redelivered message keeps the pillars already written and the progress made so far.
+    # Quick reviews answer a whole pillar per model call, so their progress is counted in pillars
     response = wafr_accelerator_runs_table.update_item(
         Key=wafr_accelerator_run_key,
-        UpdateExpression="SET review_status = :val",
-        ExpressionAttributeValues={':val': "In Progress"},
+        UpdateExpression="SET review_status = :val, pillars = if_not_exists(pillars, :empty_map), stage_started_at = if_not_exists(stage_started_at, :empty_map), "
+                         "progress_total = :total, progress_done = if_not_exists(progress_done, :zero), progress_unit = :unit, llm_model_id = :model",
+        ExpressionAttributeValues={':val': "In Progress", ':empty_map': {}, ':total': len(lens_pillars), ':zero': 0, ':unit': "pillars", ':model': LLM_MODEL_ID},
         ReturnValues='UPDATED_NEW'  
     )
     
@@ -150,57 +314,85 @@ def do_quick_analysis (data, context):
         # Get the bucket object
         output_bucket = s3.Bucket(UPLOAD_BUCKET_NAME)
         
-        # Extract document text and write to s3 
-        extracted_document_text = extract_document_text(UPLOAD_BUCKET_NAME, document_s3_key, output_bucket, wafr_accelerator_runs_table, wafr_accelerator_run_key, REGION)
+        # A redelivered message resumes from the stages completed by the earlier attempts
+        checkpoint = get_checkpoint(wafr_accelerator_runs_table, wafr_accelerator_run_key)
+        completed_stages = checkpoint['completed_stages']
+        
+        logger.info (f"Completed stages from earlier attempts: {completed_stages}")
+        
+        if (EXTRACT_DOCUMENT_TEXT_STAGE in completed_stages):
+            extracted_document_text = checkpoint['extracted_document']
+        else:
+            # Extract document text and write to s3 
+            progress.set_progress_stage(wafr_accelerator_runs_table, wafr_accelerator_run_key, "extract_document_text")
+            extracted_document_text = extract_document_text(UPLOAD_BUCKET_NAME, document_s3_key, output_bucket, wafr_accelerator_runs_table, wafr_accelerator_run_key, REGION)
         
         logger.debug ("do_quick_analysis checkpoint 3")
 
-        # Generate solution summary
-        summary = generate_solution_summary (extracted_document_text, wafr_accelerator_runs_table, wafr_accelerator_run_key)
+        if (GENERATE_SOLUTION_SUMMARY_STAGE in completed_stages):
+            summary = checkpoint['architecture_summary']
+        else:
+            # Generate solution summary
+            progress.set_progress_stage(wafr_accelerator_runs_table, wafr_accelerator_run_key, "generate_solution_summary")
+            summary = generate_solution_summary (extracted_document_text, wafr_accelerator_runs_table, wafr_accelerator_run_key, bypass_response_cache)
 
-        logger.info ("Generated architecture summary:" + summary)
+        logger.info ("Generated architecture summary: %s", structured_logging.capped(summary))
         
         logger.debug ("do_quick_analysis checkpoint 4")
         
+        # Large documents are indexed by section once per review, and each pillar prompt gets the architecture summary
+        # plus the sections relevant to the pillar's questions instead of the whole document
+        section_index_filename = document_s3_key[:document_s3_key.rfind('.')] + "-section-index.json"
+        section_index = document_index.load_index(bedrock_client, extracted_document_text, UPLOAD_BUCKET_NAME, section_index_filename)
+        
         partition_key_value = wafr_lens
     
         sort_key_values = pillars
     
         logger.info ("wafr_lens: " + wafr_lens)
         
-        pillar_responses = []
         pillar_counter = 0
         
+        progress.set_progress_stage(wafr_accelerator_runs_table, wafr_accelerator_run_key, "review_pillars")
+        
         #Get All the pillar prompts in a loop
-        for item in pillars:
-            logger.info (f"selected_pillars: {item}") 
-            response = wafr_prompts_table.query(
-                ProjectionExpression ='wafr_pillar_id, wafr_pillar_prompt',
-                KeyConditionExpression=Key('wafr_lens').eq(wafr_lens) & Key('wafr_pillar').eq(item),
-                ScanIndexForward=True  
-            )
+        for lens, item in lens_pillars:
+            logger.info (f"selected_pillars: {item} of {lens['wafr_lens']}") 
+            
+            pillar_stage = get_pillar_stage(review_lenses.scoped(lens['lens_tag'], item))
+            
+            if (pillar_stage in completed_stages):
+                logger.info (f"Pillar {item} of {lens['wafr_lens']} already completed, skipping")
+                pillar_counter += 1
+                continue
+            
+            response = get_pillar_prompt(lens['wafr_lens'], item)
            
             logger.info (f"response wafr_pillar_id: "  + str(response['Items'][0]['wafr_pillar_id']))
-            logger.info (f"response wafr_pillar_prompt: " + response['Items'][0]['wafr_pillar_prompt'])
+            logger.debug ("response wafr_pillar_prompt: %s", structured_logging.capped(response['Items'][0]['wafr_pillar_prompt']))
             
             logger.debug ("document_s3_key.rstrip('.'): " + document_s3_key.rstrip('.'))
             logger.debug ("document_s3_key[:document_s3_key.rfind('.')]: " + document_s3_key[:document_s3_key.rfind('.')] )
-            pillar_review_prompt_filename = document_s3_key[:document_s3_key.rfind('.')]+ "-" + wafr_lens + "-" + item + "-prompt.txt"
-            pillar_review_output_filename = document_s3_key[:document_s3_key.rfind('.')]+ "-" + wafr_lens + "-" + item + "-output.txt"
+            pillar_review_prompt_filename = document_s3_key[:document_s3_key.rfind('.')]+ "-" + lens['wafr_lens'] + "-" + item + "-prompt.txt"
+            pillar_review_output_filename = document_s3_key[:document_s3_key.rfind('.')]+ "-" + lens['wafr_lens'] + "-" + item + "-output.txt"
             
             logger.info (f"pillar_review_prompt_filename: {pillar_review_prompt_filename}")
             logger.info (f"pillar_review_output_filename: {pillar_review_output_filename}")
             
             pillar_specific_prompt_question = response['Items'][0]['wafr_pillar_prompt']
             
-            claude_prompt_body = bedrock_prompt(wafr_lens, item, pillar_specific_prompt_question, KNOWLEDGE_BASE_ID, extracted_document_text, WAFR_REFERENCE_DOCS_BUCKET)
+            # The pillar prompt lists its questions one per line, after its instructions
+            pillar_questions = [line.strip() for line in pillar_specific_prompt_question.splitlines() if line.strip().endswith('?')]
+            document_content = document_index.relevant_content(bedrock_client, section_index, extracted_document_text, pillar_questions, summary)
+            
+            claude_prompt_body = bedrock_prompt(lens['wafr_lens'], item, pillar_specific_prompt_question, KNOWLEDGE_BASE_ID, document_content, WAFR_REFERENCE_DOCS_BUCKET)
             output_bucket.put_object(Key=pillar_review_prompt_filename, Body=claude_prompt_body)
             
             logger.debug (f"do_quick_analysis checkpoint 5.{pillar_counter}")
             
             streaming = True
             
-            pillar_review_output = invoke_bedrock(streaming, claude_prompt_body, pillar_review_output_filename, output_bucket)
+            pillar_review_output = invoke_bedrock(streaming, claude_prompt_body, pillar_review_output_filename, output_bucket, bypass_response_cache)
 
             # Comment the next line if you would like to retain the prompts files
             output_bucket.Object(pillar_review_prompt_filename).delete()
@@ -210,31 +402,29 @@ def do_quick_analysis (data, context):
             logger.info ("pillar_id" + str(response['Items'][0]['wafr_pillar_id']))#
             
             pillarResponse = {
-                'pillar_name': item,
+                'pillar_name': f"{item} ({lens['wafr_lens']})" if lens['lens_tag'] else item,
                 'pillar_id': str(response['Items'][0]['wafr_pillar_id']),
                 'llm_response': pillar_review_output
             }
         
-            pillar_responses.append(pillarResponse)
+            # Checkpoint each pillar as soon as it is done, together with its completed stage
+            response = wafr_accelerator_runs_table.update_item(
+                Key=wafr_accelerator_run_key,
+                UpdateExpression="SET pillars.#pillar_id = :val ADD completed_stages :stage, progress_done :one",
+                ExpressionAttributeNames={'#pillar_id': review_lenses.scoped(lens['lens_tag'], pillarResponse['pillar_id'])},
+                ExpressionAttributeValues={
+                    ':val': pillarResponse,
+                    ':stage': {pillar_stage},
+                    ':one': 1
+                },
+                ReturnValues='UPDATED_NEW'  
+            )
+            
+            logger.info (f"dynamodb pillar checkpoint response: {response}" )
             
             pillar_counter += 1
         
         logger.debug (f"do_quick_analysis checkpoint 7")
-        
-        attribute_updates = {
-            'pillars': {
-                'Action': 'ADD'  
-            }
-        }
-        
-        response = wafr_accelerator_runs_table.update_item(
-            Key=wafr_accelerator_run_key,
-            UpdateExpression="SET pillars = :val",
-            ExpressionAttributeValues={':val': pillar_responses},
-            ReturnValues='UPDATED_NEW'  
-        )
-        
-        logger.info (f"dynamodb status update response: {response}" )
         logger.debug (f"do_quick_analysis checkpoint 8")
 
         response = wafr_accelerator_runs_table.update_item(
@@ -245,9 +435,18 @@ def do_quick_analysis (data, context):
         )
         
         logger.info (f"dynamodb status update response: {response}" )
+        
+        progress.set_progress_stage(wafr_accelerator_runs_table, wafr_accelerator_run_key, "completed")
     except Exception as error:
         handle_error (data, error)
         raise Exception (f'Exception caught in do_quick_analysis: {error}')
+    
+    # The review is complete, so a report that fails to render leaves the UI rendering it from the run item
+    try:
+        review_report.publish(wafr_accelerator_runs_table, wafr_accelerator_run_key, UPLOAD_BUCKET_NAME)
+    except Exception as error:
+        logger.error (f"Unable to render the report of {analysis_id}: {error}")
+        emf_metrics.put_metric("ReportsFailed", 1)
         
     logger.debug (f"do_quick_analysis checkpoint 9")
     
@@ -255,68 +454,97 @@ def do_quick_analysis (data, context):
     logger.info("Exiting start_wafr_review at " + exit_timeestamp)
     
 
+def get_pillar_prompt(wafr_lens, pillar):
+    # Warm containers reuse the pillar prompt until insert_wafr_prompts loads new prompts
+    return reference_data_cache.get_versioned(WAFR_PROMPT_DD_TABLE_NAME, 'pillar_prompt', load_pillar_prompt, wafr_lens, pillar)
+
+def load_pillar_prompt(wafr_lens, pillar):
+    # Only needed on a reference data cache miss
+    from boto3.dynamodb.conditions import Key
+
+    wafr_prompts_table = dynamodb.Table(WAFR_PROMPT_DD_TABLE_NAME)
+    
+    return wafr_prompts_table.query(
+        ProjectionExpression ='wafr_pillar_id, wafr_pillar_prompt',
+        KeyConditionExpression=Key('wafr_lens').eq(wafr_lens) & Key('wafr_pillar').eq(pillar),
+        ScanIndexForward=True  
+    )
+
+def get_pillar_stage(pillar):
+    return "pillar:" + pillar
+
+def get_checkpoint(wafr_accelerator_runs_table, wafr_accelerator_run_key):
+
+    response = wafr_accelerator_runs_table.get_item(
+        Key=wafr_accelerator_run_key,
+        ProjectionExpression='completed_stages, extracted_document, architecture_summary'
+    )
+    item = response.get('Item', {})
+
+    return {
+        'completed_stages': item.get('completed_stages', set()),
+        'extracted_document': item.get('extracted_document', ''),
+        'architecture_summary': item.get('architecture_summary', '')
+    }
+
 def extract_document_text(upload_bucket_name, document_s3_key, output_bucket, wafr_accelerator_runs_table, wafr_accelerator_run_key, region):
 
-    textract_config = Config(retries = dict(max_attempts = 5))
-    textract_client = boto3.client('textract', region_name=region, config=textract_config)
+    textract_client = aws_clients.client('textract', region_name=region, retries = dict(max_attempts = 5))
 
     logger.debug ("extract_document_text checkpoint 1")
 
-    response = textract_client.start_document_text_detection(
-        DocumentLocation={
-            'S3Object': {
-                'Bucket': upload_bucket_name,
-                'Name': document_s3_key
+    with emf_metrics.timed("textract") as measurement:
+        response = textract_client.start_document_text_detection(
+            DocumentLocation={
+                'S3Object': {
+                    'Bucket': upload_bucket_name,
+                    'Name': document_s3_key
+                }
             }
-        }
-    )
-    
-    job_id = response["JobId"]
-
-    logger.debug ("extract_document_text checkpoint 2")
-    
-    # Wait for the job to complete
-    while True:
-        response = textract_client.get_document_text_detection(JobId=job_id)
-        status = response["JobStatus"]
-        if status == "SUCCEEDED":
-            break
-    
-    logger.debug ("extract_document_text checkpoint 3")
+        )
+        
+        job_id = response["JobId"]
     
-    pages = []
-    next_token = None
-    while True:
-        if next_token:
-            response = textract_client.get_document_text_detection(JobId=job_id, NextToken=next_token)
-        else:
+        logger.debug ("extract_document_text checkpoint 2")
+        
+        # Wait for the job to complete
+        while True:
             response = textract_client.get_document_text_detection(JobId=job_id)
-        pages.append(response)
-        if 'NextToken' in response:
-            next_token = response['NextToken']
-        else:
-            break
-    
-    logger.debug ("extract_document_text checkpoint 4")
-    
-    # Extract the text from all pages
-    extracted_text = ""
-    for page in pages:
-        for item in page["Blocks"]:
-            if item["BlockType"] == "LINE":
-                extracted_text += item["Text"] + "\n"
-    
-    attribute_updates = {
-        'extracted_document': {
-            'Action': 'ADD'  
-        }
-    }
+            status = response["JobStatus"]
+            if status == "SUCCEEDED":
+                break
+        
+        logger.debug ("extract_document_text checkpoint 3")
+        
+        pages = []
+        next_token = None
+        while True:
+            if next_token:
+                response = textract_client.get_document_text_detection(JobId=job_id, NextToken=next_token)
+            else:
+                response = textract_client.get_document_text_detection(JobId=job_id)
+            pages.append(response)
+            if 'NextToken' in response:
+                next_token = response['NextToken']
+            else:
+                break
+        
+        logger.debug ("extract_document_text checkpoint 4")
+        
+        # Extract the text from all pages
+        extracted_text = ""
+        for page in pages:
+            for item in page["Blocks"]:
+                if item["BlockType"] == "LINE":
+                    extracted_text += item["Text"] + "\n"
+        
+        measurement.add("DocumentCharacters", len(extracted_text))
     
     # Update the item
     response = wafr_accelerator_runs_table.update_item(
         Key=wafr_accelerator_run_key,
-        UpdateExpression="SET extracted_document = :val",
-        ExpressionAttributeValues={':val': extracted_text}, 
+        UpdateExpression="SET extracted_document = :val ADD completed_stages :stage",
+        ExpressionAttributeValues={':val': extracted_text, ':stage': {EXTRACT_DOCUMENT_TEXT_STAGE}}, 
         ReturnValues='UPDATED_NEW' 
     )
     
@@ -329,111 +557,102 @@ def extract_document_text(upload_bucket_name, document_s3_key, output_bucket, wa
         
     return extracted_text
     
-def generate_solution_summary (extracted_document_text, wafr_accelerator_runs_table, wafr_accelerator_run_key):
+def generate_solution_summary (extracted_document_text, wafr_accelerator_runs_table, wafr_accelerator_run_key, bypass_response_cache=False):
 
-    prompt = f"The following document is a solution architecture document that you are reviewing as an AWS Cloud Solutions Architect. Please summarise the following solution in 250 words. Begin directly with the architecture summary, don't provide any other opening or closing statements.\n<Architecture>\n{extracted_document_text}\n</Architecture>\n" #\nSummary:"
-    
-    response = bedrock_client.invoke_model(
-        modelId= LLM_MODEL_ID, 
-        contentType="application/json",
-        accept="application/json",
-        body = json.dumps({
-            "anthropic_version": "bedrock-2023-05-31",
-            "max_tokens": 200000,
-            "messages": [
-                {
-                    "role": "user",
-                    "content": [{"type": "text", "text": prompt}],
-                }
-            ],
-            }   
-        )
-    )
-    
-    logger.info(f"generate_solution_summary: response: {response}")
-    
-    # Extract the summary
-    response_body = json.loads(response['body'].read())
-    summary = response_body['content'][0]['text']
+    # Large documents are summarised in chunks; every summary request goes through the response cache
+    summary = document_summary.summarize(bedrock_client, LLM_MODEL_ID, extracted_document_text, bypass_response_cache)
     
     logger.debug (f"start_wafr_review checkpoint 9")
     
-    attribute_updates = {
-        'architecture_summary': {
-            'Action': 'ADD'  
-        }
-    }
-
     logger.debug (f"start_wafr_review checkpoint 10")
     
     response = wafr_accelerator_runs_table.update_item(
         Key=wafr_accelerator_run_key,
-        UpdateExpression="SET architecture_summary = :val",
-        ExpressionAttributeValues={':val': summary}, 
+        UpdateExpression="SET architecture_summary = :val ADD completed_stages :stage",
+        ExpressionAttributeValues={':val': summary, ':stage': {GENERATE_SOLUTION_SUMMARY_STAGE}}, 
         ReturnValues='UPDATED_NEW'  
     )
     
     return summary
         
-def invoke_bedrock(streaming, claude_prompt_body, pillar_review_output_filename, output_bucket):
+def invoke_bedrock(streaming, claude_prompt_body, pillar_review_output_filename, output_bucket, bypass_response_cache=False):
+    
+    cached_response = response_cache.get(LLM_MODEL_ID, claude_prompt_body, bypass_response_cache)
+    if cached_response is not None:
+        return cached_response
     
     pillar_review_output = ""
     retries = 1
     max_retries = BEDROCK_MAX_TRIES
     
-    while retries <= max_retries:
-        try:
-            if(streaming):
-                streaming_response = bedrock_client.invoke_model_with_response_stream(
-                    modelId=LLM_MODEL_ID,
-                    body=claude_prompt_body,
-                )
-                
-                logger.debug (f"invoke_bedrock checkpoint 1.{retries}")
-                stream = streaming_response.get("body")
-                
-                logger.debug (f"invoke_bedrock checkpoint 2.{retries}")
-        
-                for chunk in parse_stream(stream):
-                    pillar_review_output += chunk
+    with emf_metrics.timed("bedrock_invoke_model") as measurement:
+        while retries <= max_retries:
+            try:
+                if(streaming):
+                    streaming_response = bedrock_client.invoke_model_with_response_stream(
+                        modelId=LLM_MODEL_ID,
+                        body=claude_prompt_body,
+                    )
                     
-                # Uncomment next line if you would like to see response files for each question too. 
-                # output_bucket.put_object(Key=pillar_review_output_filename, Body=bytes(pillar_review_output, encoding='utf-8'))
-                
-                return pillar_review_output
-                
-            else:
-                non_streaming_response = bedrock_client.invoke_model(
-                    modelId=LLM_MODEL_ID,
-                    body=claude_prompt_body,
-                )
-                
-                response_json = json.loads(non_streaming_response["body"].read().decode("utf-8"))
-        
-                logger.info (response_json)
-                
-                logger.debug (f"invoke_bedrock checkpoint 1.{retries}")
-        
-                # Extract the response text.
-                pillar_review_output = response_json["content"][0]["text"]
-        
-                logger.debug (pillar_review_output)
-                logger.debug (f"invoke_bedrock checkpoint 2.{retries}")
-                
-                # Uncomment next line if you would like to see response files for each question too. 
-                # output_bucket.put_object(Key=pillar_review_output_filename, Body=pillar_review_output)
-                
-                return pillar_review_output
-                
-        except Exception as e:
-            retries += 1
-            logger.info(f"Sleeping as attempt {retries} failed with exception: {e}")
-            time.sleep(BEDROCK_SLEEP_DURATION)  # Add a delay before the next retry
-
-    logger.info(f"Maximum retries ({max_retries}) exceeded. Unable to invoke the model.")
-    raise Exception (f"Maximum retries ({max_retries}) exceeded. Unable to invoke the model.")
+                    logger.debug (f"invoke_bedrock checkpoint 1.{retries}")
+                    stream = streaming_response.get("body")
+                    
+                    logger.debug (f"invoke_bedrock checkpoint 2.{retries}")
+            
+                    usage = {}
+                    for chunk in parse_stream(stream, usage):
+                        pillar_review_output += chunk
+                        
+                    # Uncomment next line if you would like to see response files for each question too. 
+                    # output_bucket.put_object(Key=pillar_review_output_filename, Body=bytes(pillar_review_output, encoding='utf-8'))
+                    
+                    add_invocation_metrics(measurement, retries - 1, usage)
+                    response_cache.put(LLM_MODEL_ID, claude_prompt_body, pillar_review_output, usage)
+                    return pillar_review_output
+                    
+                else:
+                    non_streaming_response = bedrock_client.invoke_model(
+                        modelId=LLM_MODEL_ID,
+                        body=claude_prompt_body,
+                    )
+                    
+                    response_json = json.loads(non_streaming_response["body"].read().decode("utf-8"))
+            
+                    logger.debug ("response_json: %s", structured_logging.capped(response_json))
+                    
+                    logger.debug (f"invoke_bedrock checkpoint 1.{retries}")
+            
+                    # Extract the response text.
+                    pillar_review_output = response_json["content"][0]["text"]
+            
+                    logger.debug ("pillar_review_output: %s", structured_logging.capped(pillar_review_output))
+                    logger.debug (f"invoke_bedrock checkpoint 2.{retries}")
+                    
+                    # Uncomment next line if you would like to see response files for each question too. 
+                    # output_bucket.put_object(Key=pillar_review_output_filename, Body=pillar_review_output)
+                    
+                    add_invocation_metrics(measurement, retries - 1, response_json.get("usage", {}))
+                    response_cache.put(LLM_MODEL_ID, claude_prompt_body, pillar_review_output, response_json.get("usage", {}))
+                    return pillar_review_output
+                    
+            except Exception as e:
+                retries += 1
+                logger.info(f"Sleeping as attempt {retries} failed with exception: {e}")
+                time.sleep(BEDROCK_SLEEP_DURATION)  # Add a delay before the next retry
+    
+        measurement.add("Retries", retries - 1)
+        logger.info(f"Maximum retries ({max_retries}) exceeded. Unable to invoke the model.")
+        raise Exception (f"Maximum retries ({max_retries}) exceeded. Unable to invoke the model.")
+
+def add_invocation_metrics(measurement, retries, usage):
+    measurement.add("Retries", retries)
+    measurement.add("InputTokens", usage.get("input_tokens", 0))
+    measurement.add("OutputTokens", usage.get("output_tokens", 0))
 
 def get_lens_filter(kb_bucket, wafr_lens):
+    return reference_data_cache.get_static('lens_filter', build_lens_filter, kb_bucket, wafr_lens)
+
+def build_lens_filter(kb_bucket, wafr_lens):
 
     # Map lens prefixes to their corresponding lens names - allows for additional of lenses
     lens_mapping = {
@@ -563,18 +782,19 @@ def retrieve(questions, kbId, lens_filter):
     - Risks
     {questions}"""
     
-    return bedrock_agent_client.retrieve(
-        retrievalQuery= {
-            'text': kb_prompt
-        },
-        knowledgeBaseId=kbId,
-        retrievalConfiguration={
-            'vectorSearchConfiguration':{
-                'numberOfResults': 20,
-                "filter": lens_filter
+    with emf_metrics.timed("kb_retrieve"):
+        return bedrock_agent_client.retrieve(
+            retrievalQuery= {
+                'text': kb_prompt
+            },
+            knowledgeBaseId=kbId,
+            retrievalConfiguration={
+                'vectorSearchConfiguration':{
+                    'numberOfResults': 20,
+                    "filter": lens_filter
+                }
             }
-        }
-    )
+        )
 
 def get_contexts(retrievalResults):
     contexts = []
@@ -582,12 +802,16 @@ def get_contexts(retrievalResults):
         contexts.append(retrievedResult['content']['text'])
     return contexts
 
-def parse_stream(stream):
+def parse_stream(stream, usage=None):
     for event in stream:
         chunk = event.get('chunk')
         if chunk:
             message = json.loads(chunk.get("bytes").decode())
             if message['type'] == "content_block_delta":
                 yield message['delta']['text'] or ""
+            elif message['type'] == "message_start" and usage is not None:
+                usage.update(message['message'].get('usage', {}))
+            elif message['type'] == "message_delta" and usage is not None:
+                usage.update(message.get('usage', {}))
             elif message['type'] == "message_stop":
                 return "\n"
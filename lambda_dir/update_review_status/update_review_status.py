@@ -1,50 +1,91 @@
 import os
-import boto3
 import json
 import datetime
 import time
 import logging
 import uuid
 
-from boto3.dynamodb.conditions import Key
-from boto3.dynamodb.conditions import Attr
-from botocore.client import Config
 from botocore.exceptions import ClientError
 
-s3 = boto3.resource('s3')
-dynamodb = boto3.resource('dynamodb')
-well_architected_client = boto3.client('wellarchitected')
+import aws_clients
+import cassettes
+import emf_metrics
+import structured_logging
+import progress
+
+s3 = aws_clients.lazy_resource('s3')
+dynamodb = aws_clients.lazy_resource('dynamodb')
+well_architected_client = aws_clients.lazy_client('wellarchitected')
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+@cassettes.recorded
 def lambda_handler(event, context):
     
     entry_timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H-%M-%S-%f")
     
+    structured_logging.start_invocation(logger, event)
+    
     logger.info(f"update_review_status invoked at {entry_timestamp}" )
-    logger.info(json.dumps(event))
+    logger.info("Event: %s", structured_logging.capped(event))
         
     return_response = 'Success'
     
-    # Parse the input data
-    data = event
+    # Parse the input data - a list of pillar results from the Map state, or a single payload when a redrive has nothing left to run
+    data = event if isinstance(event, list) else [event]
 
     wafr_accelerator_runs_table = dynamodb.Table(data[0]['wafr_accelerator_runs_table'])
     wafr_accelerator_run_key = data[0]['wafr_accelerator_run_key']
     wafr_workload_id = data[0]['wafr_accelerator_run_items']['wafr_workload_id']
     
+    emf_metrics.start_invocation("update_review_status", wafr_accelerator_run_key['analysis_id'], data[0].get('llm_model_id'), data[0]['wafr_accelerator_run_items'].get('selected_lens'))
+    
+    failed_questions = []
+    for pillar_result in data:
+        failed_questions.extend(pillar_result.get('failed_questions', []))
+    
     try:
         logger.debug(f"update_review_status checkpoint 1")
+        
+        # Pillars whose questions still failed after the Map's retries are passed on as the pillar's input with the
+        # error (question_failure); which questions failed is on the run item
+        if any('question_failure' in pillar_result for pillar_result in data):
+            failed_questions = sorted(set(failed_questions) | set(get_failed_questions(wafr_accelerator_runs_table, wafr_accelerator_run_key)))
+        
+        if failed_questions:
+            # Leave the milestone for the redrive that completes the remaining questions
+            logger.info(f"{len(failed_questions)} questions failed: {failed_questions}")
+            emf_metrics.put_metrics({'ReviewsErrored': (1, 'Count'), 'QuestionsFailed': (len(failed_questions), 'Count')})
+            
+            wafr_accelerator_runs_table.update_item(
+                Key=wafr_accelerator_run_key,
+                UpdateExpression="SET review_status = :val",
+                ExpressionAttributeValues={':val': "Errored"},
+                ReturnValues='UPDATED_NEW'  
+            )
+            
+            return {
+                'statusCode': 200,
+                'body' : 'Failed',
+                'wafr_accelerator_runs_table': data[0]['wafr_accelerator_runs_table'],
+                'wafr_accelerator_run_key': wafr_accelerator_run_key
+            }
 
-        # Create a milestone
-        wafr_milestone = well_architected_client.create_milestone(
-            WorkloadId=wafr_workload_id,
-            MilestoneName="WAFR Accelerator Baseline",
-            ClientRequestToken=str(uuid.uuid4())
-        )
+        # Create a milestone; milestone names are unique within a workload, and an update adds to the earlier review's workload
+        if data[0]['wafr_accelerator_run_items'].get('previous_analysis_id'):
+            milestone_name = f"WAFR Accelerator Update {data[0]['wafr_accelerator_run_items']['creation_date']}"
+        else:
+            milestone_name = "WAFR Accelerator Baseline"
+        
+        with emf_metrics.timed("wa_create_milestone"):
+            wafr_milestone = well_architected_client.create_milestone(
+                WorkloadId=wafr_workload_id,
+                MilestoneName=milestone_name,
+                ClientRequestToken=str(uuid.uuid4())
+            )
 
-        logger.debug(f"Milestone created - {json.dumps(wafr_milestone)}")
+        logger.debug("Milestone created - %s", structured_logging.capped(wafr_milestone))
 
         # Update the item
         response = wafr_accelerator_runs_table.update_item(
@@ -53,6 +94,10 @@ def lambda_handler(event, context):
             ExpressionAttributeValues={':val': "Completed"},
             ReturnValues='UPDATED_NEW'  
         )
+        
+        progress.set_progress_stage(wafr_accelerator_runs_table, wafr_accelerator_run_key, "completed")
+        emf_metrics.put_metric("ReviewsCompleted", 1)
+        
         logger.debug(f"update_review_status checkpoint 2")
     except Exception as error:
         return_response = 'Failed'
@@ -62,7 +107,16 @@ def lambda_handler(event, context):
     
     logger.info(f"Exiting update_review_status at {exit_timestamp}" )
     
+    # The report stage renders the report of a completed review from the run item
     return {
         'statusCode': 200,
-        'body' : return_response
+        'body' : return_response,
+        'wafr_accelerator_runs_table': data[0]['wafr_accelerator_runs_table'],
+        'wafr_accelerator_run_key': wafr_accelerator_run_key
     }
+
+def get_failed_questions(wafr_accelerator_runs_table, wafr_accelerator_run_key):
+    
+    item = wafr_accelerator_runs_table.get_item(Key=wafr_accelerator_run_key, ProjectionExpression='question_status').get('Item', {})
+    
+    return [question_key for question_key, status in item.get('question_status', {}).items() if status == "Failed"]
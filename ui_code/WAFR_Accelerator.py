@@ -1,10 +1,10 @@
 import streamlit as st
 from PIL import Image
 
+import ui_session
+
 # Redirect to login if not authenticated
-if 'authenticated' not in st.session_state or not st.session_state['authenticated']:
-    st.warning('You are not logged in. Please log in to access this page.')
-    st.switch_page("pages/1_Login.py")
+ui_session.require_login()
 
 # Main content for the home page
 st.write("""
@@ -19,12 +19,6 @@ st.write("""
 To get started, simply navigate through the features available in the navigation bar. 
 """)
 
-# Logout function
-def logout():
-    st.session_state['authenticated'] = False
-    st.session_state.pop('username', None)
-    st.rerun()
-
 # Add logout button in sidebar
 if st.sidebar.button('Logout'):
-    logout()
+    ui_session.logout()
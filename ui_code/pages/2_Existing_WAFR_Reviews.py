@@ -1,20 +1,28 @@
 import streamlit as st
+import streamlit.components.v1 as components
 from streamlit_lottie import st_lottie
 import pandas as pd
 import boto3
 import json
+import re
+import time
 from boto3.dynamodb.types import TypeDeserializer
 import os
 from PIL import Image
 
+import emf_metrics
+import ui_session
+
 # Set AWS credentials securely
 os.environ['AWS_ACCESS_KEY_ID'] = st.secrets["AWS_ACCESS_KEY_ID"]
 os.environ['AWS_SECRET_ACCESS_KEY'] = st.secrets["AWS_SECRET_ACCESS_KEY"]
 os.environ['AWS_REGION'] = st.secrets["AWS_REGION"]
 
-if 'authenticated' not in st.session_state or not st.session_state['authenticated']:
-    st.warning('You are not logged in. Please log in to access this page.')
-    st.switch_page("pages/1_Login.py")
+# Page metrics are off unless METRICS_SINK is set, e.g. to the CloudWatch agent on this instance (tcp://127.0.0.1:25888)
+emf_metrics.configure_sink(st.secrets.get("METRICS_SINK", "off"))
+emf_metrics.start_invocation("ui_existing_reviews")
+
+ui_session.require_login()
 
 st.set_page_config(page_title="WAFR Analysis Grid", layout="wide")
 
@@ -34,31 +42,55 @@ st.markdown("<div style='text-align: center;'>", unsafe_allow_html=True)
 st_lottie(lottie_animation, height=250, key="welcome")
 st.markdown("</div>", unsafe_allow_html=True)
 
-def logout():
-    st.session_state['authenticated'] = False
-    st.session_state.pop('username', None)
-    st.rerun()
-
 if st.sidebar.button('Logout'):
-    logout()
+    ui_session.logout()
 
 # AWS clients
 client = boto3.client("bedrock-runtime", region_name=os.environ["AWS_REGION"])
 dynamodb = boto3.client("dynamodb", region_name=os.environ["AWS_REGION"])
+sqs = boto3.client("sqs", region_name=os.environ["AWS_REGION"])
+s3 = boto3.client("s3", region_name=os.environ["AWS_REGION"])
 
 # Use inference profile ARN as modelId
 model_id = st.secrets["INFERENCE_PROFILE_ARN"]
 
+# How often a running review's progress is refreshed
+PROGRESS_POLL_SECONDS = 10
+
+# The list of reviews leaves out the extracted document and the pillar responses, which are read only when needed.
+# Completed reviews have a pre-rendered report in the upload bucket, which is viewed and downloaded from there
+REVIEW_LIST_ATTRIBUTES = ("analysis_id, analysis_title, workload_desc, analysis_review_type, selected_lens, additional_lenses, "
+                          "creation_date, review_status, analysis_submitter, review_owner, architecture_summary, "
+                          "selected_wafr_pillars, question_status, report_prefix")
+REPORT_URL_EXPIRY_SECONDS = 3600
+REPORT_VIEW_HEIGHT = 900
+
+PROGRESS_STAGE_LABELS = {
+    'prepare_review': "Preparing the review",
+    'extract_document_text': "Extracting document text",
+    'generate_solution_summary': "Generating solution summary",
+    'generate_prompts': "Generating question prompts",
+    'answer_questions': "Answering questions",
+    'batch_inference': "Waiting for the batch inference job",
+    'review_pillars': "Reviewing pillars",
+    'completed': "Completed"
+}
+
 def load_data():
     try:
-        response = dynamodb.scan(TableName=st.secrets["WAFR_ACCELERATOR_RUNS_DD_TABLE_NAME"])
-        items = response['Items']
-        while 'LastEvaluatedKey' in response:
+        with emf_metrics.timed("dynamodb_scan"):
             response = dynamodb.scan(
                 TableName=st.secrets["WAFR_ACCELERATOR_RUNS_DD_TABLE_NAME"],
-                ExclusiveStartKey=response['LastEvaluatedKey']
+                ProjectionExpression=REVIEW_LIST_ATTRIBUTES
             )
-            items.extend(response['Items'])
+            items = response['Items']
+            while 'LastEvaluatedKey' in response:
+                response = dynamodb.scan(
+                    TableName=st.secrets["WAFR_ACCELERATOR_RUNS_DD_TABLE_NAME"],
+                    ProjectionExpression=REVIEW_LIST_ATTRIBUTES,
+                    ExclusiveStartKey=response['LastEvaluatedKey']
+                )
+                items.extend(response['Items'])
 
         if not items:
             st.warning("There are no existing WAFR review records")
@@ -78,7 +110,6 @@ def load_data():
             'review_status': 'Status',
             'analysis_submitter': 'Created By',
             'review_owner': 'Review Owner',
-            'extracted_document': 'Document',
             'architecture_summary': 'Solution Summary'
         }
 
@@ -88,24 +119,123 @@ def load_data():
             if col not in df.columns:
                 df[col] = ''
 
-        if 'pillars' in df.columns:
-            df['pillars'] = df['pillars'].apply(
-                lambda p: p if isinstance(p, list) else [])
+        # Analyses of several lenses list all of them
+        if 'additional_lenses' in df.columns:
+            df['WAFR Lens'] = [', '.join([lens] + sorted(additional_lenses)) if isinstance(additional_lenses, dict) else lens
+                               for lens, additional_lenses in zip(df['WAFR Lens'], df['additional_lenses'])]
+
+        if 'report_prefix' in df.columns:
+            df['report_prefix'] = df['report_prefix'].fillna('')
         else:
-            df['pillars'] = [[] for _ in range(len(df))]
+            df['report_prefix'] = ''
 
         if 'selected_wafr_pillars' not in df.columns:
             df['selected_wafr_pillars'] = ''
 
+        if 'question_status' in df.columns:
+            df['question_status'] = df['question_status'].apply(
+                lambda q: q if isinstance(q, dict) else {})
+        else:
+            df['question_status'] = [{} for _ in range(len(df))]
+
         return df[[
             'Analysis Id', 'Workload Name', 'Workload Description', 'Analysis Type',
             'WAFR Lens', 'Creation Date', 'Status', 'Created By', 'Review Owner',
-            'Solution Summary', 'pillars', 'selected_wafr_pillars', 'Document'
+            'Solution Summary', 'selected_wafr_pillars', 'question_status', 'report_prefix'
         ]]
     except Exception as e:
         st.error(f"Failed to load data: {e}")
         return pd.DataFrame()
 
+def get_pillar_list(pillars):
+    # pillars is a map keyed by pillar id; reviews created before that stored a list
+    if isinstance(pillars, dict):
+        return sorted(pillars.values(), key=lambda p: int(p.get('pillar_id', 0)))
+    return pillars if isinstance(pillars, list) else []
+
+def load_review_attributes(analysis_id, analysis_submitter, attributes):
+    # The attributes the list of reviews leaves out, for the selected review only
+    with emf_metrics.timed("dynamodb_get_review"):
+        response = dynamodb.get_item(
+            TableName=st.secrets["WAFR_ACCELERATOR_RUNS_DD_TABLE_NAME"],
+            Key={'analysis_id': {'S': analysis_id}, 'analysis_submitter': {'S': analysis_submitter}},
+            ProjectionExpression=attributes
+        )
+    deserializer = TypeDeserializer()
+    return {k: deserializer.deserialize(v) for k, v in response.get('Item', {}).items()}
+
+def report_url(key, filename):
+    return s3.generate_presigned_url(
+        'get_object',
+        Params={'Bucket': st.secrets["WAFR_UPLOAD_BUCKET_NAME"], 'Key': key, 'ResponseContentDisposition': f'attachment; filename="{filename}"'},
+        ExpiresIn=REPORT_URL_EXPIRY_SECONDS
+    )
+
+@st.cache_data(max_entries=20, show_spinner=False)
+def load_report(key):
+    # A report version is never rewritten, so it is fetched once
+    with emf_metrics.timed("s3_get_report"):
+        return s3.get_object(Bucket=st.secrets["WAFR_UPLOAD_BUCKET_NAME"], Key=key)['Body'].read().decode('utf-8')
+
+def display_report(analysis):
+    report_prefix = analysis['report_prefix']
+    file_prefix = re.sub(r'[^\w.-]+', '-', analysis['Workload Name']).strip('-') or "wafr-review"
+
+    columns = st.columns(3)
+    for column, (label, filename) in zip(columns, [("Download PDF", "report.pdf"), ("Download HTML", "report.html"), ("Download Markdown", "report.md")]):
+        column.link_button(label, report_url(report_prefix + filename, f"{file_prefix}-{filename}"))
+
+    try:
+        report_html = load_report(report_prefix + "report.html")
+    except Exception as e:
+        st.error(f"Failed to load the report: {e}")
+        return
+    components.html(report_html, height=REPORT_VIEW_HEIGHT, scrolling=True)
+
+def load_progress(analysis_id, analysis_submitter):
+    # Only the small set of progress attributes is read, not the whole review
+    with emf_metrics.timed("dynamodb_get_progress"):
+        response = dynamodb.get_item(
+            TableName=st.secrets["WAFR_ACCELERATOR_RUNS_DD_TABLE_NAME"],
+            Key={'analysis_id': {'S': analysis_id}, 'analysis_submitter': {'S': analysis_submitter}},
+            ProjectionExpression='review_status, progress_stage, progress_total, progress_done, progress_baseline, progress_unit, stage_started_at'
+        )
+    deserializer = TypeDeserializer()
+    return {k: deserializer.deserialize(v) for k, v in response.get('Item', {}).items()}
+
+@st.fragment(run_every=PROGRESS_POLL_SECONDS)
+def display_progress(analysis_id, analysis_submitter):
+    try:
+        progress = load_progress(analysis_id, analysis_submitter)
+    except Exception as e:
+        st.error(f"Failed to load progress: {e}")
+        return
+
+    if progress.get('review_status') not in ("Submitted", "In Progress"):
+        st.write(f"Review {str(progress.get('review_status', '')).lower()}. Refresh this page to see the results.")
+        return
+
+    stage = progress.get('progress_stage')
+    if not stage:
+        st.write("Waiting for the review to start")
+        return
+
+    stage_started_at = int(progress.get('stage_started_at', {}).get(stage, time.time()))
+    stage_elapsed = max(0, int(time.time()) - stage_started_at)
+    st.write(f"Current stage: {PROGRESS_STAGE_LABELS.get(stage, stage)} (for {stage_elapsed // 60} min {stage_elapsed % 60} s)")
+
+    total = int(progress.get('progress_total', 0))
+    done = int(progress.get('progress_done', 0))
+    if total:
+        unit = progress.get('progress_unit', "questions")
+        text = f"{done} of {total} {unit} done"
+        # ETA from the rate of the current stage, ignoring work carried over from an earlier attempt
+        done_in_stage = done - int(progress.get('progress_baseline', 0))
+        if stage in ('answer_questions', 'review_pillars') and done_in_stage > 0 and done < total:
+            eta = int(stage_elapsed / done_in_stage * (total - done))
+            text = f"{text}, about {max(1, eta // 60)} min remaining"
+        st.progress(min(done / total, 1.0), text=text)
+
 def display_summary(analysis):
     st.subheader("Summary")
     selected_pillars = ', '.join(analysis['selected_wafr_pillars']) if isinstance(analysis['selected_wafr_pillars'], list) else str(analysis['selected_wafr_pillars'])
@@ -126,6 +256,101 @@ def display_summary(analysis):
     }
     st.dataframe(pd.DataFrame(summary_data), hide_index=True, use_container_width=True)
 
+    if analysis['Status'] in ("Submitted", "In Progress"):
+        display_progress(analysis['Analysis Id'], analysis['Created By'])
+
+    question_status = analysis['question_status']
+    if question_status:
+        completed = sum(1 for status in question_status.values() if status == "Completed")
+        st.write(f"Questions answered: {completed} of {len(question_status)}")
+
+    # Failed Deep reviews can be redriven; only the stages and questions that did not complete are run again
+    if analysis['Status'] == "Errored" and analysis['Analysis Type'] != "Quick":
+        failed = [question_id for question_id, status in question_status.items() if status != "Completed"]
+        if failed:
+            st.write(f"Questions to redrive: {', '.join(failed)}")
+        if st.button("Redrive failed review"):
+            redrive_review(analysis)
+
+def redrive_review(analysis):
+    try:
+        with emf_metrics.timed("sqs_send_message"):
+            sqs.send_message(
+                QueueUrl=st.secrets["SQS_QUEUE_NAME"],
+                MessageBody=json.dumps({
+                    'request_type': 'Redrive',
+                    'analysis_id': analysis['Analysis Id'],
+                    'analysis_submitter': analysis['Created By'],
+                    'analysis_review_type': analysis['Analysis Type']
+                })
+            )
+        st.success("Redrive submitted. Refresh this page to follow its progress.")
+    except Exception as e:
+        st.error(f"Error sending redrive request to SQS: {str(e)}")
+
+def load_findings(analysis_id, risk_level, submitter=None):
+    # Findings are only recorded for reviews run against the Well-Architected Tool. Given a submitter, the findings
+    # of all their analyses, from the submitter index (sort key risk level#analysis id)
+    query_kwargs = {'TableName': st.secrets["WAFR_FINDINGS_DD_TABLE_NAME"]}
+    if submitter:
+        query_kwargs['IndexName'] = 'analysis_submitter-index'
+        if risk_level == "All":
+            query_kwargs['KeyConditionExpression'] = 'analysis_submitter = :submitter'
+            query_kwargs['ExpressionAttributeValues'] = {':submitter': {'S': submitter}}
+        else:
+            query_kwargs['KeyConditionExpression'] = 'analysis_submitter = :submitter AND begins_with(risk_analysis, :risk_level)'
+            query_kwargs['ExpressionAttributeValues'] = {':submitter': {'S': submitter}, ':risk_level': {'S': f"{risk_level}#"}}
+    elif risk_level == "All":
+        query_kwargs['KeyConditionExpression'] = 'analysis_id = :analysis_id'
+        query_kwargs['ExpressionAttributeValues'] = {':analysis_id': {'S': analysis_id}}
+    else:
+        query_kwargs['IndexName'] = 'risk_level-index'
+        query_kwargs['KeyConditionExpression'] = 'analysis_id = :analysis_id AND risk_level = :risk_level'
+        query_kwargs['ExpressionAttributeValues'] = {':analysis_id': {'S': analysis_id}, ':risk_level': {'S': risk_level}}
+
+    try:
+        with emf_metrics.timed("dynamodb_query_findings"):
+            response = dynamodb.query(**query_kwargs)
+            items = response['Items']
+            while 'LastEvaluatedKey' in response:
+                response = dynamodb.query(ExclusiveStartKey=response['LastEvaluatedKey'], **query_kwargs)
+                items.extend(response['Items'])
+    except Exception as e:
+        st.error(f"Failed to load findings: {e}")
+        return pd.DataFrame()
+
+    deserializer = TypeDeserializer()
+    data = [{k: deserializer.deserialize(v) for k, v in item.items()} for item in items]
+    if not data:
+        return pd.DataFrame()
+
+    df = pd.DataFrame(data)
+    columns = (['analysis_id'] if submitter else []) + ['pillar_name', 'question_id', 'question', 'risk_level', 'assessment', 'recommendations_and_examples']
+    for col in columns:
+        if col not in df.columns:
+            df[col] = ''
+
+    return df[columns].rename(columns={
+        'analysis_id': 'Analysis Id',
+        'pillar_name': 'Pillar',
+        'question_id': 'Question Id',
+        'question': 'Question',
+        'risk_level': 'Risk',
+        'assessment': 'Assessment',
+        'recommendations_and_examples': 'Recommendations'
+    })
+
+def display_findings(analysis):
+    st.subheader("Findings by risk")
+    risk_level = st.selectbox("Risk level:", ["All", "High", "Medium", "Low", "None", "Not Applicable", "Unknown"])
+    scope = st.radio("Findings of:", ["This analysis", f"All analyses by {analysis['Created By']}"], horizontal=True)
+    submitter = analysis['Created By'] if scope != "This analysis" else None
+    findings = load_findings(analysis['Analysis Id'], risk_level, submitter)
+    if findings.empty:
+        st.write("No findings recorded for this risk level")
+        return
+    st.dataframe(findings.sort_values((['Analysis Id'] if submitter else []) + ['Pillar', 'Question Id']), hide_index=True, use_container_width=True)
+
 def parse_stream(stream):
     for event in stream:
         chunk = event.get('chunk')
@@ -151,7 +376,13 @@ def main():
         return
 
     record = df[df['Workload Name'] == selected_name].iloc[0]
-    tab_titles = ["Summary", "Solution Summary"] + [p['pillar_name'] for p in record['pillars']]
+    show_findings = bool(st.secrets.get("WAFR_FINDINGS_DD_TABLE_NAME")) and record['Analysis Type'] != "Quick"
+    # Reviews without a report (not completed yet, or completed before reports) show their pillars from the run item
+    has_report = bool(record['report_prefix'])
+    pillars = [] if has_report else get_pillar_list(load_review_attributes(record['Analysis Id'], record['Created By'], 'pillars').get('pillars'))
+    tab_titles = ["Summary", "Solution Summary"] + (["Report"] if has_report else [p['pillar_name'] for p in pillars])
+    if show_findings:
+        tab_titles.append("Findings")
     tabs = st.tabs(tab_titles)
 
     with tabs[0]:
@@ -160,13 +391,21 @@ def main():
         st.subheader("Solution Summary")
         st.write(record['Solution Summary'])
 
-    for i, pillar in enumerate(record['pillars'], start=2):
+    if has_report:
+        with tabs[2]:
+            display_report(record)
+
+    for i, pillar in enumerate(pillars, start=2):
         with tabs[i]:
             st.subheader(f"Review findings & recommendations for pillar: {pillar['pillar_name']}")
             st.write(pillar.get('llm_response', 'No data'))
 
+    if show_findings:
+        with tabs[-1]:
+            display_findings(record)
+
     st.subheader("WAFR Chat", divider="rainbow")
-    chat_areas = ["Summary", "Solution Summary", "Document"] + [p['pillar_name'] for p in record['pillars']]
+    chat_areas = ["Summary", "Solution Summary", "Document"] + (["Report"] if has_report else [p['pillar_name'] for p in pillars])
     selected_area = st.selectbox("Select area for chat:", chat_areas)
     prompt = st.text_input("Ask a question:")
 
@@ -187,9 +426,12 @@ def main():
         elif selected_area == "Solution Summary":
             context = f"Solution Summary:\n{record['Solution Summary']}"
         elif selected_area == "Document":
-            context = f"Document:\n{record['Document']}"
+            document = load_review_attributes(record['Analysis Id'], record['Created By'], 'extracted_document').get('extracted_document', '')
+            context = f"Document:\n{document}"
+        elif selected_area == "Report":
+            context = load_report(record['report_prefix'] + "report.md")
         else:
-            pillar = next((p for p in record['pillars'] if p['pillar_name'] == selected_area), None)
+            pillar = next((p for p in pillars if p['pillar_name'] == selected_area), None)
             context = pillar.get('llm_response', 'No data') if pillar else 'No data'
 
         full_prompt = f"{context.strip()}\n\nUser Question: {prompt}"
@@ -1,10 +1,10 @@
 import streamlit as st
 from PIL import Image
 
+import ui_session
+
 # ---------------- Session Check -------------------
-if 'authenticated' not in st.session_state or not st.session_state['authenticated']:
-    st.warning('You are not logged in. Please log in to access this page.')
-    st.switch_page("pages/1_Login.py")
+ui_session.require_login()
 
 # ---------------- Light Theme CSS -------------------
 st.markdown("""
@@ -89,12 +89,6 @@ def architecture():
 if __name__ == "__main__":
     architecture()
 
-# ---------------- Logout Function -------------------
-def logout():
-    st.session_state['authenticated'] = False
-    st.session_state.pop('username', None)
-    st.rerun()
-
 # ---------------- Logout Button -------------------
 if st.sidebar.button("Logout"):
-    logout()
+    ui_session.logout()
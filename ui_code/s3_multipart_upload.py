@@ -0,0 +1,81 @@
+import os
+import math
+
+import boto3
+from botocore.config import Config
+import streamlit.components.v1 as components
+
+import emf_metrics
+
+# Documents go from the browser straight to S3 as a multipart upload, through presigned URLs for each part, so the
+# Streamlit server never receives them: it only creates and completes the upload and records the key. The upload
+# bucket allows PUT from the UI origin and exposes the ETag header of each part (CORS rule in the stack)
+UPLOAD_PART_BYTES = 8 * 1024 * 1024
+# Textract's limit for PDF documents
+UPLOAD_MAX_BYTES = 500 * 1024 * 1024
+UPLOAD_MAX_PARALLEL_PARTS = 4
+UPLOAD_URL_EXPIRY_SECONDS = 3600
+
+# The browser side, static HTML and JavaScript without a build step
+document_upload_component = components.declare_component(
+    "s3_multipart_upload",
+    path=os.path.join(os.path.dirname(os.path.abspath(__file__)), "components", "s3_multipart_upload")
+)
+
+clients = {}
+
+def s3_client(region):
+    # Presigned URLs of the regional endpoint, as the global endpoint redirects requests for new buckets, which fails the CORS preflight
+    if region not in clients:
+        clients[region] = boto3.client('s3', region_name=region, endpoint_url=f"https://s3.{region}.amazonaws.com",
+                                       config=Config(signature_version='s3v4', s3={'addressing_style': 'virtual'}))
+    return clients[region]
+
+def start_upload(bucket, key, size, region):
+    """Creates the multipart upload of a document of size bytes, with a presigned URL for each part."""
+
+    client = s3_client(region)
+
+    with emf_metrics.timed("s3_create_multipart_upload"):
+        upload_id = client.create_multipart_upload(Bucket=bucket, Key=key, ContentType="application/pdf")['UploadId']
+
+    part_urls = [
+        client.generate_presigned_url(
+            'upload_part',
+            Params={'Bucket': bucket, 'Key': key, 'UploadId': upload_id, 'PartNumber': part_number},
+            ExpiresIn=UPLOAD_URL_EXPIRY_SECONDS
+        )
+        for part_number in range(1, max(1, math.ceil(size / UPLOAD_PART_BYTES)) + 1)
+    ]
+
+    return {'upload_id': upload_id, 'part_urls': part_urls, 'part_bytes': UPLOAD_PART_BYTES, 'max_parallel': UPLOAD_MAX_PARALLEL_PARTS}
+
+def complete_upload(bucket, key, upload_id, parts, region):
+
+    with emf_metrics.timed("s3_complete_multipart_upload"):
+        s3_client(region).complete_multipart_upload(
+            Bucket=bucket,
+            Key=key,
+            UploadId=upload_id,
+            MultipartUpload={'Parts': sorted(({'PartNumber': part['PartNumber'], 'ETag': part['ETag']} for part in parts), key=lambda part: part['PartNumber'])}
+        )
+
+def discard_upload(bucket, key, upload_id, completed, region):
+    # A replaced document: its unfinished upload is aborted, a finished one deleted. Anything left over is removed by
+    # the bucket's lifecycle rule for incomplete multipart uploads
+    try:
+        if completed:
+            s3_client(region).delete_object(Bucket=bucket, Key=key)
+        else:
+            s3_client(region).abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+    except Exception as e:
+        print(f"Unable to discard upload of {key}: {e}")
+
+def document_uploader(status, file_name=None, upload=None, key=None):
+    """
+    The document upload control. status is idle, uploading (with upload from start_upload) or uploaded. Returns the
+    last event of the browser side: selected (name, size), uploaded (upload_id, parts) or failed (upload_id, error),
+    each with a nonce, as the same event is returned again on every rerun.
+    """
+
+    return document_upload_component(status=status, file_name=file_name, upload=upload, key=key, default=None)
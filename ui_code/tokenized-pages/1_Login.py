@@ -5,6 +5,8 @@ import boto3
 import logging
 from PIL import Image
 
+import ui_session
+
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -103,7 +105,13 @@ def authenticate(username, password):
             AuthFlow='USER_PASSWORD_AUTH',
             AuthParameters={'USERNAME': username, 'PASSWORD': password}
         )
-        return True, username
+        # The signed ID token is the session, verified by every page on whichever UI instance serves it
+        result = resp.get('AuthenticationResult', {})
+        claims = ui_session.start_session(result.get('IdToken'), result.get('AccessToken'))
+        if claims is None:
+            st.error(f"Sign in could not be completed: {resp.get('ChallengeName', 'no token was issued')}")
+            return False, None
+        return True, claims['cognito:username']
     except client.exceptions.NotAuthorizedException:
         return False, None
     except client.exceptions.UserNotFoundException:
@@ -115,15 +123,13 @@ def authenticate(username, password):
 # Login page content
 st.title('Login')
 
-if 'authenticated' not in st.session_state:
-    st.session_state['authenticated'] = False
+current_user = ui_session.current_user()
+ui_session.sync_cookie()
 
-if st.session_state['authenticated']:
-    st.success(f"Welcome back, {st.session_state['username']}!")
+if current_user:
+    st.success(f"Welcome back, {current_user}!")
     if st.button('Logout'):
-        st.session_state['authenticated'] = False
-        st.session_state.pop('username', None)
-        st.rerun()
+        ui_session.logout()
 else:
     tab1, tab2 = st.tabs(["Login", "Register"])
 
@@ -136,8 +142,6 @@ else:
             if username and password:
                 success, name = authenticate(username, password)
                 if success:
-                    st.session_state['authenticated'] = True
-                    st.session_state['username'] = name
                     st.rerun()
                 else:
                     st.warning("Invalid username or password.")
@@ -148,7 +152,7 @@ else:
         st.info("Please contact your Admin to get registered.")
 
 # Navigation options
-if st.session_state['authenticated']:
+if current_user:
     st.write("Please select where you'd like to go:")
 
     col1, col2, col3 = st.columns(3)
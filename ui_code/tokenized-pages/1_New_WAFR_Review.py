@@ -10,6 +10,10 @@ import os
 import requests
 from PIL import Image
 
+import emf_metrics
+import s3_multipart_upload
+import ui_session
+
 # ------------------- PAGE CONFIG -------------------
 st.set_page_config(page_title="Create WAFR Analysis", layout="wide")
 
@@ -20,10 +24,12 @@ WAFR_UPLOAD_BUCKET_NAME = st.secrets["WAFR_UPLOAD_BUCKET_NAME"]
 WAFR_ACCELERATOR_RUNS_DD_TABLE_NAME = st.secrets["WAFR_ACCELERATOR_RUNS_DD_TABLE_NAME"]
 SQS_QUEUE_NAME = st.secrets["SQS_QUEUE_NAME"]
 
+# Page metrics are off unless METRICS_SINK is set, e.g. to the CloudWatch agent on this instance (tcp://127.0.0.1:25888)
+emf_metrics.configure_sink(st.secrets.get("METRICS_SINK", "off"))
+emf_metrics.start_invocation("ui_new_review")
+
 # ------------------- AUTH CHECK -------------------
-if 'authenticated' not in st.session_state or not st.session_state['authenticated']:
-    st.warning('You are not logged in. Please log in to access this page.')
-    st.switch_page("pages/1_Login.py")
+ui_session.require_login()
 
 # ------------------- LOAD ANIMATION -------------------
 def load_lottie_file(filepath: str):
@@ -38,7 +44,6 @@ st.image(logo, width=150)
 st_lottie(lottie_animation, speed=1, width=400, height=250, key="wafr_anim")
 
 # ------------------- AWS CLIENTS -------------------
-s3_client = boto3.client('s3', region_name=AWS_REGION)
 well_architected_client = boto3.client('wellarchitected', region_name=AWS_REGION)
 
 # ------------------- STATIC DATA -------------------
@@ -53,7 +58,7 @@ lenses = list_static_lenses()
 lens_list = list(lenses.keys())
 
 def get_current_user():
-    return st.session_state.get('username', 'Unknown User')
+    return ui_session.current_user() or 'Unknown User'
 
 # ------------------- SESSION STATE -------------------
 if 'form_submitted' not in st.session_state:
@@ -62,6 +67,7 @@ if 'form_submitted' not in st.session_state:
 if 'form_data' not in st.session_state:
     st.session_state.form_data = {
         'wafr_lens': lens_list[0],
+        'additional_lenses': [],
         'environment': 'PREPRODUCTION',
         'analysis_name': '',
         'created_by': get_current_user(),
@@ -77,35 +83,77 @@ else:
 if 'success_message' not in st.session_state:
     st.session_state.success_message = None
 
+# The document of the next analysis: its analysis id and key, and the state of its upload from the browser. Kept in
+# the shared session store, as the upload outlives the connection to this UI instance
+document_upload = ui_session.load('document_upload', {})
+
 # ------------------- HELPERS -------------------
-def upload_to_s3(file, bucket, key):
-    try:
-        s3_client.upload_fileobj(file, bucket, key)
+def handle_upload_event(upload_event):
+    # Returns whether the upload control has to be rendered again with the new upload state
+    if not upload_event or upload_event.get('nonce') == st.session_state.get('upload_event_nonce'):
+        return False
+    st.session_state.upload_event_nonce = upload_event['nonce']
+    document_upload = ui_session.load('document_upload', {})
+
+    if upload_event['event'] == 'selected':
+        discard_document_upload()
+        if not upload_event['name'].lower().endswith('.pdf'):
+            st.error("Please upload a PDF document.")
+        elif upload_event['size'] > s3_multipart_upload.UPLOAD_MAX_BYTES:
+            st.error(f"Documents can be up to {s3_multipart_upload.UPLOAD_MAX_BYTES // (1024 * 1024)} MB.")
+        else:
+            analysis_id = str(uuid.uuid4())
+            s3_key = f"{get_current_user()}/analyses/{analysis_id}/{upload_event['name']}"
+            try:
+                upload = s3_multipart_upload.start_upload(WAFR_UPLOAD_BUCKET_NAME, s3_key, upload_event['size'], AWS_REGION)
+            except Exception as e:
+                st.error(f"Error starting the upload to S3: {str(e)}")
+                return False
+            ui_session.save('document_upload', {'analysis_id': analysis_id, 's3_key': s3_key, 'file_name': upload_event['name'],
+                                               'status': 'uploading', 'upload': upload})
         return True
-    except Exception as e:
-        st.error(f"Error uploading to S3: {str(e)}")
+
+    if upload_event.get('upload_id') != document_upload.get('upload', {}).get('upload_id'):
         return False
 
+    if upload_event['event'] == 'uploaded':
+        try:
+            s3_multipart_upload.complete_upload(WAFR_UPLOAD_BUCKET_NAME, document_upload['s3_key'], document_upload['upload']['upload_id'], upload_event['parts'], AWS_REGION)
+            ui_session.save('document_upload', dict(document_upload, status='uploaded'))
+        except Exception as e:
+            st.error(f"Error completing the upload to S3: {str(e)}")
+            discard_document_upload()
+    else:
+        st.error(f"Error uploading to S3: {upload_event.get('error')}")
+        discard_document_upload()
+    return True
+
+def discard_document_upload():
+    document_upload = ui_session.load('document_upload', {})
+    if document_upload:
+        s3_multipart_upload.discard_upload(WAFR_UPLOAD_BUCKET_NAME, document_upload['s3_key'], document_upload['upload']['upload_id'],
+                                           document_upload['status'] == 'uploaded', AWS_REGION)
+        ui_session.save('document_upload', {})
+
 def trigger_wafr_review(input_data):
     try:
         sqs = boto3.client('sqs', region_name=AWS_REGION)
-        response = sqs.send_message(
-            QueueUrl=SQS_QUEUE_NAME,
-            MessageBody=json.dumps(input_data)
-        )
+        with emf_metrics.timed("sqs_send_message"):
+            response = sqs.send_message(
+                QueueUrl=SQS_QUEUE_NAME,
+                MessageBody=json.dumps(input_data)
+            )
         return response['MessageId']
     except Exception as e:
         st.error(f"Error sending message to SQS: {str(e)}")
         return None
 
-def create_wafr_analysis(analysis_data, uploaded_file):
-    analysis_id = str(uuid.uuid4())
-    if uploaded_file:
-        s3_key = f"{analysis_data['created_by']}/analyses/{analysis_id}/{uploaded_file.name}"
-        if not upload_to_s3(uploaded_file, WAFR_UPLOAD_BUCKET_NAME, s3_key):
-            return False, "Failed to upload document to S3."
-    else:
+def create_wafr_analysis(analysis_data, document_upload):
+    # The document is already in S3, uploaded from the browser
+    if document_upload.get('status') != 'uploaded':
         return False, "No document uploaded. Please upload a document before creating the analysis."
+    analysis_id = document_upload['analysis_id']
+    s3_key = document_upload['s3_key']
 
     wafr_review_input = {
         'analysis_id': analysis_id,
@@ -117,6 +165,7 @@ def create_wafr_analysis(analysis_data, uploaded_file):
         'review_owner': analysis_data['review_owner'],
         'analysis_owner': analysis_data['created_by'],
         'lenses': lenses[analysis_data['wafr_lens']],
+        'additional_lenses': {lens: lenses[lens] for lens in analysis_data['additional_lenses']},
         'environment': analysis_data['environment'],
         'workload_desc': analysis_data['workload_desc'],
         'industry_type': analysis_data['industry_type'],
@@ -128,23 +177,25 @@ def create_wafr_analysis(analysis_data, uploaded_file):
         dynamodb = boto3.resource('dynamodb', region_name=AWS_REGION)
         table = dynamodb.Table(WAFR_ACCELERATOR_RUNS_DD_TABLE_NAME)
         creation_date = datetime.datetime.now().strftime("%Y-%m-%d %H-%M-%S")
-        table.put_item(Item={
-            'analysis_id': analysis_id,
-            'analysis_submitter': analysis_data['created_by'],
-            'analysis_title': analysis_data['analysis_name'],
-            'selected_lens': analysis_data['wafr_lens'],
-            'creation_date': creation_date,
-            'review_status': "Submitted",
-            'selected_wafr_pillars': analysis_data['selected_pillars'],
-            'document_s3_key': s3_key,
-            'analysis_owner': analysis_data['created_by'],
-            'lenses': lenses[analysis_data['wafr_lens']],
-            'environment': analysis_data['environment'],
-            'workload_desc': analysis_data['workload_desc'],
-            'review_owner': analysis_data['review_owner'],
-            'industry_type': analysis_data['industry_type'],
-            'analysis_review_type': "Quick"
-        })
+        with emf_metrics.timed("dynamodb_put_item"):
+            table.put_item(Item={
+                'analysis_id': analysis_id,
+                'analysis_submitter': analysis_data['created_by'],
+                'analysis_title': analysis_data['analysis_name'],
+                'selected_lens': analysis_data['wafr_lens'],
+                'creation_date': creation_date,
+                'review_status': "Submitted",
+                'selected_wafr_pillars': analysis_data['selected_pillars'],
+                'document_s3_key': s3_key,
+                'analysis_owner': analysis_data['created_by'],
+                'lenses': lenses[analysis_data['wafr_lens']],
+                'additional_lenses': wafr_review_input['additional_lenses'],
+                'environment': analysis_data['environment'],
+                'workload_desc': analysis_data['workload_desc'],
+                'review_owner': analysis_data['review_owner'],
+                'industry_type': analysis_data['industry_type'],
+                'analysis_review_type': "Quick"
+            })
         return True, f"WAFR Analysis created successfully! Message ID: {message_id}"
     else:
         return False, "Failed to start the analysis process."
@@ -181,9 +232,7 @@ def duplicate_wafr_accelerator_workload(workload_name):
 # ------------------- SIDEBAR -------------------
 with st.sidebar:
     if st.button('Logout'):
-        st.session_state['authenticated'] = False
-        st.session_state.pop('username', None)
-        st.rerun()
+        ui_session.logout()
 
 # ------------------- SUCCESS MESSAGE -------------------
 if st.session_state.success_message:
@@ -209,13 +258,23 @@ with st.expander("Additional Details", expanded=True):
     with col2:
         industry_type = st.selectbox("Industry Type", ["Agriculture", "Education", "Healthcare", "Finance", "Technology"])
         wafr_lens = st.selectbox("WAFR Lens", lens_list, index=lens_list.index(st.session_state.form_data['wafr_lens']))
+        # Reviewed in the same analysis, from the same document extraction and summary
+        additional_lenses = st.multiselect("Additional Lenses", [lens for lens in lens_list if lens != wafr_lens],
+                                           default=[lens for lens in st.session_state.form_data['additional_lenses'] if lens != wafr_lens])
 
 with st.expander("Select Pillars", expanded=True):
     pillars = ["Operational Excellence", "Security", "Reliability", "Performance Efficiency", "Cost Optimization", "Sustainability"]
     selected_pillars = st.multiselect("Select WAFR Pillars", pillars, default=st.session_state.form_data['selected_pillars'], key="pillar_select")
 
 with st.expander("Document Upload", expanded=True):
-    uploaded_file = st.file_uploader("Upload Document", type=["pdf"])
+    upload_event = s3_multipart_upload.document_uploader(
+        document_upload.get('status', 'idle'),
+        document_upload.get('file_name'),
+        document_upload.get('upload') if document_upload.get('status') == 'uploading' else None,
+        key="document_upload_control"
+    )
+    if handle_upload_event(upload_event):
+        st.rerun()
 
 # ------------------- SUBMIT BUTTON -------------------
 if st.button("Create WAFR Analysis", type="primary", use_container_width=True):
@@ -227,8 +286,8 @@ if st.button("Create WAFR Analysis", type="primary", use_container_width=True):
         st.error("Review owner needs to be at least 3 characters long.")
     elif not selected_pillars:
         st.error("Please select at least one WAFR Pillar.")
-    elif not uploaded_file:
-        st.error("Please upload a document.")
+    elif ui_session.load('document_upload', {}).get('status') != 'uploaded':
+        st.error("Please upload a document and wait for the upload to finish.")
     elif duplicate_wafr_accelerator_workload(analysis_name):
         st.error("Workload with the same name already exists!")
     elif duplicate_wa_tool_workload(analysis_name):
@@ -236,6 +295,7 @@ if st.button("Create WAFR Analysis", type="primary", use_container_width=True):
     else:
         st.session_state.form_data.update({
             'wafr_lens': wafr_lens,
+            'additional_lenses': additional_lenses,
             'environment': wafr_environment,
             'analysis_name': analysis_name,
             'selected_pillars': selected_pillars,
@@ -245,7 +305,7 @@ if st.button("Create WAFR Analysis", type="primary", use_container_width=True):
             'analysis_review_type': "Quick"
         })
         with st.spinner("Creating WAFR Analysis..."):
-            success, message = create_wafr_analysis(st.session_state.form_data, uploaded_file)
+            success, message = create_wafr_analysis(st.session_state.form_data, ui_session.load('document_upload', {}))
         if success:
             st.session_state.success_message = message
             st.session_state.form_submitted = True
@@ -256,6 +316,7 @@ if st.button("Create WAFR Analysis", type="primary", use_container_width=True):
 if st.session_state.form_submitted:
     st.session_state.form_data = {
         'wafr_lens': lens_list[0],
+        'additional_lenses': [],
         'environment': 'PREPRODUCTION',
         'analysis_name': '',
         'created_by': get_current_user(),
@@ -265,5 +326,6 @@ if st.session_state.form_submitted:
         'industry_type': 'Agriculture',
         'analysis_review_type': "Quick"
     }
+    ui_session.save('document_upload', {})
     st.session_state.form_submitted = False
     st.rerun()
@@ -0,0 +1,216 @@
+import os
+import json
+import logging
+
+import boto3
+import jwt
+import streamlit as st
+import streamlit.components.v1 as components
+
+# Who is logged in is not kept on the Streamlit server: the login page stores the user's Cognito ID token in a
+# cookie, and every page run verifies the token's signature against the user pool's public keys, so any UI instance
+# behind the load balancer can serve any connection. What a session keeps across page runs is saved to the UI
+# sessions table (WAFR_UI_SESSIONS_DD_TABLE_NAME), keyed by the login, so a connection to another instance picks up
+# where the last one left off. Without the table it stays in the instance's session state.
+# With the table, a login is only valid while its row exists: logout deletes the row, so the token in the cookie is
+# refused from then on, even where a copy of it is still around. Without the table a token stays valid until it expires
+TOKEN_COOKIE = "wafr_id_token"
+# ID token validity of the app client (stack)
+SESSION_HOURS = 8
+# Allowed clock difference to Cognito when checking the expiry of a token
+CLOCK_SKEW_SECONDS = 60
+
+COGNITO_USER_POOL_ID = st.secrets.get("COGNITO_USER_POOL_ID")
+COGNITO_APP_CLIENT_ID = st.secrets.get("COGNITO_APP_CLIENT_ID")
+COGNITO_REGION = st.secrets.get("COGNITO_REGION")
+WAFR_UI_SESSIONS_DD_TABLE_NAME = st.secrets.get("WAFR_UI_SESSIONS_DD_TABLE_NAME")
+
+logger = logging.getLogger(__name__)
+
+# Writes the token cookie from the browser, static HTML and JavaScript without a build step
+session_cookie_component = components.declare_component(
+    "session_cookie",
+    path=os.path.join(os.path.dirname(os.path.abspath(__file__)), "components", "session_cookie")
+)
+
+# Shared by all sessions of this instance; PyJWKClient caches the signing keys
+resources = {}
+
+def issuer():
+    return f"https://cognito-idp.{COGNITO_REGION}.amazonaws.com/{COGNITO_USER_POOL_ID}"
+
+def jwks_client():
+    if 'jwks' not in resources:
+        resources['jwks'] = jwt.PyJWKClient(f"{issuer()}/.well-known/jwks.json")
+    return resources['jwks']
+
+def sessions_table():
+    if 'sessions' not in resources:
+        region = st.secrets.get("AWS_REGION", COGNITO_REGION)
+        resources['sessions'] = boto3.resource('dynamodb', region_name=region).Table(WAFR_UI_SESSIONS_DD_TABLE_NAME)
+    return resources['sessions']
+
+def verify_token(token):
+    """Returns the claims of a valid ID token of the app client, or None."""
+
+    try:
+        claims = jwt.decode(
+            token,
+            jwks_client().get_signing_key_from_jwt(token).key,
+            algorithms=["RS256"],
+            audience=COGNITO_APP_CLIENT_ID,
+            issuer=issuer(),
+            leeway=CLOCK_SKEW_SECONDS,
+            options={"require": ["exp", "iat", "sub"]}
+        )
+    except jwt.ExpiredSignatureError:
+        return None
+    except jwt.PyJWTError as e:
+        logger.warning(f"Session token rejected: {e}")
+        return None
+
+    # Access tokens are signed with the same keys
+    return claims if claims.get('token_use') == 'id' else None
+
+def start_session(token, access_token=None):
+    """Starts the session of the tokens from initiate_auth; returns the ID token's claims, or None if it is not valid."""
+
+    claims = verify_token(token) if token else None
+    if claims is None:
+        return None
+
+    if WAFR_UI_SESSIONS_DD_TABLE_NAME:
+        # The access token is kept for the Cognito sign out, which may run on another instance
+        sessions_table().update_item(
+            Key={'session_id': session_id(claims)},
+            UpdateExpression="SET #username = :username, access_token = :access_token, expires_at = :expires_at",
+            ExpressionAttributeNames={'#username': 'username'},
+            ExpressionAttributeValues={':username': claims['cognito:username'], ':access_token': access_token,
+                                       ':expires_at': int(claims['exp'])}
+        )
+    st.session_state['id_token'] = token
+    st.session_state['access_token'] = access_token
+    st.session_state['signed_out'] = False
+    return claims
+
+def session_active(claims):
+    """Whether the login of the claims has not been logged out; always true without the sessions table."""
+
+    if not WAFR_UI_SESSIONS_DD_TABLE_NAME:
+        return True
+    # Consistent read, as the row of a login on this connection may have only just been written
+    try:
+        item = sessions_table().get_item(
+            Key={'session_id': session_id(claims)},
+            ProjectionExpression="session_id",
+            ConsistentRead=True
+        )
+    except Exception as e:
+        logger.error(f"Unable to check the session: {e}")
+        return False
+    return 'Item' in item
+
+def current_session():
+    """The claims of the logged in user's token, or None when nobody is logged in."""
+
+    if st.session_state.get('signed_out'):
+        return None
+
+    # The cookie is read from the request that opened the connection, so a login on this connection is only in
+    # the session state until the browser reconnects. Either way the token is verified on every run
+    for token in (st.session_state.get('id_token'), st.context.cookies.get(TOKEN_COOKIE)):
+        claims = verify_token(token) if token else None
+        if claims and session_active(claims):
+            st.session_state['id_token'] = token
+            return claims
+
+    st.session_state.pop('id_token', None)
+    return None
+
+def current_user():
+    claims = current_session()
+    return claims['cognito:username'] if claims else None
+
+def require_login():
+    claims = current_session()
+    if claims is None:
+        st.warning('You are not logged in. Please log in to access this page.')
+        st.switch_page("pages/1_Login.py")
+    return claims
+
+def sync_cookie():
+    # Rendered by the login page: stores the token of a new login in the cookie and clears it after a logout
+    token = None if st.session_state.get('signed_out') else st.session_state.get('id_token')
+    if st.context.cookies.get(TOKEN_COOKIE) != token:
+        session_cookie_component(name=TOKEN_COOKIE, value=token or "", max_age=SESSION_HOURS * 3600 if token else 0,
+                                 key="session_cookie", default=None)
+
+def logout():
+    claims = current_session()
+    access_token = st.session_state.get('access_token')
+    if claims and WAFR_UI_SESSIONS_DD_TABLE_NAME:
+        try:
+            item = sessions_table().delete_item(
+                Key={'session_id': session_id(claims)},
+                ReturnValues="ALL_OLD"
+            ).get('Attributes', {})
+            access_token = access_token or item.get('access_token')
+        except Exception as e:
+            logger.error(f"Unable to delete session data: {e}")
+    # Revokes the refresh and access tokens of the user; ID tokens stay valid until they expire, which is what the
+    # session row is for
+    if claims and access_token:
+        try:
+            boto3.client('cognito-idp', region_name=COGNITO_REGION).global_sign_out(AccessToken=access_token)
+        except Exception as e:
+            logger.warning(f"Unable to sign out of Cognito: {e}")
+    # Also drops what load cached for this connection, so a next login starts clean
+    st.session_state.clear()
+    st.session_state['signed_out'] = True
+    st.rerun()
+
+def session_id(claims):
+    # Same for every token of one login
+    return claims.get('origin_jti') or f"{claims['sub']}#{claims['auth_time']}"
+
+def load(name, default=None):
+    """A value the session saved with save, on this or any other UI instance."""
+
+    if name in st.session_state:
+        return st.session_state[name]
+
+    value = default
+    claims = current_session()
+    if claims and WAFR_UI_SESSIONS_DD_TABLE_NAME:
+        try:
+            item = sessions_table().get_item(
+                Key={'session_id': session_id(claims)},
+                ProjectionExpression="#value",
+                ExpressionAttributeNames={'#value': name}
+            ).get('Item', {})
+            if name in item:
+                value = json.loads(item[name])
+        except Exception as e:
+            logger.error(f"Unable to load session data {name}: {e}")
+
+    st.session_state[name] = value
+    return value
+
+def save(name, value):
+    st.session_state[name] = value
+
+    claims = current_session()
+    if claims and WAFR_UI_SESSIONS_DD_TABLE_NAME:
+        # Stored as JSON, as DynamoDB returns numbers as Decimal; expires with the login, and is not written once the
+        # login's row is deleted by a logout
+        try:
+            sessions_table().update_item(
+                Key={'session_id': session_id(claims)},
+                ConditionExpression="attribute_exists(session_id)",
+                UpdateExpression="SET #value = :value, #username = :username, expires_at = :expires_at",
+                ExpressionAttributeNames={'#value': name, '#username': 'username'},
+                ExpressionAttributeValues={':value': json.dumps(value), ':username': claims['cognito:username'],
+                                           ':expires_at': int(claims['exp'])}
+            )
+        except Exception as e:
+            logger.error(f"Unable to save session data {name}: {e}")
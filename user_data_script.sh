@@ -23,7 +23,7 @@ while [ "$success" = false ] && [ $attempt_num -le $max_attempts ]; do
 
   # Upgrade pip and install Python packages
   python3 -m pip install --upgrade pip
-  python3 -m pip install boto3 awscli streamlit streamlit-lottie streamlit-authenticator numpy python-dotenv aws-cdk-lib constructs cdklabs.generative_ai_cdk_constructs
+  python3 -m pip install boto3 awscli "streamlit>=1.37" streamlit-lottie "PyJWT[crypto]" streamlit-authenticator numpy python-dotenv aws-cdk-lib constructs cdklabs.generative_ai_cdk_constructs
 
   if [ $? -eq 0 ]; then
     echo "Installation succeeded."
@@ -179,6 +179,9 @@ class WafrGenaiAcceleratorStack(Stack):
             destination_bucket=wafrReferenceDocsBucket
         )
         
+        # Days a cached model response is kept (response_cache in the wafr_common layer)
+        RESPONSE_CACHE_TTL_DAYS = 30
+
         #S3 Bucket where customer design is stored
         userUploadBucket = s3.Bucket(self, 
             'wafr-accelerator-upload',
@@ -187,7 +190,11 @@ class WafrGenaiAcceleratorStack(Stack):
             server_access_logs_bucket=accessLogsBucket,
             server_access_logs_prefix="wafr-upload-docs-logs/",
             removal_policy=RemovalPolicy.DESTROY, 
-            auto_delete_objects=True)
+            auto_delete_objects=True,
+            # Model responses too large for the response cache table (response_cache in the wafr_common layer), and
+            # document uploads from the browser that were never completed
+            lifecycle_rules=[s3.LifecycleRule(prefix="response-cache/", expiration=Duration.days(RESPONSE_CACHE_TTL_DAYS)),
+                             s3.LifecycleRule(abort_incomplete_multipart_upload_after=Duration.days(1))])
         
         UPLOAD_BUCKET_NAME = userUploadBucket.bucket_name
               
@@ -212,7 +219,10 @@ class WafrGenaiAcceleratorStack(Stack):
             retention_period=Duration.days(4),
             delivery_delay=Duration.seconds(5),
             dead_letter_queue=sqs.DeadLetterQueue(
-                max_receive_count=5,
+                # Only a backstop: reviews deferred by the admission scheduler are received many times before they
+                # run, 100 receives being about 23 hours of deferrals at ADMISSION_MAX_DEFER_SECONDS. startWafrReview
+                # moves messages that failed ADMISSION_MAX_ATTEMPTS times after admission here itself
+                max_receive_count=100,
                 queue=wafrAcceleratorDeadLetterQueue,
             ),
             encryption=sqs.QueueEncryption.KMS_MANAGED,  # Use the AWS-managed KMS key for SQS
@@ -230,8 +240,93 @@ class WafrGenaiAcceleratorStack(Stack):
             removal_policy=RemovalPolicy.DESTROY
         )
         
+
+        #Create DynamoDB table for the admission slots of in-flight reviews (admission_leases in the wafr_common layer)
+        wafrAdmissionLeasesTable = dynamodb.TableV2(self, "admission-leases",
+            table_name=f"wafr-admission-leases-{entryTimestamp}",
+            partition_key=dynamodb.Attribute(
+                name="lease_id", type=dynamodb.AttributeType.STRING),
+            time_to_live_attribute="expires_at",
+            billing=dynamodb.Billing.on_demand(),
+            removal_policy=RemovalPolicy.DESTROY
+        )
+
+        #Create DynamoDB table for the batch inference pools, which combine the records of the reviews queued in batch
+        #mode within a window into one Bedrock batch job (batch_inference in generate_pillar_question_response)
+        wafrBatchPoolsTable = dynamodb.TableV2(self, "batch-pools",
+            table_name=f"wafr-batch-pools-{entryTimestamp}",
+            partition_key=dynamodb.Attribute(
+                name="pool_id", type=dynamodb.AttributeType.STRING),
+            time_to_live_attribute="expires_at",
+            billing=dynamodb.Billing.on_demand(),
+            removal_policy=RemovalPolicy.DESTROY
+        )
+
+        #Create DynamoDB table for the model responses cached by hash of model id and request body
+        wafrResponseCacheTable = dynamodb.TableV2(self, "response-cache",
+            table_name=f"wafr-response-cache-{entryTimestamp}",
+            partition_key=dynamodb.Attribute(
+                name="cache_key", type=dynamodb.AttributeType.STRING),
+            time_to_live_attribute="expires_at",
+            billing=dynamodb.Billing.on_demand(),
+            removal_policy=RemovalPolicy.DESTROY
+        )
+
+        #Create DynamoDB table for the UI session data, keyed by login, so any UI instance can serve a session
+        wafrUISessionsTable = dynamodb.TableV2(self, "ui-sessions",
+            table_name=f"wafr-ui-sessions-{entryTimestamp}",
+            partition_key=dynamodb.Attribute(
+                name="session_id", type=dynamodb.AttributeType.STRING),
+            time_to_live_attribute="expires_at",
+            billing=dynamodb.Billing.on_demand(),
+            removal_policy=RemovalPolicy.DESTROY
+        )
+
+        #Create DynamoDB table for per question findings of Deep reviews, indexed by risk level within an analysis and
+        #by submitter (sort key risk_analysis, "<risk level>#<analysis id>") for the findings across a submitter's analyses
+        wafrFindingsTable = dynamodb.TableV2(self, "review-findings",
+            table_name=f"wafr-findings-{entryTimestamp}",
+            partition_key=dynamodb.Attribute(
+                name="analysis_id", type=dynamodb.AttributeType.STRING),
+                sort_key=dynamodb.Attribute(
+                    name="question_id", type=dynamodb.AttributeType.STRING),
+            local_secondary_indexes=[
+                dynamodb.LocalSecondaryIndexProps(
+                    index_name="risk_level-index",
+                    sort_key=dynamodb.Attribute(
+                        name="risk_level", type=dynamodb.AttributeType.STRING)
+                )
+            ],
+            global_secondary_indexes=[
+                dynamodb.GlobalSecondaryIndexPropsV2(
+                    index_name="analysis_submitter-index",
+                    partition_key=dynamodb.Attribute(
+                        name="analysis_submitter", type=dynamodb.AttributeType.STRING),
+                    sort_key=dynamodb.Attribute(
+                        name="risk_analysis", type=dynamodb.AttributeType.STRING)
+                )
+            ],
+            billing=dynamodb.Billing.on_demand(),
+            removal_policy=RemovalPolicy.DESTROY
+        )
                                 
         WAFR_RUNS_TABLE = wafrRunsTable.table_name
+        WAFR_FINDINGS_TABLE = wafrFindingsTable.table_name
+        ADMISSION_LEASES_TABLE = wafrAdmissionLeasesTable.table_name
+        BATCH_POOLS_TABLE = wafrBatchPoolsTable.table_name
+        RESPONSE_CACHE_TABLE = wafrResponseCacheTable.table_name
+        UI_SESSIONS_TABLE = wafrUISessionsTable.table_name
+
+        # Model of Deep reviews. Reviews record the model they ran with, and a redrive reuses it; prepare_wafr_redrive
+        # only falls back to this for reviews from before the model was recorded
+        DEEP_REVIEW_LLM_MODEL_ID = "anthropic.claude-3-5-sonnet-20240620-v1:0"
+
+        # Upper bound on reviews admitted at once; the admission scheduler lowers it further based on Bedrock quota
+        MAX_CONCURRENT_REVIEWS = 5
+
+        # Set to "true" to record the external calls of every review function invocation to gzipped cassettes under
+        # cassettes/ in the upload bucket, for offline replay with benchmarks/replay_cassettes.py
+        RECORD_CASSETTES = "false"
 
         #Adds the created S3 bucket [docBucket] as a Data Source for Bedrock KB
         kbDataSource = bedrock.S3DataSource(self, 'DataSource',
@@ -275,6 +370,13 @@ class WafrGenaiAcceleratorStack(Stack):
         
         WAFR_PILLAR_QUESTIONS_PROMPT_TABLE = wafrPillarQuestionPromptsTable.table_name
         
+        # Shared helpers for every Lambda function, e.g. the lazily created boto3 clients (aws_clients)
+        wafrCommonLayer = _lambda.LayerVersion(self, "wafrCommonLayer",
+            code=_lambda.Code.from_asset("lambda_dir/layers/wafr_common"),
+            compatible_runtimes=[_lambda.Runtime.PYTHON_3_12],
+            description="Shared helpers for the WAFR accelerator Lambda functions"
+        )
+        
         # Create an IAM role for the insertWafrPromptsFunctionRole Lambda function
         insertWafrPromptsFunctionRole = iam.Role(
             self, "LambdaRole",
@@ -286,6 +388,7 @@ class WafrGenaiAcceleratorStack(Stack):
         
         insertWafrPromptsFunction = _lambda.Function(self, "insertWAFRPrompts",
             runtime=_lambda.Runtime.PYTHON_3_12,
+            layers=[wafrCommonLayer],
             code = _lambda.Code.from_asset("lambda_dir/insert_wafr_prompts"), 
             handler="insert_wafr_prompts.lambda_handler",
             timeout=cdk.Duration.seconds(30),
@@ -368,6 +471,33 @@ class WafrGenaiAcceleratorStack(Stack):
                             },
                             effect=iam.Effect.ALLOW
                         ),
+                        # Findings tab, by analysis and by submitter
+                        iam.PolicyStatement(
+                            actions=["dynamodb:Query"],
+                            resources=[
+                                wafrFindingsTable.table_arn,
+                                f"{wafrFindingsTable.table_arn}/index/*"
+                            ],
+                            conditions={
+                                "StringEquals": {
+                                    "aws:ResourceAccount": self.account
+                                }
+                            },
+                            effect=iam.Effect.ALLOW
+                        ),
+                        # Session data of the UI pages
+                        iam.PolicyStatement(
+                            actions=["dynamodb:GetItem", "dynamodb:UpdateItem", "dynamodb:DeleteItem"],
+                            resources=[
+                                wafrUISessionsTable.table_arn
+                            ],
+                            conditions={
+                                "StringEquals": {
+                                    "aws:ResourceAccount": self.account
+                                }
+                            },
+                            effect=iam.Effect.ALLOW
+                        ),
                         iam.PolicyStatement(
                             actions=[
                                 "s3:PutObject",
@@ -387,6 +517,22 @@ class WafrGenaiAcceleratorStack(Stack):
                             },
                             effect=iam.Effect.ALLOW
                         ),
+                        # Documents replaced on the New WAFR Review page before the analysis is created
+                        iam.PolicyStatement(
+                            actions=[
+                                "s3:AbortMultipartUpload",
+                                "s3:DeleteObject"
+                            ],
+                            resources=[
+                                f"arn:aws:s3:::wafr-accelerator-upload-{entryTimestamp}/*"
+                            ],
+                            conditions={
+                                "StringEquals": {
+                                    "aws:ResourceAccount": self.account
+                                }
+                            },
+                            effect=iam.Effect.ALLOW
+                        ),
                         iam.PolicyStatement(
                             actions=[
                                 "bedrock:InvokeModel",
@@ -578,6 +724,18 @@ class WafrGenaiAcceleratorStack(Stack):
         )
             
         #Print the Cloudfront Public Domain Name after CDK Deployment for easier access
+        CfnOutput(
+            self, "Review-Findings-Table-Name",
+            value=WAFR_FINDINGS_TABLE,
+            description="Per question findings table; set it as WAFR_FINDINGS_DD_TABLE_NAME in the UI secrets to show the findings tab"
+        )
+
+        CfnOutput(
+            self, "UI-Sessions-Table-Name",
+            value=UI_SESSIONS_TABLE,
+            description="UI session data table; set it as WAFR_UI_SESSIONS_DD_TABLE_NAME in the UI secrets to share sessions between UI instances"
+        )
+        
         CfnOutput(
             self, "FrontEnd-EC2-Instance-Id",
             value=EC2_INSTANCE_ID,
@@ -636,6 +794,16 @@ class WafrGenaiAcceleratorStack(Stack):
         
         cdn.apply_removal_policy(RemovalPolicy.DESTROY)
         
+        # The New WAFR Review page uploads documents from the browser straight to the upload bucket in parts, and
+        # completing the upload needs the ETag of each part
+        userUploadBucket.add_cors_rule(
+            allowed_methods=[s3.HttpMethods.PUT],
+            allowed_origins=[f"https://{cdn.distribution_domain_name}", "http://localhost:8501"],
+            allowed_headers=["*"],
+            exposed_headers=["ETag"],
+            max_age=3000
+        )
+        
         #Print the Cloudfront Public Domain Name after CDK Deployment for easier access
         CfnOutput(
             self, "CloudFront-Distribution-Domain-Name",
@@ -686,6 +854,9 @@ class WafrGenaiAcceleratorStack(Stack):
                 scopes=[cognito.OAuthScope.OPENID, cognito.OAuthScope.EMAIL, cognito.OAuthScope.PROFILE],
                 callback_urls=[f"https://{cdn.distribution_domain_name}", "http://localhost:8501"]
             ),
+            # The ID token is the UI session (ui_code/ui_session.py, SESSION_HOURS)
+            id_token_validity=Duration.hours(8),
+            access_token_validity=Duration.hours(8),
             prevent_user_existence_errors=True
         )
         
@@ -802,6 +973,7 @@ class WafrGenaiAcceleratorStack(Stack):
         
         replaceUITokensFunction = _lambda.Function(self, "replaceUITokensFunction",
             runtime=_lambda.Runtime.PYTHON_3_12,
+            layers=[wafrCommonLayer],
             code = _lambda.Code.from_asset("lambda_dir/replace_ui_tokens"), # Points to the lambda directory
             handler="replace_ui_tokens.lambda_handler",
             timeout=cdk.Duration.seconds(300),
@@ -828,11 +1000,50 @@ class WafrGenaiAcceleratorStack(Stack):
         )
                     
         #Uploading UI code to the corresponding S3 bucket [wafrReferenceDocsBucket]
+        # The pages send metrics with the emf_metrics module of the Lambda layer, deployed next to them
         wafrUIBucketDeploy = s3deploy.BucketDeployment(self, "uploaduicode",
-            sources=[s3deploy.Source.asset('ui_code')],
+            sources=[
+                s3deploy.Source.asset('ui_code'),
+                s3deploy.Source.asset('lambda_dir/layers/wafr_common/python', exclude=['*', '!emf_metrics.py'])
+            ],
             destination_bucket=wafrUIBucket
         )
                
+        # Service role assumed by Amazon Bedrock to read batch inference input and write its output
+        bedrockBatchInferenceRole = iam.Role(
+            self, "bedrockBatchInferenceRole",
+            assumed_by=iam.ServicePrincipal("bedrock.amazonaws.com",
+                conditions={
+                    "StringEquals": {
+                        "aws:SourceAccount": self.account
+                    }
+                }
+            ),
+            inline_policies={
+                "bedrockBatchInferenceRolePolicies": iam.PolicyDocument(
+                    statements=[
+                        iam.PolicyStatement(
+                            actions=[
+                                "s3:GetObject",
+                                "s3:PutObject",
+                                "s3:ListBucket"
+                            ],
+                            resources=[
+                                f"arn:aws:s3:::wafr-accelerator-upload-{entryTimestamp}",
+                                f"arn:aws:s3:::wafr-accelerator-upload-{entryTimestamp}/*"
+                            ],
+                            conditions={
+                                "StringEquals": {
+                                    "aws:ResourceAccount": self.account
+                                }
+                            },
+                            effect=iam.Effect.ALLOW
+                        )
+                    ]
+                )
+            }
+        )
+        
         # Create an IAM role for the startWafrReviewFunctionRole Lambda function
         startWafrReviewFunctionRole = iam.Role(
             self, "startWafrReviewFunctionRoleLambdaRole",
@@ -879,7 +1090,9 @@ class WafrGenaiAcceleratorStack(Stack):
                                 "bedrock:InvokeModelWithResponseStream"
                             ],
                             resources=[
-                                f"arn:aws:bedrock:{self.region}::foundation-model/anthropic.claude-sonnet-4-20250514-v1:0"
+                                f"arn:aws:bedrock:{self.region}::foundation-model/anthropic.claude-sonnet-4-20250514-v1:0",
+                                # Section embeddings of large documents (document_index in the wafr_common layer)
+                                f"arn:aws:bedrock:{self.region}::foundation-model/amazon.titan-embed-text-v2:0"
                             ],
                             effect=iam.Effect.ALLOW
                         ),
@@ -893,6 +1106,27 @@ class WafrGenaiAcceleratorStack(Stack):
                             ],
                             effect=iam.Effect.ALLOW
                         ),
+                        iam.PolicyStatement(
+                            actions=[
+                                "bedrock:CreateModelInvocationJob",
+                                "bedrock:GetModelInvocationJob",
+                                "bedrock:StopModelInvocationJob"
+                            ],
+                            resources=[
+                                f"arn:aws:bedrock:{self.region}::foundation-model/*",
+                                f"arn:aws:bedrock:{self.region}:{self.account}:model-invocation-job/*"
+                            ],
+                            effect=iam.Effect.ALLOW
+                        ),
+                        iam.PolicyStatement(
+                            actions=[
+                                "iam:PassRole"
+                            ],
+                            resources=[
+                                bedrockBatchInferenceRole.role_arn
+                            ],
+                            effect=iam.Effect.ALLOW
+                        ),
                         iam.PolicyStatement(
                             actions=[
                                 "sqs:SendMessage",
@@ -912,7 +1146,28 @@ class WafrGenaiAcceleratorStack(Stack):
                                 "states:DescribeExecution",
                                 "states:GetExecutionHistory"
                             ],
-                            resources=[f"arn:aws:states:{self.region}:{self.account}:stateMachine:WAFRReviewStateMachine-{entryTimestamp}"]
+                            resources=[
+                                f"arn:aws:states:{self.region}:{self.account}:stateMachine:WAFRReviewStateMachine-{entryTimestamp}",
+                                f"arn:aws:states:{self.region}:{self.account}:stateMachine:WAFRRedriveStateMachine-{entryTimestamp}",
+                                # Admission frees the slots of executions that are no longer running
+                                f"arn:aws:states:{self.region}:{self.account}:execution:WAFRReviewStateMachine-{entryTimestamp}:*",
+                                f"arn:aws:states:{self.region}:{self.account}:execution:WAFRRedriveStateMachine-{entryTimestamp}:*"
+                            ]
+                        ),
+                        iam.PolicyStatement(
+                            actions=[
+                                "states:ListExecutions"
+                            ],
+                            resources=[
+                                f"arn:aws:states:{self.region}:{self.account}:stateMachine:WAFRReviewStateMachine-{entryTimestamp}",
+                                f"arn:aws:states:{self.region}:{self.account}:stateMachine:WAFRRedriveStateMachine-{entryTimestamp}"
+                            ]
+                        ),
+                        iam.PolicyStatement(
+                            actions=[
+                                "cloudwatch:GetMetricData"
+                            ],
+                            resources=["*"]
                         ),
                         iam.PolicyStatement(
                             actions=[
@@ -950,79 +1205,192 @@ class WafrGenaiAcceleratorStack(Stack):
         region = Stack.of(self).region or "ap-south-1"
         reference_docs_bucket = WAFR_REFERENCE_DOCS_BUCKET or "undefined-reference-docs-bucket" 
         
-        #Define Lambda functions
+        #Define Lambda functions - each admitted Deep review runs one execution of these at a time
         prepare_wafr_review = _lambda.Function(self, "prepare_wafr_review",
             runtime=_lambda.Runtime.PYTHON_3_12,
+            layers=[wafrCommonLayer],
+            tracing=_lambda.Tracing.ACTIVE,
             handler="prepare_wafr_review.lambda_handler",
             code=_lambda.Code.from_asset("lambda_dir/prepare_wafr_review"),
             timeout=cdk.Duration.minutes(5),
             memory_size=512,
             environment={
                 "KNOWLEDGE_BASE_ID": KB_ID,
-                "LLM_MODEL_ID": "anthropic.claude-3-5-sonnet-20240620-v1:0",
+                "LLM_MODEL_ID": DEEP_REVIEW_LLM_MODEL_ID,
                 "REGION": Stack.of(self).region, 
                 "UPLOAD_BUCKET_NAME": userUploadBucket.bucket_name,
                 "WAFR_ACCELERATOR_RUNS_DD_TABLE_NAME": WAFR_RUNS_TABLE,
                 "WAFR_PROMPT_DD_TABLE_NAME": WAFR_PILLAR_QUESTIONS_PROMPT_TABLE,
+                "WAFR_FINDINGS_DD_TABLE_NAME": WAFR_FINDINGS_TABLE,
                 "BEDROCK_SLEEP_DURATION" : "60",
-                "BEDROCK_MAX_TRIES" : "5"
+                "BEDROCK_MAX_TRIES" : "5",
+                "DOCUMENT_SLICING" : "true",
+                "DOCUMENT_SLICE_TOKENS" : "8000"
             },
             role = startWafrReviewFunctionRole,
-            reserved_concurrent_executions=1
+            reserved_concurrent_executions=MAX_CONCURRENT_REVIEWS
         )
         extract_document_text = _lambda.Function(self, "extract_document_text",
             runtime=_lambda.Runtime.PYTHON_3_12,
+            layers=[wafrCommonLayer],
+            tracing=_lambda.Tracing.ACTIVE,
             handler="extract_document_text.lambda_handler",
             code=_lambda.Code.from_asset("lambda_dir/extract_document_text"),
             timeout=cdk.Duration.minutes(15),
             memory_size=256,
             role = startWafrReviewFunctionRole,
-            reserved_concurrent_executions=1
+            reserved_concurrent_executions=MAX_CONCURRENT_REVIEWS
         )
         generate_solution_summary = _lambda.Function(self, "generate_solution_summary",
             runtime=_lambda.Runtime.PYTHON_3_12,
+            layers=[wafrCommonLayer],
+            tracing=_lambda.Tracing.ACTIVE,
             handler="generate_solution_summary.lambda_handler",
             code=_lambda.Code.from_asset("lambda_dir/generate_solution_summary"),
             timeout=cdk.Duration.minutes(15),
             memory_size=256,
             role = startWafrReviewFunctionRole,
-            reserved_concurrent_executions=1
+            reserved_concurrent_executions=MAX_CONCURRENT_REVIEWS
         )
         generate_prompts = _lambda.Function(self, "generate_prompts_for_all_the_selected_pillars",
             runtime=_lambda.Runtime.PYTHON_3_12,
+            layers=[wafrCommonLayer],
+            tracing=_lambda.Tracing.ACTIVE,
             handler="generate_prompts_for_all_the_selected_pillars.lambda_handler",
             code=_lambda.Code.from_asset("lambda_dir/generate_prompts_for_six_pillars"),
             timeout=cdk.Duration.minutes(15),
             memory_size=256,
             role = startWafrReviewFunctionRole,
-            reserved_concurrent_executions=1,
+            reserved_concurrent_executions=MAX_CONCURRENT_REVIEWS,
             environment={
-                "WAFR_REFERENCE_DOCS_BUCKET" : WAFR_REFERENCE_DOCS_BUCKET
+                "WAFR_REFERENCE_DOCS_BUCKET" : WAFR_REFERENCE_DOCS_BUCKET,
+                "DOCUMENT_SLICING" : "true",
+                "DOCUMENT_SLICE_TOKENS" : "8000"
             }
         )
         generate_pillar_question_response = _lambda.Function(self, "generate_pillar_question_response",
             runtime=_lambda.Runtime.PYTHON_3_12,
+            layers=[wafrCommonLayer],
+            tracing=_lambda.Tracing.ACTIVE,
             handler="generate_pillar_question_response.lambda_handler",
             code=_lambda.Code.from_asset("lambda_dir/generate_pillar_question_response"),
             timeout=cdk.Duration.minutes(15),
             memory_size=256,
             role = startWafrReviewFunctionRole,
-            reserved_concurrent_executions=1,
+            reserved_concurrent_executions=MAX_CONCURRENT_REVIEWS,
+            environment={
+                "BEDROCK_SLEEP_DURATION" : "60",
+                "BEDROCK_MAX_TRIES" : "5"
+            }
+        )
+        # Optional Bedrock batch inference path for non-urgent Deep reviews (inference_mode = "batch")
+        submit_batch_inference_job = _lambda.Function(self, "submit_batch_inference_job",
+            runtime=_lambda.Runtime.PYTHON_3_12,
+            layers=[wafrCommonLayer],
+            tracing=_lambda.Tracing.ACTIVE,
+            handler="batch_inference.submit_handler",
+            code=_lambda.Code.from_asset("lambda_dir/generate_pillar_question_response"),
+            timeout=cdk.Duration.minutes(15),
+            memory_size=512,
+            role = startWafrReviewFunctionRole,
+            environment={
+                "BEDROCK_SLEEP_DURATION" : "60",
+                "BEDROCK_MAX_TRIES" : "5",
+                # Reviews queued in batch mode within the same window share one batch job
+                "BEDROCK_BATCH_POOL_MINUTES" : "60",
+                "BEDROCK_BATCH_TIMEOUT_HOURS" : "24",
+                "BATCH_POOLS_DD_TABLE_NAME": BATCH_POOLS_TABLE,
+                "ADMISSION_LEASES_DD_TABLE_NAME": ADMISSION_LEASES_TABLE,
+                "MAX_CONCURRENT_REVIEWS": str(MAX_CONCURRENT_REVIEWS)
+            }
+        )
+        check_batch_inference_job = _lambda.Function(self, "check_batch_inference_job",
+            runtime=_lambda.Runtime.PYTHON_3_12,
+            layers=[wafrCommonLayer],
+            tracing=_lambda.Tracing.ACTIVE,
+            handler="batch_inference.status_handler",
+            code=_lambda.Code.from_asset("lambda_dir/generate_pillar_question_response"),
+            # The first member to poll after the pool's window submits the job of the whole pool
+            timeout=cdk.Duration.minutes(5),
+            memory_size=256,
+            role = startWafrReviewFunctionRole,
+            environment={
+                "BEDROCK_SLEEP_DURATION" : "60",
+                "BEDROCK_MAX_TRIES" : "5",
+                "BEDROCK_BATCH_ROLE_ARN" : bedrockBatchInferenceRole.role_arn,
+                "BEDROCK_BATCH_MIN_RECORDS" : "100",
+                "BEDROCK_BATCH_TIMEOUT_HOURS" : "24",
+                "BATCH_POOLS_DD_TABLE_NAME": BATCH_POOLS_TABLE,
+                "ADMISSION_LEASES_DD_TABLE_NAME": ADMISSION_LEASES_TABLE,
+                "MAX_CONCURRENT_REVIEWS": str(MAX_CONCURRENT_REVIEWS)
+            }
+        )
+        collect_batch_inference_results = _lambda.Function(self, "collect_batch_inference_results",
+            runtime=_lambda.Runtime.PYTHON_3_12,
+            layers=[wafrCommonLayer],
+            tracing=_lambda.Tracing.ACTIVE,
+            handler="batch_inference.collect_handler",
+            code=_lambda.Code.from_asset("lambda_dir/generate_pillar_question_response"),
+            timeout=cdk.Duration.minutes(15),
+            memory_size=512,
+            role = startWafrReviewFunctionRole,
+            reserved_concurrent_executions=MAX_CONCURRENT_REVIEWS,
             environment={
                 "BEDROCK_SLEEP_DURATION" : "60",
                 "BEDROCK_MAX_TRIES" : "5"
             }
         )
+        prepare_wafr_redrive = _lambda.Function(self, "prepare_wafr_redrive",
+            runtime=_lambda.Runtime.PYTHON_3_12,
+            layers=[wafrCommonLayer],
+            tracing=_lambda.Tracing.ACTIVE,
+            handler="prepare_wafr_redrive.lambda_handler",
+            code=_lambda.Code.from_asset("lambda_dir/prepare_wafr_redrive"),
+            timeout=cdk.Duration.minutes(5),
+            memory_size=256,
+            environment={
+                "KNOWLEDGE_BASE_ID": KB_ID,
+                "LLM_MODEL_ID": DEEP_REVIEW_LLM_MODEL_ID,
+                "REGION": Stack.of(self).region, 
+                "UPLOAD_BUCKET_NAME": userUploadBucket.bucket_name,
+                "WAFR_ACCELERATOR_RUNS_DD_TABLE_NAME": WAFR_RUNS_TABLE,
+                "WAFR_PROMPT_DD_TABLE_NAME": WAFR_PILLAR_QUESTIONS_PROMPT_TABLE,
+                "WAFR_FINDINGS_DD_TABLE_NAME": WAFR_FINDINGS_TABLE
+            },
+            role = startWafrReviewFunctionRole,
+            reserved_concurrent_executions=MAX_CONCURRENT_REVIEWS
+        )
         update_review_status = _lambda.Function(self, "update_review_status",
             runtime=_lambda.Runtime.PYTHON_3_12,
+            layers=[wafrCommonLayer],
+            tracing=_lambda.Tracing.ACTIVE,
             handler="update_review_status.lambda_handler",
             code=_lambda.Code.from_asset("lambda_dir/update_review_status"),
             timeout=cdk.Duration.minutes(15),
             memory_size=256,
             role = startWafrReviewFunctionRole,
-            reserved_concurrent_executions=1
+            reserved_concurrent_executions=MAX_CONCURRENT_REVIEWS
+        )
+        # Renders the Markdown, HTML and PDF report of a completed review into the upload bucket
+        generate_review_report = _lambda.Function(self, "generate_review_report",
+            runtime=_lambda.Runtime.PYTHON_3_12,
+            layers=[wafrCommonLayer],
+            tracing=_lambda.Tracing.ACTIVE,
+            handler="generate_review_report.lambda_handler",
+            code=_lambda.Code.from_asset("lambda_dir/generate_review_report"),
+            timeout=cdk.Duration.minutes(5),
+            memory_size=512,
+            environment={
+                "UPLOAD_BUCKET_NAME": userUploadBucket.bucket_name,
+                "WAFR_FINDINGS_DD_TABLE_NAME": WAFR_FINDINGS_TABLE
+            },
+            role = startWafrReviewFunctionRole
         )
 
+        wafrFindingsTable.grant_read_write_data(startWafrReviewFunctionRole)
+        wafrResponseCacheTable.grant_read_write_data(startWafrReviewFunctionRole)
+        wafrBatchPoolsTable.grant_read_write_data(startWafrReviewFunctionRole)
+
         # Create an IAM role for the Step Function
         step_function_role = iam.Role(
             self, "WAFRStepFunctionRole",
@@ -1051,6 +1419,11 @@ class WafrGenaiAcceleratorStack(Stack):
         generate_prompts.grant_invoke(step_function_role)
         generate_pillar_question_response.grant_invoke(step_function_role)
         update_review_status.grant_invoke(step_function_role)
+        generate_review_report.grant_invoke(step_function_role)
+        submit_batch_inference_job.grant_invoke(step_function_role)
+        check_batch_inference_job.grant_invoke(step_function_role)
+        collect_batch_inference_results.grant_invoke(step_function_role)
+        prepare_wafr_redrive.grant_invoke(step_function_role)
         
         # Define Step Function tasks
         pass_state = sfn.Pass(
@@ -1089,6 +1462,32 @@ class WafrGenaiAcceleratorStack(Stack):
             lambda_function=update_review_status,
             output_path="$.Payload"
         )
+        generate_review_report_task = tasks.LambdaInvoke(
+            self, "Generate review report",
+            lambda_function=generate_review_report,
+            output_path="$.Payload"
+        )
+
+        submit_batch_inference_job_task = tasks.LambdaInvoke(
+            self, "Submit batch inference job",
+            lambda_function=submit_batch_inference_job,
+            output_path="$.Payload.body"
+        )
+        check_batch_inference_job_task = tasks.LambdaInvoke(
+            self, "Check batch inference job",
+            lambda_function=check_batch_inference_job,
+            output_path="$.Payload.body"
+        )
+        collect_batch_inference_results_task = tasks.LambdaInvoke(
+            self, "Collect batch inference results",
+            lambda_function=collect_batch_inference_results,
+            output_path="$.Payload.body"
+        )
+        
+        batch_wait_state = sfn.Wait(
+            self, "Wait for batch inference job",
+            time=sfn.WaitTime.duration(cdk.Duration.minutes(5))
+        )
 
         wait_state = sfn.Wait(
             self, "Wait", 
@@ -1102,6 +1501,45 @@ class WafrGenaiAcceleratorStack(Stack):
             items_path="$.all_pillar_prompts"
         )
         
+        # A pillar with failed questions is written and then raises QuestionsFailed; the retries only run the failed
+        # questions again. If they still fail, the pillar is passed on with the error and the review is left for a redrive
+        generate_pillar_question_response_task.add_retry(
+            errors=["QuestionsFailed"],
+            interval=cdk.Duration.minutes(1),
+            max_attempts=2,
+            backoff_rate=2
+        )
+        generate_pillar_question_response_task.add_catch(
+            sfn.Pass(self, "Leave failed questions for a redrive"),
+            errors=["QuestionsFailed"],
+            result_path="$.question_failure"
+        )
+        # Same for the pillars answered from the batch output
+        collect_batch_inference_results_task.add_retry(
+            errors=["QuestionsFailed"],
+            interval=cdk.Duration.minutes(1),
+            max_attempts=2,
+            backoff_rate=2
+        )
+        collect_batch_inference_results_task.add_catch(
+            sfn.Pass(self, "Leave failed batch questions for a redrive"),
+            errors=["QuestionsFailed"],
+            result_path="$.question_failure"
+        )
+
+        # The review functions are limited to MAX_CONCURRENT_REVIEWS reserved concurrent executions, so concurrent
+        # reviews can have their invocations throttled; those are retried instead of failing the review
+        for lambda_task in [prepare_wafr_review_task, extract_document_text_task, generate_solution_summary_task, generate_prompts_task,
+                            generate_pillar_question_response_task, update_review_status_task, generate_review_report_task,
+                            submit_batch_inference_job_task, check_batch_inference_job_task, collect_batch_inference_results_task]:
+            lambda_task.add_retry(
+                errors=["Lambda.TooManyRequestsException"],
+                interval=cdk.Duration.seconds(30),
+                max_attempts=6,
+                backoff_rate=2,
+                jitter_strategy=sfn.JitterType.FULL
+            )
+
         # Define the iterator chain
         iterator_chain = sfn.Chain \
             .start(wait_state) \
@@ -1117,6 +1555,48 @@ class WafrGenaiAcceleratorStack(Stack):
             removal_policy=RemovalPolicy.DESTROY 
         )
 
+        map_state.next(update_review_status_task)
+        update_review_status_task.next(generate_review_report_task)
+
+        # The batch output is written one pillar per invocation like the on-demand path, so no invocation has to fit
+        # the whole review in the Lambda timeout and a retry only redoes its own pillar
+        collect_map_state = sfn.Map(
+            self, "Collect batch inference results per pillar",
+            max_concurrency=1,
+            items_path="$.all_pillar_prompts"
+        )
+        collect_map_state.iterator(collect_batch_inference_results_task)
+        collect_map_state.next(update_review_status_task)
+        
+        # Batch inference loop - poll the pool until its job is submitted and the job until it finishes. Failed jobs,
+        # and pools with too few records for a job, fall back to the on-demand Map once the review holds an admission
+        # slot again (WaitingForSlot until then)
+        batch_job_status_choice = sfn.Choice(self, "Batch inference job finished?") \
+            .when(sfn.Condition.or_(
+                    sfn.Condition.string_equals("$.batch_job.status", "Completed"),
+                    sfn.Condition.string_equals("$.batch_job.status", "PartiallyCompleted")),
+                collect_map_state) \
+            .when(sfn.Condition.or_(
+                    sfn.Condition.string_equals("$.batch_job.status", "Failed"),
+                    sfn.Condition.string_equals("$.batch_job.status", "Stopped"),
+                    sfn.Condition.string_equals("$.batch_job.status", "Expired"),
+                    sfn.Condition.string_equals("$.batch_job.status", "Skipped")),
+                map_state) \
+            .otherwise(batch_wait_state)
+        
+        batch_wait_state.next(check_batch_inference_job_task).next(batch_job_status_choice)
+        
+        batch_job_submitted_choice = sfn.Choice(self, "Batch inference job submitted?") \
+            .when(sfn.Condition.string_equals("$.batch_job.status", "Skipped"), map_state) \
+            .otherwise(batch_wait_state)
+        
+        inference_mode_choice = sfn.Choice(self, "Use batch inference?") \
+            .when(sfn.Condition.and_(
+                    sfn.Condition.is_present("$.wafr_accelerator_run_items.inference_mode"),
+                    sfn.Condition.string_equals("$.wafr_accelerator_run_items.inference_mode", "batch")),
+                submit_batch_inference_job_task.next(batch_job_submitted_choice)) \
+            .otherwise(map_state)
+
         # Define the chain of states
         chain = sfn.Chain \
             .start(pass_state) \
@@ -1124,8 +1604,7 @@ class WafrGenaiAcceleratorStack(Stack):
             .next(extract_document_text_task) \
             .next(generate_solution_summary_task) \
             .next(generate_prompts_task) \
-            .next(map_state) \
-            .next(update_review_status_task)
+            .next(inference_mode_choice)
 
         # Create the state machine using definitionBody instead of definition
         state_machine = sfn.StateMachine(
@@ -1133,7 +1612,8 @@ class WafrGenaiAcceleratorStack(Stack):
             state_machine_name=f"WAFRReviewStateMachine-{entryTimestamp}",
             removal_policy=RemovalPolicy.DESTROY,
             definition_body=sfn.DefinitionBody.from_chainable(chain),
-            timeout=cdk.Duration.seconds(6000),
+            # Long enough for a batch inference job (BEDROCK_BATCH_TIMEOUT_HOURS) plus the rest of the review
+            timeout=cdk.Duration.hours(26),
             role=step_function_role,
             tracing_enabled=True,
             logs=sfn.LogOptions(
@@ -1143,8 +1623,123 @@ class WafrGenaiAcceleratorStack(Stack):
             )
         )        
         
+        # Redrive state machine - reruns a failed Deep review from its first incomplete stage, reusing completed answers
+        redrive_prepare_task = tasks.LambdaInvoke(
+            self, "Prepare WAFR review redrive",
+            lambda_function=prepare_wafr_redrive,
+            output_path="$.Payload.body"
+        )
+        redrive_prepare_wafr_review_task = tasks.LambdaInvoke(
+            self, "Redrive - Prepare WAFR review",
+            lambda_function=prepare_wafr_review,
+            input_path="$.records",
+            output_path="$.Payload.body"
+        )
+        redrive_extract_document_text_task = tasks.LambdaInvoke(
+            self, "Redrive - Extract document text",
+            lambda_function=extract_document_text,
+            output_path="$.Payload.body"
+        )
+        redrive_generate_solution_summary_task = tasks.LambdaInvoke(
+            self, "Redrive - Generate solution summary",
+            lambda_function=generate_solution_summary,
+            output_path="$.Payload.body"
+        )
+        redrive_generate_prompts_task = tasks.LambdaInvoke(
+            self, "Redrive - Generate prompts for selected pillars",
+            lambda_function=generate_prompts,
+            output_path="$.Payload.body"
+        )
+        redrive_generate_pillar_question_response_task = tasks.LambdaInvoke(
+            self, "Redrive - Generate pillar question response",
+            lambda_function=generate_pillar_question_response,
+            output_path="$.Payload.body"
+        )
+        redrive_update_review_status_task = tasks.LambdaInvoke(
+            self, "Redrive - Mark review as complete",
+            lambda_function=update_review_status,
+            output_path="$.Payload"
+        )
+        redrive_generate_review_report_task = tasks.LambdaInvoke(
+            self, "Redrive - Generate review report",
+            lambda_function=generate_review_report,
+            output_path="$.Payload"
+        )
+        
+        redrive_wait_state = sfn.Wait(
+            self, "Redrive - Wait", 
+            time=sfn.WaitTime.duration(cdk.Duration.seconds(40))
+        )
+        
+        redrive_map_state = sfn.Map(
+            self, "Redrive - Loop through pillars with pending questions",
+            max_concurrency=1,
+            items_path="$.all_pillar_prompts"
+        )
+        
+        redrive_generate_pillar_question_response_task.add_retry(
+            errors=["QuestionsFailed"],
+            interval=cdk.Duration.minutes(1),
+            max_attempts=2,
+            backoff_rate=2
+        )
+        redrive_generate_pillar_question_response_task.add_catch(
+            sfn.Pass(self, "Redrive - Leave failed questions for a redrive"),
+            errors=["QuestionsFailed"],
+            result_path="$.question_failure"
+        )
+        
+        for lambda_task in [redrive_prepare_task, redrive_prepare_wafr_review_task, redrive_extract_document_text_task,
+                            redrive_generate_solution_summary_task, redrive_generate_prompts_task, redrive_generate_pillar_question_response_task,
+                            redrive_update_review_status_task, redrive_generate_review_report_task]:
+            lambda_task.add_retry(
+                errors=["Lambda.TooManyRequestsException"],
+                interval=cdk.Duration.seconds(30),
+                max_attempts=6,
+                backoff_rate=2,
+                jitter_strategy=sfn.JitterType.FULL
+            )
+        
+        redrive_map_state.iterator(sfn.Chain \
+            .start(redrive_wait_state) \
+            .next(redrive_generate_pillar_question_response_task))
+        
+        redrive_map_state.next(redrive_update_review_status_task)
+        redrive_update_review_status_task.next(redrive_generate_review_report_task)
+        
+        redrive_prepare_wafr_review_task \
+            .next(redrive_extract_document_text_task) \
+            .next(redrive_generate_solution_summary_task) \
+            .next(redrive_generate_prompts_task) \
+            .next(redrive_map_state)
+        
+        redrive_stage_choice = sfn.Choice(self, "Redrive from which stage?") \
+            .when(sfn.Condition.string_equals("$.redrive_stage", "prepare"), redrive_prepare_wafr_review_task) \
+            .when(sfn.Condition.string_equals("$.redrive_stage", "extract"), redrive_extract_document_text_task) \
+            .when(sfn.Condition.string_equals("$.redrive_stage", "summary"), redrive_generate_solution_summary_task) \
+            .when(sfn.Condition.string_equals("$.redrive_stage", "prompts"), redrive_generate_prompts_task) \
+            .when(sfn.Condition.is_present("$.all_pillar_prompts[0]"), redrive_map_state) \
+            .otherwise(redrive_update_review_status_task)
+        
+        redrive_state_machine = sfn.StateMachine(
+            self, "WAFRRedriveStateMachine",
+            state_machine_name=f"WAFRRedriveStateMachine-{entryTimestamp}",
+            removal_policy=RemovalPolicy.DESTROY,
+            definition_body=sfn.DefinitionBody.from_chainable(sfn.Chain.start(redrive_prepare_task).next(redrive_stage_choice)),
+            timeout=cdk.Duration.hours(26),
+            role=step_function_role,
+            tracing_enabled=True,
+            logs=sfn.LogOptions(
+                destination=wafr_stepmachine_log_group,
+                level=sfn.LogLevel.ALL,
+                include_execution_data=False
+            )
+        )
+        
         startWafrReviewFunction = _lambda.Function(self, "startWafrReview",
             runtime=_lambda.Runtime.PYTHON_3_12,
+            layers=[wafrCommonLayer],
+            tracing=_lambda.Tracing.ACTIVE,
             code = _lambda.Code.from_asset("lambda_dir/start_wafr_review"), # Points to the lambda directory
             handler="start_wafr_review.lambda_handler",
             timeout=cdk.Duration.minutes(15),
@@ -1157,23 +1752,52 @@ class WafrGenaiAcceleratorStack(Stack):
                 "WAFR_ACCELERATOR_RUNS_DD_TABLE_NAME": WAFR_RUNS_TABLE,
                 "WAFR_PROMPT_DD_TABLE_NAME": WAFR_PILLAR_QUESTIONS_PROMPT_TABLE,
                 "START_WAFR_REVIEW_STATEMACHINE_ARN": state_machine.state_machine_arn,
+                "START_WAFR_REDRIVE_STATEMACHINE_ARN": redrive_state_machine.state_machine_arn,
                 "BEDROCK_SLEEP_DURATION" : "60",
                 "BEDROCK_MAX_TRIES" : "5",
-                "WAFR_REFERENCE_DOCS_BUCKET" : WAFR_REFERENCE_DOCS_BUCKET
+                "WAFR_REFERENCE_DOCS_BUCKET" : WAFR_REFERENCE_DOCS_BUCKET,
+                "ADMISSION_LEASES_DD_TABLE_NAME": ADMISSION_LEASES_TABLE,
+                "MAX_CONCURRENT_REVIEWS": str(MAX_CONCURRENT_REVIEWS),
+                "ADMISSION_MAX_ATTEMPTS": "5",
+                "DEAD_LETTER_QUEUE_URL": wafrAcceleratorDeadLetterQueue.queue_url,
+                # Quotas of the Quick review model (LLM_MODEL_ID) and of the Deep review model, which are separate
+                "BEDROCK_TPM_LIMIT": "200000",
+                "BEDROCK_RPM_LIMIT": "200",
+                "DEEP_REVIEW_LLM_MODEL_ID": DEEP_REVIEW_LLM_MODEL_ID,
+                "DEEP_REVIEW_BEDROCK_TPM_LIMIT": "200000",
+                "DEEP_REVIEW_BEDROCK_RPM_LIMIT": "200",
+                "INTERACTIVE_RESERVE_FRACTION": "0.2"
             },
             role = startWafrReviewFunctionRole,
-            reserved_concurrent_executions=1
+            reserved_concurrent_executions=MAX_CONCURRENT_REVIEWS
         )
 
         wafrPillarQuestionPromptsTable.grant_write_data(startWafrReviewFunction)
         wafrRunsTable.grant_write_data(startWafrReviewFunction)
+        wafrAdmissionLeasesTable.grant_read_write_data(startWafrReviewFunction)
+
+        # The review functions all run as startWafrReviewFunctionRole, which can already write to the upload bucket
+        for review_function in [startWafrReviewFunction, prepare_wafr_review, extract_document_text, generate_solution_summary,
+                                generate_prompts, generate_pillar_question_response, submit_batch_inference_job,
+                                check_batch_inference_job, collect_batch_inference_results, prepare_wafr_redrive, update_review_status,
+                                generate_review_report]:
+            review_function.add_environment("RECORD_CASSETTES", RECORD_CASSETTES)
+            review_function.add_environment("CASSETTE_BUCKET", userUploadBucket.bucket_name)
+            review_function.add_environment("RESPONSE_CACHE_TABLE", RESPONSE_CACHE_TABLE)
+            review_function.add_environment("RESPONSE_CACHE_BUCKET", userUploadBucket.bucket_name)
+            review_function.add_environment("RESPONSE_CACHE_TTL_DAYS", str(RESPONSE_CACHE_TTL_DAYS))
         
         # Grant the Lambda function permission to access the SQS queue
         wafrAcceleratorQueue.grant_consume_messages(startWafrReviewFunction)
         
-        sqs_event_source = lambda_event_source.SqsEventSource(wafrAcceleratorQueue, batch_size=1 )#, maximum_concurrency = 2 )
+        # Each invocation admits as many reviews from the batch as the Bedrock quota allows and reports the rest as partial batch failures
+        sqs_event_source = lambda_event_source.SqsEventSource(wafrAcceleratorQueue,
+            batch_size=10,
+            max_batching_window=Duration.seconds(5),
+            report_batch_item_failures=True,
+            max_concurrency=MAX_CONCURRENT_REVIEWS
+        )
         
-        # Create the SQS event source with maximum concurrency set to 2
         startWafrReviewFunction.add_event_source(sqs_event_source)
         
         # # ------------ Node dependencies ---------------------
@@ -1197,5 +1821,6 @@ class WafrGenaiAcceleratorStack(Stack):
         wafrUIBucketDeploy.node.add_dependency(ec2_create)
         
         startWafrReviewFunction.node.add_dependency(state_machine)
+        startWafrReviewFunction.node.add_dependency(redrive_state_machine)
         startWafrReviewFunction.node.add_dependency(ec2_create)
         